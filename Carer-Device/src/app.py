@@ -1,42 +1,176 @@
 from flask import Flask, jsonify, request
-from phe import paillier
+import numpy as np
 import math
 import time
+import os
+import threading
+import collections
+import hmac
+import json
+import re
+import paillier_engine
+import decryption_engine
+import key_store
 
 app = Flask(__name__)
 
-# Generate Paillier public and private keys
-public_key, private_key = paillier.generate_paillier_keypair()
+# Paillier keys, loaded from the encrypted key file (created on the first start) or generated when there is no
+# CARER_KEY_PASSPHRASE, see key_store.py. Requests are decrypted with the key they name, which may also be the key the
+# last rotation replaced, within its grace period
+private_key = key_store.load_carer_keys()
+public_key = private_key.public_key
+public_key_fingerprint = paillier_engine.key_fingerprint(public_key.n)
+
+# Token required by the key rotation endpoint (empty allows every request)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 radius = 100            # Geofence radius in meters
 earth_radius = 6371000  # Approximate Earth radius in meters
 
+# Results are compared against the radius in haversine space: a reference result is the haversine a = sin²(d / 2R) of
+# the distance d from the geofence centre and a proposed result is 2a, both increasing with d, so d <= radius exactly
+# when the result is at most the same expression of the radius. Thresholds are computed once per radius, instead of a
+# square root and an arcsine (or arctangent) of every result
+HAVERSINE_SCALE = {"ref": 1, "prop": 2}
+# Decrypted results are fixed-point, so the result for a location at a geofence's centre may be slightly below 0
+HAVERSINE_TOLERANCE = 1e-9
+
+# Result positions of the geofences users were last found inside, most recent last. In short-circuit 'any inside'
+# evaluation they are decrypted first, as users tend to stay in or return to the same places. Positions are only
+# meaningful within one generation of the geofencing service's geofences, so the history starts again when it changes
+RECENT_HITS_SIZE = int(os.environ.get("RECENT_HITS_SIZE", "16"))
+recent_hits = {'generation': None, 'positions': collections.OrderedDict()}
+recent_hits_lock = threading.Lock()
+
+# Outcomes of the jobs delivered in batches, one JSON file per job id (next to the lock a job is claimed with), so a
+# redelivered job is answered without decrypting it again whichever gunicorn worker it reaches. Files older than
+# PROCESSED_JOBS_TTL seconds are removed
+PROCESSED_JOBS_DIR = os.environ.get("PROCESSED_JOBS_DIR", "/tmp/carer-processed-jobs")
+PROCESSED_JOBS_TTL = float(os.environ.get("PROCESSED_JOBS_TTL", "3600"))
+processed_jobs_cleaned_at = 0.0
+
+def set_current_key():
+    global private_key, public_key, public_key_fingerprint
+    private_key = key_store.carer_keys['current']
+    public_key = private_key.public_key
+    public_key_fingerprint = paillier_engine.key_fingerprint(public_key.n)
+
+
+@app.before_request
+def check_carer_keys():
+    # A stat per request, so every worker serves a key another worker has rotated, and the worker's thread keeping
+    # the key pool full is started
+    key_store.sync_carer_keys()
+    key_store.start_key_pool_filler()
+    if key_store.carer_keys['current'] is not private_key:
+        set_current_key()
+
+
 @app.route("/get-public-key", methods=['GET'])
 def get_public_key():
     public_key_data = {
-        "public_key_n": public_key.n  # 'n' is the serialized representation of the Paillier public key
+        "public_key_n": public_key.n,  # 'n' is the serialized representation of the Paillier public key
+        "fingerprint": public_key_fingerprint,  # Short identifier clients send instead of 'n'
+        "key_size": public_key.n.bit_length(),
+        # Every key results are accepted for: the current key, and the key it replaced during its grace period
+        "accepted_public_keys": [accepted_key.public_key.n for accepted_key in key_store.accepted_private_keys()]
     }
     return jsonify(public_key_data)
 
+
+@app.route("/rotate-key", methods=['POST'])
+def rotate_key():
+    # Replace the carer's key with the next pre-generated key of the pool, or with a key of another 'key_size' (bits).
+    # The replaced key is still accepted for KEY_GRACE_PERIOD seconds, so locations encrypted before the rotation are
+    # still evaluated
+    if ADMIN_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {ADMIN_TOKEN}"):
+        return jsonify({
+            "status": "error",
+            "message": "Admin token missing or invalid"
+        }), 401
+
+    # Gunicorn workers only share keys through the key file: without one, a rotation would only change the key of the
+    # worker that handled it, and the others would keep serving and decrypting with the old key
+    if key_store.carer_keys['path'] is None:
+        return jsonify({
+            "status": "error",
+            "message": "Key rotation needs a key file shared by the carer's workers, set CARER_KEY_PASSPHRASE"
+        }), 409
+
+    data = request.get_json(silent=True) or {}
+    key_size = data.get('key_size') if isinstance(data, dict) else None
+    if key_size is not None and (type(key_size) is not int or key_size < paillier_engine.MIN_KEY_SIZE or key_size % 8 != 0):
+        return jsonify({
+            "status": "error",
+            "message": f"'key_size' must be a multiple of 8 bits of at least {paillier_engine.MIN_KEY_SIZE}"
+        }), 400
+
+    start = time.time()
+    try:
+        rotated_key, pooled = key_store.rotate_carer_key(key_size)
+    except (OSError, ValueError) as e:
+        print(f"Failed to rotate the carer key: {e}")
+        return jsonify({
+            "status": "error",
+            "message": f"Couldn't rotate the key: {e}"
+        }), 500
+    set_current_key()
+
+    print(f"Carer key rotated to {public_key_fingerprint} ({'pooled' if pooled else 'generated'}) in {round((time.time() - start) * 1000, 3)} ms")
+
+    return jsonify({
+        "status": "success",
+        "message": "Key rotated",
+        "public_key_n": public_key.n,
+        "fingerprint": public_key_fingerprint,
+        "key_size": public_key.n.bit_length(),
+        "pooled": pooled,
+        "grace_period": key_store.KEY_GRACE_PERIOD,
+        "seconds": time.time() - start
+    }), 200
+
 @app.route("/submit-geofence-result-ref", methods=['POST'])
 def submit_geofence_result():
-    # Retrieve JSON payload
-    data = request.get_json()
+    # Retrieve JSON or binary payload
+    data, parse_time = read_request_payload()
 
-    # Check if the encrypted data and public key are provided in the payload
-    if not data or 'encrypted_results' not in data or 'public_key_n' not in data:
+    # Check if the encrypted data and public key (or its fingerprint) are provided in the payload
+    if not data or 'encrypted_results' not in data or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
         return jsonify({
             "status": "error",
             "message": "Missing 'encrypted_results' or 'public_key_n' in request data"
         }), 400
 
-    # Verify the provided public key matches the carer's public key
-    if data['public_key_n'] != public_key.n:
+    # Verify the provided public key matches the carer's public key (or the key it replaced, within its grace period)
+    request_private_key = key_store.private_key_for_payload(data)
+    if request_private_key is None:
         return jsonify({
             "status": "error",
             "message": "Public key mismatch. Encryption was not done with the correct public key."
         }), 400
     
-    encrypted_result_list = parse_encrypted_results(data['encrypted_results'], public_key)
+    # Several results may be packed into each ciphertext
+    packed = data.get('packed', False) is True
+
+    # Optional radii of the geofences, and whether to report each result's distance
+    try:
+        radii = parse_radii(data.get('radii'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    distances = data.get('distances', False) is True
+
+    # Optionally stop decrypting at the first geofence the user is inside
+    try:
+        short_circuit = parse_short_circuit(data, distances)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    encrypted_result_list = parse_encrypted_results(data['encrypted_results'], request_private_key.public_key, packed)
 
     if encrypted_result_list is None:
         return jsonify({
@@ -49,18 +183,27 @@ def submit_geofence_result():
     with open("commCarerOutRef.txt", "a") as f:
         f.write(f"{request_size/1024}\n")
 
+    # Write Parse Time (ms) Reference to file
+    with open("parseCarerOutRef.txt", "a") as f:
+        f.write(f"{parse_time*1000}\n")
+
     start = time.time()
 
-    haversine_intermediate_values = decrypt_encrypted_results(encrypted_result_list, private_key)
+    if short_circuit is not None:
+        # Decrypt in priority order, only until a geofence the user is inside is found
+        results, decryptions = evaluate_any_inside("ref", encrypted_result_list, request_private_key, packed, radii, **short_circuit)
+    else:
+        haversine_intermediate_values = decrypt_encrypted_results(encrypted_result_list, request_private_key, packed)
 
-    if haversine_intermediate_values is None:
-        return jsonify({
-            "status": "error",
-            "message": "Couldn't decrypt encrypted results",
-        }), 500
+        if haversine_intermediate_values is None:
+            return jsonify({
+                "status": "error",
+                "message": "Couldn't decrypt encrypted results",
+            }), 500
     
-    # Determine if user is inside or outside the geofence based on the results
-    results = evaluate_geofence_result(haversine_intermediate_values)
+        # Determine if user is inside or outside the geofence based on the results
+        results = evaluate_geofence_results("ref", haversine_intermediate_values, radii, distances)
+        decryptions = len(encrypted_result_list)
 
     end = time.time()
     print("(Runtime Performance Experiment) Decryption & Evaluation Runtime Reference:", round((end-start), 3), "s")
@@ -69,9 +212,16 @@ def submit_geofence_result():
     with open("runDecOutRef.txt", "a") as f:
         f.write(f"{(end-start)}\n")
 
-    if 1 in results:
+    # Write Decryptions Reference to file
+    with open("decCountCarerOutRef.txt", "a") as f:
+        f.write(f"{decryptions}\n")
+
+    if results is not None and distances:
+        results, result_distances = results
+
+    if results is not None and 1 in results:
         print("User is inside the geofence.")
-    elif 0 in results and 1 not in results:
+    elif results is not None and 0 in results and 1 not in results:
         print("User is outside the geofence.")
     else:
         print("Evaluation failed.")
@@ -80,34 +230,63 @@ def submit_geofence_result():
             "message": "Evaluation failed. Unable to determine geofence status."
         }), 500
     
-    # Return a success response
-    return jsonify({
+    # Return a success response, with the distance from every geofence centre when asked for
+    response = {
         "status": "success",
         "message": "Geofence result processed successfully"
-    }), 200
+    }
+    if distances:
+        response["distances"] = np.round(result_distances, 2).tolist()
+    if short_circuit is not None:
+        response["decryptions"] = decryptions
+
+    return jsonify(response), 200
 
 
 
 @app.route("/submit-geofence-result-prop", methods=['POST'])
 def submit_geofence_result_prop():
-    # Retrieve JSON payload
-    data = request.get_json()
+    # Retrieve JSON or binary payload
+    data, parse_time = read_request_payload()
 
-    # Check if the encrypted data and public key are provided in the payload
-    if not data or 'encrypted_results' not in data or 'public_key_n' not in data:
+    # Check if the encrypted data and public key (or its fingerprint) are provided in the payload
+    if not data or 'encrypted_results' not in data or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
         return jsonify({
             "status": "error",
             "message": "Missing 'encrypted_results' or 'public_key_n' in request data"
         }), 400
 
-    # Verify the provided public key matches the carer's public key
-    if data['public_key_n'] != public_key.n:
+    # Verify the provided public key matches the carer's public key (or the key it replaced, within its grace period)
+    request_private_key = key_store.private_key_for_payload(data)
+    if request_private_key is None:
         return jsonify({
             "status": "error",
             "message": "Public key mismatch. Encryption was not done with the correct public key."
         }), 400
     
-    encrypted_result_list = parse_encrypted_results(data['encrypted_results'], public_key)
+    # Several results may be packed into each ciphertext
+    packed = data.get('packed', False) is True
+
+    # Optional radii of the geofences, and whether to report each result's distance
+    try:
+        radii = parse_radii(data.get('radii'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    distances = data.get('distances', False) is True
+
+    # Optionally stop decrypting at the first geofence the user is inside
+    try:
+        short_circuit = parse_short_circuit(data, distances)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    encrypted_result_list = parse_encrypted_results(data['encrypted_results'], request_private_key.public_key, packed)
 
     if encrypted_result_list is None:
         return jsonify({
@@ -119,19 +298,28 @@ def submit_geofence_result_prop():
     # Write Recieved Communication KB Proposed to file
     with open("commCarerOutProp.txt", "a") as f:
         f.write(f"{request_size/1024}\n")
+
+    # Write Parse Time (ms) Proposed to file
+    with open("parseCarerOutProp.txt", "a") as f:
+        f.write(f"{parse_time*1000}\n")
     
     start_prop = time.time()
 
-    haversine_intermediate_values = decrypt_encrypted_results(encrypted_result_list, private_key)
+    if short_circuit is not None:
+        # Decrypt in priority order, only until a geofence the user is inside is found
+        results, decryptions = evaluate_any_inside("prop", encrypted_result_list, request_private_key, packed, radii, **short_circuit)
+    else:
+        haversine_intermediate_values = decrypt_encrypted_results(encrypted_result_list, request_private_key, packed)
 
-    if haversine_intermediate_values is None:
-        return jsonify({
-            "status": "error",
-            "message": "Couldn't decrypt encrypted results",
-        }), 500
+        if haversine_intermediate_values is None:
+            return jsonify({
+                "status": "error",
+                "message": "Couldn't decrypt encrypted results",
+            }), 500
 
-    # Determine if User is inside or outside the geofence based on the results
-    results = evaluate_geofence_result_prop(haversine_intermediate_values)
+        # Determine if User is inside or outside the geofence based on the results
+        results = evaluate_geofence_results("prop", haversine_intermediate_values, radii, distances)
+        decryptions = len(encrypted_result_list)
 
     end_prop = time.time()
     print("(Runtime Performance Experiment) Decryption & Evaluation Runtime Proposed:", round((end_prop-start_prop), 3), "s")
@@ -140,9 +328,16 @@ def submit_geofence_result_prop():
     with open("runDecOutProp.txt", "a") as f:
         f.write(f"{(end_prop-start_prop)}\n")
 
-    if 1 in results:
+    # Write Decryptions Proposed to file
+    with open("decCountCarerOutProp.txt", "a") as f:
+        f.write(f"{decryptions}\n")
+
+    if results is not None and distances:
+        results, result_distances = results
+
+    if results is not None and 1 in results:
         print("User is inside the geofence.")
-    elif 0 in results and 1 not in results:
+    elif results is not None and 0 in results and 1 not in results:
         print("User is outside the geofence.")
     else:
         print("Evaluation failed.")
@@ -151,50 +346,388 @@ def submit_geofence_result_prop():
             "message": "Evaluation failed. Unable to determine geofence status."
         }), 500
     
-    # Return a success response
-    return jsonify({
+    # Return a success response, with the distance from every geofence centre when asked for
+    response = {
         "status": "success",
         "message": "Geofence result processed successfully"
+    }
+    if distances:
+        response["distances"] = np.round(result_distances, 2).tolist()
+    if short_circuit is not None:
+        response["decryptions"] = decryptions
+
+    return jsonify(response), 200
+
+
+
+@app.route("/submit-geofence-results-batch", methods=['POST'])
+def submit_geofence_results_batch():
+    # Results of several jobs from the geofencing service's delivery queue, each with its job id and system ('ref' or 'prop')
+    data, parse_time = read_request_payload()
+
+    if not data or type(data.get('deliveries')) is not list or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
+        return jsonify({
+            "status": "error",
+            "message": "Missing 'deliveries' or 'public_key_n' in request data"
+        }), 400
+
+    # Verify the provided public key matches the carer's public key (or the key it replaced, within its grace period)
+    request_private_key = key_store.private_key_for_payload(data)
+    if request_private_key is None:
+        return jsonify({
+            "status": "error",
+            "message": "Public key mismatch. Encryption was not done with the correct public key."
+        }), 400
+
+    results = {}
+    for delivery in data['deliveries']:
+        job_id = delivery.get('job_id') if isinstance(delivery, dict) else None
+        # Job ids name the files the outcomes are kept in, so only letters, digits, '-' and '_' are accepted
+        if type(job_id) is not str or not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", job_id):
+            return jsonify({
+                "status": "error",
+                "message": "Every delivery needs a 'job_id' of up to 64 letters, digits, '-' or '_'"
+            }), 400
+
+        # Redelivered jobs get the outcome they got the first time, even from another worker. The job is claimed while
+        # it is looked up, decrypted and saved, so a redelivery reaching another worker meanwhile waits for the outcome
+        # rather than decrypting it too. Only successes are saved, a job that failed is processed again when redelivered
+        os.makedirs(PROCESSED_JOBS_DIR, exist_ok=True)
+        with key_store.KeyFileLock(processed_job_path(job_id)):
+            result = read_processed_job(job_id)
+            if result is None:
+                result = process_delivered_job(delivery, request_private_key)
+                if result.get("status") == "success":
+                    write_processed_job(job_id, result)
+
+        results[job_id] = result
+
+    cleanup_processed_jobs()
+
+    # Return the outcome of every job
+    return jsonify({
+        "status": "success",
+        "message": "Geofence results processed",
+        "results": results
     }), 200
 
-    
-def evaluate_geofence_result(haversine_intermediate_values):
-    results = []
-    for haversine_intermediate in haversine_intermediate_values:
+
+def processed_job_path(job_id):
+    return os.path.join(PROCESSED_JOBS_DIR, f"{job_id}.json")
+
+
+def read_processed_job(job_id):
+    try:
+        with open(processed_job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_processed_job(job_id, result):
+    # Write to a temporary file and rename it, so another worker never reads a partly written outcome
+    path = processed_job_path(job_id)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(result, f)
+    os.replace(temporary_path, path)
+
+
+def cleanup_processed_jobs():
+    global processed_jobs_cleaned_at
+
+    # At most once a minute, remove the outcomes of jobs older than PROCESSED_JOBS_TTL
+    now = time.time()
+    if now - processed_jobs_cleaned_at < 60:
+        return
+    processed_jobs_cleaned_at = now
+
+    try:
+        file_names = os.listdir(PROCESSED_JOBS_DIR)
+    except OSError:
+        return
+    for file_name in file_names:
+        path = os.path.join(PROCESSED_JOBS_DIR, file_name)
         try:
-            central_angle = 2 * math.atan2(math.sqrt(haversine_intermediate), math.sqrt(1 - haversine_intermediate))
-            
-            distance = earth_radius * central_angle 
-            print(f"Distance from geofence centre: {round(distance, 2)} meters")
+            if now - os.path.getmtime(path) > PROCESSED_JOBS_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@app.route("/submit-geofence-results-fixes", methods=['POST'])
+def submit_geofence_results_fixes():
+    # Results of several timestamped location fixes of one system ('ref' or 'prop'), sent by the geofencing service
+    # for a batch of fixes from one device, with the outcome of every fix returned in the same exchange
+    data, parse_time = read_request_payload()
+
+    if not data or type(data.get('fixes')) is not list or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
+        return jsonify({
+            "status": "error",
+            "message": "Missing 'fixes' or 'public_key_n' in request data"
+        }), 400
+
+    # Verify the provided public key matches the carer's public key (or the key it replaced, within its grace period)
+    request_private_key = key_store.private_key_for_payload(data)
+    if request_private_key is None:
+        return jsonify({
+            "status": "error",
+            "message": "Public key mismatch. Encryption was not done with the correct public key."
+        }), 400
+
+    system = data.get('system')
+    if system not in ("ref", "prop") or not data['fixes'] or not all(isinstance(fix, dict) and type(fix.get('timestamp')) in (int, float) for fix in data['fixes']):
+        return jsonify({
+            "status": "error",
+            "message": "'system' must be 'ref' or 'prop', and 'fixes' a list of fixes with numeric timestamps"
+        }), 400
+
+    packed = data.get('packed', False) is True
+
+    # Every fix is compared against the same geofences, so one 'radii' (if any) applies to all of them
+    distances = data.get('distances', False) is True
+
+    start = time.time()
+
+    # Fixes are processed in the order they were taken, and reported in the order they were sent
+    outcomes = {}
+    for i in sorted(range(len(data['fixes'])), key=lambda i: data['fixes'][i]['timestamp']):
+        fix = data['fixes'][i]
+        print(f"Location fix taken at {fix['timestamp']}:")
+        outcomes[i] = process_geofence_results(system, fix.get('encrypted_results'), request_private_key, packed, data.get('radii'), distances, data)
+
+    end = time.time()
+    print(f"(Runtime Performance Experiment) Decryption & Evaluation Runtime per Fix {system} ({len(outcomes)} fixes):", round((end-start)/len(outcomes), 3), "s")
+
+    # Write Decryption Runtime per fix to file
+    with open(f"runDecFixOut{'Ref' if system == 'ref' else 'Prop'}.txt", "a") as f:
+        f.write(f"{(end-start)/len(outcomes)}\n")
 
-            # Return 1 if distance is within the radius, else 0
-            results.append(1 if distance <= radius else 0)
+    # Return the outcome of every fix
+    return jsonify({
+        "status": "success",
+        "message": "Geofence results processed",
+        "fixes": [dict(outcomes[i], timestamp=fix['timestamp']) for i, fix in enumerate(data['fixes'])]
+    }), 200
+
+
+def process_delivered_job(delivery, private_key):
+    # Decrypt and evaluate one delivered job, returning its outcome as the single-job endpoints would report it
+    return process_geofence_results(delivery.get('system'), delivery.get('encrypted_results'), private_key, delivery.get('packed', False) is True,
+                                    delivery.get('radii'), delivery.get('distances', False) is True, delivery)
+
+
+def process_geofence_results(system, encrypted_results, private_key, packed=False, radii=None, distances=False, options=None):
+    # Decrypt and evaluate the results of one location with the private key of the request, returning its outcome as
+    # the single-location endpoints would report it. options holds the short-circuit settings of the request or delivery, if any
+    if system not in ("ref", "prop"):
+        return {"status": "error", "message": "'system' must be 'ref' or 'prop'"}
+
+    try:
+        radii = parse_radii(radii)
+        short_circuit = parse_short_circuit(options or {}, distances)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+
+    encrypted_result_list = parse_encrypted_results(encrypted_results or [], private_key.public_key, packed)
+
+    if not encrypted_result_list:
+        return {"status": "error", "message": "Invalid encrypted results"}
+
+    start = time.time()
+
+    if short_circuit is not None:
+        # Decrypt in priority order, only until a geofence the user is inside is found
+        results, decryptions = evaluate_any_inside(system, encrypted_result_list, private_key, packed, radii, **short_circuit)
+    else:
+        haversine_intermediate_values = decrypt_encrypted_results(encrypted_result_list, private_key, packed)
+
+        if haversine_intermediate_values is None:
+            return {"status": "error", "message": "Couldn't decrypt encrypted results"}
+
+        # Determine if the user is inside or outside the geofence based on the results
+        results = evaluate_geofence_results(system, haversine_intermediate_values, radii, distances)
+
+    end = time.time()
+    print(f"(Batch) Decryption & Evaluation Runtime {system}:", round((end-start), 3), "s")
+
+    if results is not None and distances:
+        results, result_distances = results
+
+    if results is not None and 1 in results:
+        print("User is inside the geofence.")
+    elif results is not None and 0 in results:
+        print("User is outside the geofence.")
+    else:
+        print("Evaluation failed.")
+        return {"status": "error", "message": "Evaluation failed. Unable to determine geofence status."}
+
+    if distances:
+        return {"status": "success", "message": "Geofence result processed successfully", "distances": np.round(result_distances, 2).tolist()}
+    if short_circuit is not None:
+        return {"status": "success", "message": "Geofence result processed successfully", "decryptions": decryptions}
+    return {"status": "success", "message": "Geofence result processed successfully"}
 
-        except Exception as e:
-            print(f"Unexpected error in evaluate_geofence_result: {e}")
-            return None
     
-    return results
+def geofence_thresholds(system, radii=None):
+    # Largest 'ref' (a) or 'prop' (2a) result of a location within each radius (m), or within the default radius.
+    # Radii beyond half the Earth's circumference contain every location, so they are capped there, where sin² peaks
+    radii = np.minimum(np.asarray(radius if radii is None else radii, dtype=float), math.pi * earth_radius)
+    return HAVERSINE_SCALE[system] * np.sin(radii / (2 * earth_radius)) ** 2
+
+
+# Thresholds of the default radius, computed once
+default_thresholds = {system: geofence_thresholds(system) for system in HAVERSINE_SCALE}
+
+
+def evaluate_geofence_results(system, haversine_intermediate_values, radii=None, distances=False):
+    # Compare every decrypted 'ref' or 'prop' result against its geofence's threshold at once, returning 1 for
+    # each geofence the user is within and 0 for the others. Radii are the default radius, one radius for every
+    # geofence or one per geofence in result order. With distances, the distance (m) from every geofence centre is
+    # returned too (results, distances), which is the only time the trigonometry is needed
+    values = np.asarray(haversine_intermediate_values, dtype=float)
+    scale = HAVERSINE_SCALE[system]
+
+    # Results outside the range of haversine values weren't computed for a location, so there is nothing to compare
+    if values.ndim != 1 or not np.isfinite(values).all() or (values < -HAVERSINE_TOLERANCE).any() or (values > scale + HAVERSINE_TOLERANCE).any():
+        print(f"Unexpected error in evaluate_geofence_results: results out of range for the '{system}' system")
+        return None
+
+    if radii is not None and np.ndim(radii) and len(radii) != len(values):
+        print(f"Unexpected error in evaluate_geofence_results: {len(radii)} radii for {len(values)} results")
+        return None
+
+    thresholds = default_thresholds[system] if radii is None else geofence_thresholds(system, radii)
+    results = (values <= thresholds).astype(np.int8)
+
+    if not distances:
+        return results
 
+    return results, 2 * earth_radius * np.arcsin(np.sqrt(np.clip(values / scale, 0, 1)))
 
-def evaluate_geofence_result_prop(haversine_intermediate_values):
+
+def parse_short_circuit(data, distances=False):
+    # Settings of the short-circuit 'any inside' mode from a request or delivery ('any_inside': true), or None for a
+    # full evaluation. 'priority' lists result positions to decrypt first (e.g. the geofences of the user's carer),
+    # after the recent hits unless 'recent_hits_first' is false. Distances need every result, so they turn it off
+    if data.get('any_inside', False) is not True or distances:
+        return None
+
+    priority = data.get('priority', [])
+    if type(priority) is not list or not all(type(position) is int and position >= 0 for position in priority):
+        raise ValueError("'priority' must be a list of result positions")
+
+    return {
+        'priority': priority,
+        'recent_hits_first': data.get('recent_hits_first', True) is not False,
+        'generation': data.get('generation')
+    }
+
+
+def evaluate_any_inside(system, encrypted_result_list, private_key, packed=False, radii=None, priority=(), recent_hits_first=True, generation=None):
+    # Decrypt the results in priority order, a round at a time (one ciphertext per decryption process), and stop at
+    # the first geofence the user is inside. Returns the results evaluated (ending with a 1 if the user is inside a
+    # geofence, all 0 if not) and the number of ciphertexts decrypted, or None and that number if it failed
+    # Positions of every ciphertext's first result (a packed ciphertext holds several)
+    starts = np.cumsum([0] + [encrypted_result[2] if packed else 1 for encrypted_result in encrypted_result_list])
+    count = int(starts[-1])
+    if radii is not None and np.ndim(radii) and len(radii) != count:
+        print(f"Unexpected error in evaluate_any_inside: {len(radii)} radii for {count} results")
+        return None, 0
+
+    # Ciphertexts holding the recent hits, then those holding the priority positions, then the rest in order
+    positions = [position for position in (recent_hit_positions(generation) if recent_hits_first else []) + list(priority) if position < count]
+    order = list(dict.fromkeys((np.searchsorted(starts, positions, side="right") - 1).tolist()))
+    prioritised = set(order)
+    order += [i for i in range(len(encrypted_result_list)) if i not in prioritised]
+
+    round_size = max(decryption_engine.DECRYPTION_WORKERS, 1)
     results = []
-    for haversine_intermediate in haversine_intermediate_values:
-        try:
-            distance = 2 * earth_radius * math.asin(math.sqrt(haversine_intermediate / 2))            
-            print(f"Distance from geofence centre: {round(distance, 2)} meters")
+    decryptions = 0
 
-            # Return 1 if distance is within the radius, else 0
-            results.append(1 if distance <= radius else 0)
+    try:
+        for round_start in range(0, len(order), round_size):
+            indexes = order[round_start:round_start + round_size]
+            plaintexts = decryption_engine.decrypt_ciphertexts(private_key, [encrypted_result_list[i][0] for i in indexes], decryption_workers(private_key), chunk_size=1)
+            decryptions += len(indexes)
+
+            for i, plaintext in zip(indexes, plaintexts):
+                if packed:
+                    ciphertext, exponent, slots, slot_bits = encrypted_result_list[i]
+                    values = paillier_engine.unpack_slots(plaintext, slots, slot_bits, exponent)
+                else:
+                    values = [paillier_engine.decode_plaintext(private_key.public_key, plaintext, encrypted_result_list[i][1])]
+
+                ciphertext_radii = radii[starts[i]:starts[i + 1]] if radii is not None and np.ndim(radii) else radii
+                ciphertext_results = evaluate_geofence_results(system, values, ciphertext_radii)
+                if ciphertext_results is None:
+                    return None, decryptions
+
+                results.extend(ciphertext_results.tolist())
+                if 1 in ciphertext_results:
+                    record_recent_hit(generation, int(starts[i]) + int(np.argmax(ciphertext_results)))
+                    print(f"Short-circuit evaluation {system}: inside after {decryptions} of {len(encrypted_result_list)} decryptions")
+                    return results, decryptions
+    except Exception as e:
+        print(f"Error decrypting encrypted results: {e}")
+        return None, decryptions
 
-        except Exception as e:
-            print(f"Unexpected error in evaluate_geofence_result: {e}")
-            return None
-    
-    return results
+    print(f"Short-circuit evaluation {system}: outside after all {decryptions} decryptions")
+    return results, decryptions
 
 
-def parse_encrypted_results(encrypted_results, public_key):
+def recent_hit_positions(generation):
+    # Positions of the geofences users were last found inside in this generation, most recent first
+    with recent_hits_lock:
+        if recent_hits['generation'] != generation:
+            return []
+        return list(reversed(recent_hits['positions']))
+
+
+def record_recent_hit(generation, position):
+    with recent_hits_lock:
+        if recent_hits['generation'] != generation:
+            recent_hits['positions'].clear()
+            recent_hits['generation'] = generation
+
+        positions = recent_hits['positions']
+        positions.pop(position, None)
+        positions[position] = True
+        while len(positions) > RECENT_HITS_SIZE:
+            positions.popitem(last=False)
+
+
+def parse_radii(radii):
+    # Optional radii (m) sent with the results, one for every geofence or a list of one per geofence in result order
+    if radii is None:
+        return None
+
+    values = radii if type(radii) is list else [radii]
+    if not values or not all(type(value) in (int, float) and math.isfinite(value) and value > 0 for value in values):
+        raise ValueError("'radii' must be a positive number or a list of one per geofence")
+
+    return np.array(radii, dtype=float)
+
+
+def read_request_payload():
+    # Parse the request body by its content type, returning the payload and the parse time
+    start = time.time()
+
+    if request.mimetype == paillier_engine.BINARY_CONTENT_TYPE:
+        try:
+            data = paillier_engine.decode_binary_payload(request.get_data())
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid binary payload: {e}")
+            data = None
+    else:
+        data = request.get_json()
+
+    return data, time.time() - start
+
+
+def parse_encrypted_results(encrypted_results, public_key, packed=False):
+    # Results are kept as the raw integers they arrived as, (ciphertext, exponent) or (ciphertext, exponent, slots,
+    # slot_bits) when packed, which is all the decryption engine needs
     encrypted_result_list = []
     
     try:
@@ -205,24 +738,51 @@ def parse_encrypted_results(encrypted_results, public_key):
 
             if ciphertext_value is None or exponent is None:
                 raise ValueError("Missing ciphertext or exponent in encrypted result entry")
+            if type(ciphertext_value) is not int or type(exponent) is not int or ciphertext_value <= 0:
+                raise ValueError("Ciphertext and exponent must be integers")
+
+            if packed:
+                # Packed entries also carry their slot layout, which must fit in the plaintext
+                slots = entry.get("slots")
+                slot_bits = entry.get("slot_bits")
 
-            encrypted_result = paillier.EncryptedNumber(public_key, ciphertext_value, exponent) # Reconstruct the EncryptedNumber objects
-            encrypted_result_list.append(encrypted_result)
-            # Print encrypted values to confirm they are encrypted
-            print("encrypted result:", encrypted_result)
+                if type(slots) is not int or type(slot_bits) is not int or slots < 1 or slot_bits < 2:
+                    raise ValueError("Missing or invalid slots or slot_bits in packed encrypted result entry")
+                if slots * slot_bits > public_key.n.bit_length() - 2:
+                    raise ValueError(f"{slots} slots of {slot_bits} bits don't fit in the plaintext")
 
+                encrypted_result_list.append((ciphertext_value, exponent, slots, slot_bits))
+            else:
+                encrypted_result_list.append((ciphertext_value, exponent))
+
+        print(f"{len(encrypted_result_list)} encrypted results received")
         return encrypted_result_list
     except Exception as e:
         print(f"Error parsing encrypted results: {e}")
         return None
 
 
-def decrypt_encrypted_results(encrypted_result_list, private_key):
+def decryption_workers(private_key):
+    # The decryption pool holds the current key. Results for the key it replaced (during its grace period) are
+    # decrypted serially, rather than restarting the pool with each key in turn
+    return None if private_key is key_store.carer_keys['current'] else 0
+
+
+def decrypt_encrypted_results(encrypted_result_list, private_key, packed=False):
     decrypted_values = []
     
     try:
-        for encrypted_result in encrypted_result_list:
-            decrypted_value = private_key.decrypt(encrypted_result)     # Decrypt the results using the private key
+        # Decrypt every ciphertext at once, spread over the decryption pool when there is one
+        plaintexts = decryption_engine.decrypt_ciphertexts(private_key, [encrypted_result[0] for encrypted_result in encrypted_result_list], decryption_workers(private_key))
+
+        for encrypted_result, plaintext in zip(encrypted_result_list, plaintexts):
+            if packed:
+                # One decryption per packed ciphertext, then split it into its results
+                ciphertext, exponent, slots, slot_bits = encrypted_result
+                decrypted_values.extend(paillier_engine.unpack_slots(plaintext, slots, slot_bits, exponent))
+                continue
+
+            decrypted_value = paillier_engine.decode_plaintext(private_key.public_key, plaintext, encrypted_result[1])   # Decode the decrypted results
             decrypted_values.append(decrypted_value)                    # Store the results
         
         return decrypted_values
@@ -232,4 +792,5 @@ def decrypt_encrypted_results(encrypted_result_list, private_key):
 
 
 if __name__ == '__main__':
+    decryption_engine.start_decryption_pool(private_key)
     app.run(debug=True, host="0.0.0.0", port=5002) 
\ No newline at end of file
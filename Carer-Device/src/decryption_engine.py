@@ -0,0 +1,231 @@
+from concurrent.futures import ProcessPoolExecutor
+from phe import paillier
+import multiprocessing
+import threading
+import argparse
+import random
+import time
+import csv
+import os
+import paillier_engine
+
+# Decryption engine of the Carer Device. Results arrive as raw ciphertext integers and are decrypted with
+# Chinese-remaindering on backend integers (GMP through gmpy2 when it is installed), in chunks spread over a pool of
+# processes that each hold the private key, so the hundreds of results of a location are decrypted on every core
+
+# Processes decrypting chunks of a request's ciphertexts in parallel (0 decrypts them serially in the gunicorn worker)
+DECRYPTION_WORKERS = int(os.environ.get("DECRYPTION_WORKERS", "0"))
+
+# Ciphertexts per chunk sent to a pool process. Requests with no more ciphertexts than this are decrypted serially,
+# as sending them to the pool costs more than it saves
+DECRYPTION_CHUNK_SIZE = int(os.environ.get("DECRYPTION_CHUNK_SIZE", "32"))
+
+# Persistent process pool, the modulus of the key its processes hold, how many there are and the process the pool
+# belongs to (gunicorn workers each need their own). Request threads start and replace it under the lock, so only one
+# pool is ever built at a time
+decryption_pool = None
+decryption_pool_key = None
+decryption_pool_workers = None
+decryption_pool_pid = None
+decryption_pool_lock = threading.RLock()
+
+# Private key parts held by a pool process, by modulus
+decryption_keys = {}
+
+
+def set_decryption_key(public_key_n, p, q):
+    # Runs in each pool process as it starts: only the primes are sent, the rest of the key is derived from them
+    private_key = paillier.PaillierPrivateKey(paillier.PaillierPublicKey(public_key_n), p, q)
+    decryption_keys.clear()
+    decryption_keys[public_key_n] = paillier_engine.private_key_crt_parts(private_key)
+
+
+def start_decryption_pool(private_key, workers=None):
+    global decryption_pool, decryption_pool_key, decryption_pool_workers, decryption_pool_pid
+    workers = DECRYPTION_WORKERS if workers is None else workers
+
+    if workers <= 0:
+        return None
+
+    with decryption_pool_lock:
+        # A pool holding another key (or of another size) is replaced
+        if decryption_pool is None or decryption_pool_pid != os.getpid() or decryption_pool_key != private_key.public_key.n or decryption_pool_workers != workers:
+            stop_decryption_pool()
+            # The pool is started from request threads while key_store's pool filler may hold the key file's lock, which
+            # forked processes would inherit and hold for good. Processes started by the fork server don't inherit this
+            # process's state, and get the key from the initializer
+            decryption_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=set_decryption_key,
+                initargs=(private_key.public_key.n, private_key.p, private_key.q)
+            )
+            decryption_pool_key = private_key.public_key.n
+            decryption_pool_workers = workers
+            decryption_pool_pid = os.getpid()
+
+            # Warm the pool so the first request doesn't pay for starting the processes
+            list(decryption_pool.map(warm_pool_process, range(workers)))
+            print(f"Decryption pool started with {workers} processes")
+
+        return decryption_pool
+
+
+def stop_decryption_pool():
+    global decryption_pool, decryption_pool_key, decryption_pool_workers, decryption_pool_pid
+
+    with decryption_pool_lock:
+        if decryption_pool is not None and decryption_pool_pid == os.getpid():
+            decryption_pool.shutdown(wait=True)
+
+        decryption_pool = None
+        decryption_pool_key = None
+        decryption_pool_workers = None
+        decryption_pool_pid = None
+
+
+def warm_pool_process(i):
+    return os.getpid()
+
+
+def decrypt_chunk(public_key_n, ciphertexts):
+    # Runs in a pool process: plain integers in, plaintext integers out
+    parts = decryption_keys.get(public_key_n)
+    if parts is None:
+        raise ValueError("The decryption process doesn't hold the private key for these ciphertexts")
+
+    return [paillier_engine.crt_decrypt(parts, ciphertext) for ciphertext in ciphertexts]
+
+
+def decrypt_ciphertexts(private_key, ciphertexts, workers=None, chunk_size=None):
+    # Plaintext integers (mod n, not yet decoded) of raw ciphertext integers, in order. Split into chunks across the
+    # decryption pool when there is one and there is more than one chunk, otherwise decrypted here
+    chunk_size = chunk_size or DECRYPTION_CHUNK_SIZE
+
+    pool = start_decryption_pool(private_key, workers)
+    if pool is None or len(ciphertexts) <= chunk_size:
+        parts = paillier_engine.private_key_crt_parts(private_key)
+        return [paillier_engine.crt_decrypt(parts, ciphertext) for ciphertext in ciphertexts]
+
+    chunks = [ciphertexts[start:start + chunk_size] for start in range(0, len(ciphertexts), chunk_size)]
+    plaintexts = []
+    for chunk in pool.map(decrypt_chunk, [private_key.public_key.n] * len(chunks), chunks):
+        plaintexts.extend(chunk)
+
+    return plaintexts
+
+
+def benchmark_decryption(batch_sizes, worker_counts, key_size=2048, chunk_size=None, repeats=3, seed=0):
+    # Decryption throughput of batches of ciphertexts, as the carer decrypted them before (phe's EncryptedNumber
+    # and private_key.decrypt, one at a time) and with the engine serially (0 workers) and over each pool size.
+    # Returns rows of (engine, workers, batch size, ms per batch, decryptions per second)
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=key_size)
+    rng = random.Random(seed)
+
+    # Results in the range of haversine values, encrypted without obfuscation (it doesn't change decryption's cost)
+    values = [rng.uniform(0, 2) for _ in range(max(batch_sizes))]
+    encodings = [paillier_engine.encode(public_key, value) for value in values]
+    ciphertexts = [int(paillier_engine.raw_encrypt_unobfuscated(public_key, encoding.encoding)) for encoding in encodings]
+    exponent = encodings[0].exponent
+    rows = []
+
+    for batch_size in batch_sizes:
+        batch = ciphertexts[:batch_size]
+
+        def phe_decrypt():
+            return [private_key.decrypt(paillier.EncryptedNumber(public_key, ciphertext, exponent)) for ciphertext in batch]
+
+        expected = phe_decrypt()
+        seconds = timed(phe_decrypt, repeats)
+        rows.append(("phe", 1, batch_size, seconds * 1e3, batch_size / seconds))
+
+        for workers in worker_counts:
+            # Starts the pool (outside the timing), and checks the engine decrypts to what phe does
+            decrypted = decrypt_ciphertexts(private_key, batch, workers, chunk_size)
+            if [paillier_engine.decode_plaintext(public_key, plaintext, exponent) for plaintext in decrypted] != expected:
+                raise RuntimeError(f"The decryption engine with {workers} workers doesn't decrypt to phe's results")
+
+            seconds = timed(lambda: decrypt_ciphertexts(private_key, batch, workers, chunk_size), repeats)
+            rows.append(("engine", workers, batch_size, seconds * 1e3, batch_size / seconds))
+
+    stop_decryption_pool()
+    return rows
+
+
+def timed(function, repeats=3):
+    # Best time of repeats calls of function, in seconds
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the carer's decryption throughput"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bench = commands.add_parser("bench", help="Decryption throughput against batch size and number of pool processes")
+    bench.add_argument(
+        "-b", "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100, 300, 1000],
+        help="Numbers of ciphertexts decrypted together (e.g. the geofences of a location)"
+    )
+    bench.add_argument(
+        "-w", "--workers",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4],
+        help="Numbers of pool processes (0 decrypts serially, as DECRYPTION_WORKERS=0)"
+    )
+    bench.add_argument(
+        "-k", "--key-size",
+        type=int,
+        default=2048,
+        help="Bit length of the Paillier modulus n"
+    )
+    bench.add_argument(
+        "-cs", "--chunk-size",
+        type=int,
+        default=DECRYPTION_CHUNK_SIZE,
+        help="Ciphertexts per chunk sent to a pool process"
+    )
+    bench.add_argument(
+        "-o", "--output",
+        default=None,
+        help="CSV file to save the results to (e.g. Results/decryptionThroughput.csv)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    if args.command == "bench":
+        rows = benchmark_decryption(args.batch_sizes, args.workers, args.key_size, args.chunk_size)
+        print(f"{args.key_size}-bit key, {paillier_engine.PAILLIER_BACKEND} backend, chunks of {args.chunk_size}:")
+        print(f"{'Engine':>8}{'Workers':>9}{'Batch':>8}{'ms/batch':>12}{'dec/s':>10}")
+        for engine, workers, batch_size, milliseconds, throughput in rows:
+            print(f"{engine:>8}{workers:>9}{batch_size:>8}{round(milliseconds, 2):>12}{round(throughput):>10}")
+
+        if args.output:
+            save_rows(args.output, ["Engine", "Workers", "Batch Size", "Time per Batch (ms)", "Decryptions per Second"], rows)
+
+
+def save_rows(path, headers, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from phe import paillier
+import subprocess
+import statistics
+import threading
+import argparse
+import tempfile
+import hashlib
+import fcntl
+import json
+import time
+import csv
+import sys
+import os
+import paillier_engine
+
+# Key store of the Carer Device. The carer's Paillier keypair is kept in a key file encrypted at rest, so a restart
+# loads the same key in milliseconds instead of generating new primes, and neither ciphertexts in flight nor the key
+# the geofencing service has cached are invalidated. The file also holds a pool of keypairs generated in the
+# background, so rotating the key never waits for prime generation, and the key the last rotation replaced, which is
+# still accepted for KEY_GRACE_PERIOD seconds. The file is JSON:
+#   {"version": 1, "kdf": {"salt", "n", "r", "p"}, "nonce", "ciphertext"}
+# where the ciphertext is AES-256-GCM (header authenticated) under a key derived from CARER_KEY_PASSPHRASE with
+# scrypt, and decrypts to
+#   {"current": key, "previous": key or null, "retired_at": unix time or null, "pool": [key, ...]}
+# with every key as {"n", "p", "q"}. Salt, nonce and ciphertext are hex
+KEY_FILE_VERSION = 1
+SCRYPT_PARAMETERS = {"n": 2**14, "r": 8, "p": 1}   # 16 MB, tens of milliseconds per load
+
+# Path of the key file, and the passphrase it is encrypted under. Without a passphrase nothing is saved, and a new
+# key is generated at every start (as the carer always did)
+CARER_KEY_FILE = os.environ.get("CARER_KEY_FILE", "carer_key.enc")
+CARER_KEY_PASSPHRASE = os.environ.get("CARER_KEY_PASSPHRASE", "")
+
+# Bit length of the modulus n of generated keys (the shared KEY_SIZE). A key file holding a key of another size is
+# rotated to a key of this size on startup
+KEY_SIZE = paillier_engine.KEY_SIZE
+
+# Keypairs kept generated in the key file for rotations, and seconds between checks that the pool is full
+KEY_POOL_SIZE = int(os.environ.get("KEY_POOL_SIZE", "2"))
+KEY_POOL_CHECK_INTERVAL = float(os.environ.get("KEY_POOL_CHECK_INTERVAL", "10"))
+
+# Seconds the key replaced by a rotation is still accepted, for ciphertexts in flight and caches of the old key
+KEY_GRACE_PERIOD = float(os.environ.get("KEY_GRACE_PERIOD", "300"))
+
+# Keys this process serves (PaillierPrivateKey objects), and the key file they were loaded from with its passphrase
+# and identity (inode, mtime), so a file rewritten by another gunicorn worker is reloaded on the next request
+carer_keys = {'current': None, 'previous': None, 'retired_at': None, 'pool': [], 'path': None, 'passphrase': None, 'file_id': None}
+carer_keys_lock = threading.RLock()
+
+# Process whose background thread keeps the key pool full (gunicorn workers each start their own, and the one holding
+# the filler lock generates the keys)
+key_pool_filler_pid = None
+
+
+class KeyFileLock(object):
+    # Exclusive lock on a key file across processes, held while it is read, changed and written back, so the
+    # gunicorn workers never lose each other's rotations or pool keys
+    def __init__(self, path, blocking=True):
+        self.path = path + ".lock"
+        self.blocking = blocking
+        self.fd = None
+
+    def acquire(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)   # Closing the descriptor releases the lock
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def generate_private_key(key_size=None):
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=key_size or KEY_SIZE)
+    return private_key
+
+
+def key_bits(private_key):
+    return private_key.public_key.n.bit_length()
+
+
+def key_entry(private_key):
+    return {"n": private_key.public_key.n, "p": private_key.p, "q": private_key.q}
+
+
+def private_key_from_entry(entry):
+    # Raises ValueError if the primes aren't the modulus' factors
+    return paillier.PaillierPrivateKey(paillier.PaillierPublicKey(entry['n']), entry['p'], entry['q'])
+
+
+def derive_file_key(passphrase, salt, n, r, p):
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+
+
+def encrypt_keys(keys, passphrase):
+    # The key file contents of keys ('current', 'previous', 'retired_at' and 'pool'), encrypted under the passphrase
+    salt = os.urandom(16)
+    nonce = os.urandom(12)
+    header = {"version": KEY_FILE_VERSION, "kdf": dict(SCRYPT_PARAMETERS, salt=salt.hex()), "nonce": nonce.hex()}
+
+    plaintext = json.dumps({
+        "current": key_entry(keys['current']),
+        "previous": key_entry(keys['previous']) if keys['previous'] is not None else None,
+        "retired_at": keys['retired_at'],
+        "pool": [key_entry(private_key) for private_key in keys['pool']]
+    }).encode()
+
+    file_key = derive_file_key(passphrase, salt, **SCRYPT_PARAMETERS)
+    ciphertext = AESGCM(file_key).encrypt(nonce, plaintext, json.dumps(header, sort_keys=True).encode())
+
+    return json.dumps(dict(header, ciphertext=ciphertext.hex())).encode()
+
+
+def decrypt_keys(data, passphrase):
+    # Keys of a key file's contents. Raises ValueError if it isn't a key file of this version, the passphrase is
+    # wrong or the file has been altered
+    try:
+        document = json.loads(data)
+        header = {"version": document['version'], "kdf": document['kdf'], "nonce": document['nonce']}
+        if header['version'] != KEY_FILE_VERSION:
+            raise ValueError(f"unsupported version {header['version']}")
+        kdf = header['kdf']
+        file_key = derive_file_key(passphrase, bytes.fromhex(kdf['salt']), kdf['n'], kdf['r'], kdf['p'])
+        nonce, ciphertext = bytes.fromhex(header['nonce']), bytes.fromhex(document['ciphertext'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Not a carer key file: {e}")
+
+    try:
+        plaintext = AESGCM(file_key).decrypt(nonce, ciphertext, json.dumps(header, sort_keys=True).encode())
+    except InvalidTag:
+        raise ValueError("Wrong passphrase, or the key file has been altered")
+
+    keys = json.loads(plaintext)
+    return {
+        'current': private_key_from_entry(keys['current']),
+        'previous': private_key_from_entry(keys['previous']) if keys['previous'] is not None else None,
+        'retired_at': keys['retired_at'],
+        'pool': [private_key_from_entry(entry) for entry in keys['pool']]
+    }
+
+
+def write_key_file(path, keys, passphrase):
+    # Written next to the path (readable by the owner only) and renamed over it, so a reader never sees half a file
+    temporary_path = path + ".tmp"
+    try:
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(encrypt_keys(keys, passphrase))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def read_key_file(path, passphrase):
+    # The keys in a key file and the file's identity
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        keys = decrypt_keys(f.read(), passphrase)
+    return keys, (stat.st_ino, stat.st_mtime_ns)
+
+
+def set_carer_keys(keys, path=None, passphrase=None, file_id=None):
+    with carer_keys_lock:
+        carer_keys.update(keys, path=path, passphrase=passphrase, file_id=file_id)
+
+
+def load_carer_keys(path=None, passphrase=None):
+    # Load the carer's keys from the key file at startup, generating a key and saving it when there is no file yet.
+    # A file that can't be read or decrypted raises (OSError or ValueError) rather than being replaced, as that
+    # would lose the key. Returns the current private key
+    path = CARER_KEY_FILE if path is None else path
+    passphrase = CARER_KEY_PASSPHRASE if passphrase is None else passphrase
+    start = time.time()
+
+    if not passphrase:
+        set_carer_keys({'current': generate_private_key(), 'previous': None, 'retired_at': None, 'pool': []})
+        print(f"No CARER_KEY_PASSPHRASE: generated a new carer key in {round((time.time() - start) * 1000, 3)} ms, it isn't saved")
+        return carer_keys['current']
+
+    with KeyFileLock(path):
+        if not os.path.exists(path):
+            write_key_file(path, {'current': generate_private_key(), 'previous': None, 'retired_at': None, 'pool': []}, passphrase)
+            print(f"Generated a new carer key and saved it to {path}")
+        keys, file_id = read_key_file(path, passphrase)
+
+        # KEY_SIZE has changed since the key was saved
+        if key_bits(keys['current']) != KEY_SIZE:
+            print(f"Rotating the {key_bits(keys['current'])}-bit carer key to a {KEY_SIZE}-bit key (KEY_SIZE)")
+            keys = rotated_keys(keys, KEY_SIZE)[0]
+            write_key_file(path, keys, passphrase)
+            keys, file_id = read_key_file(path, passphrase)
+
+    set_carer_keys(keys, path, passphrase, file_id)
+    print(f"Carer key {paillier_engine.key_fingerprint(keys['current'].public_key.n)} loaded from {path} in {round((time.time() - start) * 1000, 3)} ms "
+          f"({len(keys['pool'])} pooled keys)")
+    return carer_keys['current']
+
+
+def sync_carer_keys():
+    # Reload the key file if it has been rewritten since it was loaded (e.g. rotated by another gunicorn worker).
+    # Keys that weren't loaded from a file are left alone
+    path = carer_keys['path']
+    if path is None:
+        return
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+
+    if (stat.st_ino, stat.st_mtime_ns) != carer_keys['file_id']:
+        with carer_keys_lock:
+            if carer_keys['path'] == path and (stat.st_ino, stat.st_mtime_ns) != carer_keys['file_id']:
+                try:
+                    keys, file_id = read_key_file(path, carer_keys['passphrase'])
+                    set_carer_keys(keys, path, carer_keys['passphrase'], file_id)
+                except (OSError, ValueError) as e:
+                    print(f"Keeping the current carer key, key file {path} can't be loaded: {e}")
+
+
+def accepted_private_keys(now=None):
+    # The current key, and the key it replaced while that is within its grace period
+    now = time.time() if now is None else now
+    with carer_keys_lock:
+        keys = [carer_keys['current']]
+        if carer_keys['previous'] is not None and carer_keys['retired_at'] is not None and now - carer_keys['retired_at'] <= KEY_GRACE_PERIOD:
+            keys.append(carer_keys['previous'])
+    return keys
+
+
+def private_key_for_payload(data):
+    # The accepted private key the payload was encrypted for (named by its fingerprint or modulus), or None
+    for private_key in accepted_private_keys():
+        if paillier_engine.payload_matches_key(data, private_key.public_key.n):
+            return private_key
+    return None
+
+
+def rotated_keys(keys, key_size=None):
+    # Keys after replacing the current key with the next pooled key of key_size bits (the current key's size by
+    # default), generating one if the pool has none, with the replaced key kept for its grace period. Pooled keys of
+    # other sizes are dropped, as the pool is refilled at the new key's size. Returns the keys, the new key and
+    # whether it came from the pool
+    key_size = key_size or key_bits(keys['current'])
+    pool = [private_key for private_key in keys['pool'] if key_bits(private_key) == key_size]
+    pooled = bool(pool)
+    private_key = pool.pop(0) if pooled else generate_private_key(key_size)
+    return {'current': private_key, 'previous': keys['current'], 'retired_at': time.time(), 'pool': pool}, private_key, pooled
+
+
+def rotate_carer_key(key_size=None):
+    # Replace the current key with the next pooled key of key_size bits (by default the current key's size).
+    # Returns the new key and whether it came from the pool
+    path, passphrase = carer_keys['path'], carer_keys['passphrase']
+
+    if path is None:
+        with carer_keys_lock:
+            keys, private_key, pooled = rotated_keys(carer_keys, key_size)
+            set_carer_keys(keys)
+        return private_key, pooled
+
+    # Rotated from the file, which other workers may have rotated or filled since this one loaded it
+    with KeyFileLock(path):
+        keys, file_id = read_key_file(path, passphrase)
+        keys, private_key, pooled = rotated_keys(keys, key_size)
+        write_key_file(path, keys, passphrase)
+        keys, file_id = read_key_file(path, passphrase)
+
+    set_carer_keys(keys, path, passphrase, file_id)
+    return private_key, pooled
+
+
+def top_up_key_pool(size=None):
+    # Generate one keypair for the key file's pool if it has fewer than size, returning whether it did. The key is
+    # generated without holding the file lock, so requests and rotations in other workers aren't held up by it
+    path, passphrase = carer_keys['path'], carer_keys['passphrase']
+    size = KEY_POOL_SIZE if size is None else size
+
+    with KeyFileLock(path):
+        keys, file_id = read_key_file(path, passphrase)
+    if len(keys['pool']) >= size:
+        return False
+
+    private_key = generate_private_key(key_bits(keys['current']))
+
+    with KeyFileLock(path):
+        keys, file_id = read_key_file(path, passphrase)
+        if len(keys['pool']) < size:
+            keys['pool'].append(private_key)
+            write_key_file(path, keys, passphrase)
+            print(f"Generated a pooled carer key ({len(keys['pool'])} of {size})")
+
+    return True
+
+
+def start_key_pool_filler():
+    # Start this process's thread keeping the pool full, once per process (keys kept in a file only)
+    global key_pool_filler_pid
+
+    if carer_keys['path'] is None or KEY_POOL_SIZE <= 0 or key_pool_filler_pid == os.getpid():
+        return
+
+    key_pool_filler_pid = os.getpid()
+    threading.Thread(target=fill_key_pool, args=(os.getpid(), carer_keys['path']), daemon=True).start()
+
+
+def fill_key_pool(pid, path):
+    # Every worker runs this, but only the process holding the filler lock generates keys, so the workers don't all
+    # spend CPU generating keys for the same pool. When that process exits its lock is released and another takes over
+    filler_lock = KeyFileLock(path + ".fill", blocking=False)
+
+    while key_pool_filler_pid == pid and carer_keys['path'] == path:
+        if filler_lock.fd is not None or filler_lock.acquire():
+            try:
+                while top_up_key_pool():
+                    pass
+            except (OSError, ValueError) as e:
+                print(f"Couldn't fill the carer key pool: {e}")
+
+        time.sleep(KEY_POOL_CHECK_INTERVAL)
+
+    filler_lock.release()
+
+
+def benchmark_cold_start(key_size=None, repeats=5):
+    # Time the carer takes to get its key at startup, generating one as it did before and loading it from the key
+    # file, both for the key alone and for starting the app (a fresh interpreter importing it). Returns rows of
+    # (measurement, key source, mean ms, standard deviation ms)
+    key_size = key_size or KEY_SIZE
+    rows = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "carer_key.enc")
+        passphrase = "cold start benchmark"
+        write_key_file(path, {'current': generate_private_key(key_size), 'previous': None, 'retired_at': None, 'pool': []}, passphrase)
+
+        def key_generation():
+            generate_private_key(key_size)
+
+        def key_file_load():
+            read_key_file(path, passphrase)
+
+        rows.append(("Key", "generated", *timings(key_generation, repeats)))
+        rows.append(("Key", "key file", *timings(key_file_load, repeats)))
+
+        # The app as gunicorn imports it, with the key generated (no passphrase) and loaded from the key file
+        source_directory = os.path.dirname(os.path.abspath(__file__))
+        for source, environment in [("generated", {"CARER_KEY_PASSPHRASE": ""}), ("key file", {"CARER_KEY_PASSPHRASE": passphrase, "CARER_KEY_FILE": path})]:
+            environment = dict(os.environ, KEY_POOL_SIZE="0", **environment)
+            command = [sys.executable, "-c", "import app"]
+
+            def app_start():
+                subprocess.run(command, cwd=source_directory, env=environment, check=True, stdout=subprocess.DEVNULL)
+
+            rows.append(("App start", source, *timings(app_start, repeats)))
+
+    return rows
+
+
+def timings(function, repeats=5):
+    # Mean and standard deviation of repeats calls of function, in milliseconds
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(samples), statistics.stdev(samples) if len(samples) > 1 else 0.0
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Create the carer's encrypted key file and measure the carer's cold start"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init = commands.add_parser("init", help="Create a key file (from CARER_KEY_PASSPHRASE) with a key and a full pool")
+    init.add_argument("path", nargs="?", default=CARER_KEY_FILE, help="Key file to create")
+    init.add_argument("-ps", "--pool-size", type=int, default=KEY_POOL_SIZE, help="Keypairs to generate for the pool")
+    init.add_argument("-k", "--key-size", type=int, default=KEY_SIZE, help="Bit length of the Paillier modulus n")
+
+    coldstart = commands.add_parser("coldstart", help="Startup time with the key generated, as before, and loaded from the key file")
+    coldstart.add_argument("-k", "--key-size", type=int, default=KEY_SIZE, help="Bit length of the Paillier modulus n")
+    coldstart.add_argument("-r", "--repetitions", type=int, default=5, help="Repetitions of each measurement")
+    coldstart.add_argument("-o", "--output", default=None, help="CSV file to save the results to (e.g. Results/coldStart.csv)")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    if args.command == "init":
+        if not CARER_KEY_PASSPHRASE:
+            sys.exit("Set CARER_KEY_PASSPHRASE to the passphrase to encrypt the key file under")
+        if os.path.exists(args.path):
+            sys.exit(f"{args.path} already exists, the key it holds would be lost")
+
+        keys = {'current': generate_private_key(args.key_size), 'previous': None, 'retired_at': None,
+                'pool': [generate_private_key(args.key_size) for _ in range(args.pool_size)]}
+        with KeyFileLock(args.path):
+            write_key_file(args.path, keys, CARER_KEY_PASSPHRASE)
+        print(f"Key file {args.path} created with key {paillier_engine.key_fingerprint(keys['current'].public_key.n)} and {args.pool_size} pooled keys")
+
+    elif args.command == "coldstart":
+        rows = benchmark_cold_start(args.key_size, args.repetitions)
+        print(f"{args.key_size}-bit key, {args.repetitions} repetitions:")
+        print(f"{'Measurement':>12}{'Key':>11}{'Mean (ms)':>12}{'SD (ms)':>10}")
+        for measurement, source, mean, deviation in rows:
+            print(f"{measurement:>12}{source:>11}{round(mean, 2):>12}{round(deviation, 2):>10}")
+
+        if args.output:
+            with open(args.output, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Measurement", "Key Source", "Mean (ms)", "Standard Deviation (ms)"])
+                writer.writerows(rows)
+            print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Make the service modules and the shared modules at the repository root importable, as they are inside the container
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
@@ -1,6 +1,14 @@
 import pytest
 import json
+import os
+import math
+import time
+import threading
+import numpy as np
+import paillier_engine
 from phe import paillier
+from unittest.mock import patch
+import src.app as src_app
 from src.app import app, public_key  # Import app and public_key from Flask app
 
 # Define global public key for tests
@@ -13,6 +21,12 @@ def client():
     with app.test_client() as client:
         yield client
 
+
+# Keep the outcomes of delivered jobs of each test in its own directory, so no outcome of an earlier run is reused
+@pytest.fixture(autouse=True)
+def processed_jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(src_app, "PROCESSED_JOBS_DIR", str(tmp_path / "processed-jobs"))
+
 # Test the /get-public-key API endpoint to ensure it returns a valid public key
 def test_get_public_key(client):
     # Send a GET request to retrieve the public key
@@ -278,4 +292,464 @@ def test_submit_geofence_result_prop_decryption_failure(client):
     assert response.status_code == 500                                                                              # Check if the response status code is a Bad Request
     response_json = response.get_json()                                                                             # Parse JSON from response
     assert response_json["status"] == "error"                                                                       # Confirm response status
-    assert response_json["message"] == "Couldn't decrypt encrypted results"                                          # Confirm error message
\ No newline at end of file
+    assert response_json["message"] == "Couldn't decrypt encrypted results"                                          # Confirm error message
+
+
+# Test the /submit-geofence-result-prop API endpoint unpacks several results packed into one ciphertext
+def test_submit_geofence_result_prop_packed_success(client):
+    import paillier_engine
+
+    # Pack two results at the fixed-point exponent into two slots of one plaintext, as the geofencing service does
+    exponent = -28
+    slot_bits, slots = paillier_engine.packing_layout(public_key, exponent, 2)
+    offset = 1 << (slot_bits - 1)
+    test_values = [1.1672744938776433e-15, 1.5]
+    plaintext = sum((round(value * 16**-exponent) + offset) << (k * slot_bits) for k, value in enumerate(test_values))
+
+    encrypted_result = paillier.EncryptedNumber(public_key, public_key.raw_encrypt(plaintext), exponent)
+
+    # Prepare the payload with the packed result and its slot layout
+    data = {
+        "encrypted_results": [
+            {"ciphertext": encrypted_result.ciphertext(), "exponent": exponent, "slots": 2, "slot_bits": slot_bits}
+        ],
+        "public_key_n": public_key.n,
+        "packed": True
+    }
+
+    # Send POST request to the /submit-geofence-result-prop endpoint using the test client
+    response = client.post(
+        "/submit-geofence-result-prop",
+        data=json.dumps(data),
+        content_type="application/json"
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 200                                           # Check if the response status code is OK
+    response_json = response.get_json()                                          # Parse JSON from response
+    assert response_json["status"] == "success"                                  # Confirm response status
+    assert response_json["message"] == "Geofence result processed successfully"  # Confirm success message
+
+
+
+# Test the /submit-geofence-result-prop API endpoint rejects a packed slot layout that can't fit in the plaintext
+def test_submit_geofence_result_prop_packed_invalid_layout(client):
+    encrypted_result = public_key.encrypt(1.5)
+
+    # Prepare the payload with more slots than the plaintext can hold
+    data = {
+        "encrypted_results": [
+            {"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent, "slots": public_key.n.bit_length(), "slot_bits": 2}
+        ],
+        "public_key_n": public_key.n,
+        "packed": True
+    }
+
+    # Send POST request to the /submit-geofence-result-prop endpoint using the test client
+    response = client.post(
+        "/submit-geofence-result-prop",
+        data=json.dumps(data),
+        content_type="application/json"
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 400                          # Check if the response status code is a Bad Request
+    response_json = response.get_json()                         # Parse JSON from response
+    assert response_json["status"] == "error"                   # Confirm response status
+    assert response_json["message"] == "Invalid encrypted results"  # Confirm error message
+
+
+
+# Test the /submit-geofence-result-ref API endpoint accepts the binary wire format
+def test_submit_geofence_result_ref_binary_success(client):
+    import paillier_engine
+
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+
+    # Prepare the payload with encrypted data, then encode it in the binary format
+    data = {
+        "encrypted_results": [
+            {"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent},
+            {"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}
+        ],
+        "public_key_n": public_key.n
+    }
+
+    # Send POST request to the /submit-geofence-result-ref endpoint using the test client
+    response = client.post(
+        "/submit-geofence-result-ref",
+        data=paillier_engine.encode_binary_payload(data, public_key.n),
+        content_type=paillier_engine.BINARY_CONTENT_TYPE
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 200                                           # Check if the response status code is OK
+    response_json = response.get_json()                                          # Parse JSON from response
+    assert response_json["status"] == "success"                                  # Confirm response status
+    assert response_json["message"] == "Geofence result processed successfully"  # Confirm success message
+
+
+
+# Test the /submit-geofence-result-ref API endpoint rejects a truncated binary payload
+def test_submit_geofence_result_ref_binary_truncated(client):
+    import paillier_engine
+
+    encrypted_result = public_key.encrypt(0.5)
+    data = {
+        "encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}],
+        "public_key_n": public_key.n
+    }
+
+    # Send POST request to the /submit-geofence-result-ref endpoint with the last bytes of the ciphertext buffer cut off
+    response = client.post(
+        "/submit-geofence-result-ref",
+        data=paillier_engine.encode_binary_payload(data, public_key.n)[:-10],
+        content_type=paillier_engine.BINARY_CONTENT_TYPE
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 400                                                       # Check if the response status code is a Bad Request
+    response_json = response.get_json()                                                      # Parse JSON from response
+    assert response_json["status"] == "error"                                                # Confirm response status
+    assert response_json["message"] == "Missing 'encrypted_results' or 'public_key_n' in request data"  # Confirm error message
+
+
+
+# Test the /get-public-key API endpoint also returns the key's fingerprint, which clients send instead of 'n'
+def test_get_public_key_fingerprint(client):
+    import paillier_engine
+
+    # Send a GET request to retrieve the public key
+    response = client.get("/get-public-key")
+
+    # Check the fingerprint is the one derived from the returned modulus
+    assert response.status_code == 200
+    public_key_data = response.get_json()
+    assert public_key_data["fingerprint"] == paillier_engine.key_fingerprint(public_key_data["public_key_n"])
+
+
+
+# Test the /submit-geofence-results-batch API endpoint processes several delivered jobs and reports each job's outcome
+def test_submit_geofence_results_batch_success(client):
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    encrypted_results = [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]
+
+    # Prepare a batch with one job for each system, and one job with invalid results
+    data = {
+        "deliveries": [
+            {"job_id": "batch-ref", "system": "ref", "encrypted_results": encrypted_results, "packed": False},
+            {"job_id": "batch-prop", "system": "prop", "encrypted_results": encrypted_results, "packed": False},
+            {"job_id": "batch-invalid", "system": "prop", "encrypted_results": [{"ciphertext": "invalid"}], "packed": False}
+        ],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    # The batch is accepted, and the outcome of each job is reported by its job id
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert results["batch-ref"]["status"] == "success"
+    assert results["batch-prop"]["status"] == "success"
+    assert results["batch-invalid"]["status"] == "error"
+
+
+# Test a job delivered again (a retried batch) gets its first outcome without being decrypted again
+def test_submit_geofence_results_batch_redelivery(client):
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    data = {
+        "deliveries": [
+            {"job_id": "batch-redelivered", "system": "prop", "encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]}
+        ],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    first = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    with patch("src.app.decrypt_encrypted_results") as mock_decrypt:
+        second = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    assert mock_decrypt.call_count == 0
+    assert first.get_json()["results"] == second.get_json()["results"]
+    assert second.get_json()["results"]["batch-redelivered"]["status"] == "success"
+    # The outcome is kept in a file, where every gunicorn worker finds it
+    assert os.path.exists(os.path.join(src_app.PROCESSED_JOBS_DIR, "batch-redelivered.json"))
+
+
+# Test a job delivered to two workers at once is decrypted by one of them, the other waiting for its outcome
+def test_submit_geofence_results_batch_concurrent_redelivery():
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    data = {
+        "deliveries": [
+            {"job_id": "batch-concurrent", "system": "prop", "encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]}
+        ],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    # Slow the decryption down, so the second delivery arrives while the first is still being processed
+    process_delivered_job = src_app.process_delivered_job
+    def slow_process_delivered_job(delivery, private_key):
+        time.sleep(0.2)
+        return process_delivered_job(delivery, private_key)
+
+    responses = []
+    def deliver():
+        with app.test_client() as client:
+            responses.append(client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json"))
+
+    with patch("src.app.process_delivered_job", side_effect=slow_process_delivered_job) as mock_process:
+        threads = [threading.Thread(target=deliver) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mock_process.call_count == 1
+    assert [response.get_json()["results"]["batch-concurrent"]["status"] for response in responses] == ["success", "success"]
+
+
+# Test a job that failed isn't saved, so a redelivery of it is processed again
+def test_submit_geofence_results_batch_failed_job_not_saved(client):
+    data = {
+        "deliveries": [{"job_id": "batch-failed", "system": "prop", "encrypted_results": [{"ciphertext": "invalid"}]}],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    first = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    assert first.get_json()["results"]["batch-failed"]["status"] == "error"
+    assert not os.path.exists(os.path.join(src_app.PROCESSED_JOBS_DIR, "batch-failed.json"))
+
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    data["deliveries"][0]["encrypted_results"] = [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]
+    second = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    assert second.get_json()["results"]["batch-failed"]["status"] == "success"
+
+
+# Test job ids that can't name an outcome file are rejected
+def test_submit_geofence_results_batch_invalid_job_id(client):
+    data = {
+        "deliveries": [{"job_id": "../batch", "system": "prop", "encrypted_results": []}],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert not os.path.exists(src_app.PROCESSED_JOBS_DIR)
+
+
+# Test the /submit-geofence-results-batch API endpoint rejects a batch for a different public key
+def test_submit_geofence_results_batch_public_key_mismatch(client):
+    data = {
+        "deliveries": [{"job_id": "batch-mismatch", "system": "prop", "encrypted_results": []}],
+        "public_key_n": TEST_PUBLIC_KEY_N
+    }
+
+    response = client.post("/submit-geofence-results-batch", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Public key mismatch. Encryption was not done with the correct public key."
+
+
+# Test the /submit-geofence-results-fixes API endpoint processes several timestamped fixes and reports each fix's outcome in the order sent
+def test_submit_geofence_results_fixes_success(client):
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    encrypted_results = [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]
+
+    # Prepare fixes sent out of order, one of them with invalid results
+    data = {
+        "system": "prop",
+        "fixes": [
+            {"timestamp": 1700000002.5, "encrypted_results": encrypted_results},
+            {"timestamp": 1700000001, "encrypted_results": [{"ciphertext": "invalid"}]},
+            {"timestamp": 1700000000, "encrypted_results": encrypted_results}
+        ],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-results-fixes", data=json.dumps(data), content_type="application/json")
+
+    # The fixes are accepted, and the outcome of each fix is reported with its timestamp
+    assert response.status_code == 200
+    fixes = response.get_json()["fixes"]
+    assert [fix["timestamp"] for fix in fixes] == [1700000002.5, 1700000001, 1700000000]
+    assert [fix["status"] for fix in fixes] == ["success", "error", "success"]
+
+
+# Test the /submit-geofence-results-fixes API endpoint rejects fixes without timestamps
+def test_submit_geofence_results_fixes_missing_timestamp(client):
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    data = {
+        "system": "ref",
+        "fixes": [{"encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}]}],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-results-fixes", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "error"
+
+
+# Test the /submit-geofence-results-fixes API endpoint rejects fixes for a different public key
+def test_submit_geofence_results_fixes_public_key_mismatch(client):
+    data = {
+        "system": "prop",
+        "fixes": [{"timestamp": 1700000000, "encrypted_results": []}],
+        "public_key_n": TEST_PUBLIC_KEY_N
+    }
+
+    response = client.post("/submit-geofence-results-fixes", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Public key mismatch. Encryption was not done with the correct public key."
+
+
+# Test comparing results against thresholds gives the same outcome and distances as computing every distance
+@pytest.mark.parametrize("system", ["ref", "prop"])
+def test_evaluate_geofence_results_matches_distances(system):
+    rng = np.random.default_rng(21)
+    distances = np.concatenate([rng.uniform(0, 400, 500), [0, 50, 100, 150, 20000000]])
+    radii = rng.choice([50, 100, 150], len(distances))
+    radii[-4:] = [50, 100, 150, 100]
+
+    # Results as the geofencing service computes them: a = sin²(d / 2R) for 'ref' and 2a for 'prop'
+    values = src_app.HAVERSINE_SCALE[system] * np.sin(distances / (2 * src_app.earth_radius)) ** 2
+
+    results, result_distances = src_app.evaluate_geofence_results(system, values.tolist(), radii.tolist(), distances=True)
+
+    assert list(results) == [1 if distance <= r else 0 for distance, r in zip(result_distances, radii)]
+    assert np.allclose(result_distances, distances, atol=1e-6)
+
+    # Without radii, every result is compared against the default radius
+    assert list(src_app.evaluate_geofence_results(system, values)) == list((result_distances <= src_app.radius).astype(int))
+
+
+# Test results outside the range of haversine values, or with radii for a different number of geofences, fail to evaluate
+@pytest.mark.parametrize("values, radii", [([-0.5], None), ([2.5], None), ([float("nan")], None), ([0.1, 0.2], [100, 100, 100])])
+def test_evaluate_geofence_results_invalid(values, radii):
+    assert src_app.evaluate_geofence_results("prop", values, radii) is None
+
+
+# Test the /submit-geofence-result-prop API endpoint compares every result against its own geofence's radius and reports distances when asked
+def test_submit_geofence_result_prop_radii_and_distances(client, capsys):
+    # Results of two geofences 75 m away
+    encrypted_result = public_key.encrypt(2 * math.sin(75 / (2 * src_app.earth_radius)) ** 2)
+    data = {
+        "encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}] * 2,
+        "public_key_fingerprint": src_app.public_key_fingerprint,
+        "distances": True
+    }
+
+    # Inside only when one of the geofences has a radius over 75 m
+    outcomes = []
+    for radii in ([50, 100], [50, 50], 100):
+        response = client.post("/submit-geofence-result-prop", data=json.dumps(dict(data, radii=radii)), content_type="application/json")
+        assert response.status_code == 200
+        assert response.get_json()["distances"] == [75.0, 75.0]
+        outcomes.append("inside" if "User is inside the geofence." in capsys.readouterr().out else "outside")
+
+    assert outcomes == ["inside", "outside", "inside"]
+
+    # Distances are only reported when asked for
+    response = client.post("/submit-geofence-result-prop", data=json.dumps(dict(data, distances=False)), content_type="application/json")
+    assert "distances" not in response.get_json()
+
+
+# Test the /submit-geofence-result-ref API endpoint rejects radii that aren't positive numbers
+@pytest.mark.parametrize("radii", [0, -10, "100", [100, None], []])
+def test_submit_geofence_result_ref_invalid_radii(client, radii):
+    encrypted_result = public_key.encrypt(1.1672744938776433e-15)
+    data = {
+        "encrypted_results": [{"ciphertext": encrypted_result.ciphertext(), "exponent": encrypted_result.exponent}],
+        "public_key_fingerprint": src_app.public_key_fingerprint,
+        "radii": radii
+    }
+
+    response = client.post("/submit-geofence-result-ref", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "'radii' must be a positive number or a list of one per geofence"
+
+
+# Results of six geofences for a user 75 m from the fifth, and the radii that put the user inside only that one
+def short_circuit_results():
+    values = [2 * math.sin(distance / (2 * src_app.earth_radius)) ** 2 for distance in [900, 500, 300, 250, 75, 1200]]
+    encrypted = [public_key.encrypt(value) for value in values]
+    return [{"ciphertext": result.ciphertext(), "exponent": result.exponent} for result in encrypted]
+
+
+# Test short-circuit evaluation decrypts in priority order, stops at the first geofence the user is inside, and then
+# decrypts the geofence last found first
+def test_submit_geofence_result_prop_short_circuit(client):
+    data = {
+        "encrypted_results": short_circuit_results(),
+        "public_key_fingerprint": src_app.public_key_fingerprint,
+        "any_inside": True,
+        "generation": 1001
+    }
+
+    def decryptions(**options):
+        response = client.post("/submit-geofence-result-prop", data=json.dumps(dict(data, **options)), content_type="application/json")
+        assert response.status_code == 200
+        return response.get_json()["decryptions"]
+
+    # In geofence order the hit is the fifth ciphertext, and a carer-given priority goes straight to it
+    assert decryptions(recent_hits_first=False) == 5
+    assert decryptions(recent_hits_first=False, priority=[4, 0]) == 1
+
+    # The hit is remembered for this generation only
+    assert decryptions() == 1
+    assert decryptions(generation=1002) == 5
+
+    # Outside every geofence, every result is decrypted
+    assert decryptions(radii=50) == 6
+
+    # Without 'any_inside', or when distances are asked for, every result is decrypted as before
+    response = client.post("/submit-geofence-result-prop", data=json.dumps(dict(data, any_inside=False)), content_type="application/json")
+    assert "decryptions" not in response.get_json()
+    response = client.post("/submit-geofence-result-prop", data=json.dumps(dict(data, distances=True)), content_type="application/json")
+    assert len(response.get_json()["distances"]) == 6
+
+
+# Test short-circuit evaluation of packed results stops at the pack holding the first geofence the user is inside
+def test_submit_geofence_results_fixes_short_circuit_packed(client):
+    slot_bits = 70
+    values = [2 * math.sin(distance / (2 * src_app.earth_radius)) ** 2 for distance in [900, 500, 300, 250, 75, 1200]]
+    packs = []
+    for pack in (values[:2], values[2:4], values[4:]):
+        encodings = [paillier_engine.encode(public_key, value) for value in pack]
+        plaintext = sum((paillier_engine.signed_mantissa(encoding) + (1 << (slot_bits - 1))) << (k * slot_bits) for k, encoding in enumerate(encodings))
+        packs.append({"ciphertext": int(paillier_engine.raw_encrypt_unobfuscated(public_key, plaintext)), "exponent": encodings[0].exponent, "slots": len(pack), "slot_bits": slot_bits})
+
+    data = {
+        "system": "prop",
+        "fixes": [{"timestamp": 1700000000, "encrypted_results": packs}, {"timestamp": 1700000001, "encrypted_results": packs}],
+        "packed": True,
+        "any_inside": True,
+        "generation": 1003,
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-results-fixes", data=json.dumps(data), content_type="application/json")
+
+    # The first fix decrypts every pack up to the third, the second goes straight to it
+    assert response.status_code == 200
+    assert [fix["decryptions"] for fix in response.get_json()["fixes"]] == [3, 1]
+
+
+# Test the /submit-geofence-result-ref API endpoint rejects a priority that isn't a list of result positions
+def test_submit_geofence_result_ref_invalid_priority(client):
+    data = {
+        "encrypted_results": short_circuit_results(),
+        "public_key_fingerprint": src_app.public_key_fingerprint,
+        "any_inside": True,
+        "priority": [1, -2]
+    }
+
+    response = client.post("/submit-geofence-result-ref", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "'priority' must be a list of result positions"
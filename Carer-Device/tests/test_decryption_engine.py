@@ -0,0 +1,125 @@
+import pytest
+import json
+import threading
+from phe import paillier
+import paillier_engine
+import decryption_engine
+import src.app as src_app
+from src.app import app, public_key, private_key
+
+# Haversine intermediate values to encrypt, as the geofencing service would send for five geofences
+TEST_VALUES = [1.1672744938776433e-15, 0.25, 1.0, 1.9999, 0.000123]
+
+
+# Pytest fixture to set up the test client for Flask app
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+# Pytest fixture to stop any decryption pool a test started
+@pytest.fixture(autouse=True)
+def stop_pool():
+    yield
+    decryption_engine.stop_decryption_pool()
+
+
+def encrypted_results(values):
+    encrypted = [public_key.encrypt(value) for value in values]
+    return [{"ciphertext": result.ciphertext(), "exponent": result.exponent} for result in encrypted]
+
+
+# Test the engine decrypts raw ciphertexts to the plaintexts phe does, serially and in chunks over a pool
+@pytest.mark.parametrize("workers, chunk_size", [(0, None), (2, 2), (2, 100)])
+def test_decrypt_ciphertexts_matches_phe(workers, chunk_size):
+    encrypted = [public_key.encrypt(value) for value in TEST_VALUES]
+
+    plaintexts = decryption_engine.decrypt_ciphertexts(private_key, [result.ciphertext() for result in encrypted], workers, chunk_size)
+
+    assert plaintexts == [private_key.raw_decrypt(result.ciphertext()) for result in encrypted]
+    assert [paillier_engine.decode_plaintext(public_key, plaintext, result.exponent) for plaintext, result in zip(plaintexts, encrypted)] == \
+        [private_key.decrypt(result) for result in encrypted]
+
+
+# Test the pool is started once, and replaced when the key it holds changes
+def test_decryption_pool_follows_key():
+    pool = decryption_engine.start_decryption_pool(private_key, 1)
+    assert decryption_engine.start_decryption_pool(private_key, 1) is pool
+
+    other_public_key, other_private_key = paillier.generate_paillier_keypair(n_length=512)
+    encrypted = other_public_key.encrypt(0.5)
+    plaintexts = decryption_engine.decrypt_ciphertexts(other_private_key, [encrypted.ciphertext()] * 3, 1, 1)
+
+    assert decryption_engine.decryption_pool is not pool
+    assert decryption_engine.decryption_pool_key == other_public_key.n
+    assert plaintexts == [other_private_key.raw_decrypt(encrypted.ciphertext())] * 3
+
+    # A pool process refuses ciphertexts of a key it doesn't hold
+    with pytest.raises(ValueError):
+        decryption_engine.decryption_pool.submit(decryption_engine.decrypt_chunk, public_key.n, [encrypted.ciphertext()]).result()
+
+
+# Test request threads starting the pool at once share one pool, whose processes come from the fork server rather than
+# being forked from the threaded worker (they would inherit any key file lock held at the time)
+def test_decryption_pool_started_once_by_concurrent_threads():
+    barrier = threading.Barrier(4)
+    pools = []
+
+    def start():
+        barrier.wait()
+        pools.append(decryption_engine.start_decryption_pool(private_key, 1))
+
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(pools) == 4 and all(pool is pools[0] for pool in pools)
+    assert pools[0]._mp_context.get_start_method() == "forkserver"
+
+
+# Test the endpoints decrypt through the pool when one is configured, packed or not
+@pytest.mark.parametrize("packed", [False, True])
+def test_submit_geofence_result_prop_decryption_pool(client, monkeypatch, packed):
+    monkeypatch.setattr(decryption_engine, "DECRYPTION_WORKERS", 2)
+    monkeypatch.setattr(decryption_engine, "DECRYPTION_CHUNK_SIZE", 1)
+
+    if packed:
+        # Two ciphertexts of three and two results, packed as the geofencing service packs them
+        slot_bits = 70
+        results = []
+        for values in (TEST_VALUES[:3], TEST_VALUES[3:]):
+            mantissas = [paillier_engine.encode(public_key, value) for value in values]
+            plaintext = sum((paillier_engine.signed_mantissa(mantissa) + (1 << (slot_bits - 1))) << (k * slot_bits) for k, mantissa in enumerate(mantissas))
+            ciphertext = paillier_engine.raw_encrypt_unobfuscated(public_key, plaintext)
+            results.append({"ciphertext": int(ciphertext), "exponent": mantissas[0].exponent, "slots": len(values), "slot_bits": slot_bits})
+    else:
+        results = encrypted_results(TEST_VALUES)
+
+    data = {
+        "encrypted_results": results,
+        "public_key_fingerprint": src_app.public_key_fingerprint,
+        "packed": packed,
+        "distances": True
+    }
+
+    response = client.post("/submit-geofence-result-prop", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 200
+    assert len(response.get_json()["distances"]) == len(TEST_VALUES)
+    assert decryption_engine.decryption_pool is not None
+
+
+# Test ciphertexts that aren't integers are rejected before anything is decrypted
+def test_submit_geofence_result_ref_invalid_ciphertext(client):
+    data = {
+        "encrypted_results": [{"ciphertext": "123", "exponent": -14}, {"ciphertext": 1.5, "exponent": -14}],
+        "public_key_fingerprint": src_app.public_key_fingerprint
+    }
+
+    response = client.post("/submit-geofence-result-ref", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Invalid encrypted results"
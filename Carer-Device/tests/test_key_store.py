@@ -0,0 +1,235 @@
+import pytest
+import json
+import os
+import stat
+import time
+from phe import paillier
+import paillier_engine
+import key_store
+import src.app as src_app
+from src.app import app
+
+PASSPHRASE = "correct horse battery staple"
+
+
+# Pytest fixture to set up the test client for Flask app
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+# Pytest fixture to generate small keys without a background pool filler, and to restore the keys the app serves afterwards
+@pytest.fixture(autouse=True)
+def carer_keys(monkeypatch):
+    monkeypatch.setattr(key_store, "KEY_SIZE", 512)
+    monkeypatch.setattr(key_store, "KEY_POOL_SIZE", 0)
+    original_keys = dict(key_store.carer_keys)
+    yield key_store.carer_keys
+    key_store.carer_keys.update(original_keys)
+    src_app.set_current_key()
+
+
+def small_key():
+    return key_store.generate_private_key(512)
+
+
+# Test a key file decrypts back to exactly the keys it was written with, and is readable by its owner only
+def test_key_file_round_trip(tmp_path):
+    path = str(tmp_path / "carer_key.enc")
+    keys = {'current': small_key(), 'previous': small_key(), 'retired_at': 1700000000.0, 'pool': [small_key(), small_key()]}
+
+    key_store.write_key_file(path, keys, PASSPHRASE)
+    loaded, file_id = key_store.read_key_file(path, PASSPHRASE)
+
+    for name in ['current', 'previous']:
+        assert loaded[name] == keys[name]
+    assert loaded['pool'] == keys['pool']
+    assert loaded['retired_at'] == keys['retired_at']
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    # The primes aren't stored in the clear
+    with open(path, "rb") as f:
+        assert str(keys['current'].p) not in f.read().decode()
+
+
+# Test a wrong passphrase, an altered file and a file that isn't a key file are all rejected
+@pytest.mark.parametrize("corruption", ["passphrase", "ciphertext", "header", "not a key file"])
+def test_key_file_rejects_invalid_files(tmp_path, corruption):
+    path = str(tmp_path / "carer_key.enc")
+    key_store.write_key_file(path, {'current': small_key(), 'previous': None, 'retired_at': None, 'pool': []}, PASSPHRASE)
+
+    with open(path) as f:
+        document = json.load(f)
+    if corruption == "ciphertext":
+        document['ciphertext'] = ("0" if document['ciphertext'][0] != "0" else "1") + document['ciphertext'][1:]
+    elif corruption == "header":
+        document['kdf']['salt'] = "00" * 16     # Derives another key, and the header is authenticated anyway
+    elif corruption == "not a key file":
+        document = {"geofences": []}
+    with open(path, "w") as f:
+        json.dump(document, f)
+
+    with pytest.raises(ValueError):
+        key_store.read_key_file(path, "wrong passphrase" if corruption == "passphrase" else PASSPHRASE)
+
+
+# Test the first start generates and saves a key, and later starts load the same key instead of generating one
+def test_load_carer_keys_persists_key(tmp_path):
+    path = str(tmp_path / "carer_key.enc")
+
+    first = key_store.load_carer_keys(path, PASSPHRASE)
+    second = key_store.load_carer_keys(path, PASSPHRASE)
+
+    assert os.path.exists(path)
+    assert second == first
+    assert key_store.carer_keys['path'] == path
+
+    # A key file that can't be decrypted isn't replaced, which would lose its key
+    with pytest.raises(ValueError):
+        key_store.load_carer_keys(path, "wrong passphrase")
+    assert key_store.read_key_file(path, PASSPHRASE)[0]['current'] == first
+
+
+# Test without a passphrase a key is generated and nothing is saved, as before
+def test_load_carer_keys_without_passphrase(tmp_path):
+    path = str(tmp_path / "carer_key.enc")
+
+    private_key = key_store.load_carer_keys(path, "")
+
+    assert not os.path.exists(path)
+    assert key_store.carer_keys['path'] is None
+    assert private_key.public_key.n.bit_length() == 512
+
+
+# Test the pool is filled to its size, and a rotation takes its next key and accepts the old one during the grace period
+def test_rotation_uses_pool_and_grace_period(tmp_path, monkeypatch):
+    path = str(tmp_path / "carer_key.enc")
+    old_key = key_store.load_carer_keys(path, PASSPHRASE)
+
+    assert key_store.top_up_key_pool(2) is True
+    assert key_store.top_up_key_pool(2) is True
+    assert key_store.top_up_key_pool(2) is False
+    pool = key_store.read_key_file(path, PASSPHRASE)[0]['pool']
+    assert len(pool) == 2
+
+    new_key, pooled = key_store.rotate_carer_key()
+
+    assert pooled is True
+    assert new_key == pool[0]
+    assert key_store.carer_keys['current'] == new_key
+    assert key_store.read_key_file(path, PASSPHRASE)[0]['pool'] == pool[1:]
+
+    # Payloads for either key are matched to their key while the old key is in its grace period
+    for private_key in [old_key, new_key]:
+        data = {"public_key_fingerprint": paillier_engine.key_fingerprint(private_key.public_key.n)}
+        assert key_store.private_key_for_payload(data) == private_key
+
+    monkeypatch.setattr(key_store, "KEY_GRACE_PERIOD", 0)
+    time.sleep(0.01)
+    assert key_store.accepted_private_keys() == [new_key]
+    assert key_store.private_key_for_payload({"public_key_n": old_key.public_key.n}) is None
+
+
+# Test a key file rotated by another gunicorn worker is served from this worker's next sync
+def test_rotated_key_file_is_reloaded(tmp_path):
+    path = str(tmp_path / "carer_key.enc")
+    old_key = key_store.load_carer_keys(path, PASSPHRASE)
+
+    rotated_key = small_key()
+    time.sleep(0.01)    # A new modification time, as the rename gives the file
+    key_store.write_key_file(path, {'current': rotated_key, 'previous': old_key, 'retired_at': time.time(), 'pool': []}, PASSPHRASE)
+
+    key_store.sync_carer_keys()
+
+    assert key_store.carer_keys['current'] == rotated_key
+    assert key_store.carer_keys['previous'] == old_key
+
+
+# Test the rotation endpoint switches the key the carer publishes, while results for the old key are still decrypted
+def test_rotate_key_endpoint(client, tmp_path):
+    path = str(tmp_path / "carer_key.enc")
+    old_key = key_store.load_carer_keys(path, PASSPHRASE)
+    key_store.top_up_key_pool(1)
+    src_app.set_current_key()
+
+    response = client.post("/rotate-key")
+
+    assert response.status_code == 200
+    assert response.get_json()["pooled"] is True
+    new_n = response.get_json()["public_key_n"]
+    assert new_n != old_key.public_key.n
+
+    public_key_data = client.get("/get-public-key").get_json()
+    assert public_key_data["public_key_n"] == new_n
+    assert public_key_data["accepted_public_keys"] == [new_n, old_key.public_key.n]
+
+    # A location encrypted for the old key before the rotation, at the geofence centre
+    encrypted = old_key.public_key.encrypt(1.1672744938776433e-15)
+    data = {
+        "encrypted_results": [{"ciphertext": encrypted.ciphertext(), "exponent": encrypted.exponent}],
+        "public_key_fingerprint": paillier_engine.key_fingerprint(old_key.public_key.n)
+    }
+
+    response = client.post("/submit-geofence-result-ref", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 200
+
+
+# Test the rotation endpoint requires the admin token when there is one
+def test_rotate_key_endpoint_requires_token(client, monkeypatch):
+    monkeypatch.setattr(src_app, "ADMIN_TOKEN", "secret")
+    current_key = key_store.carer_keys['current']
+
+    response = client.post("/rotate-key", headers={"Authorization": "Bearer wrong"})
+
+    assert response.status_code == 401
+    assert key_store.carer_keys['current'] is current_key
+
+
+# Test the rotation endpoint refuses to rotate a key that isn't kept in a key file, which only one worker would see
+def test_rotate_key_endpoint_requires_key_file(client):
+    current_key = key_store.load_carer_keys(None, "")
+    src_app.set_current_key()
+
+    response = client.post("/rotate-key")
+
+    assert response.status_code == 409
+    assert response.get_json()["message"] == "Key rotation needs a key file shared by the carer's workers, set CARER_KEY_PASSPHRASE"
+    assert key_store.carer_keys['current'] is current_key
+
+
+# Test a key file saved with another KEY_SIZE is moved to a key of KEY_SIZE on startup, keeping the old key for its grace period
+def test_load_carer_keys_rotates_to_key_size(tmp_path, monkeypatch):
+    path = str(tmp_path / "carer_key.enc")
+    old_key = key_store.load_carer_keys(path, PASSPHRASE)
+    key_store.top_up_key_pool(1)
+
+    monkeypatch.setattr(key_store, "KEY_SIZE", 640)
+    new_key = key_store.load_carer_keys(path, PASSPHRASE)
+
+    assert key_store.key_bits(new_key) == 640
+    assert key_store.carer_keys['previous'] == old_key
+    # The pooled 512-bit key isn't used for, or kept after, the change of size
+    assert key_store.read_key_file(path, PASSPHRASE)[0]['pool'] == []
+
+
+# Test the rotation endpoint rotates to the key size it is given, and rejects sizes below MIN_KEY_SIZE
+def test_rotate_key_endpoint_key_size(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(paillier_engine, "MIN_KEY_SIZE", 512)
+    old_key = key_store.load_carer_keys(str(tmp_path / "carer_key.enc"), PASSPHRASE)
+    src_app.set_current_key()
+
+    response = client.post("/rotate-key", data=json.dumps({"key_size": 640}), content_type="application/json")
+
+    assert response.status_code == 200
+    assert response.get_json()["key_size"] == 640
+    assert client.get("/get-public-key").get_json()["key_size"] == 640
+    assert key_store.carer_keys['previous'] == old_key
+
+    for key_size in [256, "1024", 1001]:
+        response = client.post("/rotate-key", data=json.dumps({"key_size": key_size}), content_type="application/json")
+
+        assert response.status_code == 400
+        assert response.get_json()["message"] == "'key_size' must be a multiple of 8 bits of at least 512"
+        assert client.get("/get-public-key").get_json()["key_size"] == 640
@@ -6,6 +6,7 @@ import stats
 import argparse
 import pandas as pd
 import numpy as np
+import paillier_engine
 
 
 def generate_user_points(center_latitude, center_longitude, radius, earth_radius, num_points=30):
@@ -43,8 +44,12 @@ def generate_user_points(center_latitude, center_longitude, radius, earth_radius
     return points_inside, points_outside, points_edge
 
 
+def haversine_intermediate(user_latitude, user_longitude, center_latitude, center_longitude):
+    return math.sin((user_latitude - center_latitude)/2)**2 + math.cos(user_latitude) * math.cos(center_latitude) * math.sin((user_longitude - center_longitude)/2)**2
+
+
 def haversine(user_latitude, user_longitude, center_latitude, center_longitude, earth_radius):
-    a = math.sin((user_latitude - center_latitude)/2)**2 + math.cos(user_latitude) * math.cos(center_latitude) * math.sin((user_longitude - center_longitude)/2)**2
+    a = haversine_intermediate(user_latitude, user_longitude, center_latitude, center_longitude)
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     distance = earth_radius * c
     return distance
@@ -56,8 +61,9 @@ def evaluate_geofence(user_latitude, user_longitude, center_latitude, center_lon
     return 1 if distance <= radius else 0
 
 
-def initialize_keys():
-    public_key, private_key = paillier.generate_paillier_keypair()
+def initialize_keys(key_size=None):
+    # Keys of the carer's size (KEY_SIZE) unless another size is given
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=key_size or paillier_engine.KEY_SIZE)
     return public_key, private_key
 
 # Reference encrypted haversine system
@@ -66,10 +72,10 @@ def ref_precompute_user_terms(user_latitude, user_longitude, public_key):
     # Terms derived from User point (original, squared, combined, encrypted where applicable)
     alpha = math.cos(user_latitude / 2)
     alpha_sq = alpha**2
-    alpha_sq_enc = public_key.encrypt(alpha_sq)
+    alpha_sq_enc = paillier_engine.encrypt(public_key, alpha_sq)
     gamma = math.sin(user_latitude / 2)
     gamma_sq = gamma**2
-    gamma_sq_enc = public_key.encrypt(gamma_sq)
+    gamma_sq_enc = paillier_engine.encrypt(public_key, gamma_sq)
     zeta = math.cos(user_latitude)
     theta = math.sin(user_longitude / 2)
     theta_sq = theta**2
@@ -77,16 +83,16 @@ def ref_precompute_user_terms(user_latitude, user_longitude, public_key):
     mu_sq = mu**2
 
     alpha_gamma_product_A = alpha * gamma            
-    alpha_gamma_product_A_enc = public_key.encrypt(alpha_gamma_product_A)       # A-specific part for term2
+    alpha_gamma_product_A_enc = paillier_engine.encrypt(public_key, alpha_gamma_product_A)       # A-specific part for term2
 
     zeta_theta_sq_product_A  = zeta * theta_sq          
-    zeta_theta_sq_product_A_enc = public_key.encrypt(zeta_theta_sq_product_A)   # A-specific part for term4
+    zeta_theta_sq_product_A_enc = paillier_engine.encrypt(public_key, zeta_theta_sq_product_A)   # A-specific part for term4
 
     zeta_theta_mu_product_A = zeta * theta * mu
-    zeta_theta_mu_product_A_enc = public_key.encrypt(zeta_theta_mu_product_A)   # A-specific part for term5
+    zeta_theta_mu_product_A_enc = paillier_engine.encrypt(public_key, zeta_theta_mu_product_A)   # A-specific part for term5
 
     zeta_mu_sq_product_A = zeta * mu_sq             
-    zeta_mu_sq_product_A_enc = public_key.encrypt(zeta_mu_sq_product_A)         # A-specific part for term6
+    zeta_mu_sq_product_A_enc = paillier_engine.encrypt(public_key, zeta_mu_sq_product_A)         # A-specific part for term6
 
     # Return all precomputed terms as a dictionary
     return {
@@ -123,21 +129,24 @@ def ref_calculate_intermediate_haversine_value(user_precomputed, center_latitude
     eta_lambda_sq_product_B = eta * lambda_sq       # B-specific part for term4
     eta_lambda_nu_product_B = eta * lambda_ * nu    # B-specific part for term5
     eta_nu_sq_product_B = eta * nu_sq               # B-specific part for term6
+
+    public_key = alpha_sq_enc.public_key
+
+    # B-terms encoded like the geofencing service, with the -2 factors of term2 and term5 folded in
+    coefficients = [paillier_engine.encode(public_key, term) for term in (beta_sq, -2 * beta_delta_product_B, delta_sq, eta_lambda_sq_product_B, -2 * eta_lambda_nu_product_B, eta_nu_sq_product_B)]
     
-    # Compute haversine intermediate value
-    term1 = alpha_sq_enc * beta_sq
-    term2 = -2 * (alpha_gamma_product_A_enc * beta_delta_product_B)
-    term3 = gamma_sq_enc * delta_sq
-    term4 = zeta_theta_sq_product_A_enc * eta_lambda_sq_product_B
-    term5 = -2 * (zeta_theta_mu_product_A_enc * eta_lambda_nu_product_B)
-    term6 = zeta_mu_sq_product_A_enc * eta_nu_sq_product_B
-    haversine_intermediate = term1 + term2 + term3 + term4 + term5 + term6
+    # Compute haversine intermediate value (term1 + ... + term6) with the geofencing service's multi-exponentiation kernel
+    ciphertexts, exponents, multiplications = paillier_engine.encrypted_inner_products(
+        (alpha_sq_enc, alpha_gamma_product_A_enc, gamma_sq_enc, zeta_theta_sq_product_A_enc, zeta_theta_mu_product_A_enc, zeta_mu_sq_product_A_enc),
+        [coefficients]
+    )
+    haversine_intermediate = paillier_engine.encrypted_number(public_key, ciphertexts[0], exponents[0])
 
     return haversine_intermediate
 
 
 def ref_evaluate_geofence_encrypted(encrypted_result, radius, earth_radius, private_key):
-    haversine_intermediate = private_key.decrypt(encrypted_result)
+    haversine_intermediate = paillier_engine.decrypt(private_key, encrypted_result)
 
     central_angle = 2 * math.atan2(math.sqrt(haversine_intermediate), math.sqrt(1 - haversine_intermediate))
 
@@ -152,9 +161,9 @@ def ref_evaluate_geofence_encrypted(encrypted_result, radius, earth_radius, priv
 # Proposed encrypted haversine system
 def prop_precompute_user_terms(user_latitude, user_longitude, public_key):
     # Terms derived from User point
-    c1 = public_key.encrypt(math.sin(user_latitude))
-    c2 = public_key.encrypt(math.cos(user_latitude) * math.cos(user_longitude))
-    c3 = public_key.encrypt(math.cos(user_latitude) * math.sin(user_longitude))
+    c1 = paillier_engine.encrypt(public_key, math.sin(user_latitude))
+    c2 = paillier_engine.encrypt(public_key, math.cos(user_latitude) * math.cos(user_longitude))
+    c3 = paillier_engine.encrypt(public_key, math.cos(user_latitude) * math.sin(user_longitude))
 
     # Return all precomputed terms as a dictionary
     return {
@@ -170,13 +179,19 @@ def prop_calculate_intermediate_haversine_value(user_precomputed, center_latitud
     c2 = user_precomputed['c2']
     c3 = user_precomputed['c3']
 
-    # Compute haversine intermediate value
-    a = 1 - c1 * math.sin(center_latitude) - c2 * math.cos(center_latitude) * math.cos(center_longitude) - c3 * math.cos(center_latitude) * math.sin(center_longitude)
+    public_key = c1.public_key
+
+    # Centre terms encoded like the geofencing service, pre-negated so 1 - c·B becomes c·(-B) + 1
+    coefficients = [paillier_engine.encode(public_key, term) for term in (-math.sin(center_latitude), -math.cos(center_latitude) * math.cos(center_longitude), -math.cos(center_latitude) * math.sin(center_longitude))]
+
+    # Compute haversine intermediate value with the geofencing service's multi-exponentiation kernel
+    ciphertexts, exponents, multiplications = paillier_engine.encrypted_inner_products((c1, c2, c3), [coefficients], constant=1)
+    a = paillier_engine.encrypted_number(public_key, ciphertexts[0], exponents[0])
     return a
 
 
 def prop_evaluate_geofence_encrypted(encrypted_result, radius, earth_radius, private_key):
-    haversine_intermediate = private_key.decrypt(encrypted_result)
+    haversine_intermediate = paillier_engine.decrypt(private_key, encrypted_result)
 
     distance = 2 * earth_radius * math.asin(math.sqrt(haversine_intermediate / 2))
     # print(f"Distance from geofence centre: {round(distance, 2)} meters")
@@ -187,7 +202,7 @@ def prop_evaluate_geofence_encrypted(encrypted_result, radius, earth_radius, pri
 # End of Proposed encrypted haversine system
 
 
-def security_overhead_exeperiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, public_key, private_key, num_repetitions_mean):
+def security_overhead_exeperiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, public_key, private_key, num_repetitions_mean, key_sizes=None):
 
     tableResults = []
     all_raw_data_ref = []
@@ -319,12 +334,107 @@ def security_overhead_exeperiment(user_latitude, user_longitude, center_latitude
 
     print(f"Security overhead results saved to Results/security_overhead.csv\n")
 
+    # How each stage and the payloads scale with the key size, for each number of queries
+    if key_sizes:
+        key_size_security_experiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, num_repetitions_mean, key_sizes, encryption_counts)
+
+
+def key_size_security_experiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, num_repetitions_mean, key_sizes, encryption_counts):
+
+    tableResults = []
+    all_raw_data_ref = []
+    all_raw_data_prop = []
+
+    # Output files with temporary data: the encryption, computation and decryption runtime of each repetition
+    files = ["Outputs/securityEncOutRef.txt", "Outputs/securityEncOutProp.txt", "Outputs/securityCompOutRef.txt", "Outputs/securityCompOutProp.txt",
+             "Outputs/securityDecOutRef.txt", "Outputs/securityDecOutProp.txt", "Outputs/securityRunOutRef.txt", "Outputs/securityRunOutProp.txt"]
+    metrics = ["Encryption (s)", "Computation (s)", "Decryption (s)", "Runtime (s)"]
+
+    for key_size in key_sizes:
+        public_key, private_key = initialize_keys(key_size)
+
+        # Every ciphertext is a number mod n^2, so the payload of a query only depends on the key size: the user's
+        # terms (6 reference, 3 proposed) sent to the geofencing service and the result sent on to the carer
+        ciphertext_bytes = (public_key.nsquare.bit_length() + 7) // 8
+
+        for num_encryptions in encryption_counts:
+
+            # Clear output files of temporary data
+            for file_name in files:
+                with open(file_name, 'w'):
+                    pass
+
+            # Repeat for average
+            for i in range(num_repetitions_mean):
+                stage_runtimes = [0.0] * 6
+
+                for i in range(num_encryptions):
+                    start = time.time()
+                    user_precomputed_ref = ref_precompute_user_terms(user_latitude, user_longitude, public_key)
+                    encrypted = time.time()
+                    encrypted_result_ref = ref_calculate_intermediate_haversine_value(user_precomputed_ref, center_latitude, center_longitude)
+                    computed = time.time()
+                    ref_evaluate_geofence_encrypted(encrypted_result_ref, radius, earth_radius, private_key)
+                    decrypted = time.time()
+                    stage_runtimes[0] += encrypted - start
+                    stage_runtimes[2] += computed - encrypted
+                    stage_runtimes[4] += decrypted - computed
+
+                    start = time.time()
+                    user_precomputed_prop = prop_precompute_user_terms(user_latitude, user_longitude, public_key)
+                    encrypted = time.time()
+                    encrypted_result_prop = prop_calculate_intermediate_haversine_value(user_precomputed_prop, center_latitude, center_longitude)
+                    computed = time.time()
+                    prop_evaluate_geofence_encrypted(encrypted_result_prop, radius, earth_radius, private_key)
+                    decrypted = time.time()
+                    stage_runtimes[1] += encrypted - start
+                    stage_runtimes[3] += computed - encrypted
+                    stage_runtimes[5] += decrypted - computed
+
+                # Write each stage's runtime, and the total, to file
+                for file_name, runtime in zip(files, stage_runtimes + [stage_runtimes[0] + stage_runtimes[2] + stage_runtimes[4], stage_runtimes[1] + stage_runtimes[3] + stage_runtimes[5]]):
+                    with open(file_name, "a") as f:
+                        f.write(f"{(runtime)}\n")
+
+            # Load temporary security data
+            stages = [np.loadtxt(file_name, dtype=float) for file_name in files]
+            payload_ref = ciphertext_bytes * (6 + 1) * num_encryptions / 1024
+            payload_prop = ciphertext_bytes * (3 + 1) * num_encryptions / 1024
+
+            all_raw_data_ref.append(np.column_stack((np.full(len(stages[0]), key_size), np.full(len(stages[0]), num_encryptions), stages[0], stages[2], stages[4], stages[6], np.full(len(stages[0]), payload_ref))))
+            all_raw_data_prop.append(np.column_stack((np.full(len(stages[1]), key_size), np.full(len(stages[1]), num_encryptions), stages[1], stages[3], stages[5], stages[7], np.full(len(stages[1]), payload_prop))))
+
+            # Calculate staistics and present in table
+            security_stats = stats.main(files)
+
+            for i, metric in enumerate(metrics):
+                tableResults.append(
+                    [key_size if i == 0 else "", num_encryptions if i == 0 else "", metric,
+                    f"{round(security_stats[2*i]['Mean'], 3)} ± {round(security_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(security_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(security_stats[2*i]['95% Confidence Interval'][1], 3)})",
+                    f"{round(security_stats[2*i+1]['Mean'], 3)} ± {round(security_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(security_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(security_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+                )
+
+            # The payload isn't measured here: it is computed from the ciphertext size, hence its label
+            tableResults.append(["", "", "Payload, computed from ciphertext size (KB)", round(payload_ref, 3), round(payload_prop, 3)])
+
+    # Saves all the raw key size data
+    header = "Key Size,# of Queries,Runtime Encrypt,Runtime Compute,Runtime Decrypt,Total Runtime,Computed Payload (KB)"
+    np.savetxt('ExperimentsAllRawData/security_key_size_all_raw_data_ref.csv', np.vstack(all_raw_data_ref), delimiter=',', header=header, comments='')
+    np.savetxt('ExperimentsAllRawData/security_key_size_all_raw_data_prop.csv', np.vstack(all_raw_data_prop), delimiter=',', header=header, comments='')
+
+    head = ["Key Size", "Enc.", "Metric", "Ref. Alg.", "Prop. Alg."]
+    save_results(tableResults, head, "Results/security_overhead_key_sizes.csv")
+
+    print(f"Security overhead results by key size saved to Results/security_overhead_key_sizes.csv\n")
+
 
 def accuracy_experiment(center_latitude, center_longitude, center_latitude_float, center_longitude_float, radius, earth_radius, public_key, private_key, num_repetitions_mean):
 
     tableResults = []
     all_raw_data_ref = []
     all_raw_data_prop = []
+    encoding_errors_ref = []
+    encoding_errors_prop = []
 
     files = ["Outputs/accuracyRef.txt", "Outputs/accuracyProp.txt"]
     # Clear output files of temporary data
@@ -355,6 +465,11 @@ def accuracy_experiment(center_latitude, center_longitude, center_latitude_float
             encrypted_result_prop = prop_calculate_intermediate_haversine_value(user_precomputed_prop, center_latitude, center_longitude)
             system_result_prop = "Inside" if prop_evaluate_geofence_encrypted(encrypted_result_prop, radius, earth_radius, private_key) else "Outside"
 
+            # Error introduced by the Paillier encoding, against the plaintext intermediate value (proposed 'a' is twice the haversine one)
+            a = haversine_intermediate(user_latitude, user_longitude, center_latitude, center_longitude)
+            encoding_errors_ref.append(abs(paillier_engine.decrypt(private_key, encrypted_result_ref) - a))
+            encoding_errors_prop.append(abs(paillier_engine.decrypt(private_key, encrypted_result_prop) - 2 * a))
+
             # Check if both systems are correctly identifying if a point is inside/outside
             final_result_ref = "Correct" if ground_truth == system_result_ref else "Incorrect"
             final_result_prop = "Correct" if ground_truth == system_result_prop else "Incorrect"
@@ -422,6 +537,17 @@ def accuracy_experiment(center_latitude, center_longitude, center_latitude_float
         f"{round(accuracy_stats[1]['Mean'], 3)} ± {round(accuracy_stats[1]['Standard Deviation'], 3)} (95% CI: {round(accuracy_stats[1]['95% Confidence Interval'][0], 3)}, {round(accuracy_stats[1]['95% Confidence Interval'][1], 3)})"]
     )
 
+    # Check the encoding precision keeps the classification correct
+    encoding = f"fixed-point, exponent {paillier_engine.FIXED_POINT_EXPONENT}" if paillier_engine.FIXED_POINT_ENCODING else "float"
+    tableResults.append(
+        [f"Max Abs. Error ({encoding})", 
+        f"{max(encoding_errors_ref):.3e}", 
+        f"{max(encoding_errors_prop):.3e}"]
+    )
+
+    if accuracy_stats[0]['Mean'] < 100 or accuracy_stats[1]['Mean'] < 100:
+        print(f"Warning: accuracy below 100% with {encoding} encoding, consider a lower FIXED_POINT_EXPONENT")
+
     head = ["Metric", "Ref. Alg.", "Prop. Alg."]
     save_results(tableResults, head, "Results/accuracy.csv")
 
@@ -464,6 +590,14 @@ def parse_arguments():
         help="Number of repetitions to calculate mean"
     )
 
+    parser.add_argument(
+        "-ks", "--key-sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Key sizes (bits) to repeat the security overhead experiment for, e.g. 1024 2048 3072 (only used in security mode, results go to Results/security_overhead_key_sizes.csv)"
+    )
+
     return parser.parse_args()
 
 
@@ -489,7 +623,7 @@ def main():
     # Handle selected mode
     if args.mode == "security":
         # Quantify the additional runtime overhead introduced by encryption
-        security_overhead_exeperiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, public_key, private_key, num_repetitions_mean=args.repetitions)
+        security_overhead_exeperiment(user_latitude, user_longitude, center_latitude, center_longitude, radius, earth_radius, public_key, private_key, num_repetitions_mean=args.repetitions, key_sizes=args.key_sizes)
 
     elif args.mode == "accuracy":
         # Evaluate the correctness of the geofencing system in determining whether a point is inside or outside the geofence
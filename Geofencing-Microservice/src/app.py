@@ -2,17 +2,143 @@ from flask import Flask, jsonify, request
 from phe import paillier
 import requests
 import overpass
+import numpy as np
 import math
 import time
+import os
+import multiprocessing
+import threading
+import queue
+import collections
+import uuid
+import hmac
+import json
+import re
+import fcntl
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import paillier_engine
+import http_pool
+import geofence_snapshot
 
 
 app = Flask(__name__)
 
-# Global variable to store geofence point coordinates
+# Global variable to store the coordinates of the geofences that are evaluated (and their source ids), as views of the
+# geofence table's columns rather than lists
 geofence_coordinates = []
+geofence_ids = []
+
+# Per-geofence coefficient table, rebuilt whenever the geofence set changes, and the number of tables built so far
+# (each table's 'version', which tells pool processes whose cached encodings belong to which table)
+geofence_coefficients = None
+geofence_table_version = 0
+
+# The whole geofence table (ids, coordinates, coefficients, radius, group and active flag, inactive geofences included),
+# and its index by id, built on the first lookup
+geofence_table = None
+geofence_index = None
+
+# Geofence snapshot loaded at startup instead of querying Overpass, written whenever the geofences are fetched.
+# Where the current geofences came from ('snapshot', 'overpass', 'file' or None when set directly), and the snapshot file's
+# identity and generation when they came from one, so workers notice a snapshot replaced by another worker's refresh.
+# Every worker maps the same snapshot read-only, so the catalogue and its coefficients are held once however many
+# workers there are
+GEOFENCE_SNAPSHOT = os.environ.get("GEOFENCE_SNAPSHOT", "snapshots/geofences.snapshot")
+
+# Local GeoJSON, CSV or OSM XML file the geofences are imported from instead of Overpass (streamed into the snapshot),
+# optionally only the points with a tag ('key=value' or 'key')
+GEOFENCE_SOURCE_FILE = os.environ.get("GEOFENCE_SOURCE_FILE", "")
+GEOFENCE_SOURCE_TAG = os.environ.get("GEOFENCE_SOURCE_TAG", "") or None
+# Token admin requests that change the geofences must send as 'Authorization: Bearer <token>'. Without one the admin API
+# (and /geofences/refresh) refuses every request, as it can replace the catalogue and read files on the service
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+geofence_source = {'source': None, 'snapshot': None, 'file_id': None, 'built_at': None, 'generation': None}
+geofence_lock = threading.RLock()
+# Guards the per-key dicts of encoded coefficient rows, which request threads add keys to and evict keys from
+encoded_lock = threading.Lock()
+
+# Number of geofences from which per-request fixed-base tables for the user's ciphertexts pay for themselves
+FIXED_BASE_THRESHOLD = int(os.environ.get("FIXED_BASE_THRESHOLD", "16"))
+
+# Processes evaluating chunks of the geofence list in parallel (0 evaluates each request serially in its own worker)
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", "0"))
+
+# Default number of geofences per chunk, a request can ask for a different chunk size
+PARALLEL_CHUNK_SIZE = int(os.environ.get("PARALLEL_CHUNK_SIZE", "50"))
+
+# Largest magnitude of a haversine intermediate value ('a' is in [0, 1], the proposed 2a in [0, 2]), which sizes the slots
+# when several results are packed into one ciphertext
+PACKED_VALUE_BOUND = 2
+
+# Seconds a carer public key is trusted before it is fetched from the carer again
+KEY_REGISTRY_TTL = float(os.environ.get("KEY_REGISTRY_TTL", "300"))
+
+# Shortest time between two refreshes caused by unknown fingerprints, so bad requests can't flood the carer
+KEY_REGISTRY_MIN_REFRESH = float(os.environ.get("KEY_REGISTRY_MIN_REFRESH", "1"))
+
+# Carer public keys (PaillierPublicKey objects, with their nsquare precomputed) by fingerprint, when they were fetched,
+# the modulus of the carer's current key and whether a thread is fetching them from the carer. The lock is only held
+# to read or swap the registry, never during the fetch
+key_registry = {'keys': {}, 'refreshed_at': None, 'current': None, 'refreshing': False}
+key_registry_lock = threading.Lock()
+key_registry_refreshed = threading.Condition(key_registry_lock)
+
+# Serial evaluations arriving within BATCH_WINDOW seconds of each other are coalesced and evaluated together, in one
+# pass over the geofence coefficients that shares the work that doesn't depend on the user's ciphertexts (0 evaluates each
+# request on its own). Coalescing needs concurrent requests in one process, i.e. gunicorn --threads.
+# A request can ask for its own window (up to BATCH_MAX_WINDOW) so the experiments can compare window sizes
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", "0"))
+BATCH_MAX_WINDOW = float(os.environ.get("BATCH_MAX_WINDOW", "1"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "64"))
+
+# Most location fixes accepted in one /submit-user-location-batch request, e.g. fixes a device buffered while offline
+FIX_BATCH_MAX_SIZE = int(os.environ.get("FIX_BATCH_MAX_SIZE", "256"))
+
+# Submissions waiting for the current batch, and whether a thread is already waiting out the window for them
+batch_pending = []
+batch_leader_active = False
+batch_condition = threading.Condition()
+
+# Persistent process pool, and the process it belongs to (gunicorn workers each need their own). The pool outlives
+# geofence updates: every chunk is sent with its coefficient terms, so a pool process never relies on a table of its own
+process_pool = None
+process_pool_pid = None
+process_pool_lock = threading.RLock()
+
+# In a pool process, the coefficient rows it has encoded, by (table version, public key n) and then by (system, start, count)
+POOL_ENCODED_KEYS = 2
+pool_encoded = collections.OrderedDict()
+
+# Requests sent with 'Prefer: respond-async' are acknowledged with 202 and a job id once queued. A background thread
+# evaluates them and hands the results to a delivery thread, which sends them to the carer in batches.
+# Both queues are bounded: a full delivery queue holds up evaluation, and a full job queue turns requests away with 503
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "64"))
+DELIVERY_QUEUE_SIZE = int(os.environ.get("DELIVERY_QUEUE_SIZE", "64"))
+
+# Most jobs delivered to the carer in one request, and how long the delivery thread waits for a batch to fill (s)
+DELIVERY_BATCH_SIZE = int(os.environ.get("DELIVERY_BATCH_SIZE", "16"))
+DELIVERY_BATCH_WINDOW = float(os.environ.get("DELIVERY_BATCH_WINDOW", "0.01"))
+
+# Redeliveries of a batch after a connection error or 5xx, with exponential backoff (DELIVERY_BACKOFF * 2^attempt s).
+# The carer answers a job id it has already processed without processing it again, so redelivering is safe
+DELIVERY_RETRIES = int(os.environ.get("DELIVERY_RETRIES", "5"))
+DELIVERY_BACKOFF = float(os.environ.get("DELIVERY_BACKOFF", "0.2"))
+
+# Job state is kept in one JSON file per job, so a status poll can be answered by any gunicorn worker.
+# Files older than JOB_STATE_TTL seconds are removed
+JOB_STATE_DIR = os.environ.get("JOB_STATE_DIR", "/tmp/geofencing-jobs")
+JOB_STATE_TTL = float(os.environ.get("JOB_STATE_TTL", "3600"))
+
+# Job and delivery queues and the process their threads run in (gunicorn workers each start their own)
+job_queue = None
+delivery_queue = None
+job_workers_pid = None
+job_workers_lock = threading.Lock()
+job_states_cleaned_at = 0
 
 def get_geofence_coordinates():
-    global geofence_coordinates  # Store globally
+    # Fetch the geofences from Overpass, returning whether it succeeded (the current geofences are kept if not)
     # Initialize Overpass API
     api = overpass.API(timeout=60000)  # 60s timeout (If timeout error occurs: Increase timeout or reduce 'out qt' to a lower number reducing number of geofences fetched 
 
@@ -35,44 +161,838 @@ def get_geofence_coordinates():
         if num_coordinates < numGeofenceBoundaries:
             raise ValueError(f"Insufficient coordinates: Found {num_coordinates}, but need at least {numGeofenceBoundaries}")
         
-        # Extract lat and lon values, round to 5 dp, convert to radians
-        for i in range(numGeofenceBoundaries):  # Limit to 'n' Cafes
-            feature = result['features'][i]
-            lon, lat = feature['geometry']['coordinates']
-            lon_rounded, lat_rounded = round(lon, 6), round(lat, 6)
-
-            '''
-            To prevent floating-point equality after rounding (e.g., 28.523500 == 28.52350),
-            which cause math domain errors in encrypted trigonometric operations,
-            we add a small offset (1e-6) to the coordinate if both lon and lat end in zero.
-            This offset shifts the coordinate by ~11.1 cm — negligible for geofencing accuracy.
-            '''
-
-            # Convert to string to check the last decimal digit
-            lon_str = f"{lon_rounded:.{6}f}"
-            lat_str = f"{lat_rounded:.{6}f}"
-
-            if lon_str[-1] == "0" and lat_str[-1] == "0":
-            # Add a tiny offset to lat_rounded to make last digit a '1' 
-                lat_rounded += 10**-6  # 0.000001
-                lat_rounded = round(lat_rounded, 6)  # Round again just in case
-
-            print(f"longitude: {lon_rounded}, latitude: {lat_rounded}") # Print geofences coordinates for testing
-            geofence_coordinates.append([math.radians(lon_rounded), math.radians(lat_rounded)])
+        # Extract ids and lat and lon values, round to 5 dp, convert to radians (limit to 'n' Cafes)
+        fetched_ids, fetched_coordinates = geofence_snapshot.process_geofence_features(result['features'], numGeofenceBoundaries)
         
+        set_geofence_coordinates(fetched_coordinates, fetched_ids)
+        geofence_source['source'] = "overpass"
+
         print(f"Number of processed geofence coordinates: {len(geofence_coordinates)}")
         print("Geofence coordinates fetched successfully.")
+        return True
     except Exception as e:
             print(f"Failed to fetch geofence coordinates: {e.__class__.__name__}: {e}")
-            
+            return False
+
+
+def import_geofence_coordinates():
+    # Stream the geofences from GEOFENCE_SOURCE_FILE straight into the snapshot and map it, returning whether it
+    # succeeded (the current geofences are kept if not)
+    try:
+        geofence_snapshot.import_geofences(GEOFENCE_SOURCE_FILE, GEOFENCE_SNAPSHOT, tag=GEOFENCE_SOURCE_TAG)
+        load_geofence_snapshot(GEOFENCE_SNAPSHOT, source="file")
+
+        print(f"Number of processed geofence coordinates: {len(geofence_coordinates)}")
+        print("Geofence coordinates imported successfully.")
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Failed to import geofence coordinates from {GEOFENCE_SOURCE_FILE}: {e.__class__.__name__}: {e}")
+        return False
+
+
+def fetch_geofences():
+    # Fetch the geofences from their source (GEOFENCE_SOURCE_FILE if set, otherwise Overpass) into the snapshot
+    if GEOFENCE_SOURCE_FILE:
+        return import_geofence_coordinates()
+
+    if not get_geofence_coordinates():
+        return False
+
+    save_geofence_snapshot()
+    return True
+
+
+def load_geofences(refresh=False):
+    # Map the geofence snapshot if there is one (unless refreshing), otherwise fetch the geofences from their source and
+    # save them as the snapshot for the next start. Returns whether there are geofences from either
+    with geofence_lock:
+        if not refresh and os.path.exists(GEOFENCE_SNAPSHOT):
+            try:
+                start = time.time()
+                load_geofence_snapshot(GEOFENCE_SNAPSHOT)
+                print(f"Loaded {len(geofence_coordinates)} geofences from snapshot {GEOFENCE_SNAPSHOT} in {round((time.time()-start)*1000, 3)} ms")
+                return True
+            except (OSError, ValueError) as e:
+                print(f"Ignoring geofence snapshot {GEOFENCE_SNAPSHOT}: {e}")
+
+        with GeofenceWriteLock():
+            fetched = fetch_geofences()
+        if not fetched:
+            print(f"WARNING: No geofences could be fetched, serving {len(geofence_coordinates)} geofences ({geofence_source['source'] or 'none loaded'})")
+            return len(geofence_coordinates) > 0
+
+        return True
+
+
+def save_geofence_snapshot():
+    # Save the fetched geofences, and serve them from the snapshot like every other worker will
+    try:
+        geofence_snapshot.write_snapshot(GEOFENCE_SNAPSHOT, geofence_table)
+        load_geofence_snapshot(GEOFENCE_SNAPSHOT, source="overpass")
+        print(f"Saved {len(geofence_coordinates)} geofences to snapshot {GEOFENCE_SNAPSHOT}")
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Failed to save geofence snapshot {GEOFENCE_SNAPSHOT}: {e}")
+        return False
+
+
+def load_geofence_snapshot(path, source="snapshot"):
+    # Identify the file before mapping it, so a snapshot replaced in the meantime is noticed on the next request
+    stat = os.stat(path)
+    table = geofence_snapshot.load_snapshot(path)
+
+    set_geofence_table(table)
+    geofence_source.update(source=source, snapshot=path, file_id=(stat.st_ino, stat.st_mtime_ns), built_at=table['built_at'], generation=table['generation'])
+
+
+def sync_geofence_snapshot():
+    # Remap the snapshot if it has been replaced since it was loaded (e.g. refreshed by another gunicorn worker).
+    # Geofences that weren't loaded from a snapshot are left alone
+    path = geofence_source['snapshot']
+    if path is None:
+        return
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+
+    if (stat.st_ino, stat.st_mtime_ns) != geofence_source['file_id']:
+        with geofence_lock:
+            if geofence_source['snapshot'] == path and (stat.st_ino, stat.st_mtime_ns) != geofence_source['file_id']:
+                try:
+                    load_geofence_snapshot(path, geofence_source['source'])
+                    print(f"Reloaded {len(geofence_coordinates)} geofences from replaced snapshot {path} (generation {geofence_source['generation']})")
+                except (OSError, ValueError) as e:
+                    print(f"Keeping the current geofences, replaced snapshot {path} can't be loaded: {e}")
+
+
+class GeofenceWriteLock(object):
+    # Held while the geofences are changed and the snapshot written: geofence_lock within this worker, then an exclusive
+    # lock on the snapshot across processes, so two gunicorn workers never each build the next generation from their own
+    # copy and lose one of the changes. A snapshot another worker published meanwhile is loaded before the change is made
+    def __init__(self, path=None):
+        self.path = (GEOFENCE_SNAPSHOT if path is None else path) + ".lock"
+        self.fd = None
+
+    def acquire(self):
+        # geofence_lock first, so threads of this worker never hold the file lock while waiting for it
+        geofence_lock.acquire()
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.release()
+            raise
+        sync_geofence_snapshot()
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)   # Closing the descriptor releases the lock
+            self.fd = None
+        geofence_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def set_geofence_coordinates(coordinates, ids=None, radius=None, group=None, active=None):
+    # Replace the geofence set and rebuild its coefficient table so the two never go out of sync
+    set_geofence_table(geofence_snapshot.build_geofence_table(coordinates, ids, radius, group, active))
+    geofence_source.update(source=None, snapshot=None, file_id=None, built_at=None, generation=None)
+
+
+def set_geofence_table(table):
+    global geofence_coordinates, geofence_ids, geofence_coefficients, geofence_table, geofence_index, geofence_table_version
+    # Replace the geofence set with a table of ids, coordinates and coefficients (built here or mapped from a snapshot).
+    # Requests evaluate the active geofences, views of the table's columns (a prefix of them for a snapshot).
+    # Everything is prepared before the globals are swapped, and a request reads geofence_coefficients once and passes
+    # it on, so requests in flight evaluate, and send the radii and generation of, the table they started with (its
+    # mapping stays valid until they drop it)
+    active = geofence_snapshot.active_geofences(table)
+    geofence_table_version += 1
+    coefficients = {
+        'version': geofence_table_version,
+        # Generation of the snapshot the table was mapped from (None for tables built here), sent to the carer with the
+        # priority positions in this table
+        'generation': table.get('generation'),
+        'prop_terms': active['prop_terms'],
+        'ref_terms': active['ref_terms'],
+        # Radii (m) the carer compares each geofence's result against, and groups it can be asked to decrypt first
+        'radius': active['radius'],
+        'group': active['group'],
+        # Paillier encodings of the terms, filled in lazily per public key
+        'encoded': {}
+    }
+    if geofence_coefficients is not None and geofence_coefficients['encoded']:
+        carry_over_encodings(geofence_coefficients, geofence_ids, geofence_coordinates, coefficients, active['ids'], active['coordinates'])
+    geofence_table, geofence_index, geofence_coordinates, geofence_ids, geofence_coefficients = table, None, active['coordinates'], active['ids'], coefficients
+
+
+def get_carer_geofence_radii(number_of_geofences, coefficients=None):
+    # Radii (m) of the first number_of_geofences geofences of the request's table (the current one by default), sent
+    # with their results so the carer compares each result against its own geofence's radius: one number when they all
+    # have the same radius (the usual case), else a list
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    radii = coefficients['radius'][:number_of_geofences]
+
+    if len(radii) == 0:
+        return None
+    if (radii == radii[0]).all():
+        return float(radii[0])
+    return radii.tolist()
+
+
+def get_carer_short_circuit(data, number_of_geofences, coefficients=None):
+    # Short-circuit settings sent to the carer when a request asks for 'any_inside': the carer then decrypts in
+    # priority order and stops at the first geofence the user is inside. The priority is the positions of the geofences
+    # in the request's 'priority_group' (e.g. the places of the user's carer), after the geofences the carer last
+    # found users inside unless 'recent_hits_first' is false. Positions belong to the generation sent with them
+    if data.get('any_inside', False) is not True:
+        return None
+
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    short_circuit = {"any_inside": True, "generation": coefficients['generation']}
+
+    if data.get('priority_group') is not None:
+        short_circuit["priority"] = np.flatnonzero(coefficients['group'][:number_of_geofences] == data['priority_group']).tolist()
+    if data.get('recent_hits_first', True) is False:
+        short_circuit["recent_hits_first"] = False
+
+    return short_circuit
+
+
+def get_encoded_geofence_coefficients(public_key, system, start=0, stop=None, coefficients=None):
+    # Encoded coefficient rows of the 'ref' or 'prop' system for geofences start to stop (all by default) of the
+    # request's table (the current one by default).
+    # Encodings depend on the public key, so they are cached per key alongside the table they came from, and only the
+    # rows requests have asked for are encoded, as encoding a catalogue of a million geofences up front would take
+    # minutes and millions of Python objects
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    encoded = coefficients['encoded']
+
+    # The rows of the key are looked up (or added) under the lock, but encoded outside it: the list stays usable even if
+    # another thread evicts the key, and two threads encoding the same row store the same encoding
+    with encoded_lock:
+        if public_key.n not in encoded:
+            # Only the carer's accepted keys are needed: its current key, and after a rotation the key it replaced
+            while len(encoded) >= 2:
+                del encoded[next(iter(encoded))]
+            count = len(coefficients['prop_terms'])
+            encoded[public_key.n] = {'prop': [None] * count, 'ref': [None] * count}
+
+        rows = encoded[public_key.n][system]
+    stop = len(rows) if stop is None else min(stop, len(rows))
+
+    if None in rows[start:stop]:
+        terms = coefficients[f'{system}_terms']
+        for i in range(start, stop):
+            if rows[i] is None:
+                rows[i] = [paillier_engine.encode(public_key, term) for term in terms[i].tolist()]
+
+    return rows[start:stop]
+
+
+def carry_over_encodings(previous, previous_ids, previous_coordinates, coefficients, ids, coordinates):
+    # Move the encoded rows of geofences whose id and centre haven't changed to their positions in the new table, so after
+    # an update only the geofences that changed are encoded again
+    with encoded_lock:
+        previous_encoded = list(previous['encoded'].items())
+
+    for public_key_n, systems in previous_encoded:
+        carried = {}
+        for system, rows in systems.items():
+            carried[system] = [None] * len(ids)
+            encoded_positions = np.array([i for i, row in enumerate(rows) if row is not None], dtype=np.int64)
+            if not len(encoded_positions):
+                continue
+
+            # Find every new geofence among the encoded old ones
+            index = geofence_snapshot.build_geofence_index({'ids': np.asarray(previous_ids)[encoded_positions]})
+            found = geofence_snapshot.find_geofences(index, ids)
+            targets = np.flatnonzero(found >= 0)
+            sources = encoded_positions[found[targets]]
+            unchanged = np.all(np.asarray(previous_coordinates)[sources] == coordinates[targets], axis=1)
+
+            for target, source in zip(targets[unchanged].tolist(), sources[unchanged].tolist()):
+                carried[system][target] = rows[source]
+
+        coefficients['encoded'][public_key_n] = carried
+
+
+def get_geofence_index():
+    global geofence_index
+    # Index of the geofence table by id, built when a geofence is first looked up
+    with geofence_lock:
+        if geofence_index is None:
+            geofence_index = geofence_snapshot.build_geofence_index(geofence_table)
+        return geofence_index
+
+
+def evaluate_intermediate_values(user_values, coefficient_rows, constant=0):
+    # Raising each user ciphertext to hundreds of scalars is the fixed-base case, so above the threshold the kernel
+    # builds a table per ciphertext (and per inverse, which negative scalars need) once for this request
+    fixed_base = len(coefficient_rows) >= FIXED_BASE_THRESHOLD
+
+    # Each intermediate value is Enc(constant)·∏ c_i^(b_i) mod n², computed by one simultaneous multi-exponentiation
+    ciphertexts, exponents, multiplications = paillier_engine.encrypted_inner_products(user_values, coefficient_rows, constant, fixed_base)
+
+    public_key = user_values[0].public_key
+    intermediate_values = [paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext, exponent in zip(ciphertexts, exponents)]
+
+    return intermediate_values, multiplications
+
+
+def start_process_pool():
+    global process_pool, process_pool_pid
+
+    if PARALLEL_WORKERS <= 0:
+        return None
+
+    with process_pool_lock:
+        if process_pool is None or process_pool_pid != os.getpid():
+            process_pool = ProcessPoolExecutor(
+                max_workers=PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context("fork")
+            )
+            process_pool_pid = os.getpid()
+
+            # Warm the pool so the first request doesn't pay for starting the processes
+            list(process_pool.map(warm_pool_process, range(PARALLEL_WORKERS)))
+            print(f"Process pool started with {PARALLEL_WORKERS} processes")
+
+        return process_pool
+
+
+def restart_process_pool(broken_pool):
+    # Replace a pool that broke (one of its processes died, e.g. killed for running out of memory), unless another
+    # thread has replaced it already, so the requests after it don't fail too
+    global process_pool, process_pool_pid
+
+    with process_pool_lock:
+        if process_pool is broken_pool:
+            print("Process pool broken, starting a new one")
+            broken_pool.shutdown(wait=False)
+            process_pool = None
+            process_pool_pid = None
+        return start_process_pool()
+
+
+def stop_process_pool():
+    global process_pool, process_pool_pid
+
+    with process_pool_lock:
+        if process_pool is not None and process_pool_pid == os.getpid():
+            process_pool.shutdown(wait=True)
+
+        process_pool = None
+        process_pool_pid = None
+
+
+def warm_pool_process(i):
+    return os.getpid()
+
+
+def evaluate_geofence_chunk(public_key_n, user_values, system, version, start, terms, constant, packed=False):
+    # Runs in a pool process: user_values are (ciphertext, exponent) pairs, terms the chunk's coefficient terms in the
+    # request's table (starting at geofence start) and only plain integers are sent back
+    public_key = paillier.PaillierPublicKey(public_key_n)
+    values = [paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext, exponent in user_values]
+    coefficient_rows = get_encoded_chunk_coefficients(public_key, system, version, start, terms)
+
+    if packed:
+        intermediate_values, packing, multiplications = evaluate_packed_intermediate_values(values, coefficient_rows, constant)
+    else:
+        intermediate_values, multiplications = evaluate_intermediate_values(values, coefficient_rows, constant)
+        packing = None
+
+    return [(value.ciphertext(False), value.exponent) for value in intermediate_values], packing, multiplications, os.getpid()
+
+
+def get_encoded_chunk_coefficients(public_key, system, version, start, terms):
+    # Encoded rows of a chunk's terms, cached in the pool process for the keys of the latest tables it has seen, as the
+    # same chunks come back with every request
+    rows_by_chunk = pool_encoded.get((version, public_key.n))
+    if rows_by_chunk is None:
+        while len(pool_encoded) >= POOL_ENCODED_KEYS:
+            pool_encoded.popitem(last=False)
+        rows_by_chunk = pool_encoded[(version, public_key.n)] = {}
+
+    rows = rows_by_chunk.get((system, start, len(terms)))
+    if rows is None:
+        rows = rows_by_chunk[(system, start, len(terms))] = [[paillier_engine.encode(public_key, term) for term in row] for row in terms.tolist()]
+    return rows
+
+
+def evaluate_packed_intermediate_values(user_values, coefficient_rows, constant=0):
+    # As evaluate_intermediate_values, but the results are packed into the slots of as few ciphertexts as possible.
+    # Returns the packed ciphertexts and the (slots, slot_bits) layout of each
+    fixed_base = len(coefficient_rows) >= FIXED_BASE_THRESHOLD
+
+    ciphertexts, exponent, slot_counts, slot_bits, multiplications = paillier_engine.encrypted_packed_inner_products(
+        user_values, coefficient_rows, constant, PACKED_VALUE_BOUND, fixed_base)
+
+    public_key = user_values[0].public_key
+    intermediate_values = [paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext in ciphertexts]
+    packing = [(slots, slot_bits) for slots in slot_counts]
+
+    return intermediate_values, packing, multiplications
+
+
+def uses_process_pool(number_of_geofences, chunk_size=None, coefficients=None):
+    # Whether a request for number_of_geofences geofences is split into chunks across the process pool. The pool
+    # processes then encode their own chunks' coefficients, so the request's process doesn't encode any
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    number_of_geofences = len(coefficients['prop_terms'][:number_of_geofences])
+    return start_process_pool() is not None and number_of_geofences > (chunk_size or PARALLEL_CHUNK_SIZE)
+
+
+def evaluate_geofences(user_values, system, number_of_geofences, constant=0, chunk_size=None, packed=False, batch_window=None, coefficients=None):
+    # Evaluate the first number_of_geofences geofences of the 'ref' or 'prop' terms of the request's table (the current
+    # one by default), split into chunks across
+    # the process pool when there is one and the request spans more than one chunk, otherwise coalesced with
+    # other requests arriving within the batch window.
+    # Returns the intermediate values, their packing layouts (None unless packed), the multiplication counts,
+    # the number of processes used and the batch it was evaluated in ({'size': users, 'wait': seconds})
+    public_key = user_values[0].public_key
+    chunk_size = chunk_size or PARALLEL_CHUNK_SIZE
+    batch_window = BATCH_WINDOW if batch_window is None else batch_window
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+
+    if not uses_process_pool(number_of_geofences, chunk_size, coefficients):
+        if batch_window > 0:
+            intermediate_values, packing, multiplications, batch = evaluate_geofences_coalesced(user_values, system, number_of_geofences, constant, packed, batch_window, coefficients)
+            return intermediate_values, packing, multiplications, 1, batch
+
+        coefficient_rows = get_encoded_geofence_coefficients(public_key, system, 0, number_of_geofences, coefficients)
+        if packed:
+            intermediate_values, packing, multiplications = evaluate_packed_intermediate_values(user_values, coefficient_rows, constant)
+        else:
+            intermediate_values, multiplications = evaluate_intermediate_values(user_values, coefficient_rows, constant)
+            packing = None
+        return intermediate_values, packing, multiplications, 1, {'size': 1, 'wait': 0}
+
+    # A pool that broke is replaced and the request evaluated once more, in the new pool
+    pool = start_process_pool()
+    try:
+        return evaluate_geofence_chunks(pool, user_values, system, number_of_geofences, constant, chunk_size, packed, coefficients)
+    except BrokenProcessPool:
+        pool = restart_process_pool(pool)
+        return evaluate_geofence_chunks(pool, user_values, system, number_of_geofences, constant, chunk_size, packed, coefficients)
+
+
+def evaluate_geofence_chunks(pool, user_values, system, number_of_geofences, constant, chunk_size, packed, coefficients):
+    # Each pool process encodes the coefficients of its own chunks, sent with the chunk from the table the request started
+    # with, so a pool process evaluates the same geofences whatever has been published since
+    public_key = user_values[0].public_key
+    terms = coefficients[f'{system}_terms'][:number_of_geofences]
+    serialized_values = [(value.ciphertext(False), value.exponent) for value in user_values]
+    futures = [
+        pool.submit(evaluate_geofence_chunk, public_key.n, serialized_values, system, coefficients['version'], start, np.array(terms[start:start + chunk_size]), constant, packed)
+        for start in range(0, len(terms), chunk_size)
+    ]
+
+    # Merge the chunks back in geofence order (packed chunks each end with a partly filled ciphertext)
+    intermediate_values = []
+    packing = [] if packed else None
+    multiplications = {'generic': 0, 'actual': 0}
+    processes = set()
+    for future in futures:
+        chunk_values, chunk_packing, chunk_multiplications, pid = future.result()
+        intermediate_values.extend(paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext, exponent in chunk_values)
+        if packed:
+            packing.extend(chunk_packing)
+        multiplications['generic'] += chunk_multiplications['generic']
+        multiplications['actual'] += chunk_multiplications['actual']
+        processes.add(pid)
+
+    return intermediate_values, packing, multiplications, len(processes), {'size': 1, 'wait': 0}
+
+
+def evaluate_geofences_coalesced(user_values, system, number_of_geofences, constant, packed, batch_window, coefficients=None):
+    # Join the pending batch. The first submission in it leads: it waits out the window (or until the batch is full),
+    # takes the batch and evaluates it for everyone, while later submissions start the next batch
+    global batch_leader_active
+
+    submission = {
+        'user_values': user_values,
+        'system': system,
+        'number_of_geofences': number_of_geofences,
+        'constant': constant,
+        'packed': packed,
+        'coefficients': geofence_coefficients if coefficients is None else coefficients,
+        'submitted_at': time.time()
+    }
+
+    with batch_condition:
+        batch_pending.append(submission)
+        batch_condition.notify_all()  # A full batch needn't wait out its window
+
+        while 'result' not in submission and 'error' not in submission:
+            if batch_leader_active or not any(pending is submission for pending in batch_pending):
+                batch_condition.wait()
+                continue
+
+            batch_leader_active = True
+            batch_condition.wait_for(lambda: len(batch_pending) >= BATCH_MAX_SIZE, timeout=batch_window)
+            batch = batch_pending[:BATCH_MAX_SIZE]
+            del batch_pending[:BATCH_MAX_SIZE]
+
+            # Submissions left over from a full batch can lead the next one while this one is evaluated
+            batch_leader_active = False
+            batch_condition.notify_all()
+
+            batch_condition.release()
+            try:
+                evaluate_batch(batch)
+            finally:
+                batch_condition.acquire()
+            batch_condition.notify_all()
+
+    if 'error' in submission:
+        raise submission['error']
+    return submission['result']
+
+
+def evaluate_batch(batch):
+    # Submissions for the same system, key, ciphertext exponents, geofences (of the same table), constant and packing
+    # share one plan
+    groups = {}
+    for submission in batch:
+        user_values = submission['user_values']
+        group_key = (submission['system'], user_values[0].public_key.n, tuple(value.exponent for value in user_values),
+                     submission['number_of_geofences'], submission['coefficients']['version'], submission['constant'], submission['packed'])
+        groups.setdefault(group_key, []).append(submission)
+
+    started = time.time()
+
+    for (system, public_key_n, exponents, number_of_geofences, version, constant, packed), group in groups.items():
+        try:
+            public_key = group[0]['user_values'][0].public_key
+            coefficient_rows = get_encoded_geofence_coefficients(public_key, system, 0, number_of_geofences, group[0]['coefficients'])
+            fixed_base = len(coefficient_rows) >= FIXED_BASE_THRESHOLD
+
+            results = paillier_engine.batched_inner_products(
+                [submission['user_values'] for submission in group], coefficient_rows, constant, fixed_base, packed, PACKED_VALUE_BOUND)
+
+            for submission, result in zip(group, results):
+                if packed:
+                    ciphertexts, exponent, slot_counts, slot_bits, multiplications = result
+                    intermediate_values = [paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext in ciphertexts]
+                    packing = [(slots, slot_bits) for slots in slot_counts]
+                else:
+                    ciphertexts, exponents, multiplications = result
+                    intermediate_values = [paillier_engine.encrypted_number(public_key, ciphertext, exponent) for ciphertext, exponent in zip(ciphertexts, exponents)]
+                    packing = None
+
+                submission['result'] = (intermediate_values, packing, multiplications, {'size': len(group), 'wait': started - submission['submitted_at']})
+
+        except Exception as e:
+            for submission in group:
+                submission['error'] = e
+
+
+# Load the geofences once at startup, from the snapshot when there is one
+set_geofence_coordinates([])
+load_geofences()
+
+@app.before_request
+def check_geofence_snapshot():
+    # A stat per request, so every worker serves a snapshot another worker has refreshed
+    sync_geofence_snapshot()
+
+
+@app.route("/geofences", methods=['GET'])
+def get_geofences():
+    # Number of geofences served (evaluated, and in the table including inactive ones) and where they came from
+    return jsonify({
+        "count": len(geofence_coordinates),
+        "total": len(geofence_table['ids']),
+        "source": geofence_source['source'],
+        "snapshot": geofence_source['snapshot'],
+        "built_at": geofence_source['built_at'],
+        "generation": geofence_source['generation']
+    }), 200
+
+
+@app.route("/geofences/<int:geofence_id>", methods=['GET'])
+def get_geofence(geofence_id):
+    # A geofence by its source id: centre in degrees and its metadata
+    with geofence_lock:
+        table = geofence_table
+        position = int(geofence_snapshot.find_geofences(get_geofence_index(), [geofence_id])[0])
+
+    if position < 0:
+        return jsonify({
+            "status": "error",
+            "message": "Unknown geofence id"
+        }), 404
+
+    longitude, latitude = table['coordinates'][position].tolist()
+    return jsonify({
+        "id": geofence_id,
+        "longitude": math.degrees(longitude),
+        "latitude": math.degrees(latitude),
+        "radius": float(table['radius'][position]),
+        "group": int(table['group'][position]),
+        "active": bool(table['active'][position])
+    }), 200
+
+
+@app.route("/geofences/refresh", methods=['POST'])
+def refresh_geofences():
+    # Fetch the geofences from their source again and replace the snapshot, keeping the current geofences if that fails.
+    # This replaces every geofence published through the admin API, so it needs the admin token too
+    if not admin_request_authorised():
+        return admin_unauthorised()
+
+    with GeofenceWriteLock():
+        if not fetch_geofences():
+            return jsonify({
+                "status": "error",
+                "message": "Couldn't fetch the geofences, the current geofences are kept"
+            }), 502
+
+    return jsonify({
+        "status": "success",
+        "message": "Geofences refreshed",
+        "count": len(geofence_coordinates),
+        "source": geofence_source['source']
+    }), 200
+
+
+@app.route("/admin/geofences", methods=['POST'])
+def update_geofences():
+    # Add, update and remove geofences while requests keep being served. Only the changed geofences' coefficients are
+    # computed, the rest are copied into the next generation of the snapshot, which every worker swaps to on its next
+    # request (requests already being evaluated finish on the previous one)
+    if not admin_request_authorised():
+        return admin_unauthorised()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not any(key in data for key in ('add', 'update', 'remove')):
+        return jsonify({
+            "status": "error",
+            "message": "Request data needs 'add', 'update' or 'remove'"
+        }), 400
+
+    remove = data.get('remove', [])
+    if type(remove) is not list or any(type(geofence_id) is not int for geofence_id in remove):
+        return jsonify({
+            "status": "error",
+            "message": "'remove' must be a list of geofence ids"
+        }), 400
+
+    start = time.time()
+    with GeofenceWriteLock():
+        try:
+            added = geofence_entries_table(data.get('add', []), "add")
+            updated = geofence_entries_table(data.get('update', []), "update", geofence_table)
+            changes = geofence_snapshot.apply_geofence_changes(geofence_table, GEOFENCE_SNAPSHOT, added, updated, remove)
+            load_geofence_snapshot(GEOFENCE_SNAPSHOT, source="admin")
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+        except OSError as e:
+            return admin_write_failed(e)
+
+    print(f"Geofences updated ({changes['added']} added, {changes['updated']} updated, {changes['removed']} removed), "
+          f"generation {geofence_source['generation']} published in {round((time.time() - start) * 1000, 3)} ms")
+
+    return admin_success("Geofences updated", start, added=changes['added'], updated=changes['updated'], removed=changes['removed'])
+
+
+@app.route("/admin/geofences", methods=['PUT'])
+def replace_geofences():
+    # Replace every geofence with the geofences given, published as the next generation of the snapshot
+    if not admin_request_authorised():
+        return admin_unauthorised()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'geofences' not in data:
+        return jsonify({
+            "status": "error",
+            "message": "Missing 'geofences' in request data"
+        }), 400
+
+    start = time.time()
+    with GeofenceWriteLock():
+        try:
+            geofences = geofence_entries_table(data['geofences'], "geofences")
+            geofence_snapshot.apply_geofence_changes(geofence_snapshot.build_geofence_table([]), GEOFENCE_SNAPSHOT, added=geofences)
+            load_geofence_snapshot(GEOFENCE_SNAPSHOT, source="admin")
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+        except OSError as e:
+            return admin_write_failed(e)
+
+    return admin_success("Geofences replaced", start)
+
+
+@app.route("/admin/geofences/load", methods=['POST'])
+def load_geofence_source():
+    # Serve a new snapshot file, or geofences imported from a GeoJSON, CSV or OSM XML file ('path' on the service,
+    # e.g. in /app/snapshots), published as the next generation of the snapshot
+    if not admin_request_authorised():
+        return admin_unauthorised()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or type(data.get('path')) is not str or (data.get('tag') is not None and type(data['tag']) is not str):
+        return jsonify({
+            "status": "error",
+            "message": "Request data needs a 'path' (and optionally a 'tag') string"
+        }), 400
+
+    start = time.time()
+    with GeofenceWriteLock():
+        try:
+            with open(data['path'], "rb") as f:
+                is_snapshot = f.read(len(geofence_snapshot.SNAPSHOT_MAGIC)) == geofence_snapshot.SNAPSHOT_MAGIC
+
+            if is_snapshot:
+                geofence_snapshot.install_snapshot(data['path'], GEOFENCE_SNAPSHOT)
+            else:
+                geofence_snapshot.import_geofences(data['path'], GEOFENCE_SNAPSHOT, tag=data.get('tag'))
+            load_geofence_snapshot(GEOFENCE_SNAPSHOT, source="snapshot" if is_snapshot else "file")
+        except (OSError, ValueError) as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Couldn't load geofences from {data['path']}: {e}"
+            }), 400
+
+    return admin_success("Geofences loaded", start)
+
+
+def admin_request_authorised():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {ADMIN_TOKEN}")
+
+
+def admin_unauthorised():
+    if not ADMIN_TOKEN:
+        return jsonify({
+            "status": "error",
+            "message": "The admin API is disabled, set ADMIN_TOKEN to enable it"
+        }), 403
+
+    return jsonify({
+        "status": "error",
+        "message": "Admin token missing or invalid"
+    }), 401
+
+
+def admin_write_failed(e):
+    return jsonify({
+        "status": "error",
+        "message": f"Couldn't write the geofence snapshot, the current geofences are kept: {e}"
+    }), 500
+
+
+def admin_success(message, start, **counts):
+    return jsonify(dict({
+        "status": "success",
+        "message": message,
+        "count": len(geofence_coordinates),
+        "generation": geofence_source['generation'],
+        "seconds": time.time() - start
+    }, **counts)), 200
+
+
+def geofence_entries_table(entries, name, current=None):
+    # Table of the geofences given as {'id', 'longitude', 'latitude' (degrees), and optionally 'radius', 'group' and
+    # 'active'}, with their coefficients computed. Entries updating the current table only need an id and the values
+    # that change. Coordinates are rounded as imported ones are. Raises ValueError for invalid entries
+    if type(entries) is not list:
+        raise ValueError(f"'{name}' must be a list of geofences")
+
+    ids = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or type(entry.get('id')) is not int:
+            raise ValueError(f"Geofence {i} of '{name}' needs an integer 'id'")
+        ids.append(entry['id'])
+
+    if current is None:
+        positions = [None] * len(entries)
+    else:
+        positions = geofence_snapshot.find_geofences(get_geofence_index(), ids).tolist()
+        if -1 in positions:
+            raise ValueError(f"Unknown geofence {ids[positions.index(-1)]}")
+
+    coordinates = np.empty((len(entries), 2))
+    radius, group, active = [], [], []
+    moved, longitudes, latitudes = [], [], []
+    for i, (entry, position) in enumerate(zip(entries, positions)):
+        if position is None or 'longitude' in entry or 'latitude' in entry:
+            longitude, latitude = entry.get('longitude'), entry.get('latitude')
+            if type(longitude) not in (int, float) or type(latitude) not in (int, float) or not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+                raise ValueError(f"Geofence {i} of '{name}' needs a 'longitude' and 'latitude' in degrees")
+            moved.append(i)
+            longitudes.append(longitude)
+            latitudes.append(latitude)
+        else:
+            coordinates[i] = current['coordinates'][position]
+
+        if 'radius' in entry and (type(entry['radius']) not in (int, float) or not entry['radius'] > 0):
+            raise ValueError(f"Geofence {i} of '{name}' needs a positive 'radius' in metres")
+        if 'group' in entry and type(entry['group']) is not int:
+            raise ValueError(f"Geofence {i} of '{name}' needs an integer 'group'")
+        if 'active' in entry and type(entry['active']) is not bool:
+            raise ValueError(f"Geofence {i} of '{name}' needs a boolean 'active'")
+
+        radius.append(entry.get('radius', geofence_snapshot.DEFAULT_GEOFENCE_RADIUS if position is None else current['radius'][position]))
+        group.append(entry.get('group', 0 if position is None else current['group'][position]))
+        active.append(entry.get('active', True if position is None else current['active'][position]))
+
+    if moved:
+        longitudes, latitudes = geofence_snapshot.sanitise_coordinates(longitudes, latitudes)
+        coordinates[moved] = np.radians(np.column_stack((longitudes, latitudes)))
+
+    return geofence_snapshot.build_geofence_table(coordinates, ids, radius, group, active)
+
+
+def read_evaluation_options(data):
+    # The number of geofences to evaluate, and the options every submission endpoint takes on how to evaluate them and
+    # have the carer decrypt the results. Raises ValueError for invalid ones
+    number_of_geofences = data.get('number_of_geofences')
+    if type(number_of_geofences) is not int or number_of_geofences < 0:
+        raise ValueError("'number_of_geofences' must be a non-negative integer")
+
+    # Optional geofences per parallel chunk, so the experiments can measure the chunk size trade-off
+    chunk_size = data.get('chunk_size')
+    if chunk_size is not None and (type(chunk_size) is not int or chunk_size < 1):
+        raise ValueError("'chunk_size' must be a positive integer")
+
+    # Optionally pack several results into each ciphertext for the carer
+    packed = data.get('packed', False)
+    if type(packed) is not bool:
+        raise ValueError("'packed' must be a boolean")
+
+    # Optionally have the carer stop decrypting at the first geofence the user is inside
+    if type(data.get('any_inside', False)) is not bool or type(data.get('recent_hits_first', True)) is not bool or type(data.get('priority_group', 0)) is not int:
+        raise ValueError("'any_inside' and 'recent_hits_first' must be booleans and 'priority_group' an integer")
+
+    return number_of_geofences, chunk_size, packed
 
-# Fetch the geofence point coordinates once at startup
-get_geofence_coordinates()
 
 @app.route("/submit-user-location-ref", methods=['POST'])
 def submit_user_location_ref():
-    # Retrieve JSON payload
-    data = request.get_json()
+    # Retrieve JSON or binary payload
+    data, wire_format, parse_time = read_request_payload()
+
+    # The geofences this request is evaluated against, taken once as it arrives: the radii, priority positions and
+    # generation sent to the carer come from the same table as the results, even if the geofences are updated meanwhile
+    coefficients = geofence_coefficients
     
     if not data:
         return jsonify({
@@ -80,18 +1000,18 @@ def submit_user_location_ref():
             "message": "Request data is missing"
         }), 400
 
-    # Check if user encrypted location and public key are provided in the payload
-    if 'user_encrypted_location' not in data or 'public_key_n' not in data:
+    # Check if user encrypted location and public key (or its fingerprint) are provided in the payload
+    if 'user_encrypted_location' not in data or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
         return jsonify({
             "status": "error",
             "message": "Missing 'user_encrypted_location' or 'public_key_n' in request data"
         }), 400
     
-    public_key_n_current = get_carer_public_key()
-    public_key = paillier.PaillierPublicKey(public_key_n_current)
+    # Look up the carer's public key the user encrypted with (fetching it from the carer only when the registry needs a refresh)
+    public_key = get_registered_public_key(paillier_engine.payload_key_fingerprint(data))
 
     # Verify the provided public key matches the server's public key
-    if data['public_key_n'] != public_key_n_current:
+    if public_key is None:
         return jsonify({
             "status": "error",
             "message": "Public key mismatch. Encryption was not done with the correct public key."
@@ -106,16 +1026,45 @@ def submit_user_location_ref():
             "message": str(e)
         }), 400
     
+    # How many geofences to evaluate and how, the same for every submission endpoint
+    try:
+        number_of_geofences, chunk_size, packed = read_evaluation_options(data)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    # Optional batch window (s) to coalesce this request with others in, so the experiments can compare window sizes
+    batch_window = data.get('batch_window')
+    if batch_window is not None and (type(batch_window) not in (int, float) or not 0 <= batch_window <= BATCH_MAX_WINDOW):
+        return jsonify({
+            "status": "error",
+            "message": f"'batch_window' must be a number of seconds between 0 and {BATCH_MAX_WINDOW}"
+        }), 400
+
     request_size = len(request.data)
     # Write Recieved Communication KB Reference to file
     with open("commGeoOutRef.txt", "a") as f:
         f.write(f"{request_size/1024}\n")
 
+    # Write Parse Time (ms) Reference to file
+    with open("parseGeoOutRef.txt", "a") as f:
+        f.write(f"{parse_time*1000}\n")
+
+    # Short-circuit settings for the carer, which asynchronous jobs carry to their delivery too
+    short_circuit = get_carer_short_circuit(data, number_of_geofences, coefficients)
+
+    # With 'Prefer: respond-async', acknowledge as soon as the evaluation is queued and deliver the results in the background
+    if prefers_async():
+        return queue_job("ref", encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit)
+
     # Calculate intermediate values for carer to decrypt
-    intermediate_values = calculate_intermediate_haversine_value_ref(*encrypted_values, data['number_of_geofences'])
+    intermediate_values = calculate_intermediate_haversine_value_ref(*encrypted_values, number_of_geofences, chunk_size, packed, batch_window, coefficients)
+    radii = get_carer_geofence_radii(number_of_geofences, coefficients)
 
     # Submit intermediate values to carer
-    submit_geofence_results_to_carer(public_key_n_current, intermediate_values, "submit-geofence-result-ref")
+    submit_geofence_results_to_carer(public_key.n, intermediate_values, "submit-geofence-result-ref", packed, wire_format, radii, short_circuit)
 
     # Return a success response
     return jsonify({
@@ -126,8 +1075,12 @@ def submit_user_location_ref():
 
 @app.route("/submit-user-location-prop", methods=['POST'])
 def submit_user_location_prop():
-    # Retrieve JSON payload
-    data = request.get_json()
+    # Retrieve JSON or binary payload
+    data, wire_format, parse_time = read_request_payload()
+
+    # The geofences this request is evaluated against, taken once as it arrives: the radii, priority positions and
+    # generation sent to the carer come from the same table as the results, even if the geofences are updated meanwhile
+    coefficients = geofence_coefficients
     
     if not data:
         return jsonify({
@@ -135,18 +1088,18 @@ def submit_user_location_prop():
             "message": "Request data is missing"
         }), 400
 
-    # Check if user encrypted location and public key are provided in the payload
-    if 'user_encrypted_location' not in data or 'public_key_n' not in data:
+    # Check if user encrypted location and public key (or its fingerprint) are provided in the payload
+    if 'user_encrypted_location' not in data or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
         return jsonify({
             "status": "error",
             "message": "Missing 'user_encrypted_location' or 'public_key_n' in request data"
         }), 400
     
-    public_key_n_current = get_carer_public_key()
-    public_key = paillier.PaillierPublicKey(public_key_n_current)
+    # Look up the carer's public key the user encrypted with (fetching it from the carer only when the registry needs a refresh)
+    public_key = get_registered_public_key(paillier_engine.payload_key_fingerprint(data))
 
     # Verify the provided public key matches the carer's public key
-    if data['public_key_n'] != public_key_n_current:
+    if public_key is None:
         return jsonify({
             "status": "error",
             "message": "Public key mismatch. Encryption was not done with the correct public key."
@@ -161,16 +1114,45 @@ def submit_user_location_prop():
             "message": str(e)
         }), 400
     
+    # How many geofences to evaluate and how, the same for every submission endpoint
+    try:
+        number_of_geofences, chunk_size, packed = read_evaluation_options(data)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    # Optional batch window (s) to coalesce this request with others in, so the experiments can compare window sizes
+    batch_window = data.get('batch_window')
+    if batch_window is not None and (type(batch_window) not in (int, float) or not 0 <= batch_window <= BATCH_MAX_WINDOW):
+        return jsonify({
+            "status": "error",
+            "message": f"'batch_window' must be a number of seconds between 0 and {BATCH_MAX_WINDOW}"
+        }), 400
+
     request_size = len(request.data)
     # Write Recieved Communication KB Proposed to file
     with open("commGeoOutProp.txt", "a") as f:
         f.write(f"{request_size/1024}\n")
 
+    # Write Parse Time (ms) Proposed to file
+    with open("parseGeoOutProp.txt", "a") as f:
+        f.write(f"{parse_time*1000}\n")
+
+    # Short-circuit settings for the carer, which asynchronous jobs carry to their delivery too
+    short_circuit = get_carer_short_circuit(data, number_of_geofences, coefficients)
+
+    # With 'Prefer: respond-async', acknowledge as soon as the evaluation is queued and deliver the results in the background
+    if prefers_async():
+        return queue_job("prop", encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit)
+
     # Calculate intermediate values for carer to decrypt
-    intermediate_values = calculate_intermediate_haversine_value_prop(*encrypted_values, data['number_of_geofences'])
+    intermediate_values = calculate_intermediate_haversine_value_prop(*encrypted_values, number_of_geofences, chunk_size, packed, batch_window, coefficients)
+    radii = get_carer_geofence_radii(number_of_geofences, coefficients)
 
     # Submit intermediate values to key authority
-    submit_geofence_results_to_carer(public_key_n_current, intermediate_values, "submit-geofence-result-prop")
+    submit_geofence_results_to_carer(public_key.n, intermediate_values, "submit-geofence-result-prop", packed, wire_format, radii, short_circuit)
 
     # Return a success response
     return jsonify({
@@ -178,13 +1160,215 @@ def submit_user_location_prop():
         "message": "Location data recieved"
     }), 200
     
-def get_carer_public_key():
+@app.route("/submit-user-location-batch", methods=['POST'])
+def submit_user_location_batch():
+    # Several timestamped location fixes of one system ('ref' or 'prop') in one request, e.g. fixes a device buffered
+    # while offline or sampled at a high rate. They are evaluated together and their results sent to the carer in one request
+    data, wire_format, parse_time = read_request_payload()
+
+    # The geofences this request is evaluated against, taken once as it arrives: the radii, priority positions and
+    # generation sent to the carer come from the same table as the results, even if the geofences are updated meanwhile
+    coefficients = geofence_coefficients
+
+    if not data:
+        return jsonify({
+            "status": "error",
+            "message": "Request data is missing"
+        }), 400
+
+    # Check if the fixes and public key (or its fingerprint) are provided in the payload
+    fixes = data.get('fixes')
+    if type(fixes) is not list or not fixes or ('public_key_n' not in data and 'public_key_fingerprint' not in data):
+        return jsonify({
+            "status": "error",
+            "message": "Missing 'fixes' or 'public_key_n' in request data"
+        }), 400
+
+    if len(fixes) > FIX_BATCH_MAX_SIZE:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {FIX_BATCH_MAX_SIZE} fixes can be sent in one request"
+        }), 400
+
+    system = data.get('system', "prop")
+    if system not in ("ref", "prop"):
+        return jsonify({
+            "status": "error",
+            "message": "'system' must be 'ref' or 'prop'"
+        }), 400
+
+    # Look up the carer's public key the user encrypted with (fetching it from the carer only when the registry needs a refresh)
+    public_key = get_registered_public_key(paillier_engine.payload_key_fingerprint(data))
+
+    # Verify the provided public key matches the carer's public key
+    if public_key is None:
+        return jsonify({
+            "status": "error",
+            "message": "Public key mismatch. Encryption was not done with the correct public key."
+        }), 400
+
+    # Extract every fix's timestamp and encrypted values
+    timestamps = []
+    fixes_values = []
+    for i, fix in enumerate(fixes):
+        if not isinstance(fix, dict) or type(fix.get('timestamp')) not in (int, float) or 'user_encrypted_location' not in fix:
+            return jsonify({
+                "status": "error",
+                "message": f"Fix {i} needs a numeric 'timestamp' and 'user_encrypted_location'"
+            }), 400
+
+        try:
+            if system == "ref":
+                encrypted_values = extract_encrypted_location_ref(fix, public_key)
+            else:
+                encrypted_values = extract_encrypted_location_prop(fix, public_key)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Fix {i}: {e}"
+            }), 400
+
+        timestamps.append(fix['timestamp'])
+        fixes_values.append(encrypted_values)
+
+    # How many geofences to evaluate and how, the same for every submission endpoint
+    try:
+        number_of_geofences, chunk_size, packed = read_evaluation_options(data)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    suffix = "Ref" if system == "ref" else "Prop"
+
+    # Write Recieved Communication KB per fix to file
+    with open(f"commGeoFixOut{suffix}.txt", "a") as f:
+        f.write(f"{len(request.data)/1024/len(fixes)}\n")
+
+    # Calculate intermediate values of every fix for carer to decrypt
+    fixes_intermediate_values = calculate_intermediate_haversine_values_batch(system, fixes_values, number_of_geofences, chunk_size, packed, coefficients)
+    radii = get_carer_geofence_radii(number_of_geofences, coefficients)
+    short_circuit = get_carer_short_circuit(data, number_of_geofences, coefficients)
+
+    # Submit the intermediate values of all fixes to key authority in one request
+    carer_response = submit_fix_results_to_carer(public_key.n, system, timestamps, fixes_intermediate_values, packed, wire_format, radii, short_circuit)
+
+    if carer_response is None:
+        return jsonify({
+            "status": "error",
+            "message": "Couldn't deliver the results to the carer"
+        }), 502
+
+    # Return the carer's outcome of every fix (whether it was processed, not whether the user is inside a geofence)
+    return jsonify({
+        "status": "success",
+        "message": "Location fixes recieved",
+        "fixes": [
+            {"timestamp": fix.get('timestamp'), "status": fix.get('status'), "message": fix.get('message')}
+            for fix in carer_response.get('fixes', [])
+        ]
+    }), 200
+
+
+def read_request_payload():
+    # Parse the request body by its content type, returning the payload, its wire format and the parse time
+    start = time.time()
+
+    if request.mimetype == paillier_engine.BINARY_CONTENT_TYPE:
+        wire_format = "binary"
+        try:
+            data = paillier_engine.decode_binary_payload(request.get_data())
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid binary payload: {e}")
+            data = None
+    else:
+        wire_format = "json"
+        data = request.get_json()
+
+    return data, wire_format, time.time() - start
+
+
+def get_registered_public_key(fingerprint):
+    # The carer's public key with this fingerprint, or None if no key the carer accepts has it.
+    # The registry is refreshed from the carer once its TTL has passed, and early when a fingerprint is unknown
+    # (the carer has changed its key), at most once per KEY_REGISTRY_MIN_REFRESH
+    with key_registry_lock:
+        refreshed_at = key_registry['refreshed_at']
+        now = time.time()
+
+        expired = refreshed_at is None or now - refreshed_at > KEY_REGISTRY_TTL
+        unknown = fingerprint not in key_registry['keys'] and (refreshed_at is None or now - refreshed_at > KEY_REGISTRY_MIN_REFRESH)
+
+        if not (expired or unknown):
+            return key_registry['keys'].get(fingerprint)
+
+        # One thread fetches the keys. Meanwhile the others are served from the cached keys, and only those whose
+        # fingerprint isn't cached wait for the fetch's result
+        if key_registry['refreshing']:
+            if fingerprint not in key_registry['keys']:
+                key_registry_refreshed.wait_for(lambda: not key_registry['refreshing'])
+            return key_registry['keys'].get(fingerprint)
+
+        key_registry['refreshing'] = True
+
+    # Fetched without the lock, then swapped in under it
+    public_key_ns = None
+    try:
+        public_key_ns = get_carer_public_keys()
+    finally:
+        with key_registry_lock:
+            try:
+                refresh_key_registry(public_key_ns)
+            finally:
+                key_registry['refreshing'] = False
+                key_registry_refreshed.notify_all()
+
+    with key_registry_lock:
+        return key_registry['keys'].get(fingerprint)
+
+
+def refresh_key_registry(public_key_ns):
+    # Swap in the keys fetched from the carer (called with key_registry_lock held).
+    # Keep serving the cached keys if the carer can't be reached
+    if public_key_ns is None:
+        return
+
+    # Only the keys the carer accepts are valid: its current key, and after a rotation the key it replaced until
+    # the carer's grace period for it ends. Keys shorter than MIN_KEY_SIZE are never accepted, so locations
+    # encrypted under them are rejected as for an unknown key
+    keys = {}
+    for public_key_n in public_key_ns:
+        fingerprint = paillier_engine.key_fingerprint(public_key_n)
+        if public_key_n.bit_length() < paillier_engine.MIN_KEY_SIZE:
+            print(f"Rejected carer public key {fingerprint}: {public_key_n.bit_length()} bits, below MIN_KEY_SIZE {paillier_engine.MIN_KEY_SIZE}")
+            continue
+        if fingerprint not in key_registry['keys']:
+            print(f"Registered carer public key {fingerprint}")
+        keys[fingerprint] = key_registry['keys'].get(fingerprint) or paillier.PaillierPublicKey(public_key_n)
+
+    key_registry['keys'] = keys
+    key_registry['refreshed_at'] = time.time()
+    key_registry['current'] = public_key_ns[0] if public_key_ns[0].bit_length() >= paillier_engine.MIN_KEY_SIZE else None
+
+
+def start_carer_obfuscation_pool(public_key):
+    # Obfuscation factors are kept precomputed for the carer's current key only. Requests for the key a rotation
+    # replaced (during the carer's grace period) compute theirs on demand, rather than restarting the pool for each key
+    if key_registry.get('current') in (None, public_key.n):
+        paillier_engine.start_obfuscation_pool(public_key)
+
+
+def get_carer_public_keys():
+    # Moduli of the public keys the carer accepts, its current key first (carers without key rotation only send that)
     try:
-        response = requests.get('http://carer:5002/get-public-key')
+        response = http_pool.get('http://carer:5002/get-public-key')
         response.raise_for_status()
 
         data = response.json()
-        return data.get('public_key_n') 
+        if data.get('public_key_n') is None:
+            return None
+        return data.get('accepted_public_keys') or [data['public_key_n']]
 
     except requests.exceptions.RequestException as e:
         # Catch HTTP errors (from raise_for_status) and other request-related issues
@@ -209,14 +1393,14 @@ def extract_encrypted_location_ref(data, public_key):
     if missing_keys:
         raise ValueError(f"Missing required keys in 'user_encrypted_location': {', '.join(missing_keys)}")
     
-    # Extract and deserialize data
+    # Extract and deserialize data, rejecting ciphertexts and exponents that aren't valid integers
     user_location_data = data['user_encrypted_location']
-    alpha_sq = paillier.EncryptedNumber(public_key, user_location_data.get('alpha_sq_ct'), user_location_data.get('alpha_sq_exp'))
-    gamma_sq = paillier.EncryptedNumber(public_key, user_location_data.get('gamma_sq_ct'), user_location_data.get('gamma_sq_exp'))
-    alpha_gamma_product_A = paillier.EncryptedNumber(public_key, user_location_data.get('alpha_gamma_product_A_ct'), user_location_data.get('alpha_gamma_product_A_exp'))
-    zeta_theta_sq_product_A = paillier.EncryptedNumber(public_key, user_location_data.get('zeta_theta_sq_product_A_ct'), user_location_data.get('zeta_theta_sq_product_A_exp'))
-    zeta_theta_mu_product_A = paillier.EncryptedNumber(public_key, user_location_data.get('zeta_theta_mu_product_A_ct'), user_location_data.get('zeta_theta_mu_product_A_exp'))
-    zeta_mu_sq_product_A = paillier.EncryptedNumber(public_key, user_location_data.get('zeta_mu_sq_product_A_ct'), user_location_data.get('zeta_mu_sq_product_A_exp'))
+    alpha_sq = paillier_engine.client_encrypted_number(public_key, user_location_data.get('alpha_sq_ct'), user_location_data.get('alpha_sq_exp'))
+    gamma_sq = paillier_engine.client_encrypted_number(public_key, user_location_data.get('gamma_sq_ct'), user_location_data.get('gamma_sq_exp'))
+    alpha_gamma_product_A = paillier_engine.client_encrypted_number(public_key, user_location_data.get('alpha_gamma_product_A_ct'), user_location_data.get('alpha_gamma_product_A_exp'))
+    zeta_theta_sq_product_A = paillier_engine.client_encrypted_number(public_key, user_location_data.get('zeta_theta_sq_product_A_ct'), user_location_data.get('zeta_theta_sq_product_A_exp'))
+    zeta_theta_mu_product_A = paillier_engine.client_encrypted_number(public_key, user_location_data.get('zeta_theta_mu_product_A_ct'), user_location_data.get('zeta_theta_mu_product_A_exp'))
+    zeta_mu_sq_product_A = paillier_engine.client_encrypted_number(public_key, user_location_data.get('zeta_mu_sq_product_A_ct'), user_location_data.get('zeta_mu_sq_product_A_exp'))
     
     # Print encrypted values to confirm they are encrypted
     print("alpha_sq_enc:", alpha_sq)
@@ -245,11 +1429,11 @@ def extract_encrypted_location_prop(data, public_key):
     if missing_keys:
         raise ValueError(f"Missing required keys in 'user_encrypted_location': {', '.join(missing_keys)}")
     
-    # Extract and deserialize data
+    # Extract and deserialize data, rejecting ciphertexts and exponents that aren't valid integers
     user_location_data = data['user_encrypted_location']
-    c1 = paillier.EncryptedNumber(public_key, user_location_data.get('c1_ct'), user_location_data.get('c1_exp'))
-    c2 = paillier.EncryptedNumber(public_key, user_location_data.get('c2_ct'), user_location_data.get('c2_exp'))
-    c3 = paillier.EncryptedNumber(public_key, user_location_data.get('c3_ct'), user_location_data.get('c3_exp'))
+    c1 = paillier_engine.client_encrypted_number(public_key, user_location_data.get('c1_ct'), user_location_data.get('c1_exp'))
+    c2 = paillier_engine.client_encrypted_number(public_key, user_location_data.get('c2_ct'), user_location_data.get('c2_exp'))
+    c3 = paillier_engine.client_encrypted_number(public_key, user_location_data.get('c3_ct'), user_location_data.get('c3_exp'))
 
     
     # Print encrypted values to confirm they are encrypted
@@ -263,39 +1447,23 @@ def extract_encrypted_location_prop(data, public_key):
 def calculate_intermediate_haversine_value_ref(
         alpha_sq, gamma_sq, alpha_gamma_product_A, 
         zeta_theta_sq_product_A, zeta_theta_mu_product_A, zeta_mu_sq_product_A,
-        number_of_geofences):
+        number_of_geofences, chunk_size=None, packed=False, batch_window=None, coefficients=None):
+
+    # Encode the coefficients for this key before timing, as they are cached for every later request (unless the
+    # pool processes evaluate and encode them), and keep obfuscation factors for it precomputed in the background
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    if not uses_process_pool(number_of_geofences, chunk_size, coefficients):
+        get_encoded_geofence_coefficients(alpha_sq.public_key, 'ref', 0, number_of_geofences, coefficients)
+    start_carer_obfuscation_pool(alpha_sq.public_key)
     
     start = time.time()
 
-    haversine_intermediate_values = []
-
-    for center_longitude, center_latitude in geofence_coordinates[:number_of_geofences]: 
-        # Terms derived from Center point (original, squared, and combined where applicable)
-        beta = math.sin(center_latitude / 2)
-        beta_sq = beta**2
-        delta = math.cos(center_latitude / 2)
-        delta_sq = delta**2
-        eta = math.cos(center_latitude)
-        lambda_ = math.cos(center_longitude / 2)
-        lambda_sq = lambda_**2
-        nu = math.sin(center_longitude / 2)
-        nu_sq = nu**2
-
-        beta_delta_product_B = beta * delta             # B-specific part for term2
-        eta_lambda_sq_product_B = eta * lambda_sq       # B-specific part for term4
-        eta_lambda_nu_product_B = eta * lambda_ * nu    # B-specific part for term5
-        eta_nu_sq_product_B = eta * nu_sq               # B-specific part for term6
-        
-        # Compute haversine intermediate value
-        term1 = alpha_sq * beta_sq
-        term2 = -2 * (alpha_gamma_product_A * beta_delta_product_B)
-        term3 = gamma_sq * delta_sq
-        term4 = zeta_theta_sq_product_A * eta_lambda_sq_product_B
-        term5 = -2 * (zeta_theta_mu_product_A * eta_lambda_nu_product_B)
-        term6 = zeta_mu_sq_product_A * eta_nu_sq_product_B
-        haversine_intermediate = term1 + term2 + term3 + term4 + term5 + term6
-
-        haversine_intermediate_values.append(haversine_intermediate)  # Store computation result
+    # Compute haversine intermediate values: the sum of the user's A-terms times each geofence's B-terms
+    # (the -2 factors of term2 and term5 are folded into the coefficients)
+    haversine_intermediate_values, packing, multiplications, processes, batch = evaluate_geofences(
+        (alpha_sq, alpha_gamma_product_A, gamma_sq, zeta_theta_sq_product_A, zeta_theta_mu_product_A, zeta_mu_sq_product_A),
+        'ref', number_of_geofences, chunk_size=chunk_size, packed=packed, batch_window=batch_window, coefficients=coefficients
+    )
 
     end = time.time()
 
@@ -305,28 +1473,62 @@ def calculate_intermediate_haversine_value_ref(
     with open("runCompOutRef.txt", "a") as f:
         f.write(f"{(end-start)}\n")
 
-    # Serialize results after timing ends
+    # Write Computation Modular Multiplications Reference (generic pow vs. path taken) to files
+    with open("runMulGenericOutRef.txt", "a") as f:
+        f.write(f"{multiplications['generic']}\n")
+    with open("runMulOutRef.txt", "a") as f:
+        f.write(f"{multiplications['actual']}\n")
+
+    # Write number of processes the computation Reference was spread over to file
+    with open("runParOutRef.txt", "a") as f:
+        f.write(f"{processes}\n")
+
+    # Write the number of requests the computation Reference was coalesced with, and the time (ms) spent waiting for them, to files
+    with open("runBatchOutRef.txt", "a") as f:
+        f.write(f"{batch['size']}\n")
+    with open("runBatchWaitOutRef.txt", "a") as f:
+        f.write(f"{batch['wait']*1000}\n")
+
+    # Serialize results, timed as their own phase as each result is obfuscated here
+    # (packed ciphertexts also carry their slot layout)
+    start = time.time()
+
     serialized_values = []
-    for intermediate_value in haversine_intermediate_values:
+    for i, intermediate_value in enumerate(haversine_intermediate_values):
         ciphertext = intermediate_value.ciphertext()
         exponent = intermediate_value.exponent
-        serialized_values.append({'ciphertext': ciphertext, 'exponent': exponent})
+        serialized_value = {'ciphertext': ciphertext, 'exponent': exponent}
+        if packing is not None:
+            serialized_value['slots'], serialized_value['slot_bits'] = packing[i]
+        serialized_values.append(serialized_value)
+
+    end = time.time()
+
+    print("(Runtime Performance Experiment) Serialization Runtime Reference:", round((end-start), 3), "s")
+
+    # Write Serialization Runtime Reference to file
+    with open("runSerOutRef.txt", "a") as f:
+        f.write(f"{(end-start)}\n")
 
     return serialized_values
 
 
-def calculate_intermediate_haversine_value_prop(c1, c2, c3, number_of_geofences):
+def calculate_intermediate_haversine_value_prop(c1, c2, c3, number_of_geofences, chunk_size=None, packed=False, batch_window=None, coefficients=None):
+
+    # Encode the coefficients for this key before timing, as they are cached for every later request (unless the
+    # pool processes evaluate and encode them), and keep obfuscation factors for it precomputed in the background
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+    if not uses_process_pool(number_of_geofences, chunk_size, coefficients):
+        get_encoded_geofence_coefficients(c1.public_key, 'prop', 0, number_of_geofences, coefficients)
+    start_carer_obfuscation_pool(c1.public_key)
     
     start = time.time()
 
-    haversine_intermediate_values = []
-
-    for center_longitude, center_latitude in geofence_coordinates[:number_of_geofences]: 
-        # Compute haversine intermediate value
-        
-        haversine_intermediate = 1 - c1 * math.sin(center_latitude) - c2 * math.cos(center_latitude) * math.cos(center_longitude) - c3 * math.cos(center_latitude) * math.sin(center_longitude)
-
-        haversine_intermediate_values.append(haversine_intermediate)  # Store computation result
+    # Compute haversine intermediate values: 1 - c·B for each geofence, i.e. c·(-B) + 1 with the pre-negated unit-vector terms
+    haversine_intermediate_values, packing, multiplications, processes, batch = evaluate_geofences(
+        (c1, c2, c3),
+        'prop', number_of_geofences, constant=1, chunk_size=chunk_size, packed=packed, batch_window=batch_window, coefficients=coefficients
+    )
 
     end = time.time()
 
@@ -336,28 +1538,182 @@ def calculate_intermediate_haversine_value_prop(c1, c2, c3, number_of_geofences)
     with open("runCompOutProp.txt", "a") as f:
         f.write(f"{(end-start)}\n")
 
-    # Serialize results after timing ends
+    # Write Computation Modular Multiplications Proposed (generic pow vs. path taken) to files
+    with open("runMulGenericOutProp.txt", "a") as f:
+        f.write(f"{multiplications['generic']}\n")
+    with open("runMulOutProp.txt", "a") as f:
+        f.write(f"{multiplications['actual']}\n")
+
+    # Write number of processes the computation Proposed was spread over to file
+    with open("runParOutProp.txt", "a") as f:
+        f.write(f"{processes}\n")
+
+    # Write the number of requests the computation Proposed was coalesced with, and the time (ms) spent waiting for them, to files
+    with open("runBatchOutProp.txt", "a") as f:
+        f.write(f"{batch['size']}\n")
+    with open("runBatchWaitOutProp.txt", "a") as f:
+        f.write(f"{batch['wait']*1000}\n")
+
+    # Serialize results, timed as their own phase as each result is obfuscated here
+    # (packed ciphertexts also carry their slot layout)
+    start = time.time()
+
     serialized_values = []
-    for intermediate_value in haversine_intermediate_values:
+    for i, intermediate_value in enumerate(haversine_intermediate_values):
         ciphertext = intermediate_value.ciphertext()
         exponent = intermediate_value.exponent
-        serialized_values.append({'ciphertext': ciphertext, 'exponent': exponent})
+        serialized_value = {'ciphertext': ciphertext, 'exponent': exponent}
+        if packing is not None:
+            serialized_value['slots'], serialized_value['slot_bits'] = packing[i]
+        serialized_values.append(serialized_value)
+
+    end = time.time()
+
+    print("(Runtime Performance Experiment) Serialization Runtime Proposed:", round((end-start), 3), "s")
+
+    # Write Serialization Runtime Proposed to file
+    with open("runSerOutProp.txt", "a") as f:
+        f.write(f"{(end-start)}\n")
 
     return serialized_values
 
 
-def submit_geofence_results_to_carer(public_key_n, intermediate_values, endpoint):
+def calculate_intermediate_haversine_values_batch(system, fixes_values, number_of_geofences, chunk_size=None, packed=False, coefficients=None):
+    # Intermediate values of several fixes of one system, in fix order. Fixes whose ciphertexts share exponents are
+    # evaluated together, sharing the work that doesn't depend on the ciphertexts (as coalesced requests do), unless the
+    # geofences are spread over the process pool, where each fix is evaluated in parallel chunks instead
+    public_key = fixes_values[0][0].public_key
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+
+    # Encode the coefficients for this key before timing, as they are cached for every later request (unless the
+    # pool processes evaluate and encode them), and keep obfuscation factors for it precomputed in the background
+    if not uses_process_pool(number_of_geofences, chunk_size, coefficients):
+        get_encoded_geofence_coefficients(public_key, system, 0, number_of_geofences, coefficients)
+    start_carer_obfuscation_pool(public_key)
+
+    start = time.time()
+
+    # Reference: the sum of the user's A-terms times each geofence's B-terms. Proposed: c·(-B) + 1
+    if system == "ref":
+        users_values = [(alpha_sq, alpha_gamma_product_A, gamma_sq, zeta_theta_sq_product_A, zeta_theta_mu_product_A, zeta_mu_sq_product_A)
+                        for alpha_sq, gamma_sq, alpha_gamma_product_A, zeta_theta_sq_product_A, zeta_theta_mu_product_A, zeta_mu_sq_product_A in fixes_values]
+        constant = 0
+    else:
+        users_values = [tuple(values) for values in fixes_values]
+        constant = 1
+
+    number_of_geofences = len(coefficients['prop_terms'][:number_of_geofences])
+    if not uses_process_pool(number_of_geofences, chunk_size, coefficients):
+        submissions = [{
+            'user_values': user_values,
+            'system': system,
+            'number_of_geofences': number_of_geofences,
+            'constant': constant,
+            'packed': packed,
+            'coefficients': coefficients,
+            'submitted_at': start
+        } for user_values in users_values]
+        evaluate_batch(submissions)
+
+        for submission in submissions:
+            if 'error' in submission:
+                raise submission['error']
+        results = [submission['result'][:2] for submission in submissions]
+    else:
+        results = [evaluate_geofences(user_values, system, number_of_geofences, constant, chunk_size, packed, batch_window=0, coefficients=coefficients)[:2] for user_values in users_values]
+
+    end = time.time()
+
+    print(f"(Runtime Performance Experiment) Computation Runtime per Fix {system} ({len(fixes_values)} fixes):", round((end-start)/len(fixes_values), 3), "s")
+
+    # Write Computation Runtime per fix to file
+    with open(f"runCompFixOut{'Ref' if system == 'ref' else 'Prop'}.txt", "a") as f:
+        f.write(f"{(end-start)/len(fixes_values)}\n")
+
+    # Serialize results (packed ciphertexts also carry their slot layout)
+    fixes_serialized_values = []
+    for intermediate_values, packing in results:
+        serialized_values = []
+        for i, intermediate_value in enumerate(intermediate_values):
+            serialized_value = {'ciphertext': intermediate_value.ciphertext(), 'exponent': intermediate_value.exponent}
+            if packing is not None:
+                serialized_value['slots'], serialized_value['slot_bits'] = packing[i]
+            serialized_values.append(serialized_value)
+        fixes_serialized_values.append(serialized_values)
+
+    return fixes_serialized_values
+
+
+def submit_fix_results_to_carer(public_key_n, system, timestamps, fixes_intermediate_values, packed=False, wire_format="json", radii=None, short_circuit=None):
+    try:
+        payload = {
+            "public_key_fingerprint": paillier_engine.key_fingerprint(public_key_n),
+            "system": system,
+            "fixes": [
+                {"timestamp": timestamp, "encrypted_results": intermediate_values}
+                for timestamp, intermediate_values in zip(timestamps, fixes_intermediate_values)
+            ]
+        }
+
+        if packed:
+            payload["packed"] = True
+
+        # Every fix is compared against the same geofences, so their radii are sent once
+        if radii is not None:
+            payload["radii"] = radii
+
+        if short_circuit is not None:
+            payload.update(short_circuit)
+
+        # Make the POST request, in the wire format the user's request came in, over the shared keep-alive connections
+        if wire_format == "binary":
+            response = http_pool.post(
+                "http://carer:5002/submit-geofence-results-fixes",
+                data=paillier_engine.encode_binary_payload(payload, public_key_n),
+                headers={"Content-Type": paillier_engine.BINARY_CONTENT_TYPE}
+            )
+        else:
+            response = http_pool.post("http://carer:5002/submit-geofence-results-fixes", json=payload)
+
+        response.raise_for_status()
+
+        return response.json()
+
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # Catch HTTP errors (from raise_for_status), other request-related issues and invalid responses
+        print(f"Failed to post fix results to key authority: {e}")
+        return None
+
+
+def submit_geofence_results_to_carer(public_key_n, intermediate_values, endpoint, packed=False, wire_format="json", radii=None, short_circuit=None):
     try:
+        # The carer's key is named by its fingerprint rather than the full modulus
         payload = {
-            "public_key_n": public_key_n, 
+            "public_key_fingerprint": paillier_engine.key_fingerprint(public_key_n), 
             "encrypted_results": intermediate_values
         }
+
+        if packed:
+            payload["packed"] = True
+
+        if radii is not None:
+            payload["radii"] = radii
+
+        if short_circuit is not None:
+            payload.update(short_circuit)
         
-        # Make the POST request
-        response = requests.post(
-            f"http://carer:5002/{endpoint}",
-            json=payload
-        )
+        # Make the POST request, in the wire format the user's request came in, over the shared keep-alive connections
+        if wire_format == "binary":
+            response = http_pool.post(
+                f"http://carer:5002/{endpoint}",
+                data=paillier_engine.encode_binary_payload(payload, public_key_n),
+                headers={"Content-Type": paillier_engine.BINARY_CONTENT_TYPE}
+            )
+        else:
+            response = http_pool.post(
+                f"http://carer:5002/{endpoint}",
+                json=payload
+            )
 
         response.raise_for_status()
 
@@ -368,5 +1724,257 @@ def submit_geofence_results_to_carer(public_key_n, intermediate_values, endpoint
         print(f"Failed to post results to key authority: {e}")
         return None
 
+@app.route("/jobs/<job_id>", methods=['GET'])
+def get_job_status(job_id):
+    # State of a job accepted with 'Prefer: respond-async': queued, evaluating, delivering, delivered or failed
+    job = read_job_state(job_id)
+
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": "Unknown job id"
+        }), 404
+
+    return jsonify(job), 200
+
+
+def prefers_async():
+    # RFC 7240 'Prefer' header, e.g. 'Prefer: respond-async, wait=10'
+    preferences = [preference.split(';')[0].split('=')[0].strip().lower() for preference in request.headers.get('Prefer', '').split(',')]
+    return 'respond-async' in preferences
+
+
+def queue_job(system, encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients=None, short_circuit=None):
+    # The job keeps the table the request arrived with, evaluated and described to the carer however long it queues,
+    # and the request's short-circuit settings
+    start_job_workers()
+    coefficients = geofence_coefficients if coefficients is None else coefficients
+
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "system": system,
+        "status": "queued",
+        "submitted_at": time.time()
+    }
+    write_job_state(job)
+
+    try:
+        job_queue.put_nowait((job, encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit))
+    except queue.Full:
+        # Backpressure: the client should retry later rather than queue work this worker can't keep up with
+        remove_job_state(job['job_id'])
+        return jsonify({
+            "status": "error",
+            "message": "Too many queued jobs, retry later"
+        }), 503, {"Retry-After": "1"}
+
+    status_url = f"/jobs/{job['job_id']}"
+    return jsonify({
+        "status": "accepted",
+        "message": "Location data recieved",
+        "job_id": job['job_id'],
+        "status_url": status_url
+    }), 202, {"Location": status_url, "Preference-Applied": "respond-async"}
+
+
+def start_job_workers():
+    global job_queue, delivery_queue, job_workers_pid
+
+    with job_workers_lock:
+        if job_workers_pid == os.getpid():
+            return
+
+        os.makedirs(JOB_STATE_DIR, exist_ok=True)
+        job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+        delivery_queue = queue.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+        threading.Thread(target=evaluate_jobs, args=(job_queue, delivery_queue), daemon=True).start()
+        threading.Thread(target=deliver_jobs, args=(delivery_queue,), daemon=True).start()
+        job_workers_pid = os.getpid()
+
+
+def evaluate_jobs(jobs, deliveries):
+    # Runs for the life of the worker: anything a job raises fails that job only, never the thread
+    while True:
+        job, encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit = jobs.get()
+        try:
+            evaluate_job(deliveries, job, encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit)
+        except Exception as e:
+            print(f"Failed to evaluate job {job['job_id']}: {e}")
+            fail_jobs([job], f"Evaluation failed: {e}")
+
+
+def evaluate_job(deliveries, job, encrypted_values, number_of_geofences, chunk_size, packed, public_key, wire_format, coefficients, short_circuit):
+    update_job_state(job, status="evaluating")
+
+    # Jobs are evaluated one at a time here, so there is nothing to coalesce them with (batch window 0)
+    if job['system'] == "ref":
+        intermediate_values = calculate_intermediate_haversine_value_ref(*encrypted_values, number_of_geofences, chunk_size, packed, 0, coefficients)
+    else:
+        intermediate_values = calculate_intermediate_haversine_value_prop(*encrypted_values, number_of_geofences, chunk_size, packed, 0, coefficients)
+
+    radii = get_carer_geofence_radii(number_of_geofences, coefficients)
+    update_job_state(job, status="delivering", evaluated_at=time.time())
+
+    # Blocks while the delivery queue is full, which in turn lets the job queue fill up
+    deliveries.put((job, public_key.n, intermediate_values, packed, wire_format, radii, short_circuit))
+
+
+def deliver_jobs(deliveries):
+    while True:
+        # Wait for a job, then collect any others that arrive within the batch window
+        batch = [deliveries.get()]
+        deadline = time.time() + DELIVERY_BATCH_WINDOW
+        while len(batch) < DELIVERY_BATCH_SIZE:
+            try:
+                batch.append(deliveries.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+
+        # One carer request per key and wire format
+        groups = {}
+        for job, public_key_n, intermediate_values, packed, wire_format, radii, short_circuit in batch:
+            groups.setdefault((public_key_n, wire_format), []).append((job, intermediate_values, packed, radii, short_circuit))
+
+        # Anything a batch raises (e.g. results that can't be encoded) fails that batch's jobs only, never the thread
+        for (public_key_n, wire_format), group in groups.items():
+            try:
+                deliver_job_batch(public_key_n, group, wire_format)
+            except Exception as e:
+                print(f"Failed to deliver {len(group)} job(s) to the carer: {e}")
+                fail_jobs([job for job, intermediate_values, packed, radii, short_circuit in group], f"Delivery failed: {e}")
+
+        cleanup_job_states()
+
+
+def fail_jobs(jobs, message):
+    # Mark the jobs failed where their state can still be written, which may be what went wrong in the first place
+    for job in jobs:
+        try:
+            update_job_state(job, status="failed", message=message)
+        except OSError as e:
+            print(f"Failed to record job {job['job_id']} as failed: {e}")
+
+
+def deliver_job_batch(public_key_n, batch, wire_format="json"):
+    # Each delivery carries its job's short-circuit settings, if any, as a single-location request would
+    payload = {
+        "public_key_fingerprint": paillier_engine.key_fingerprint(public_key_n),
+        "deliveries": [
+            dict({"job_id": job['job_id'], "system": job['system'], "encrypted_results": intermediate_values, "packed": packed, "radii": radii}, **(short_circuit or {}))
+            for job, intermediate_values, packed, radii, short_circuit in batch
+        ]
+    }
+
+    for attempt in range(DELIVERY_RETRIES + 1):
+        try:
+            if wire_format == "binary":
+                response = http_pool.post(
+                    "http://carer:5002/submit-geofence-results-batch",
+                    data=paillier_engine.encode_binary_payload(payload, public_key_n),
+                    headers={"Content-Type": paillier_engine.BINARY_CONTENT_TYPE}
+                )
+            else:
+                response = http_pool.post("http://carer:5002/submit-geofence-results-batch", json=payload)
+
+            # Server errors are retried, client errors mean the batch itself was rejected
+            if response.status_code < 500:
+                break
+            error = f"Carer responded with {response.status_code}"
+
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+
+        print(f"Failed to deliver {len(batch)} job(s) to the carer (attempt {attempt + 1}): {error}")
+        for job, intermediate_values, packed, radii, short_circuit in batch:
+            update_job_state(job, attempts=attempt + 1)
+
+        if attempt < DELIVERY_RETRIES:
+            time.sleep(DELIVERY_BACKOFF * 2 ** attempt)
+    else:
+        for job, intermediate_values, packed, radii, short_circuit in batch:
+            update_job_state(job, status="failed", message=f"Delivery failed: {error}")
+        return
+
+    # Anything but a JSON object (with an object of results) counts as no results
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    body = body if isinstance(body, dict) else {}
+    results = body.get("results") if response.status_code == 200 else None
+    results = results if isinstance(results, dict) else {}
+    message = body.get("message") if isinstance(body.get("message"), str) else ""
+
+    delivered_at = time.time()
+    for job, intermediate_values, packed, radii, short_circuit in batch:
+        result = results.get(job['job_id'])
+        result = result if isinstance(result, dict) else None
+        if result is not None and result.get("status") == "success":
+            update_job_state(job, status="delivered", delivered_at=delivered_at)
+        else:
+            update_job_state(job, status="failed", message=(result or {}).get("message") or message or f"Carer responded with {response.status_code}")
+
+
+def job_state_path(job_id):
+    return os.path.join(JOB_STATE_DIR, f"{job_id}.json")
+
+
+def write_job_state(job):
+    # Write to a temporary file and rename it, so a status poll never reads a partly written file
+    path = job_state_path(job['job_id'])
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(job, f)
+    os.replace(temporary_path, path)
+
+
+def update_job_state(job, **changes):
+    job.update(changes)
+    write_job_state(job)
+
+
+def read_job_state(job_id):
+    # Job ids are uuid4 hex strings, anything else can't name a job file
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+
+    try:
+        with open(job_state_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_job_state(job_id):
+    try:
+        os.remove(job_state_path(job_id))
+    except OSError:
+        pass
+
+
+def cleanup_job_states():
+    global job_states_cleaned_at
+
+    # At most once a minute, remove the state of jobs older than JOB_STATE_TTL
+    now = time.time()
+    if now - job_states_cleaned_at < 60:
+        return
+    job_states_cleaned_at = now
+
+    try:
+        file_names = os.listdir(JOB_STATE_DIR)
+    except OSError as e:
+        print(f"Failed to clean up job states in {JOB_STATE_DIR}: {e}")
+        return
+
+    for file_name in file_names:
+        path = os.path.join(JOB_STATE_DIR, file_name)
+        try:
+            if now - os.path.getmtime(path) > JOB_STATE_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
 if __name__ == '__main__':
+    start_process_pool()
     app.run(debug=True, host="0.0.0.0", port=5001) 
\ No newline at end of file
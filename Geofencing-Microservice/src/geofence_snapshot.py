@@ -0,0 +1,948 @@
+import numpy as np
+import xml.etree.ElementTree as ElementTree
+import argparse
+import multiprocessing
+import tracemalloc
+import shutil
+import struct
+import math
+import json
+import time
+import csv
+import sys
+import re
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows, where peak RSS isn't reported
+
+# Versioned binary snapshot of the geofence catalogue, so the service can memory-map it at startup instead of
+# querying Overpass, and every gunicorn worker (and pool process) maps the same read-only pages rather than holding
+# its own copy. Layout (little-endian): a 64-byte header, then one column after another (the 8-byte columns first,
+# so every column is aligned). Active geofences come first, so the geofences that are evaluated are a prefix of
+# every column:
+#   ids          int64   [count]       source ids (OSM node ids for Overpass results)
+#   coordinates  float64 [count, 2]    centres as (longitude, latitude) in radians
+#   prop_terms   float64 [count, 3]    proposed system coefficients (negated unit-vector terms)
+#   ref_terms    float64 [count, 6]    reference system coefficients
+#   radius       float64 [count]       radius in metres
+#   group        int32   [count]       group the geofence belongs to (e.g. one per carer or site), 0 by default
+#   active       bool    [count]       whether the geofence is evaluated, inactive geofences are kept but skipped
+SNAPSHOT_MAGIC = b"GEOFSNAP"
+SNAPSHOT_VERSION = 3
+# Magic, version, header size, geofence count, built at (unix time), active geofences, and the generation, one more
+# than the snapshot it replaced, so workers can tell which catalogue they serve
+SNAPSHOT_HEADER = struct.Struct("<8sIIQdQQ")
+SNAPSHOT_HEADER_SIZE = 64
+
+# Columns in file order, with their dtype and values per geofence
+SNAPSHOT_COLUMNS = [
+    ('ids', np.int64, 1),
+    ('coordinates', np.float64, 2),
+    ('prop_terms', np.float64, 3),
+    ('ref_terms', np.float64, 6),
+    ('radius', np.float64, 1),
+    ('group', np.int32, 1),
+    ('active', np.bool_, 1)
+]
+
+# Radius in metres of geofences whose source doesn't give one (the carer's radius)
+DEFAULT_GEOFENCE_RADIUS = float(os.environ.get("GEOFENCE_RADIUS", "100"))
+
+# Geofences read from a local source before they are sanitised and written, bounding the importer's memory
+IMPORT_CHUNK_SIZE = int(os.environ.get("GEOFENCE_IMPORT_CHUNK_SIZE", "50000"))
+
+# Source formats by file extension
+SOURCE_FORMATS = {'.geojson': "geojson", '.json': "geojson", '.geojsonl': "geojson", '.geojsons': "geojson",
+                  '.csv': "csv", '.osm': "osm", '.xml': "osm"}
+
+# CSV column names accepted for each value (case-insensitive)
+CSV_COLUMNS = {'id': ["id", "@id", "osm_id"], 'longitude': ["lon", "lng", "longitude", "x"], 'latitude': ["lat", "latitude", "y"],
+               'radius': ["radius"], 'group': ["group"], 'active': ["active"]}
+
+# Values of an 'active' column or property that mark a geofence inactive
+INACTIVE_VALUES = {"0", "false", "no", "n", "off"}
+
+
+def build_geofence_table(coordinates, ids=None, radius=None, group=None, active=None):
+    # Geofence centres as (longitude, latitude) columns in radians
+    centers = np.array(coordinates, dtype=float).reshape(-1, 2)
+    center_longitude, center_latitude = centers[:, 0], centers[:, 1]
+
+    # Ids default to the geofences' positions, the metadata to the default radius, group 0 and active
+    ids = np.arange(len(centers), dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64).reshape(-1)
+    radius = metadata_column(radius, len(centers), np.float64, DEFAULT_GEOFENCE_RADIUS)
+    group = metadata_column(group, len(centers), np.int32, 0)
+    active = metadata_column(active, len(centers), np.bool_, True)
+    for name, column in [('ids', ids), ('radius', radius), ('group', group), ('active', active)]:
+        if len(column) != len(centers):
+            raise ValueError(f"{len(column)} {name} for {len(centers)} geofences")
+
+    # Proposed system: unit-vector terms of each centre (sin φ, cos φ·cos λ, cos φ·sin λ)
+    prop_terms = np.column_stack((
+        np.sin(center_latitude),
+        np.cos(center_latitude) * np.cos(center_longitude),
+        np.cos(center_latitude) * np.sin(center_longitude)
+    ))
+
+    # Reference system: terms derived from Center point (original, squared, and combined where applicable)
+    beta = np.sin(center_latitude / 2)
+    delta = np.cos(center_latitude / 2)
+    eta = np.cos(center_latitude)
+    lambda_ = np.cos(center_longitude / 2)
+    nu = np.sin(center_longitude / 2)
+
+    ref_terms = np.column_stack((
+        beta**2,                    # B-specific part for term1
+        -2 * beta * delta,          # B-specific part for term2 (incl. the -2 factor)
+        delta**2,                   # B-specific part for term3
+        eta * lambda_**2,           # B-specific part for term4
+        -2 * eta * lambda_ * nu,    # B-specific part for term5 (incl. the -2 factor)
+        eta * nu**2                 # B-specific part for term6
+    ))
+
+    return {
+        'ids': ids,
+        'coordinates': centers,
+        # The proposed intermediate value is 1 - c·B, so its coefficients are stored negated
+        'prop_terms': -prop_terms.reshape(-1, 3),
+        'ref_terms': ref_terms.reshape(-1, 6),
+        'radius': radius,
+        'group': group,
+        'active': active
+    }
+
+
+def metadata_column(values, count, dtype, default):
+    # A metadata column of count values, the default for all of them when values is None or a single value
+    if values is None:
+        return np.full(count, default, dtype=dtype)
+    if np.ndim(values) == 0:
+        return np.full(count, values, dtype=dtype)
+    return np.array(values, dtype=dtype).reshape(-1)
+
+
+def active_geofences(table):
+    # The table of the geofences that are evaluated. Snapshots keep their active geofences first, so that is a prefix
+    # of the mapped columns. Tables built in memory are the table itself when every geofence is active (the usual
+    # case), otherwise the active rows are gathered once
+    if 'active_count' in table:
+        active_count = table['active_count']
+        if active_count == len(table['ids']):
+            return table
+        served = {name: table[name][:active_count] for name, dtype, width in SNAPSHOT_COLUMNS}
+        served['count'] = active_count
+        return served
+
+    active = table['active']
+    if active.all():
+        return table
+
+    positions = np.flatnonzero(active)
+    served = {name: np.take(table[name], positions, axis=0) for name, dtype, width in SNAPSHOT_COLUMNS}
+    served['count'] = len(positions)
+    return served
+
+
+def build_geofence_index(table):
+    # Positions of the geofences sorted by id, to look geofences up by id with a binary search rather than a dict
+    # of a million Python ints
+    order = np.argsort(table['ids'], kind="stable")
+    return {'order': order, 'sorted_ids': table['ids'][order]}
+
+
+def find_geofences(index, ids):
+    # Positions in the table of each of ids (the first geofence with the id), -1 for ids not in the table
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    sorted_ids = index['sorted_ids']
+
+    slots = np.searchsorted(sorted_ids, ids)
+    found = slots < len(sorted_ids)
+    found[found] = sorted_ids[slots[found]] == ids[found]
+
+    positions = np.full(len(ids), -1, dtype=np.int64)
+    positions[found] = index['order'][slots[found]]
+    return positions
+
+
+def sanitise_coordinates(longitudes, latitudes):
+    # Longitudes and latitudes in degrees rounded to 6 dp, as arrays.
+    # To prevent floating-point equality after rounding (e.g., 28.523500 == 28.52350), which cause math domain errors
+    # in encrypted trigonometric operations, 1e-6 is added to the latitude of coordinates whose longitude and latitude
+    # both end in zero. This offset shifts the coordinate by ~11.1 cm — negligible for geofencing accuracy.
+    longitudes = round_6dp(longitudes)
+    latitudes = round_6dp(latitudes)
+
+    # Last decimal digit of each rounded value (rounded values are within rounding error of a whole number of 1e-6)
+    both_end_in_zero = (np.rint(np.abs(longitudes) * 1e6) % 10 == 0) & (np.rint(np.abs(latitudes) * 1e6) % 10 == 0)
+    latitudes = np.where(both_end_in_zero, round_6dp(latitudes + 10**-6), latitudes)
+
+    return longitudes, latitudes
+
+
+def round_6dp(values):
+    # Python's round(value, 6) for a whole array. np.round scales by 1e6 before rounding, which can round the other
+    # way to Python's correctly rounded result when a value is within rounding error of halfway, so those few are redone
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, 6)
+
+    scaled = values * 1e6
+    near_halfway = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    if len(near_halfway):
+        rounded[near_halfway] = [round(float(value), 6) for value in values[near_halfway]]
+
+    return rounded
+
+
+def process_geofence_features(features, limit=None):
+    # Ids and (longitude, latitude) centres in radians of GeoJSON point features (as Overpass returns them),
+    # rounded to 6 dp, of at most limit features
+    features = features[:limit]
+    ids = [feature_id(feature.get('id'), i) for i, feature in enumerate(features)]
+    longitudes, latitudes = sanitise_coordinates(
+        [feature['geometry']['coordinates'][0] for feature in features],
+        [feature['geometry']['coordinates'][1] for feature in features]
+    )
+
+    for lon_rounded, lat_rounded in zip(longitudes, latitudes):
+        print(f"longitude: {lon_rounded}, latitude: {lat_rounded}") # Print geofences coordinates for testing
+
+    return ids, [[math.radians(lon), math.radians(lat)] for lon, lat in zip(longitudes, latitudes)]
+
+
+def feature_id(value, position):
+    # Numeric id of a feature: an int, or the number ending a string id such as 'node/123'. Features without one
+    # keep their position in the source as id
+    if type(value) is int:
+        return value
+    if isinstance(value, str):
+        match = re.search(r"(\d+)$", value)
+        if match:
+            return int(match.group(1))
+    return position
+
+
+def import_geofences(source_path, snapshot_path, source_format=None, tag=None, limit=None, chunk_size=None):
+    # Stream the point features of a local GeoJSON, CSV or OSM XML file into a snapshot, a chunk at a time, so memory
+    # stays bounded by the chunk size rather than the catalogue size. tag ('key=value' or 'key') keeps only matching
+    # features. Returns the number of geofences written and skipped, the import rate and the peak RSS
+    source_format = source_format or source_file_format(source_path)
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    counts = {'skipped': 0}
+
+    start = time.time()
+
+    with SnapshotWriter(snapshot_path) as writer:
+        for columns in read_geofence_points(source_path, source_format, tag, chunk_size, counts):
+            if limit is not None:
+                columns = [column[:limit - writer.count] for column in columns]
+            ids, longitudes, latitudes, radius, group, active = columns
+
+            longitudes, latitudes = sanitise_coordinates(longitudes, latitudes)
+            writer.append(build_geofence_table(np.radians(np.column_stack((longitudes, latitudes))), ids, radius, group, active))
+
+            if limit is not None and writer.count >= limit:
+                break
+
+    seconds = time.time() - start
+    stats = {
+        'count': writer.count,
+        'skipped': counts['skipped'],
+        'seconds': seconds,
+        'rate': writer.count / seconds if seconds > 0 else 0,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+    print(f"Imported {stats['count']} geofences ({stats['skipped']} features skipped) from {source_path} in {round(seconds, 3)} s "
+          f"({round(stats['rate'])} geofences/s), peak RSS {'unknown' if stats['peak_rss_mb'] is None else round(stats['peak_rss_mb'], 1)} MB")
+
+    return stats
+
+
+def apply_geofence_changes(table, snapshot_path, added=None, updated=None, removed=(), chunk_size=None):
+    # Write the next snapshot of table with the geofences of the added table appended, the rows of the updated table
+    # replacing the geofences with their ids, and the geofences with removed ids dropped. Only the added and updated
+    # geofences have had their coefficients computed (by build_geofence_table), every other row is copied over a chunk
+    # at a time. Raises ValueError, before anything is written, for ids that are added twice or already exist, or are
+    # updated or removed but don't exist (or are both). Returns the counts and how long it took
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    empty = build_geofence_table([])
+    added = empty if added is None else added
+    updated = empty if updated is None else updated
+    removed = np.array(removed, dtype=np.int64).reshape(-1)
+
+    start = time.time()
+    index = build_geofence_index(table)
+
+    # Every change must be to exactly one geofence that exists (or, when added, doesn't yet)
+    for name, ids in [('added', added['ids']), ('updated', updated['ids']), ('removed', removed)]:
+        values, counts = np.unique(ids, return_counts=True)
+        if len(values) and counts.max() > 1:
+            raise ValueError(f"Geofence {values[counts.argmax()]} is {name} more than once")
+    if len(np.intersect1d(updated['ids'], removed)):
+        raise ValueError(f"Geofence {np.intersect1d(updated['ids'], removed)[0]} is both updated and removed")
+
+    added_positions = find_geofences(index, added['ids'])
+    if (added_positions >= 0).any():
+        raise ValueError(f"Geofence {added['ids'][np.argmax(added_positions >= 0)]} already exists")
+    updated_positions = find_geofences(index, updated['ids'])
+    removed_positions = find_geofences(index, removed)
+    for ids, positions in [(updated['ids'], updated_positions), (removed, removed_positions)]:
+        if (positions < 0).any():
+            raise ValueError(f"Unknown geofence {ids[np.argmax(positions < 0)]}")
+
+    count = len(table['ids'])
+    with SnapshotWriter(snapshot_path) as writer:
+        for chunk_start in range(0, count, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, count)
+            chunk = {name: table[name][chunk_start:chunk_stop] for name, dtype, width in SNAPSHOT_COLUMNS}
+
+            # Chunks without changes are written straight from the current table
+            in_chunk = (updated_positions >= chunk_start) & (updated_positions < chunk_stop)
+            removed_in_chunk = removed_positions[(removed_positions >= chunk_start) & (removed_positions < chunk_stop)]
+            if in_chunk.any() or len(removed_in_chunk):
+                chunk = {name: np.array(column) for name, column in chunk.items()}
+                for name, dtype, width in SNAPSHOT_COLUMNS:
+                    chunk[name][updated_positions[in_chunk] - chunk_start] = updated[name][in_chunk]
+
+                keep = np.ones(chunk_stop - chunk_start, dtype=bool)
+                keep[removed_in_chunk - chunk_start] = False
+                chunk = {name: column[keep] for name, column in chunk.items()}
+
+            writer.append(chunk)
+
+        writer.append(added)
+
+    return {
+        'count': writer.count,
+        'added': len(added['ids']),
+        'updated': len(updated['ids']),
+        'removed': len(removed),
+        'seconds': time.time() - start
+    }
+
+
+def install_snapshot(source_path, snapshot_path):
+    # Replace the snapshot with a copy of another snapshot file, as the next generation. The copy is checked before it
+    # is renamed over the snapshot, so an unreadable file never replaces it
+    header = read_snapshot_header(source_path)
+    generation = snapshot_generation(snapshot_path) + 1
+    temporary_path = f"{snapshot_path}.{os.getpid()}.tmp"
+
+    try:
+        shutil.copyfile(source_path, temporary_path)
+        with open(temporary_path, "r+b") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_HEADER_SIZE, header['count'], header['built_at'],
+                                         header['active_count'], generation))
+        read_snapshot_header(temporary_path)
+        os.replace(temporary_path, snapshot_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    return header['count']
+
+
+def source_file_format(path):
+    if path.lower().endswith(".pbf"):
+        raise ValueError("OSM PBF extracts aren't supported, convert them to OSM XML first (e.g. osmium cat extract.osm.pbf -o extract.osm)")
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SOURCE_FORMATS:
+        raise ValueError(f"Unknown geofence source format '{extension}', expected one of {', '.join(sorted(SOURCE_FORMATS))}")
+
+    return SOURCE_FORMATS[extension]
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far (ru_maxrss is in KB on Linux and bytes on macOS)
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def read_geofence_points(path, source_format, tag=None, chunk_size=None, counts=None):
+    # Chunks of (ids, longitudes, latitudes, radius, group, active) arrays, in degrees, of the points in a GeoJSON,
+    # CSV or OSM XML file
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    counts = {'skipped': 0} if counts is None else counts
+    readers = {'geojson': read_geojson_points, 'csv': read_csv_points, 'osm': read_osm_points}
+
+    if source_format not in readers:
+        raise ValueError(f"Unknown geofence source format '{source_format}'")
+
+    tag_key, _, tag_value = tag.partition("=") if tag else (None, None, None)
+
+    dtypes = [np.int64, float, float, np.float64, np.int32, np.bool_]
+    columns = [[] for dtype in dtypes]
+    for point in readers[source_format](path, tag_key, tag_value or None):
+        if point is None:
+            counts['skipped'] += 1
+            continue
+
+        for column, value in zip(columns, point):
+            column.append(value)
+
+        if len(columns[0]) == chunk_size:
+            yield [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+            columns = [[] for dtype in dtypes]
+
+    if columns[0]:
+        yield [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+
+
+def point_metadata(values):
+    # (radius, group, active) of a point from its 'radius', 'group' and 'active' values (properties or CSV columns),
+    # the defaults for those it doesn't have. Raises ValueError for values that aren't a radius, group or flag
+    radius, group, active = values.get('radius'), values.get('group'), values.get('active')
+
+    radius = DEFAULT_GEOFENCE_RADIUS if radius in (None, "") else float(radius)
+    if not radius > 0:
+        raise ValueError(f"Invalid radius {radius}")
+    group = 0 if group in (None, "") else int(group)
+    active = True if active in (None, "") else str(active).strip().lower() not in INACTIVE_VALUES
+
+    return radius, group, active
+
+
+def matches_tag(tags, tag_key, tag_value):
+    # Without a tag filter every point is kept
+    if tag_key is None:
+        return True
+    return tag_key in tags and (tag_value is None or str(tags[tag_key]) == tag_value)
+
+
+def read_geojson_points(path, tag_key=None, tag_value=None):
+    # (id, longitude, latitude, radius, group, active) of every Point feature, or None for features that are skipped
+    # (other geometries, invalid metadata, not matching the tag filter). Tags are the feature's properties, or
+    # Overpass's nested 'tags'
+    position = 0
+    for feature in read_geojson_features(path):
+        if not isinstance(feature, dict):
+            feature = {}
+        geometry = feature.get('geometry') or {}
+        properties = feature.get('properties') or {}
+        tags = properties.get('tags') if isinstance(properties.get('tags'), dict) else properties
+
+        if geometry.get('type') != "Point" or not matches_tag(tags, tag_key, tag_value):
+            yield None
+        else:
+            try:
+                metadata = point_metadata(properties)
+            except (TypeError, ValueError):
+                yield None
+            else:
+                longitude, latitude = geometry['coordinates'][:2]
+                yield (feature_id(feature.get('id', properties.get('@id')), position), longitude, latitude) + metadata
+        position += 1
+
+
+def read_geojson_features(path, block_size=1 << 20):
+    # Features of a GeoJSON FeatureCollection (or of a top-level array, or one feature per line), decoded one at a time
+    # from a sliding buffer, so memory is bounded by the block size and the largest feature rather than the file
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding="utf-8") as f:
+        buffer = f.read(block_size)
+        eof = len(buffer) < block_size
+
+        # Find the features: after '"features": [' in a FeatureCollection, after '[' of a top-level array,
+        # otherwise a sequence of features
+        stripped = buffer.lstrip()
+        match = None
+        if stripped.startswith("{"):
+            match = re.search(r'"features"\s*:\s*\[', buffer)
+            while match is None and not eof:
+                block = f.read(block_size)
+                eof = len(block) < block_size
+                buffer += block
+                match = re.search(r'"features"\s*:\s*\[', buffer)
+        if match:
+            position, in_array = match.end(), True
+        elif stripped.startswith("["):
+            position, in_array = buffer.index("[") + 1, True
+        else:
+            position, in_array = 0, False
+
+        while True:
+            # Skip separators between features ('\x1e' separates GeoJSON text sequences)
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,\x1e":
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                buffer, position = f.read(block_size), 0
+                eof = len(buffer) < block_size
+
+            if position >= len(buffer) or (in_array and buffer[position] == "]"):
+                return
+
+            # Decode the next feature, reading more of the file while it is incomplete
+            while True:
+                try:
+                    feature, position = decoder.raw_decode(buffer, position)
+                    break
+                except json.JSONDecodeError as e:
+                    if eof:
+                        raise ValueError(f"Invalid GeoJSON in {path}: {e}")
+                    block = f.read(block_size)
+                    eof = len(block) < block_size
+                    buffer, position = buffer[position:] + block, 0
+
+            yield feature
+
+            # Drop what has been decoded once it is more than a block
+            if position > block_size:
+                buffer, position = buffer[position:], 0
+
+
+def read_csv_points(path, tag_key=None, tag_value=None):
+    # (id, longitude, latitude, radius, group, active) of every row, with the columns named as in CSV_COLUMNS (only
+    # the coordinates are required), or None for rows that are skipped (missing or invalid coordinates or metadata,
+    # not matching the tag filter, whose key is then a column)
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+
+        columns = {}
+        for value, names in CSV_COLUMNS.items():
+            columns[value] = next((header.index(name) for name in names if name in header), None)
+        if columns['longitude'] is None or columns['latitude'] is None:
+            raise ValueError(f"{path} needs a longitude and a latitude column (e.g. 'lon' and 'lat')")
+
+        tag_column = header.index(tag_key.lower()) if tag_key is not None and tag_key.lower() in header else None
+
+        for position, row in enumerate(reader):
+            try:
+                longitude, latitude = float(row[columns['longitude']]), float(row[columns['latitude']])
+                row_id = feature_id(int(row[columns['id']]) if columns['id'] is not None and row[columns['id']].strip().isdigit() else None, position)
+                metadata = point_metadata({name: row[columns[name]] for name in ('radius', 'group', 'active') if columns[name] is not None})
+            except (ValueError, IndexError):
+                yield None
+                continue
+
+            tags = {tag_key: row[tag_column]} if tag_column is not None and tag_column < len(row) and row[tag_column] else {}
+            yield (row_id, longitude, latitude) + metadata if matches_tag(tags, tag_key, tag_value) else None
+
+
+def read_osm_points(path, tag_key=None, tag_value=None):
+    # (id, longitude, latitude, radius, group, active) of the nodes of an OSM XML extract, with the default metadata.
+    # Without a tag filter only tagged nodes (points of interest rather than the vertices of ways) are kept.
+    # Elements are cleared once read, so memory stays bounded
+    context = ElementTree.iterparse(path, events=("start", "end"))
+    root = None
+
+    for event, element in context:
+        if root is None:
+            root = element
+        if event != "end" or element is root:
+            continue
+
+        if element.tag == "node":
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter("tag")}
+            if (tags if tag_key is None else matches_tag(tags, tag_key, tag_value)):
+                try:
+                    yield int(element.get('id')), float(element.get('lon')), float(element.get('lat')), DEFAULT_GEOFENCE_RADIUS, 0, True
+                except (TypeError, ValueError):
+                    yield None
+            elif tags:
+                yield None
+
+        # Only top-level elements are cleared, the tags of a node are needed until the node ends
+        if element.tag in ("node", "way", "relation", "bounds"):
+            root.clear()
+
+
+def column_offsets(count):
+    # Byte offset of every column for count geofences, and the total file size
+    offsets = {}
+    offset = SNAPSHOT_HEADER_SIZE
+    for name, dtype, width in SNAPSHOT_COLUMNS:
+        offsets[name] = offset
+        offset += count * width * np.dtype(dtype).itemsize
+    return offsets, offset
+
+
+def write_snapshot(path, table):
+    with SnapshotWriter(path) as writer:
+        writer.append(table)
+
+
+class SnapshotWriter(object):
+    # Writes a snapshot a chunk of geofences at a time, for catalogues too large to hold in memory: each column goes to
+    # its own temporary files as chunks arrive (one for active geofences, one for inactive), and they are joined behind
+    # the header once the count is known. The snapshot is written next to its path and then renamed over it, so the
+    # swap is atomic: a process mapping the old snapshot keeps a complete file until it maps the new one
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.active_count = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.temporary_path = f"{path}.{os.getpid()}.tmp"
+        self.column_paths = {(name, active): f"{self.temporary_path}.{name}.{'active' if active else 'inactive'}"
+                             for name, dtype, width in SNAPSHOT_COLUMNS for active in (True, False)}
+        self.columns = {key: open(column_path, "wb") for key, column_path in self.column_paths.items()}
+
+    def append(self, table):
+        count = len(table['ids'])
+        active = np.asarray(table['active'], dtype=bool).reshape(count)
+        for name, dtype, width in SNAPSHOT_COLUMNS:
+            column = np.ascontiguousarray(table[name], dtype=np.dtype(dtype).newbyteorder("<")).reshape(count, width)
+            if active.all():
+                self.columns[(name, True)].write(column.tobytes())
+            else:
+                self.columns[(name, True)].write(column[active].tobytes())
+                self.columns[(name, False)].write(column[~active].tobytes())
+        self.count += count
+        self.active_count += int(active.sum())
+
+    def commit(self):
+        for column in self.columns.values():
+            column.close()
+
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_HEADER_SIZE, self.count, time.time(),
+                                      self.active_count, snapshot_generation(self.path) + 1)
+
+        with open(self.temporary_path, "wb") as f:
+            f.write(header.ljust(SNAPSHOT_HEADER_SIZE, b"\0"))
+            for name, dtype, width in SNAPSHOT_COLUMNS:
+                for active in (True, False):
+                    with open(self.column_paths[(name, active)], "rb") as column:
+                        shutil.copyfileobj(column, f, 1 << 20)
+
+        os.replace(self.temporary_path, self.path)
+        self.remove_temporary_files()
+
+    def abort(self):
+        for column in self.columns.values():
+            column.close()
+        self.remove_temporary_files()
+
+    def remove_temporary_files(self):
+        for temporary_path in [self.temporary_path] + list(self.column_paths.values()):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        # Only a complete import replaces the snapshot
+        if exception_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def snapshot_generation(path):
+    # Generation of the snapshot at path, 0 when there is none this version can read
+    try:
+        return read_snapshot_header(path)['generation']
+    except (OSError, ValueError):
+        return 0
+
+
+def read_snapshot_header(path):
+    # Version, geofence count (and how many are active), build time and generation of a snapshot. Raises ValueError for files that aren't a snapshot this
+    # version can read, or whose size doesn't match their header
+    with open(path, "rb") as f:
+        header = f.read(SNAPSHOT_HEADER_SIZE)
+        size = os.fstat(f.fileno()).st_size
+
+    if len(header) < SNAPSHOT_HEADER.size:
+        raise ValueError("File is too short to be a geofence snapshot")
+
+    magic, version, header_size, count, built_at, active_count, generation = SNAPSHOT_HEADER.unpack_from(header)
+
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a geofence snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported geofence snapshot version {version} (expected {SNAPSHOT_VERSION})")
+    if header_size != SNAPSHOT_HEADER_SIZE or column_offsets(count)[1] != size or active_count > count:
+        raise ValueError(f"Geofence snapshot of {size} bytes doesn't match its header ({count} geofences)")
+
+    return {'version': version, 'count': count, 'built_at': built_at, 'active_count': active_count, 'generation': generation}
+
+
+def load_snapshot(path):
+    # The snapshot's table, with its columns mapped read-only from the file rather than read into memory,
+    # so loading takes the same few milliseconds whatever the catalogue size
+    header = read_snapshot_header(path)
+    count = header['count']
+    offsets, size = column_offsets(count)
+
+    table = dict(header)
+    if count == 0:
+        # Empty files can't be memory-mapped
+        for name, dtype, width in SNAPSHOT_COLUMNS:
+            table[name] = np.empty((0, width) if width > 1 else 0, dtype=dtype)
+        return table
+
+    mapped = np.memmap(path, dtype=np.uint8, mode="r", shape=(size,))
+    for name, dtype, width in SNAPSHOT_COLUMNS:
+        column = np.ndarray((count, width) if width > 1 else (count,), dtype=np.dtype(dtype).newbyteorder("<"), buffer=mapped, offset=offsets[name])
+        table[name] = column
+
+    return table
+
+
+def benchmark_catalogue(count, lookups=1000, seed=0):
+    # Memory footprint and slice, lookup and iteration times of count geofences held as the service used to hold them
+    # (a list of [longitude, latitude] lists and a list of ids) and as a table of columns. Returns rows of
+    # (operation, list, table, unit)
+    rng = np.random.default_rng(seed)
+    longitudes = np.radians(rng.uniform(-180, 180, count))
+    latitudes = np.radians(rng.uniform(-90, 90, count))
+    ids = rng.choice(np.arange(1, 20 * count, dtype=np.int64), count, replace=False)
+    wanted = ids[rng.integers(0, count, lookups)].tolist()
+    user_longitude, user_latitude = math.radians(-4.14), math.radians(50.37)
+    rows = []
+
+    # Memory: every allocation made building each representation
+    tracemalloc.start()
+    coordinate_list = [[lon, lat] for lon, lat in zip(longitudes.tolist(), latitudes.tolist())]
+    id_list = ids.tolist()
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    table = build_geofence_table(np.column_stack((longitudes, latitudes)), ids)
+    table_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    catalogue_bytes = sum(table[name].nbytes for name in ('ids', 'coordinates', 'radius', 'group', 'active'))
+    rows.append(("Memory, ids and centres (MB)", list_bytes / 1e6, (table['ids'].nbytes + table['coordinates'].nbytes) / 1e6, "MB"))
+    rows.append(("Memory, with radius, group and active (MB)", None, catalogue_bytes / 1e6, "MB"))
+    rows.append(("Memory, with coefficients (MB)", None, table_bytes / 1e6, "MB"))
+
+    # Slicing the first half, as every request slices the geofences it evaluates
+    half = count // 2
+    rows.append(("Slice first half (ms)", timed(lambda: coordinate_list[:half]) * 1e3, timed(lambda: table['coordinates'][:half]) * 1e3, "ms"))
+
+    # Lookup by id: a linear search of the id list (a few, it is slow), a dict built for it, and a binary search
+    index_list_seconds = timed(lambda: [id_list.index(geofence_id) for geofence_id in wanted[:10]], repeats=1) / 10
+    tracemalloc.start()
+    id_positions = {geofence_id: position for position, geofence_id in enumerate(id_list)}
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    dict_seconds = timed(lambda: [id_positions[geofence_id] for geofence_id in wanted]) / lookups
+
+    start = time.perf_counter()
+    index = build_geofence_index(table)
+    index_seconds = time.perf_counter() - start
+    search_seconds = timed(lambda: find_geofences(index, wanted)) / lookups
+    rows.append(("Lookup by id, list.index (us)", index_list_seconds * 1e6, search_seconds * 1e6, "us"))
+    rows.append(("Lookup by id, dict (us)", dict_seconds * 1e6, search_seconds * 1e6, "us"))
+    rows.append(("Id index, build (ms)", None, index_seconds * 1e3, "ms"))
+    rows.append(("Id index, memory (MB)", dict_bytes / 1e6, (index['order'].nbytes + index['sorted_ids'].nbytes) / 1e6, "MB"))
+
+    # Iteration: the plaintext distance from a user to every geofence, a Python loop over the list against
+    # whole-column operations
+    def list_distances():
+        return [math.asin(math.sqrt(math.sin((lat - user_latitude) / 2)**2 + math.cos(user_latitude) * math.cos(lat) * math.sin((lon - user_longitude) / 2)**2))
+                for lon, lat in coordinate_list]
+
+    def table_distances():
+        lon, lat = table['coordinates'][:, 0], table['coordinates'][:, 1]
+        return np.arcsin(np.sqrt(np.sin((lat - user_latitude) / 2)**2 + math.cos(user_latitude) * np.cos(lat) * np.sin((lon - user_longitude) / 2)**2))
+
+    rows.append(("Distance to every geofence (ms)", timed(list_distances, repeats=1) * 1e3, timed(table_distances) * 1e3, "ms"))
+
+    return rows
+
+
+def benchmark_worker_memory(count, workers=4, seed=0):
+    # Memory of each of workers forked processes serving count geofences, as gunicorn workers forked after --preload:
+    #   list      the geofences as a list of [longitude, latitude] lists plus their coefficient arrays, built before
+    #             the fork, as the service held them before snapshots (touching the lists' reference counts copies
+    #             their pages into every worker)
+    #   snapshot  the columns mapped from a snapshot, shared read-only by every worker
+    # Every worker reads all of its geofences (as evaluating them does) and is measured while all of them are alive.
+    # Returns rows of (geofences, storage, RSS, PSS, private MB per worker). Needs /proc (Linux)
+    rng = np.random.default_rng(seed)
+    longitudes = np.radians(rng.uniform(-180, 180, count))
+    latitudes = np.radians(rng.uniform(-90, 90, count))
+    context = multiprocessing.get_context("fork")
+    rows = []
+
+    for storage in ("list", "snapshot"):
+        if storage == "list":
+            coordinates = [[lon, lat] for lon, lat in zip(longitudes.tolist(), latitudes.tolist())]
+            table = build_geofence_table(coordinates)
+        else:
+            path = f"benchmark.{os.getpid()}.snapshot"
+            write_snapshot(path, build_geofence_table(np.column_stack((longitudes, latitudes))))
+            coordinates, table = None, load_snapshot(path)
+            os.remove(path)     # Stays mapped until the workers exit
+
+        results = context.Queue()
+        measured = context.Barrier(workers)
+        processes = [context.Process(target=measure_worker_memory, args=(coordinates, table, measured, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        measurements = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        rows.append((count, storage) + tuple(sum(measurement[i] for measurement in measurements) / workers for i in range(3)))
+        coordinates = table = None
+
+    return rows
+
+
+def measure_worker_memory(coordinates, table, measured, results):
+    # Runs in a forked worker: read every geofence, wait until every worker has, then measure
+    if coordinates is not None:
+        sum(lon + lat for lon, lat in coordinates[:len(coordinates)])
+    for name, dtype, width in SNAPSHOT_COLUMNS:
+        np.sum(table[name])
+
+    measured.wait()
+    results.put(process_memory_mb())
+    measured.wait()     # Nobody exits (releasing shared pages) before everyone is measured
+
+
+def process_memory_mb():
+    # RSS, PSS (shared pages split between the processes sharing them) and private memory of this process, in MB
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                values[name] = int(value.split()[0]) / 1024
+    return values['Rss'], values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def timed(function, repeats=5):
+    # Best time of repeats calls of function, in seconds
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build or inspect geofence snapshots for the geofencing service"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", aliases=["import"], help="Build a snapshot from a local GeoJSON, CSV or OSM XML file of points, streamed in chunks")
+    build.add_argument("input", help="GeoJSON FeatureCollection (e.g. a saved Overpass response) or feature sequence, CSV with lon/lat columns, or OSM XML extract")
+    build.add_argument("output", help="Snapshot file to write (GEOFENCE_SNAPSHOT of the service)")
+    build.add_argument(
+        "-f", "--format",
+        choices=["geojson", "csv", "osm"],
+        default=None,
+        help="Format of the input (default: from its extension)"
+    )
+    build.add_argument(
+        "-t", "--tag",
+        default=None,
+        help="Only keep points with this tag, 'key=value' or 'key' (e.g. amenity=cafe). OSM nodes default to every tagged node"
+    )
+    build.add_argument(
+        "-l", "--limit",
+        type=int,
+        default=None,
+        help="Number of geofences to keep (default: every point)"
+    )
+    build.add_argument(
+        "-cs", "--chunk-size",
+        type=int,
+        default=IMPORT_CHUNK_SIZE,
+        help="Points read before they are written to the snapshot, bounding memory use"
+    )
+
+    info = commands.add_parser("info", help="Print a snapshot's version, generation, geofence count and build time")
+    info.add_argument("snapshot", help="Snapshot file to inspect")
+
+    bench = commands.add_parser("bench", help="Compare the memory and speed of the geofence table against a list of coordinates")
+    bench.add_argument(
+        "-c", "--count",
+        type=int,
+        default=1000000,
+        help="Number of random geofences"
+    )
+    bench.add_argument(
+        "-o", "--output",
+        default=None,
+        help="CSV file to save the results to (e.g. Results/catalogueBenchmark.csv)"
+    )
+
+    memory = commands.add_parser("memory", help="Measure the memory of forked workers serving geofences from a list or from a snapshot (Linux)")
+    memory.add_argument(
+        "-c", "--counts",
+        type=int,
+        nargs="+",
+        default=[500, 10000, 1000000],
+        help="Numbers of random geofences"
+    )
+    memory.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=4,
+        help="Number of forked workers (gunicorn's -w)"
+    )
+    memory.add_argument(
+        "-o", "--output",
+        default=None,
+        help="CSV file to save the results to (e.g. Results/workerMemory.csv)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    if args.command in ("build", "import"):
+        import_geofences(args.input, args.output, args.format, args.tag, args.limit, args.chunk_size)
+        print(f"Wrote {args.output}")
+
+    elif args.command == "info":
+        header = read_snapshot_header(args.snapshot)
+        print(f"{args.snapshot}: version {header['version']}, generation {header['generation']}, {header['count']} geofences "
+              f"({header['active_count']} active), built {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['built_at']))}")
+
+    elif args.command == "bench":
+        rows = benchmark_catalogue(args.count)
+        print(f"{args.count} geofences:")
+        print(f"{'':<45}{'List':>12}{'Table':>12}")
+        for operation, list_value, table_value, unit in rows:
+            print(f"{operation:<45}{'-' if list_value is None else round(list_value, 3):>12}{round(table_value, 3):>12}")
+
+        if args.output:
+            save_rows(args.output, ["Operation", "List", "Table", "Unit"], rows)
+
+    elif args.command == "memory":
+        rows = [row for count in args.counts for row in benchmark_worker_memory(count, args.workers)]
+        print(f"Memory per worker (MB), {args.workers} workers:")
+        print(f"{'Geofences':>10}{'Storage':>10}{'RSS':>10}{'PSS':>10}{'Private':>10}")
+        for count, storage, rss, pss, private in rows:
+            print(f"{count:>10}{storage:>10}{round(rss, 1):>10}{round(pss, 1):>10}{round(private, 1):>10}")
+
+        if args.output:
+            save_rows(args.output, ["Geofences", "Storage", "RSS (MB)", "PSS (MB)", "Private (MB)"], rows)
+
+
+def save_rows(path, headers, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# Gunicorn loads this file from the working directory automatically
+
+def post_fork(server, worker):
+    # Each worker starts (and warms) its own process pool, as a pool forked from the master would not work
+    import app
+    app.start_process_pool()
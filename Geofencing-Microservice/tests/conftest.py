@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Make the service modules and the shared modules at the repository root importable, as they are inside the container
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+# Importing the app loads the geofences, which writes the snapshot (and its lock file) when they are fetched. Keep
+# them in a temporary directory rather than in the working tree, tests that need a snapshot set their own path
+os.environ.setdefault("GEOFENCE_SNAPSHOT", os.path.join(tempfile.mkdtemp(prefix="geofencing-tests-"), "geofences.snapshot"))
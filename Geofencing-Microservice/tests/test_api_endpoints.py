@@ -1,8 +1,11 @@
 import pytest
 import json
 from phe import paillier
-from unittest.mock import patch
-from src.app import app
+import paillier_engine
+import requests
+from unittest.mock import patch, MagicMock
+import src.app as geofencing
+from src.app import app, get_carer_geofence_radii
 
 ###### Note: if tests fail it can be due to the overpass query timing out ########
 
@@ -18,13 +21,13 @@ def client():
 
 # Test the /submit-user-location-ref API endpoint to ensure it processes and responds to encrypted user data correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_ref_success(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -60,7 +63,7 @@ def test_submit_user_location_ref_success(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-ref API endpoint to ensure it responds to missing data correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_ref_missing_data(mock_geo, mock_key, client):
     # Send POST request to the /submit-user-location-ref endpoint using the test client
@@ -80,13 +83,13 @@ def test_submit_user_location_ref_missing_data(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-ref API endpoint to ensure it responds to missing fields correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_ref_missing_fields(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
 
 
     # Prepare the payload with encrypted data
@@ -109,13 +112,13 @@ def test_submit_user_location_ref_missing_fields(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-ref API endpoint to ensure it responds to public key mismatch correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_ref_public_key_mismatch(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -151,13 +154,13 @@ def test_submit_user_location_ref_public_key_mismatch(mock_geo, mock_key, client
 
 # Test the /submit-user-location-ref API endpoint to ensure it responds to missing keys correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_ref_missing_keys(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -193,13 +196,13 @@ def test_submit_user_location_ref_missing_keys(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-prop API endpoint to ensure it processes and responds to encrypted user data correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_prop_succcess(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -232,7 +235,7 @@ def test_submit_user_location_prop_succcess(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-prop API endpoint to ensure it responds to missing data correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_prop_missing_data(mock_geo, mock_key, client):
     # Send POST request to the /submit-user-location-prop endpoint using the test client
@@ -252,13 +255,13 @@ def test_submit_user_location_prop_missing_data(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-prop API endpoint to ensure it responds to missing fields correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_prop_missing_fields(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
 
 
     # Prepare the payload with encrypted data
@@ -281,13 +284,13 @@ def test_submit_user_location_prop_missing_fields(mock_geo, mock_key, client):
 
 # Test the /submit-user-location-prop API endpoint to ensure it responds to public key mismatch correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_prop_public_key_mismatch(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -320,13 +323,13 @@ def test_submit_user_location_prop_public_key_mismatch(mock_geo, mock_key, clien
 
 # Test the /submit-user-location-prop API endpoint to ensure it responds to missing keys correctly
 # Mock public key function and geofence fetch function
-@patch("src.app.get_carer_public_key", return_value=TEST_PUBLIC_KEY_N)
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
 @patch("src.app.get_geofence_coordinates")
 def test_submit_user_location_prop_missing_keys(mock_geo, mock_key, client):
     # Test value to be encrypted and submitted
     test_value = 1.1672744938776433e-15
     public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
-    encrypted_result = public_key.encrypt(test_value)           # Encrypt the test value using the public key
+    encrypted_result = paillier_engine.encrypt(public_key, test_value)  # Encrypt the test value (fixed-point encoded, as the User Device does)
     ciphertext_value = encrypted_result.ciphertext()            # Get the encrypted ciphertext
     exponent = encrypted_result.exponent                        # Get the exponent used for encryption
 
@@ -353,4 +356,320 @@ def test_submit_user_location_prop_missing_keys(mock_geo, mock_key, client):
     assert response.status_code == 400                                                                      # Check if the response status code is a Bad Request
     response_json = response.get_json()                                                                     # Parse JSON from response
     assert response_json["status"] == "error"                                                               # Confirm response status
-    assert response_json["message"] == "Missing required keys in 'user_encrypted_location': c1_exp"         # Confirm error message
\ No newline at end of file
+    assert response_json["message"] == "Missing required keys in 'user_encrypted_location': c1_exp"         # Confirm error message
+
+
+# Test the /submit-user-location-prop API endpoint rejects ciphertexts and exponents that aren't integers, and exponents
+# other than the fixed-point exponent, instead of converting them
+@pytest.mark.parametrize("ciphertext_type, exponent, message", [
+    (str, None, "Ciphertexts and exponents must be integers, with ciphertexts below n squared"),
+    (float, None, "Ciphertexts and exponents must be integers, with ciphertexts below n squared"),
+    (int, "-14", "Ciphertexts and exponents must be integers, with ciphertexts below n squared"),
+    (int, -27, "Exponents must be the fixed-point exponent -14"),
+])
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+def test_submit_user_location_prop_invalid_ciphertexts(mock_geo, mock_key, client, ciphertext_type, exponent, message):
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+    encrypted_result = paillier_engine.encrypt(public_key, 0.5)
+    ciphertext_value = ciphertext_type(encrypted_result.ciphertext()) if ciphertext_type is not float else 1.5
+    exponent = encrypted_result.exponent if exponent is None else exponent
+
+    data = {
+            "user_encrypted_location": {
+                "c1_ct": ciphertext_value, "c1_exp": exponent,
+                "c2_ct": ciphertext_value, "c2_exp": exponent,
+                "c3_ct": ciphertext_value, "c3_exp": exponent
+            },
+            "public_key_n": TEST_PUBLIC_KEY_N,
+            "number_of_geofences": 10,
+    }
+
+    response = client.post("/submit-user-location-prop", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == message
+
+
+# Test the /submit-user-location-prop API endpoint accepts the binary wire format, with the key given by its fingerprint
+# Mock public key function and geofence fetch function
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+def test_submit_user_location_prop_binary_success(mock_geo, mock_key, client):
+
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)  # Create public key for encryption
+    encrypted_result = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+
+    # Prepare the payload with encrypted data, then encode it in the binary format
+    data = {
+            "user_encrypted_location": {
+                "c1_ct": encrypted_result.ciphertext(), "c1_exp": encrypted_result.exponent, 
+                "c2_ct": encrypted_result.ciphertext(), "c2_exp": encrypted_result.exponent,
+                "c3_ct": encrypted_result.ciphertext(), "c3_exp": encrypted_result.exponent
+            },
+            "public_key_n": TEST_PUBLIC_KEY_N,
+            "number_of_geofences": 10,
+    }
+
+    # Send POST request to the /submit-user-location-prop endpoint using the test client
+    response = client.post(
+        "/submit-user-location-prop",
+        data=paillier_engine.encode_binary_payload(data, TEST_PUBLIC_KEY_N),
+        content_type=paillier_engine.BINARY_CONTENT_TYPE
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 200                                           # Check if the response status code is OK
+    response_json = response.get_json()                                          # Parse JSON from response
+    assert response_json["status"] == "success"                                  # Confirm response status
+    assert response_json["message"] == "Location data recieved"                  # Confirm success message
+
+
+
+# Test the /submit-user-location-prop API endpoint rejects a binary payload encrypted under a different key
+# Mock public key function and geofence fetch function
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+def test_submit_user_location_prop_binary_public_key_mismatch(mock_geo, mock_key, client):
+
+    wrong_public_key, _ = paillier.generate_paillier_keypair(n_length=1024)
+    encrypted_result = wrong_public_key.encrypt(0.5)
+
+    data = {
+            "user_encrypted_location": {
+                "c1_ct": encrypted_result.ciphertext(), "c1_exp": encrypted_result.exponent, 
+                "c2_ct": encrypted_result.ciphertext(), "c2_exp": encrypted_result.exponent,
+                "c3_ct": encrypted_result.ciphertext(), "c3_exp": encrypted_result.exponent
+            },
+            "public_key_n": wrong_public_key.n,
+            "number_of_geofences": 10,
+    }
+
+    # Send POST request to the /submit-user-location-prop endpoint using the test client
+    response = client.post(
+        "/submit-user-location-prop",
+        data=paillier_engine.encode_binary_payload(data, wrong_public_key.n),
+        content_type=paillier_engine.BINARY_CONTENT_TYPE
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 400                                                                              # Check if the response status code is a Bad Request
+    response_json = response.get_json()                                                                             # Parse JSON from response
+    assert response_json["status"] == "error"                                                                       # Confirm response status
+    assert response_json["message"] == "Public key mismatch. Encryption was not done with the correct public key."  # Confirm error message
+
+
+
+# Mock carer fixes endpoint, reporting success for every fix
+def carer_fixes_response(url, json=None, **kwargs):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"status": "success", "fixes": [{"timestamp": fix["timestamp"], "status": "success", "message": "Geofence result processed successfully"} for fix in json["fixes"]]}
+    return response
+
+
+def prop_fixes_payload(timestamps):
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+    encrypted_result = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+    return {
+            "system": "prop",
+            "fixes": [{
+                "timestamp": timestamp,
+                "user_encrypted_location": {
+                    "c1_ct": encrypted_result.ciphertext(), "c1_exp": encrypted_result.exponent,
+                    "c2_ct": encrypted_result.ciphertext(), "c2_exp": encrypted_result.exponent,
+                    "c3_ct": encrypted_result.ciphertext(), "c3_exp": encrypted_result.exponent
+                }
+            } for timestamp in timestamps],
+            "public_key_n": TEST_PUBLIC_KEY_N,
+            "number_of_geofences": 10,
+    }
+
+
+# Test the /submit-user-location-batch API endpoint sends the results of every fix to the carer in one request and returns each fix's outcome
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.http_pool.post", side_effect=carer_fixes_response)
+def test_submit_user_location_batch_success(mock_post, mock_geo, mock_key, client):
+    timestamps = [1700000000, 1700000001, 1700000002.5]
+
+    response = client.post(
+        "/submit-user-location-batch",
+        data=json.dumps(prop_fixes_payload(timestamps)),
+        content_type="application/json"
+    )
+
+    # Verify the response status code and content
+    assert response.status_code == 200
+    response_json = response.get_json()
+    assert response_json["status"] == "success"
+    assert [fix["timestamp"] for fix in response_json["fixes"]] == timestamps
+    assert all(fix["status"] == "success" for fix in response_json["fixes"])
+
+    # One request to the carer's fixes endpoint for all fixes
+    assert mock_post.call_count == 1
+    assert mock_post.call_args.args[0] == "http://carer:5002/submit-geofence-results-fixes"
+    assert [fix["timestamp"] for fix in mock_post.call_args.kwargs["json"]["fixes"]] == timestamps
+    assert mock_post.call_args.kwargs["json"].get("radii") == get_carer_geofence_radii(10)
+
+
+# Test the /submit-user-location-batch API endpoint rejects a fix without a timestamp
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+def test_submit_user_location_batch_missing_timestamp(mock_geo, mock_key, client):
+    data = prop_fixes_payload([1700000000, 1700000001])
+    del data["fixes"][1]["timestamp"]
+
+    response = client.post(
+        "/submit-user-location-batch",
+        data=json.dumps(data),
+        content_type="application/json"
+    )
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Fix 1 needs a numeric 'timestamp' and 'user_encrypted_location'"
+
+
+# Test the /submit-user-location-batch API endpoint rejects more fixes than FIX_BATCH_MAX_SIZE
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.FIX_BATCH_MAX_SIZE", 2)
+def test_submit_user_location_batch_too_many_fixes(mock_geo, mock_key, client):
+    response = client.post(
+        "/submit-user-location-batch",
+        data=json.dumps(prop_fixes_payload([1700000000, 1700000001, 1700000002])),
+        content_type="application/json"
+    )
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "At most 2 fixes can be sent in one request"
+
+
+# Test every submission endpoint rejects a missing, non-integer or negative 'number_of_geofences' with 400 instead of failing
+@pytest.mark.parametrize("endpoint", ["ref", "prop", "batch"])
+@pytest.mark.parametrize("number_of_geofences", [None, "5", 5.0, True, -1])
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.http_pool.post")
+def test_submit_user_location_invalid_number_of_geofences(mock_post, mock_geo, mock_key, client, endpoint, number_of_geofences):
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+    encrypted_result = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+    value = {"ct": encrypted_result.ciphertext(), "exp": encrypted_result.exponent}
+
+    if endpoint == "batch":
+        data = prop_fixes_payload([1700000000])
+    else:
+        names = ["c1", "c2", "c3"] if endpoint == "prop" else ["alpha_sq", "gamma_sq", "alpha_gamma_product_A", "zeta_theta_sq_product_A", "zeta_theta_mu_product_A", "zeta_mu_sq_product_A"]
+        data = {
+            "user_encrypted_location": {f"{name}_{part}": value[part] for name in names for part in ("ct", "exp")},
+            "public_key_n": TEST_PUBLIC_KEY_N,
+        }
+
+    if number_of_geofences is None:
+        data.pop("number_of_geofences", None)
+    else:
+        data["number_of_geofences"] = number_of_geofences
+
+    response = client.post(f"/submit-user-location-{endpoint}", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "'number_of_geofences' must be a non-negative integer"
+    mock_post.assert_not_called()    # Nothing is evaluated or sent to the carer
+
+
+# Test the /submit-user-location-batch API endpoint reports a carer that can't be reached
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.http_pool.post", side_effect=requests.exceptions.ConnectionError("carer unreachable"))
+def test_submit_user_location_batch_carer_unreachable(mock_post, mock_geo, mock_key, client):
+    response = client.post(
+        "/submit-user-location-batch",
+        data=json.dumps(prop_fixes_payload([1700000000])),
+        content_type="application/json"
+    )
+
+    assert response.status_code == 502
+    assert response.get_json()["status"] == "error"
+
+
+# Test the /submit-user-location-prop API endpoint forwards short-circuit requests to the carer, and rejects invalid settings
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.http_pool.post")
+def test_submit_user_location_prop_any_inside(mock_post, mock_geo, mock_key, client):
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+    encrypted_result = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+    data = {
+            "user_encrypted_location": {
+                "c1_ct": encrypted_result.ciphertext(), "c1_exp": encrypted_result.exponent,
+                "c2_ct": encrypted_result.ciphertext(), "c2_exp": encrypted_result.exponent,
+                "c3_ct": encrypted_result.ciphertext(), "c3_exp": encrypted_result.exponent
+            },
+            "public_key_n": TEST_PUBLIC_KEY_N,
+            "number_of_geofences": 10,
+            "any_inside": True,
+            "recent_hits_first": False
+    }
+
+    response = client.post("/submit-user-location-prop", data=json.dumps(data), content_type="application/json")
+
+    assert response.status_code == 200
+    carer_payload = mock_post.call_args.kwargs["json"]
+    assert carer_payload["any_inside"] is True
+    assert carer_payload["recent_hits_first"] is False
+
+    for invalid in [{"any_inside": "yes"}, {"priority_group": "carer"}]:
+        response = client.post("/submit-user-location-prop", data=json.dumps(dict(data, **invalid)), content_type="application/json")
+        assert response.status_code == 400
+        assert response.get_json()["message"] == "'any_inside' and 'recent_hits_first' must be booleans and 'priority_group' an integer"
+
+
+# Load a table of three geofences with the given radii and groups, as a snapshot of the given generation would
+def load_generation(generation, radius, group):
+    table = geofencing.geofence_snapshot.build_geofence_table([[0.1, 0.9], [0.2, 0.8], [0.3, 0.7]], radius=radius, group=group)
+    table['generation'] = generation
+    geofencing.set_geofence_table(table)
+
+
+# Test geofences published while a request is evaluated don't change the radii, priority positions and generation sent
+# to the carer with its results, which all come from the table the request was evaluated against
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.get_geofence_coordinates")
+@patch("src.app.http_pool.post")
+def test_submit_user_location_prop_reload_during_evaluation(mock_post, mock_geo, mock_key, client):
+    original_coordinates = geofencing.geofence_coordinates
+    load_generation(7, [100, 200, 300], [1, 0, 1])
+    evaluate = geofencing.calculate_intermediate_haversine_value_prop
+
+    def evaluate_then_reload(*args, **kwargs):
+        intermediate_values = evaluate(*args, **kwargs)
+        load_generation(8, [500, 500, 500], [0, 1, 0])
+        return intermediate_values
+
+    public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+    encrypted_result = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+    data = {
+            "user_encrypted_location": {
+                "c1_ct": encrypted_result.ciphertext(), "c1_exp": encrypted_result.exponent,
+                "c2_ct": encrypted_result.ciphertext(), "c2_exp": encrypted_result.exponent,
+                "c3_ct": encrypted_result.ciphertext(), "c3_exp": encrypted_result.exponent
+            },
+            "public_key_n": TEST_PUBLIC_KEY_N,
+            "number_of_geofences": 3,
+            "any_inside": True,
+            "priority_group": 1
+    }
+
+    try:
+        with patch("src.app.calculate_intermediate_haversine_value_prop", side_effect=evaluate_then_reload):
+            response = client.post("/submit-user-location-prop", data=json.dumps(data), content_type="application/json")
+        reloaded_generation = geofencing.geofence_coefficients['generation']
+    finally:
+        geofencing.set_geofence_coordinates(original_coordinates)
+
+    assert response.status_code == 200
+    assert reloaded_generation == 8
+    carer_payload = mock_post.call_args.kwargs["json"]
+    assert len(carer_payload["encrypted_results"]) == 3
+    assert carer_payload["radii"] == [100, 200, 300]
+    assert carer_payload["priority"] == [0, 2]
+    assert carer_payload["generation"] == 7
@@ -0,0 +1,214 @@
+import pytest
+import json
+import os
+import queue
+import time
+import requests
+from unittest.mock import patch, MagicMock
+from phe import paillier
+import paillier_engine
+import src.app as geofencing
+from tests.test_api_endpoints import TEST_PUBLIC_KEY_N
+
+public_key = paillier.PaillierPublicKey(TEST_PUBLIC_KEY_N)
+
+
+# Pytest fixture for a test client with job state kept in a temporary directory and no delivery backoff
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(geofencing, "JOB_STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(geofencing, "DELIVERY_BACKOFF", 0)
+    monkeypatch.setattr(geofencing, "job_workers_pid", None)  # Fresh queues and threads for every test
+    with geofencing.app.test_client() as client:
+        yield client
+
+
+# Mock carer batch endpoint, reporting success for every delivered job
+def carer_batch_response(url, json=None, **kwargs):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"status": "success", "results": {delivery["job_id"]: {"status": "success"} for delivery in json["deliveries"]}}
+    return response
+
+
+def prop_payload():
+    encrypted_value = paillier_engine.encrypt(public_key, 1.1672744938776433e-15)
+    return {
+        "user_encrypted_location": {
+            "c1_ct": encrypted_value.ciphertext(), "c1_exp": encrypted_value.exponent,
+            "c2_ct": encrypted_value.ciphertext(), "c2_exp": encrypted_value.exponent,
+            "c3_ct": encrypted_value.ciphertext(), "c3_exp": encrypted_value.exponent
+        },
+        "public_key_n": TEST_PUBLIC_KEY_N,
+        "number_of_geofences": 10,
+    }
+
+
+def wait_for_job(client, status_url):
+    # Poll the job until it has been delivered or has failed
+    for i in range(200):
+        job = client.get(status_url).get_json()
+        if job["status"] in ("delivered", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("Job didn't complete")
+
+
+# Test 'Prefer: respond-async' is acknowledged with 202 and a job id, and the job is evaluated and delivered in the background
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.http_pool.post", side_effect=carer_batch_response)
+def test_submit_user_location_prop_async(mock_post, mock_key, client):
+    response = client.post(
+        "/submit-user-location-prop",
+        data=json.dumps(prop_payload()),
+        content_type="application/json",
+        headers={"Prefer": "respond-async"}
+    )
+
+    # Acknowledged before the carer is contacted
+    assert response.status_code == 202
+    assert response.headers["Preference-Applied"] == "respond-async"
+    response_json = response.get_json()
+    assert response_json["status"] == "accepted"
+    assert response.headers["Location"] == response_json["status_url"] == f"/jobs/{response_json['job_id']}"
+
+    # The job's results are then delivered to the carer's batch endpoint
+    job = wait_for_job(client, response_json["status_url"])
+    assert job["status"] == "delivered"
+    assert job["submitted_at"] <= job["evaluated_at"] <= job["delivered_at"]
+
+    delivery = mock_post.call_args.kwargs["json"]["deliveries"][0]
+    assert mock_post.call_args.args[0] == "http://carer:5002/submit-geofence-results-batch"
+    assert delivery["job_id"] == response_json["job_id"]
+    assert delivery["system"] == "prop"
+    assert delivery["packed"] is False
+
+
+# Test an asynchronous 'any_inside' request keeps its short-circuit settings, delivered with the job's results, and the
+# radii and generation of the table it was queued with even if the geofences change before it is evaluated
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+@patch("src.app.http_pool.post", side_effect=carer_batch_response)
+def test_submit_user_location_prop_async_any_inside(mock_post, mock_key, client):
+    original_coordinates = geofencing.geofence_coordinates
+    table = geofencing.geofence_snapshot.build_geofence_table([[0.1, 0.9], [0.2, 0.8], [0.3, 0.7]], radius=[100, 200, 300], group=[1, 0, 1])
+    table['generation'] = 7
+    geofencing.set_geofence_table(table)
+
+    evaluate = geofencing.calculate_intermediate_haversine_value_prop
+
+    def reload_then_evaluate(*args, **kwargs):
+        geofencing.set_geofence_coordinates([[0.4, 0.6]], radius=[500], group=[1])
+        return evaluate(*args, **kwargs)
+
+    try:
+        with patch("src.app.calculate_intermediate_haversine_value_prop", side_effect=reload_then_evaluate):
+            response = client.post(
+                "/submit-user-location-prop",
+                data=json.dumps(dict(prop_payload(), number_of_geofences=3, any_inside=True, priority_group=1, recent_hits_first=False)),
+                content_type="application/json",
+                headers={"Prefer": "respond-async"}
+            )
+            assert response.status_code == 202
+            job = wait_for_job(client, response.get_json()["status_url"])
+    finally:
+        geofencing.set_geofence_coordinates(original_coordinates)
+
+    assert job["status"] == "delivered"
+    delivery = mock_post.call_args.kwargs["json"]["deliveries"][0]
+    assert len(delivery["encrypted_results"]) == 3
+    assert delivery["radii"] == [100, 200, 300]
+    assert delivery["any_inside"] is True
+    assert delivery["priority"] == [0, 2]
+    assert delivery["recent_hits_first"] is False
+    assert delivery["generation"] == 7
+
+
+# Test a request is turned away with 503 when the job queue is full
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+def test_submit_user_location_prop_async_backpressure(mock_key, client, monkeypatch):
+    full_queue = queue.Queue(maxsize=1)
+    full_queue.put(None)
+    monkeypatch.setattr(geofencing, "job_queue", full_queue)
+    monkeypatch.setattr(geofencing, "job_workers_pid", os.getpid())
+
+    response = client.post(
+        "/submit-user-location-prop",
+        data=json.dumps(prop_payload()),
+        content_type="application/json",
+        headers={"Prefer": "respond-async"}
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert os.listdir(geofencing.JOB_STATE_DIR) == []  # The rejected job leaves no state behind
+
+
+# Test a batch is redelivered after a connection error, and its jobs fail once the retries are used up
+def test_deliver_job_batch_retries(client, monkeypatch):
+    monkeypatch.setattr(geofencing, "DELIVERY_RETRIES", 2)
+    os.makedirs(geofencing.JOB_STATE_DIR, exist_ok=True)
+
+    job = {"job_id": "a" * 32, "system": "prop", "status": "delivering", "submitted_at": time.time()}
+    with patch("src.app.http_pool.post", side_effect=[requests.exceptions.ConnectionError("refused"), carer_batch_response(None, json={"deliveries": [job]})]) as mock_post:
+        geofencing.deliver_job_batch(TEST_PUBLIC_KEY_N, [(job, [], False, None, None)])
+
+    assert mock_post.call_count == 2
+    assert geofencing.read_job_state(job["job_id"])["status"] == "delivered"
+    assert geofencing.read_job_state(job["job_id"])["attempts"] == 1
+
+    job = {"job_id": "b" * 32, "system": "prop", "status": "delivering", "submitted_at": time.time()}
+    with patch("src.app.http_pool.post", side_effect=requests.exceptions.ConnectionError("refused")) as mock_post:
+        geofencing.deliver_job_batch(TEST_PUBLIC_KEY_N, [(job, [], False, None, None)])
+
+    assert mock_post.call_count == 3
+    assert geofencing.read_job_state(job["job_id"])["status"] == "failed"
+
+
+# Test a job failing in an unexpected place is marked failed, and the job threads carry on with the next jobs
+@patch("src.app.get_carer_public_keys", return_value=[TEST_PUBLIC_KEY_N])
+def test_async_jobs_survive_failures(mock_key, client):
+    def submit():
+        response = client.post(
+            "/submit-user-location-prop",
+            data=json.dumps(prop_payload()),
+            content_type="application/json",
+            headers={"Prefer": "respond-async"}
+        )
+        assert response.status_code == 202
+        return wait_for_job(client, response.get_json()["status_url"])
+
+    # The evaluation thread: an error after the evaluation itself
+    with patch("src.app.get_carer_geofence_radii", side_effect=OSError("No space left on device")):
+        job = submit()
+    assert job["status"] == "failed"
+    assert job["message"] == "Evaluation failed: No space left on device"
+
+    # The delivery thread: a carer answering with JSON that isn't an object, then a batch that can't be sent at all
+    not_an_object = MagicMock(status_code=200)
+    not_an_object.json.return_value = ["unexpected"]
+    with patch("src.app.http_pool.post", return_value=not_an_object):
+        job = submit()
+    assert job["status"] == "failed"
+
+    with patch("src.app.http_pool.post", side_effect=ValueError("Can't encode the payload")):
+        job = submit()
+    assert job["status"] == "failed"
+    assert job["message"] == "Delivery failed: Can't encode the payload"
+
+    # Both threads are still running
+    with patch("src.app.http_pool.post", side_effect=carer_batch_response):
+        job = submit()
+    assert job["status"] == "delivered"
+
+
+# Test cleaning up the job states doesn't raise when their directory is gone
+def test_cleanup_job_states_without_directory(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(geofencing, "JOB_STATE_DIR", str(tmp_path / "missing"))
+    monkeypatch.setattr(geofencing, "job_states_cleaned_at", 0)
+
+    geofencing.cleanup_job_states()
+
+
+# Test unknown or malformed job ids are answered with 404
+def test_get_job_status_unknown(client):
+    assert client.get(f"/jobs/{'0' * 32}").status_code == 404
+    assert client.get("/jobs/..%2F..%2Fetc%2Fpasswd").status_code == 404
@@ -0,0 +1,595 @@
+import pytest
+import json
+import math
+import os
+import fcntl
+import threading
+import time
+import numpy as np
+from unittest.mock import patch
+import geofence_snapshot
+import src.app as geofencing
+
+# Geofence centres (lon, lat) in radians and their OSM node ids
+TEST_GEOFENCES = [
+    [math.radians(-9.724100), math.radians(51.573001)],
+    [math.radians(-9.910680), math.radians(51.651051)],
+    [math.radians(-0.127758), math.radians(51.507351)],
+]
+TEST_IDS = [2002, 2001, 2003]
+
+
+# Token of the admin API in the tests
+ADMIN_TOKEN = "secret"
+
+
+# Pytest fixture to point the service at a snapshot in a temporary directory, with the admin API enabled, restoring its
+# geofences afterwards
+@pytest.fixture
+def snapshot_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "geofences.snapshot")
+    monkeypatch.setattr(geofencing, "GEOFENCE_SNAPSHOT", path)
+    monkeypatch.setattr(geofencing, "ADMIN_TOKEN", ADMIN_TOKEN)
+    original_table = geofencing.geofence_table
+    original_source = dict(geofencing.geofence_source)
+    yield path
+    geofencing.set_geofence_table(original_table)
+    geofencing.geofence_source.update(original_source)
+
+
+# Test client sending the admin token with every request
+def admin_client():
+    client = geofencing.app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {ADMIN_TOKEN}"
+    return client
+
+
+# Test a snapshot maps back exactly the ids, centres and coefficients it was written with, read-only
+def test_snapshot_round_trip(tmp_path):
+    table = geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS)
+    path = str(tmp_path / "geofences.snapshot")
+
+    geofence_snapshot.write_snapshot(path, table)
+    loaded = geofence_snapshot.load_snapshot(path)
+
+    assert loaded['version'] == geofence_snapshot.SNAPSHOT_VERSION
+    assert loaded['count'] == len(TEST_GEOFENCES)
+    for name in ['ids', 'coordinates', 'prop_terms', 'ref_terms']:
+        assert np.array_equal(loaded[name], table[name])
+        assert not loaded[name].flags.writeable     # Mapped from the file, not copied into memory
+
+
+# Test an empty catalogue can be saved and loaded too
+def test_snapshot_round_trip_empty(tmp_path):
+    path = str(tmp_path / "geofences.snapshot")
+
+    geofence_snapshot.write_snapshot(path, geofence_snapshot.build_geofence_table([]))
+    loaded = geofence_snapshot.load_snapshot(path)
+
+    assert loaded['count'] == 0
+    assert loaded['prop_terms'].shape == (0, 3)
+    assert loaded['ref_terms'].shape == (0, 6)
+
+
+# Test files that aren't a complete snapshot of this version are rejected
+@pytest.mark.parametrize("corruption", ["magic", "version", "truncated"])
+def test_snapshot_rejects_invalid_files(tmp_path, corruption):
+    path = str(tmp_path / "geofences.snapshot")
+    geofence_snapshot.write_snapshot(path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES))
+
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    if corruption == "magic":
+        data[:8] = b"NOTASNAP"
+    elif corruption == "version":
+        data[8:12] = (geofence_snapshot.SNAPSHOT_VERSION + 1).to_bytes(4, "little")
+    else:
+        data = data[:-8]
+    with open(path, "wb") as f:
+        f.write(data)
+
+    with pytest.raises(ValueError):
+        geofence_snapshot.load_snapshot(path)
+
+
+# Test the CLI builds a snapshot from a local GeoJSON file, processing the features as the Overpass fetch does
+def test_snapshot_cli_build(tmp_path, capsys):
+    features = [
+        {"type": "Feature", "id": 2001, "geometry": {"type": "Point", "coordinates": [-9.91068, 51.651051]}},
+        {"type": "Feature", "id": 2002, "geometry": {"type": "Point", "coordinates": [-9.7241, 51.57]}},     # Both end in zero
+        {"type": "Feature", "id": 2003, "geometry": {"type": "Point", "coordinates": [-0.127758, 51.507351]}}
+    ]
+    input_path = tmp_path / "cafes.geojson"
+    input_path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    output_path = str(tmp_path / "geofences.snapshot")
+
+    geofence_snapshot.main(["build", str(input_path), output_path, "--limit", "2"])
+    loaded = geofence_snapshot.load_snapshot(output_path)
+
+    assert list(loaded['ids']) == [2001, 2002]
+    assert loaded['coordinates'][1][1] == pytest.approx(math.radians(51.570001))   # Offset as in the Overpass fetch
+
+    geofence_snapshot.main(["info", output_path])
+    assert "2 geofences" in capsys.readouterr().out
+
+
+# Test the service maps an existing snapshot instead of querying Overpass, and evaluates the same coefficients
+def test_load_geofences_from_snapshot(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+
+    with patch("src.app.get_geofence_coordinates") as mock_fetch:
+        assert geofencing.load_geofences() is True
+
+    assert mock_fetch.call_count == 0
+    assert geofencing.geofence_source['source'] == "snapshot"
+    assert list(geofencing.geofence_ids) == TEST_IDS
+    assert np.array_equal(geofencing.geofence_coefficients['prop_terms'], geofence_snapshot.build_geofence_table(TEST_GEOFENCES)['prop_terms'])
+
+
+# Test geofences fetched when there is no snapshot (or an unreadable one) are saved as the snapshot for the next start
+@pytest.mark.parametrize("existing", [None, b"not a snapshot"])
+def test_load_geofences_saves_snapshot(snapshot_path, existing):
+    if existing is not None:
+        with open(snapshot_path, "wb") as f:
+            f.write(existing)
+
+    def fetch():
+        geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS)
+        return True
+
+    with patch("src.app.get_geofence_coordinates", side_effect=fetch):
+        assert geofencing.load_geofences() is True
+
+    assert geofencing.geofence_source['source'] == "overpass"
+    assert list(geofence_snapshot.load_snapshot(snapshot_path)['ids']) == TEST_IDS
+
+
+# Test a snapshot replaced by another worker's refresh is served from the next request on
+def test_replaced_snapshot_is_reloaded(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES[:1], TEST_IDS[:1]))
+
+    with geofencing.app.test_client() as client:
+        response = client.get("/geofences")
+
+    assert response.get_json()["count"] == 1
+    assert list(geofencing.geofence_ids) == TEST_IDS[:1]
+
+
+# Test a failed refresh keeps the geofences being served
+def test_refresh_geofences_failure(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    with patch("src.app.get_geofence_coordinates", return_value=False):
+        with admin_client() as client:
+            response = client.post("/geofences/refresh")
+
+    assert response.status_code == 502
+    assert len(geofencing.geofence_coordinates) == len(TEST_GEOFENCES)
+
+
+# The Overpass fetch's original per-coordinate rounding, as ground truth for the vectorised version
+def sanitise_coordinate(lon, lat):
+    lon_rounded, lat_rounded = round(lon, 6), round(lat, 6)
+    if f"{lon_rounded:.6f}"[-1] == "0" and f"{lat_rounded:.6f}"[-1] == "0":
+        lat_rounded = round(lat_rounded + 10**-6, 6)
+    return lon_rounded, lat_rounded
+
+
+# Test the vectorised rounding gives exactly the per-coordinate result, incl. trailing zeros, negatives and halfway values
+def test_sanitise_coordinates_matches_scalar():
+    longitudes = [-9.72410, -9.7241, 0.0, -0.1277585, 2.1234565, -10.0000004, 179.9999995, 12.3456789]
+    latitudes = [51.57, 51.573001, 0.0, 51.5073515, 50.00000049, 59.9999995, -45.12, 51.1]
+
+    sanitised_longitudes, sanitised_latitudes = geofence_snapshot.sanitise_coordinates(longitudes, latitudes)
+
+    for lon, lat, sanitised_lon, sanitised_lat in zip(longitudes, latitudes, sanitised_longitudes, sanitised_latitudes):
+        assert (sanitised_lon, sanitised_lat) == sanitise_coordinate(lon, lat)
+
+
+# The same points (id, lon, lat, amenity) written in every source format
+SOURCE_POINTS = [(2001, -9.91068, 51.651051, "cafe"), (2002, -9.7241, 51.57, "pub"), (2003, -0.127758, 51.507351, "cafe"), (2004, 2.0, 55.25, "cafe"), (2005, 1.5, 52.5, "pub")]
+
+
+def write_source(tmp_path, source_format):
+    if source_format == "geojson":
+        path = tmp_path / "pois.geojson"
+        features = [{"type": "Feature", "id": f"node/{i}", "properties": {"amenity": amenity}, "geometry": {"type": "Point", "coordinates": [lon, lat]}} for i, lon, lat, amenity in SOURCE_POINTS]
+        features.insert(2, {"type": "Feature", "id": 9999, "properties": {"amenity": "cafe"}, "geometry": {"type": "LineString", "coordinates": [[0, 50], [1, 51]]}})
+        path.write_text(json.dumps({"type": "FeatureCollection", "features": features}, indent=1))
+    elif source_format == "geojson-sequence":
+        path = tmp_path / "pois.geojsonl"
+        path.write_text("\n".join(json.dumps({"type": "Feature", "id": i, "properties": {"amenity": amenity}, "geometry": {"type": "Point", "coordinates": [lon, lat]}}) for i, lon, lat, amenity in SOURCE_POINTS))
+    elif source_format == "csv":
+        path = tmp_path / "pois.csv"
+        path.write_text("ID,Longitude,Latitude,amenity\n" + "".join(f"{i},{lon},{lat},{amenity}\n" for i, lon, lat, amenity in SOURCE_POINTS) + "2006,not a number,50,cafe\n")
+    else:
+        path = tmp_path / "pois.osm"
+        nodes = "".join(f'<node id="{i}" lat="{lat}" lon="{lon}"><tag k="amenity" v="{amenity}"/></node>\n<node id="{i + 100}" lat="{lat}" lon="{lon}"/>\n' for i, lon, lat, amenity in SOURCE_POINTS)
+        path.write_text(f'<?xml version="1.0"?>\n<osm version="0.6">\n{nodes}<way id="1"><nd ref="2001"/><tag k="amenity" v="cafe"/></way>\n</osm>\n')
+    return str(path)
+
+
+# Test every source format is streamed into the snapshot in chunks, sanitised as the Overpass fetch does, with and without a tag filter
+@pytest.mark.parametrize("source_format", ["geojson", "geojson-sequence", "csv", "osm"])
+@pytest.mark.parametrize("tag", [None, "amenity=cafe"])
+def test_import_geofences(tmp_path, source_format, tag):
+    snapshot_path = str(tmp_path / "geofences.snapshot")
+    expected = [point for point in SOURCE_POINTS if tag is None or point[3] == "cafe"]
+
+    stats = geofence_snapshot.import_geofences(write_source(tmp_path, source_format), snapshot_path, tag=tag, chunk_size=2)
+    loaded = geofence_snapshot.load_snapshot(snapshot_path)
+
+    assert stats['count'] == len(expected)
+    assert list(loaded['ids']) == [point[0] for point in expected]
+    for (lon, lat), (i, source_lon, source_lat, amenity) in zip(loaded['coordinates'], expected):
+        sanitised_lon, sanitised_lat = sanitise_coordinate(source_lon, source_lat)
+        assert (lon, lat) == (math.radians(sanitised_lon), math.radians(sanitised_lat))
+
+    table = geofence_snapshot.build_geofence_table(loaded['coordinates'])
+    assert np.array_equal(loaded['ref_terms'], table['ref_terms'])
+
+
+# Test features split across the reader's blocks are decoded whole
+def test_read_geojson_features_small_blocks(tmp_path):
+    path = write_source(tmp_path, "geojson")
+
+    features = list(geofence_snapshot.read_geojson_features(path, block_size=16))
+
+    assert [feature["id"] for feature in features] == ["node/2001", "node/2002", 9999, "node/2003", "node/2004", "node/2005"]
+
+
+# Test a failed import leaves the existing snapshot in place and no temporary files behind
+def test_import_geofences_failure_keeps_snapshot(tmp_path):
+    snapshot_path = str(tmp_path / "geofences.snapshot")
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+
+    source_path = tmp_path / "broken.geojson"
+    source_path.write_text('{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [1, 50]}}, {"type": ')
+
+    with pytest.raises(ValueError):
+        geofence_snapshot.import_geofences(str(source_path), snapshot_path, chunk_size=1)
+
+    assert list(geofence_snapshot.load_snapshot(snapshot_path)['ids']) == TEST_IDS
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["broken.geojson", "geofences.snapshot"]
+
+
+# Test the service imports its geofences from GEOFENCE_SOURCE_FILE instead of Overpass when there is no snapshot
+def test_load_geofences_from_source_file(snapshot_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(geofencing, "GEOFENCE_SOURCE_FILE", write_source(tmp_path, "csv"))
+
+    with patch("src.app.get_geofence_coordinates") as mock_fetch:
+        assert geofencing.load_geofences() is True
+
+    assert mock_fetch.call_count == 0
+    assert geofencing.geofence_source['source'] == "file"
+    assert list(geofencing.geofence_ids) == [point[0] for point in SOURCE_POINTS]
+
+
+# Test the geofences' radius, group and active flag are saved with them (active geofences first), and default when not given
+def test_snapshot_round_trip_metadata(tmp_path):
+    path = str(tmp_path / "geofences.snapshot")
+    table = geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS, radius=[50, 100, 250.5], group=[1, 1, 2], active=[True, False, True])
+
+    geofence_snapshot.write_snapshot(path, table)
+    loaded = geofence_snapshot.load_snapshot(path)
+
+    assert loaded['active_count'] == 2
+    assert list(loaded['ids']) == [2002, 2003, 2001]
+    assert list(loaded['radius']) == [50, 250.5, 100]
+    assert list(loaded['group']) == [1, 2, 1]
+    assert list(loaded['active']) == [True, True, False]
+    assert np.array_equal(loaded['ref_terms'], geofence_snapshot.build_geofence_table([TEST_GEOFENCES[i] for i in (0, 2, 1)])['ref_terms'])
+
+    defaults = geofence_snapshot.build_geofence_table(TEST_GEOFENCES)
+    assert list(defaults['radius']) == [geofence_snapshot.DEFAULT_GEOFENCE_RADIUS] * 3
+    assert list(defaults['group']) == [0, 0, 0]
+    assert defaults['active'].all()
+
+
+# Test metadata is imported from CSV columns and GeoJSON properties, and points with invalid metadata are skipped
+@pytest.mark.parametrize("source_format", ["csv", "geojson"])
+def test_import_geofences_metadata(tmp_path, source_format):
+    points = [(1, -9.91068, 51.651051, {"radius": "50", "group": "3", "active": "yes"}),
+              (2, -9.7241, 51.57, {"active": "false"}),
+              (3, -0.127758, 51.507351, {"radius": "-10"})]
+    if source_format == "csv":
+        source_path = tmp_path / "pois.csv"
+        source_path.write_text("id,lon,lat,radius,group,active\n" + "".join(
+            f"{i},{lon},{lat},{metadata.get('radius', '')},{metadata.get('group', '')},{metadata.get('active', '')}\n" for i, lon, lat, metadata in points))
+    else:
+        source_path = tmp_path / "pois.geojson"
+        source_path.write_text(json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "id": i, "properties": metadata, "geometry": {"type": "Point", "coordinates": [lon, lat]}} for i, lon, lat, metadata in points]}))
+    snapshot_path = str(tmp_path / "geofences.snapshot")
+
+    stats = geofence_snapshot.import_geofences(str(source_path), snapshot_path)
+    loaded = geofence_snapshot.load_snapshot(snapshot_path)
+
+    assert stats['skipped'] == 1
+    assert list(loaded['ids']) == [1, 2]
+    assert list(loaded['radius']) == [50, geofence_snapshot.DEFAULT_GEOFENCE_RADIUS]
+    assert list(loaded['group']) == [3, 0]
+    assert list(loaded['active']) == [True, False]
+
+
+# Test geofences are found by id (the first of duplicated ids), and unknown ids aren't
+def test_find_geofences():
+    table = geofence_snapshot.build_geofence_table(TEST_GEOFENCES + TEST_GEOFENCES[:1], TEST_IDS + [2001])
+    index = geofence_snapshot.build_geofence_index(table)
+
+    positions = geofence_snapshot.find_geofences(index, [2003, 2001, 2002, 1, 9999])
+
+    assert list(positions) == [2, 1, 0, -1, -1]
+
+
+# Test the service evaluates only the active geofences, as views of the table when they all are, and serves
+# every geofence's metadata by id
+def test_service_active_geofences_and_lookup(snapshot_path):
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS)
+    assert np.shares_memory(geofencing.geofence_coordinates, geofencing.geofence_table['coordinates'])
+
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS, radius=[50, 100, 150], group=[1, 2, 2], active=[True, False, True])
+
+    assert list(geofencing.geofence_ids) == [2002, 2003]
+    assert np.array_equal(geofencing.geofence_coefficients['prop_terms'], geofence_snapshot.build_geofence_table([TEST_GEOFENCES[0], TEST_GEOFENCES[2]])['prop_terms'])
+
+    with geofencing.app.test_client() as client:
+        summary = client.get("/geofences").get_json()
+        geofence = client.get("/geofences/2001").get_json()
+        missing = client.get("/geofences/1")
+
+    assert (summary["count"], summary["total"]) == (2, 3)
+    assert geofence == {"id": 2001, "longitude": pytest.approx(-9.91068), "latitude": pytest.approx(51.651051), "radius": 100.0, "group": 2, "active": False}
+    assert missing.status_code == 404
+
+
+# Test the carer is sent the radii of the geofences it gets results for: one number when they are all the same, else one per geofence
+def test_carer_geofence_radii(snapshot_path):
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS)
+    assert geofencing.get_carer_geofence_radii(10) == geofence_snapshot.DEFAULT_GEOFENCE_RADIUS
+
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS, radius=[50, 100, 150], active=[True, False, True])
+    assert geofencing.get_carer_geofence_radii(10) == [50, 150]
+    assert geofencing.get_carer_geofence_radii(1) == 50
+
+    geofencing.set_geofence_coordinates([])
+    assert geofencing.get_carer_geofence_radii(10) is None
+
+
+# Test short-circuit requests ask the carer to decrypt the geofences of their priority group first, and others don't
+def test_carer_short_circuit(snapshot_path):
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES, TEST_IDS, group=[7, 1, 7])
+
+    assert geofencing.get_carer_short_circuit({}, 10) is None
+    assert geofencing.get_carer_short_circuit({"any_inside": True}, 10) == {"any_inside": True, "generation": None}
+    assert geofencing.get_carer_short_circuit({"any_inside": True, "priority_group": 7}, 10)["priority"] == [0, 2]
+    assert geofencing.get_carer_short_circuit({"any_inside": True, "priority_group": 7}, 2)["priority"] == [0]
+    assert geofencing.get_carer_short_circuit({"any_inside": True, "recent_hits_first": False}, 10)["recent_hits_first"] is False
+
+
+# Test every snapshot written over another is the next generation, and workers report the generation they serve
+def test_snapshot_generation(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    assert geofence_snapshot.read_snapshot_header(snapshot_path)['generation'] == 1
+    geofencing.load_geofences()
+
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES[:2], TEST_IDS[:2]))
+
+    with geofencing.app.test_client() as client:
+        summary = client.get("/geofences").get_json()
+
+    assert (summary["generation"], summary["count"]) == (2, 2)
+
+
+# Test the geofences a worker evaluates are views of the shared read-only mapping, inactive geofences or not,
+# rather than copies in the worker's own memory
+@pytest.mark.parametrize("active", [None, [True, False, True]])
+def test_served_geofences_are_views_of_snapshot(snapshot_path, active):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS, active=active))
+    geofencing.load_geofences()
+
+    mapped = geofencing.geofence_table
+    assert len(geofencing.geofence_coordinates) == (3 if active is None else 2)
+    for served, column in [(geofencing.geofence_coordinates, 'coordinates'), (geofencing.geofence_ids, 'ids'),
+                           (geofencing.geofence_coefficients['prop_terms'], 'prop_terms'), (geofencing.geofence_coefficients['ref_terms'], 'ref_terms')]:
+        assert np.shares_memory(served, mapped[column])
+        assert not served.flags.writeable
+
+
+# Test changes are applied across chunks: only the added and updated geofences get new rows, every other row is copied
+def test_apply_geofence_changes(tmp_path):
+    path = str(tmp_path / "geofences.snapshot")
+    table = geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS)
+    added = geofence_snapshot.build_geofence_table([[math.radians(2.35), math.radians(48.85)]], [3001])
+    updated = geofence_snapshot.build_geofence_table([TEST_GEOFENCES[2]], [2003], radius=50, active=False)
+
+    changes = geofence_snapshot.apply_geofence_changes(table, path, added, updated, [2001], chunk_size=1)
+    loaded = geofence_snapshot.load_snapshot(path)
+
+    assert (changes['count'], changes['added'], changes['updated'], changes['removed']) == (3, 1, 1, 1)
+    assert list(loaded['ids']) == [2002, 3001, 2003]     # Active geofences first
+    assert list(loaded['radius']) == [100, 100, 50]
+    assert loaded['active_count'] == 2
+    assert np.array_equal(loaded['ref_terms'][0], table['ref_terms'][0])
+    assert np.array_equal(loaded['ref_terms'][1], added['ref_terms'][0])
+
+
+# Test invalid changes are rejected before the snapshot is replaced
+@pytest.mark.parametrize("changes", [
+    {'added': [2001]},                  # Already exists
+    {'updated': [9999]},                # Unknown
+    {'removed': [9999]},                # Unknown
+    {'removed': [2001, 2001]},          # Removed twice
+    {'updated': [2001], 'removed': [2001]}
+])
+def test_apply_geofence_changes_rejects_invalid(tmp_path, changes):
+    path = str(tmp_path / "geofences.snapshot")
+    table = geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS)
+    geofence_snapshot.write_snapshot(path, table)
+
+    with pytest.raises(ValueError):
+        geofence_snapshot.apply_geofence_changes(
+            table, path,
+            added=geofence_snapshot.build_geofence_table(TEST_GEOFENCES[:len(changes.get('added', []))], changes.get('added', [])),
+            updated=geofence_snapshot.build_geofence_table(TEST_GEOFENCES[:len(changes.get('updated', []))], changes.get('updated', [])),
+            removed=changes.get('removed', []))
+
+    assert geofence_snapshot.read_snapshot_header(path)['generation'] == 1
+
+
+# Test the admin API adds, updates and removes geofences as the next generation, while a request that started on the
+# previous generation keeps its geofences
+def test_admin_update_geofences(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+    previous_table = geofencing.geofence_table
+
+    with admin_client() as client:
+        response = client.post("/admin/geofences", json={
+            "add": [{"id": 3001, "longitude": 2.35, "latitude": 48.8566, "radius": 250}],
+            "update": [{"id": 2002, "active": False}, {"id": 2003, "longitude": -0.1, "latitude": 51.5}],
+            "remove": [2001]
+        })
+        geofence = client.get("/geofences/3001").get_json()
+
+    assert response.status_code == 200
+    assert (response.get_json()["generation"], response.get_json()["count"]) == (2, 2)
+    assert list(geofencing.geofence_ids) == [2003, 3001]
+    assert geofencing.geofence_source['source'] == "admin"
+    assert (geofence["latitude"], geofence["radius"]) == (pytest.approx(48.8566), 250.0)
+
+    # The previous mapping stays readable for requests that were using it
+    assert list(previous_table['ids']) == TEST_IDS
+    assert np.isfinite(previous_table['ref_terms']).all()
+
+
+# Test invalid admin changes are rejected and leave the geofences as they were
+@pytest.mark.parametrize("payload", [
+    {},
+    {"remove": [9999]},
+    {"remove": ["2001"]},
+    {"add": [{"id": 2001, "longitude": 1, "latitude": 50}]},
+    {"add": [{"id": 3001, "longitude": 200, "latitude": 50}]},
+    {"update": [{"id": 2001, "radius": -5}]}
+])
+def test_admin_update_geofences_invalid(snapshot_path, payload):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    with admin_client() as client:
+        response = client.post("/admin/geofences", json=payload)
+
+    assert response.status_code == 400
+    assert list(geofencing.geofence_ids) == TEST_IDS
+    assert geofence_snapshot.read_snapshot_header(snapshot_path)['generation'] == 1
+
+
+# Test an admin change waits for a change another worker is publishing, and is applied on top of it rather than on
+# this worker's copy of the previous generation, so neither change is lost
+def test_admin_update_waits_for_other_worker(snapshot_path):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    # Another worker holds the snapshot's lock while it publishes generation 2
+    fd = os.open(snapshot_path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    responses = []
+
+    def update():
+        with admin_client() as client:
+            responses.append(client.post("/admin/geofences", json={"add": [{"id": 3001, "longitude": 2.35, "latitude": 48.8566}]}))
+
+    thread = threading.Thread(target=update)
+    thread.start()
+    time.sleep(0.5)
+    assert thread.is_alive()
+
+    added = geofencing.geofence_entries_table([{"id": 3002, "longitude": 2.29, "latitude": 48.86}], "add")
+    geofence_snapshot.apply_geofence_changes(geofence_snapshot.load_snapshot(snapshot_path), snapshot_path, added)
+    os.close(fd)
+    thread.join()
+
+    assert responses[0].status_code == 200
+    assert responses[0].get_json()["generation"] == 3
+    assert sorted(geofencing.geofence_ids) == sorted(TEST_IDS + [3001, 3002])
+
+
+# Test the admin API needs the token when one is set
+def test_admin_token(snapshot_path, monkeypatch):
+    payload = {"geofences": [{"id": 1, "longitude": 1, "latitude": 50}]}
+
+    with geofencing.app.test_client() as client:
+        unauthorised = client.put("/admin/geofences", json=payload, headers={"Authorization": "Bearer wrong"})
+        refresh = client.post("/geofences/refresh")
+        authorised = client.put("/admin/geofences", json=payload, headers={"Authorization": "Bearer secret"})
+
+    assert unauthorised.status_code == 401
+    assert refresh.status_code == 401
+    assert authorised.status_code == 200
+    assert list(geofencing.geofence_ids) == [1]
+
+
+# Test the admin API, the refresh included, refuses every request when no ADMIN_TOKEN is set
+def test_admin_disabled_without_token(snapshot_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(geofencing, "ADMIN_TOKEN", "")
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    with patch("src.app.get_geofence_coordinates") as mock_fetch:
+        with geofencing.app.test_client() as client:
+            responses = [
+                client.post("/geofences/refresh"),
+                client.post("/admin/geofences", json={"remove": [2001]}),
+                client.put("/admin/geofences", json={"geofences": []}),
+                client.post("/admin/geofences/load", json={"path": snapshot_path})
+            ]
+
+    assert [response.status_code for response in responses] == [403] * 4
+    assert responses[0].get_json()["message"] == "The admin API is disabled, set ADMIN_TOKEN to enable it"
+    assert mock_fetch.call_count == 0
+    assert list(geofencing.geofence_ids) == TEST_IDS
+
+
+# Test a new snapshot file or a source file can be loaded through the admin API
+@pytest.mark.parametrize("source_format", ["snapshot", "csv"])
+def test_admin_load_geofences(snapshot_path, tmp_path, source_format):
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+
+    if source_format == "snapshot":
+        path = str(tmp_path / "new.snapshot")
+        geofence_snapshot.write_snapshot(path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES[:1], [7]))
+        expected_ids = [7]
+    else:
+        path = write_source(tmp_path, "csv")
+        expected_ids = [point[0] for point in SOURCE_POINTS]
+
+    with admin_client() as client:
+        response = client.post("/admin/geofences/load", json={"path": path})
+        missing = client.post("/admin/geofences/load", json={"path": str(tmp_path / "missing.csv")})
+
+    assert response.status_code == 200
+    assert response.get_json()["generation"] == 2
+    assert list(geofencing.geofence_ids) == expected_ids
+    assert missing.status_code == 400
+
+
+# Test the encodings of geofences that didn't change carry over to the next generation, and only changed ones are encoded again
+def test_encodings_carry_over_unchanged_geofences(snapshot_path):
+    from phe import paillier
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=512)
+    geofence_snapshot.write_snapshot(snapshot_path, geofence_snapshot.build_geofence_table(TEST_GEOFENCES, TEST_IDS))
+    geofencing.load_geofences()
+    rows = geofencing.get_encoded_geofence_coefficients(public_key, 'prop')
+
+    with admin_client() as client:
+        client.post("/admin/geofences", json={"update": [{"id": 2001, "longitude": -9.9, "latitude": 51.65}, {"id": 2003, "group": 4}], "remove": [2002]})
+
+    carried = geofencing.geofence_coefficients['encoded'][public_key.n]['prop']
+    assert list(geofencing.geofence_ids) == [2001, 2003]
+    assert carried[0] is None           # Moved, so encoded again when a request needs it
+    assert carried[1] is rows[2]        # Only its group changed
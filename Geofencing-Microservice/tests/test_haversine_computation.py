@@ -0,0 +1,405 @@
+import pytest
+import math
+import os
+import signal
+import threading
+from phe import paillier
+import src.app as geofencing
+
+# Smaller key than the carer's, only to keep the tests fast
+public_key, private_key = paillier.generate_paillier_keypair(n_length=1024)
+
+# Geofence centres (lon, lat) in radians, with one close to the user so both inside/outside values are covered
+TEST_GEOFENCES = [
+    [math.radians(-9.724100), math.radians(51.573001)],
+    [math.radians(-9.910680), math.radians(51.651051)],
+    [math.radians(-0.127758), math.radians(51.507351)],
+]
+
+# User's location in radians
+USER_LATITUDE, USER_LONGITUDE = math.radians(51.57304), math.radians(-9.72409)
+
+
+# Pytest fixture to load the test geofences (and rebuild the coefficient table) for a test
+@pytest.fixture
+def geofences():
+    original_coordinates = geofencing.geofence_coordinates
+    geofencing.set_geofence_coordinates(TEST_GEOFENCES)
+    yield TEST_GEOFENCES
+    geofencing.set_geofence_coordinates(original_coordinates)
+
+
+# Plaintext haversine intermediate value 'a' used as ground truth
+def plaintext_haversine_intermediate(user_latitude, user_longitude, center_latitude, center_longitude):
+    return math.sin((user_latitude - center_latitude)/2)**2 + math.cos(user_latitude) * math.cos(center_latitude) * math.sin((user_longitude - center_longitude)/2)**2
+
+
+def decrypt_results(serialized_values):
+    return [private_key.decrypt(paillier.EncryptedNumber(public_key, value['ciphertext'], value['exponent'])) for value in serialized_values]
+
+
+# Test the coefficient table is rebuilt with one row per geofence when the geofence set changes
+def test_coefficient_table_rebuilt_on_geofence_change(geofences):
+    assert geofencing.geofence_coefficients['prop_terms'].shape == (len(geofences), 3)
+    assert geofencing.geofence_coefficients['ref_terms'].shape == (len(geofences), 6)
+
+    geofencing.set_geofence_coordinates(geofences[:1])
+
+    assert geofencing.geofence_coefficients['prop_terms'].shape == (1, 3)
+    assert geofencing.geofence_coefficients['ref_terms'].shape == (1, 6)
+
+
+# Test the reference computation matches the plaintext haversine intermediate value for every geofence
+def test_calculate_intermediate_haversine_value_ref(geofences):
+    alpha = math.cos(USER_LATITUDE / 2)
+    gamma = math.sin(USER_LATITUDE / 2)
+    zeta = math.cos(USER_LATITUDE)
+    theta = math.sin(USER_LONGITUDE / 2)
+    mu = math.cos(USER_LONGITUDE / 2)
+
+    user_terms = [public_key.encrypt(value) for value in (alpha**2, gamma**2, alpha * gamma, zeta * theta**2, zeta * theta * mu, zeta * mu**2)]
+
+    results = decrypt_results(geofencing.calculate_intermediate_haversine_value_ref(*user_terms, len(geofences)))
+
+    assert len(results) == len(geofences)
+    for result, (center_longitude, center_latitude) in zip(results, geofences):
+        assert result == pytest.approx(plaintext_haversine_intermediate(USER_LATITUDE, USER_LONGITUDE, center_latitude, center_longitude), abs=1e-12)
+
+
+# Test the proposed computation matches the plaintext value (proposed 'a' is twice the haversine intermediate value)
+def test_calculate_intermediate_haversine_value_prop(geofences):
+    c1 = public_key.encrypt(math.sin(USER_LATITUDE))
+    c2 = public_key.encrypt(math.cos(USER_LATITUDE) * math.cos(USER_LONGITUDE))
+    c3 = public_key.encrypt(math.cos(USER_LATITUDE) * math.sin(USER_LONGITUDE))
+
+    results = decrypt_results(geofencing.calculate_intermediate_haversine_value_prop(c1, c2, c3, len(geofences)))
+
+    assert len(results) == len(geofences)
+    for result, (center_longitude, center_latitude) in zip(results, geofences):
+        assert result == pytest.approx(2 * plaintext_haversine_intermediate(USER_LATITUDE, USER_LONGITUDE, center_latitude, center_longitude), abs=1e-12)
+
+
+# Test only the requested number of geofences are evaluated
+def test_calculate_intermediate_haversine_value_prop_limits_geofences(geofences):
+    c1, c2, c3 = (public_key.encrypt(0.5) for i in range(3))
+
+    results = geofencing.calculate_intermediate_haversine_value_prop(c1, c2, c3, 2)
+
+    assert len(results) == 2
+
+
+# Test inactive geofences are kept in the table but not evaluated
+def test_calculate_intermediate_haversine_value_prop_skips_inactive(geofences):
+    geofencing.set_geofence_coordinates(geofences, active=[True, False, True])
+    c1 = public_key.encrypt(math.sin(USER_LATITUDE))
+    c2 = public_key.encrypt(math.cos(USER_LATITUDE) * math.cos(USER_LONGITUDE))
+    c3 = public_key.encrypt(math.cos(USER_LATITUDE) * math.sin(USER_LONGITUDE))
+
+    results = decrypt_results(geofencing.calculate_intermediate_haversine_value_prop(c1, c2, c3, len(geofences)))
+
+    assert len(geofencing.geofence_table['ids']) == len(geofences)
+    assert len(results) == 2
+    for result, (center_longitude, center_latitude) in zip(results, [geofences[0], geofences[2]]):
+        assert result == pytest.approx(2 * plaintext_haversine_intermediate(USER_LATITUDE, USER_LONGITUDE, center_latitude, center_longitude), abs=1e-12)
+
+
+# Test only the coefficient rows requests ask for are encoded, each as encoding the whole table up front would
+def test_encoded_coefficients_are_encoded_lazily(geofences):
+    rows = geofencing.get_encoded_geofence_coefficients(public_key, 'ref', 1, 2)
+    cached = geofencing.geofence_coefficients['encoded'][public_key.n]['ref']
+
+    assert len(rows) == 1
+    assert cached[0] is None and cached[2] is None and cached[1] is rows[0]
+
+    rows = geofencing.get_encoded_geofence_coefficients(public_key, 'ref')
+    expected = [[geofencing.paillier_engine.encode(public_key, float(term)) for term in row] for row in geofencing.geofence_coefficients['ref_terms']]
+    assert [[(term.encoding, term.exponent) for term in row] for row in rows] == [[(term.encoding, term.exponent) for term in row] for row in expected]
+
+
+# Test threads encoding rows for several keys at once, adding and evicting keys, never fail and keep at most two keys
+def test_encoded_coefficients_concurrent_keys(geofences):
+    # Encoding only uses n, so keys with made-up odd moduli are enough
+    public_keys = [paillier.PaillierPublicKey(public_key.n + 2 * i) for i in range(4)]
+    barrier = threading.Barrier(len(public_keys))
+    errors = []
+
+    def encode(key):
+        barrier.wait()
+        try:
+            for _ in range(50):
+                for system in ('ref', 'prop'):
+                    rows = geofencing.get_encoded_geofence_coefficients(key, system)
+                    assert len(rows) == len(TEST_GEOFENCES) and None not in rows
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=encode, args=(key,)) for key in public_keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(geofencing.geofence_coefficients['encoded']) <= 2
+
+
+# Test a batch of fixes gives every fix the plaintext value, in fix order, with and without packing
+@pytest.mark.parametrize("packed", [False, True])
+def test_calculate_intermediate_haversine_values_batch(geofences, packed):
+    # A short track moving away from the geofence near the user
+    track = [(USER_LATITUDE + i * 1e-5, USER_LONGITUDE) for i in range(3)]
+    fixes_values = [tuple(public_key.encrypt(value) for value in (math.sin(latitude), math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude)))
+                    for latitude, longitude in track]
+
+    fixes_results = geofencing.calculate_intermediate_haversine_values_batch('prop', fixes_values, len(geofences), packed=packed)
+
+    assert len(fixes_results) == len(track)
+    for serialized_values, (latitude, longitude) in zip(fixes_results, track):
+        if packed:
+            results = []
+            for value in serialized_values:
+                plaintext = geofencing.paillier_engine.raw_decrypt(private_key, paillier.EncryptedNumber(public_key, value['ciphertext'], value['exponent']))
+                results.extend(geofencing.paillier_engine.unpack_slots(plaintext, value['slots'], value['slot_bits'], value['exponent']))
+        else:
+            results = decrypt_results(serialized_values)
+
+        assert len(results) == len(geofences)
+        for result, (center_longitude, center_latitude) in zip(results, geofences):
+            assert result == pytest.approx(2 * plaintext_haversine_intermediate(latitude, longitude, center_latitude, center_longitude), abs=1e-12)
+
+
+# Test the multi-exponentiation kernel gives exactly phe's ciphertext for 1 + Σ c·B, with and without fixed-base tables
+@pytest.mark.parametrize("fixed_base_threshold", [1, 1000])
+def test_evaluate_intermediate_values_matches_phe(geofences, monkeypatch, fixed_base_threshold):
+    monkeypatch.setattr(geofencing, "FIXED_BASE_THRESHOLD", fixed_base_threshold)
+
+    c1 = geofencing.paillier_engine.encrypt(public_key, math.sin(USER_LATITUDE))
+    c2 = geofencing.paillier_engine.encrypt(public_key, math.cos(USER_LATITUDE) * math.cos(USER_LONGITUDE))
+    c3 = geofencing.paillier_engine.encrypt(public_key, math.cos(USER_LATITUDE) * math.sin(USER_LONGITUDE))
+    coefficient_rows = geofencing.get_encoded_geofence_coefficients(public_key, 'prop')
+
+    intermediate_values, multiplications = geofencing.evaluate_intermediate_values((c1, c2, c3), coefficient_rows, constant=1)
+
+    # phe's own homomorphic operators as the reference, whichever backend produced the user's ciphertexts
+    c1, c2, c3 = (paillier.EncryptedNumber(public_key, value.ciphertext(False), value.exponent) for value in (c1, c2, c3))
+
+    for intermediate_value, (b1, b2, b3) in zip(intermediate_values, coefficient_rows):
+        expected = c1 * b1 + c2 * b2 + c3 * b3 + 1
+        assert intermediate_value.ciphertext(False) == expected.ciphertext(False)
+        assert intermediate_value.exponent == expected.exponent
+
+    # Fixed-base tables only pay off for many geofences, but interleaving always saves squarings
+    if fixed_base_threshold > len(geofences):
+        assert multiplications['actual'] < multiplications['generic']
+
+
+# Test the multi-exponentiation matches Python's pow for signed exponents across the table's range
+@pytest.mark.parametrize("fixed_base", [True, False])
+def test_multi_powmod(fixed_base):
+    modulus = public_key.nsquare
+    bases = [public_key.encrypt(0.25).ciphertext(False), public_key.encrypt(-0.5).ciphertext(False)]
+    exponent_rows = [[0, 1], [15, -16], [2**59 + 12345, 0], [-(2**60 - 1), 2**60 - 1]]
+
+    precomputed = geofencing.paillier_engine.prepare_multi_powmod(bases, exponent_rows, modulus, fixed_base)
+
+    for exponents in exponent_rows:
+        result, multiplications = geofencing.paillier_engine.multi_powmod(precomputed, exponents)
+        assert result == pow(bases[0], exponents[0], modulus) * pow(bases[1], exponents[1], modulus) % modulus
+
+
+# Test every backend's ciphertexts serialise like phe's and decrypt with both phe and the engine
+@pytest.mark.parametrize("backend", ["gmpy2", "python", "phe"])
+def test_backend_round_trip(monkeypatch, backend):
+    monkeypatch.setattr(geofencing.paillier_engine, "PAILLIER_BACKEND", backend)
+
+    for value in (0.0, 0.123456789, -0.75, 2.0):
+        encrypted = geofencing.paillier_engine.encrypt(public_key, value)
+        serialized = {'ciphertext': encrypted.ciphertext(), 'exponent': encrypted.exponent}
+
+        assert type(serialized['ciphertext']) is int
+        assert private_key.decrypt(paillier.EncryptedNumber(public_key, serialized['ciphertext'], serialized['exponent'])) == pytest.approx(value, abs=1e-12)
+
+        deserialized = geofencing.paillier_engine.encrypted_number(public_key, serialized['ciphertext'], serialized['exponent'])
+        assert geofencing.paillier_engine.decrypt(private_key, deserialized) == pytest.approx(value, abs=1e-12)
+
+
+# Test the process pool splits the geofences into chunks and merges them back in order, matching the serial evaluation
+def test_evaluate_geofences_parallel_matches_serial(geofences, monkeypatch):
+    c1, c2, c3 = (geofencing.paillier_engine.encrypt(public_key, value) for value in (0.25, -0.5, 0.75))
+
+    serial_values, _, _, serial_processes, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1)
+
+    monkeypatch.setattr(geofencing, "PARALLEL_WORKERS", 2)
+    try:
+        parallel_values, _, _, parallel_processes, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1, chunk_size=1)
+
+        # Changing the geofences keeps the pool, whose processes are sent the new table's terms with every chunk
+        pool = geofencing.process_pool
+        geofencing.set_geofence_coordinates(geofences[::-1])
+        reloaded_values, _, _, _, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1, chunk_size=1)
+        assert geofencing.process_pool is pool
+    finally:
+        geofencing.stop_process_pool()
+
+    assert serial_processes == 1
+    assert 1 <= parallel_processes <= 2
+    assert [value.ciphertext(False) for value in parallel_values] == [value.ciphertext(False) for value in serial_values]
+    assert [value.exponent for value in parallel_values] == [value.exponent for value in serial_values]
+    assert [value.ciphertext(False) for value in reloaded_values] == [value.ciphertext(False) for value in serial_values[::-1]]
+
+
+# Test a pool whose process died is replaced, and the request evaluated in the new pool instead of failing
+def test_evaluate_geofences_parallel_restarts_broken_pool(geofences, monkeypatch):
+    c1, c2, c3 = (geofencing.paillier_engine.encrypt(public_key, value) for value in (0.25, -0.5, 0.75))
+
+    serial_values, _, _, _, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1)
+
+    monkeypatch.setattr(geofencing, "PARALLEL_WORKERS", 2)
+    try:
+        pool = geofencing.start_process_pool()
+        for process in list(pool._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        parallel_values, _, _, _, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1, chunk_size=1)
+
+        assert geofencing.process_pool is not pool
+    finally:
+        geofencing.stop_process_pool()
+
+    assert [value.ciphertext(False) for value in parallel_values] == [value.ciphertext(False) for value in serial_values]
+
+
+# Test the request's process doesn't encode the coefficients when the pool processes evaluate (and encode) the chunks
+def test_evaluate_geofences_parallel_encodes_in_pool_only(geofences, monkeypatch):
+    other_public_key, _ = paillier.generate_paillier_keypair(n_length=1024)
+    c1, c2, c3 = (geofencing.paillier_engine.encrypt(other_public_key, value) for value in (0.25, -0.5, 0.75))
+
+    monkeypatch.setattr(geofencing, "PARALLEL_WORKERS", 2)
+    try:
+        values, _, _, processes, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1, chunk_size=1)
+    finally:
+        geofencing.stop_process_pool()
+
+    assert len(values) == len(geofences)
+    assert other_public_key.n not in geofencing.geofence_coefficients['encoded']
+
+
+# Test packed evaluation gives exactly the unpacked results, serially and across the process pool
+@pytest.mark.parametrize("parallel_workers", [0, 2])
+def test_evaluate_geofences_packed_matches_unpacked(geofences, monkeypatch, parallel_workers):
+    c1, c2, c3 = (geofencing.paillier_engine.encrypt(public_key, value) for value in (0.25, -0.5, 0.75))
+
+    unpacked_values, _, _, _, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1)
+
+    monkeypatch.setattr(geofencing, "PARALLEL_WORKERS", parallel_workers)
+    try:
+        packed_values, packing, _, _, _ = geofencing.evaluate_geofences((c1, c2, c3), 'prop', len(geofences), constant=1, chunk_size=2, packed=True)
+    finally:
+        geofencing.stop_process_pool()
+
+    results = []
+    for packed_value, (slots, slot_bits) in zip(packed_values, packing):
+        plaintext = geofencing.paillier_engine.raw_decrypt(private_key, packed_value)
+        results.extend(geofencing.paillier_engine.unpack_slots(plaintext, slots, slot_bits, packed_value.exponent))
+
+    # Serially all geofences fit in one ciphertext, in parallel each chunk of 2 packs on its own
+    assert len(packed_values) == (1 if parallel_workers == 0 else 2)
+    assert results == [geofencing.paillier_engine.decrypt(private_key, value) for value in unpacked_values]
+
+
+# Test results at the edges of their slots (±bound, zero and tiny negatives) unpack exactly, and overflowing a slot is detected
+def test_packed_slot_boundaries():
+    user_value = geofencing.paillier_engine.encrypt(public_key, 1.0)
+    test_values = [2.0, -2.0, 0.0, -1e-15, 1e-15, 1.9999999999999, -1.9999999999999, 0.5]
+    coefficient_rows = [[geofencing.paillier_engine.encode(public_key, value)] for value in test_values]
+
+    ciphertexts, exponent, slot_counts, slot_bits, _ = geofencing.paillier_engine.encrypted_packed_inner_products([user_value], coefficient_rows, value_bound=2)
+
+    results = []
+    for ciphertext, slots in zip(ciphertexts, slot_counts):
+        encrypted = geofencing.paillier_engine.encrypted_number(public_key, ciphertext, exponent)
+        results.extend(geofencing.paillier_engine.unpack_slots(geofencing.paillier_engine.raw_decrypt(private_key, encrypted), slots, slot_bits, exponent))
+
+    # Unpacked, each result is its own ciphertext
+    unpacked_ciphertexts, unpacked_exponents, _ = geofencing.paillier_engine.encrypted_inner_products([user_value], coefficient_rows)
+    expected = [
+        geofencing.paillier_engine.decrypt(private_key, geofencing.paillier_engine.encrypted_number(public_key, ciphertext, row_exponent))
+        for ciphertext, row_exponent in zip(unpacked_ciphertexts, unpacked_exponents)
+    ]
+
+    assert results == expected
+    for result, value in zip(results, test_values):
+        assert result == pytest.approx(value, abs=1e-12)
+
+    # A result larger than the bound spills out of its slot
+    ciphertexts, exponent, slot_counts, slot_bits, _ = geofencing.paillier_engine.encrypted_packed_inner_products([user_value], coefficient_rows[:1], value_bound=0.25)
+    with pytest.raises(OverflowError):
+        encrypted = geofencing.paillier_engine.encrypted_number(public_key, ciphertexts[0], exponent)
+        geofencing.paillier_engine.unpack_slots(geofencing.paillier_engine.raw_decrypt(private_key, encrypted), slot_counts[0], slot_bits, exponent)
+
+
+# Test the obfuscation pool hands out each precomputed factor once, and obfuscating with it keeps the plaintext
+def test_obfuscation_pool():
+    pool = geofencing.paillier_engine.ObfuscationPool(public_key, size=4)
+    try:
+        pool.fill()
+        factors = list(pool.factors)
+
+        # Each take removes a factor, so none is ever handed out twice
+        taken = [pool.take() for i in range(4)]
+        assert taken == factors
+        assert len(set(taken)) == 4
+
+        # Obfuscating with a factor changes the ciphertext but not what it decrypts to
+        for factor in taken:
+            encrypted = geofencing.paillier_engine.encrypt(public_key, 0.5)
+            obfuscated = int(encrypted.ciphertext(False) * factor % public_key.nsquare)
+            assert obfuscated != encrypted.ciphertext(False)
+            assert private_key.decrypt(paillier.EncryptedNumber(public_key, obfuscated, encrypted.exponent)) == pytest.approx(0.5)
+
+        # An empty pool still hands out fresh factors without waiting for the refill
+        pool.drain()
+        assert pool.take() not in taken
+    finally:
+        pool.stop()
+
+
+# Test evaluating several users' ciphertexts in one batch gives exactly the ciphertexts each user gets on their own
+@pytest.mark.parametrize("packed", [False, True])
+@pytest.mark.parametrize("fixed_base", [False, True])
+def test_batched_inner_products_match_individual(geofences, packed, fixed_base):
+    users_values = [[geofencing.paillier_engine.encrypt(public_key, value) for value in values] for values in [(0.25, -0.5, 0.75), (-0.1, 0.2, 0.3), (0.9, 0.0, -0.9)]]
+    coefficient_rows = geofencing.get_encoded_geofence_coefficients(public_key, 'prop')
+
+    batched = geofencing.paillier_engine.batched_inner_products(users_values, coefficient_rows, 1, fixed_base, packed)
+
+    for values, result in zip(users_values, batched):
+        if packed:
+            individual = geofencing.paillier_engine.encrypted_packed_inner_products(values, coefficient_rows, 1, 2, fixed_base)
+        else:
+            individual = geofencing.paillier_engine.encrypted_inner_products(values, coefficient_rows, 1, fixed_base)
+        assert result == individual
+
+
+# Test requests arriving within the batch window are evaluated together, each getting its own results
+def test_evaluate_geofences_coalesced(geofences):
+    users_values = [tuple(geofencing.paillier_engine.encrypt(public_key, value) for value in (0.25 * i, -0.5, 0.75)) for i in range(4)]
+    expected = [geofencing.evaluate_geofences(values, 'prop', len(geofences), constant=1)[0] for values in users_values]
+
+    results = [None] * len(users_values)
+
+    def submit(i):
+        results[i] = geofencing.evaluate_geofences(users_values[i], 'prop', len(geofences), constant=1, batch_window=0.5)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(users_values))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for (values, _, _, processes, batch), expected_values in zip(results, expected):
+        assert [value.ciphertext(False) for value in values] == [value.ciphertext(False) for value in expected_values]
+        assert batch['size'] == len(users_values)
+        assert 0 <= batch['wait'] <= 0.5 + 0.5  # Window plus scheduling slack
+    assert geofencing.batch_pending == []
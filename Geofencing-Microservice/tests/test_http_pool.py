@@ -0,0 +1,114 @@
+import pytest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http_pool
+
+
+# Minimal keep-alive HTTP server recording the client port of every request, i.e. which connection it came on
+class RecordingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    client_ports = []
+    failures_left = 0
+
+    def do_GET(self):
+        RecordingHandler.client_ports.append(self.client_address[1])
+
+        # Fail the first requests with 503 to exercise the retries
+        if RecordingHandler.failures_left > 0:
+            RecordingHandler.failures_left -= 1
+            self.send_response(503)
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        RecordingHandler.client_ports.append(self.client_address[1])
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(503 if RecordingHandler.failures_left > 0 else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+# Pytest fixture to run the server and start every test with fresh sessions
+@pytest.fixture
+def server(monkeypatch):
+    RecordingHandler.client_ports = []
+    RecordingHandler.failures_left = 0
+    monkeypatch.setattr(http_pool, "HTTP_BACKOFF", 0)
+    http_pool.close_sessions()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    http_pool.close_sessions()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+# Test sequential requests reuse one keep-alive connection
+def test_requests_reuse_connection(server):
+    for i in range(5):
+        assert http_pool.get(server).status_code == 200
+
+    assert len(RecordingHandler.client_ports) == 5
+    assert len(set(RecordingHandler.client_ports)) == 1
+
+
+# Test concurrent requests share the pool and never open more connections than its size
+def test_concurrent_requests_bounded_by_pool_size(server, monkeypatch):
+    monkeypatch.setattr(http_pool, "HTTP_POOL_SIZE", 4)
+    status_codes = []
+
+    def send():
+        for i in range(5):
+            status_codes.append(http_pool.post(server, json={"i": i}).status_code)
+
+    threads = [threading.Thread(target=send) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert status_codes == [200] * 50
+    assert len(set(RecordingHandler.client_ports)) <= 4
+
+
+# Test a pool size of 0 opens a new connection for every request
+def test_pool_disabled_opens_connection_per_request(server, monkeypatch):
+    monkeypatch.setattr(http_pool, "HTTP_POOL_SIZE", 0)
+
+    for i in range(3):
+        assert http_pool.get(server).status_code == 200
+
+    assert len(set(RecordingHandler.client_ports)) == 3
+
+
+# Test GETs are retried on 503, but POSTs are not (they may already have been processed)
+def test_retries_only_idempotent_requests(server):
+    RecordingHandler.failures_left = 2
+    assert http_pool.get(server).status_code == 200
+    assert len(RecordingHandler.client_ports) == 3
+
+    RecordingHandler.client_ports = []
+    RecordingHandler.failures_left = 1
+    assert http_pool.post(server, json={}).status_code == 503
+    assert len(RecordingHandler.client_ports) == 1
+
+
+# Test a forked process (different pid) gets its own session instead of the parent's connections
+def test_session_per_process(server, monkeypatch):
+    parent_session = http_pool.get_session()
+
+    monkeypatch.setattr(http_pool.os, "getpid", lambda: -1)
+    child_session = http_pool.get_session()
+
+    assert child_session is not parent_session
+    assert http_pool.get_session() is child_session
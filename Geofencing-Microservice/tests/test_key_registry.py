@@ -0,0 +1,154 @@
+import pytest
+import threading
+import time
+from unittest.mock import patch
+from phe import paillier
+import src.app as geofencing
+
+# Two carer keys, to simulate the carer replacing its key
+public_key, _ = paillier.generate_paillier_keypair(n_length=1024)
+new_public_key, _ = paillier.generate_paillier_keypair(n_length=1024)
+
+
+# Pytest fixture to start every test with an empty key registry
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(geofencing, "key_registry", {'keys': {}, 'refreshed_at': None, 'current': None, 'refreshing': False})
+    monkeypatch.setattr(geofencing, "KEY_REGISTRY_MIN_REFRESH", 0)
+    yield geofencing.key_registry
+
+
+# Test the carer is only asked for its key once while the registry is within its TTL
+def test_registry_caches_key_within_ttl(registry):
+    fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]) as mock_key:
+        first = geofencing.get_registered_public_key(fingerprint)
+        second = geofencing.get_registered_public_key(fingerprint)
+
+    assert mock_key.call_count == 1
+    assert first.n == public_key.n
+    assert second is first  # The same object, so its nsquare isn't recomputed
+
+
+# Test the registry is refreshed once its TTL has passed
+def test_registry_refreshes_after_ttl(registry, monkeypatch):
+    fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+    monkeypatch.setattr(geofencing, "KEY_REGISTRY_TTL", -1)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]) as mock_key:
+        geofencing.get_registered_public_key(fingerprint)
+        geofencing.get_registered_public_key(fingerprint)
+
+    assert mock_key.call_count == 2
+
+
+# Test an unknown fingerprint refreshes the registry, so a new carer key is picked up and the old one dropped
+def test_registry_follows_carer_key_change(registry):
+    old_fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+    new_fingerprint = geofencing.paillier_engine.key_fingerprint(new_public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]):
+        assert geofencing.get_registered_public_key(old_fingerprint).n == public_key.n
+
+    with patch("src.app.get_carer_public_keys", return_value=[new_public_key.n]):
+        assert geofencing.get_registered_public_key(new_fingerprint).n == new_public_key.n
+        assert geofencing.get_registered_public_key(old_fingerprint) is None
+
+
+# Test unknown fingerprints don't refresh the registry more than once per KEY_REGISTRY_MIN_REFRESH
+def test_registry_limits_refreshes_for_unknown_fingerprints(registry, monkeypatch):
+    monkeypatch.setattr(geofencing, "KEY_REGISTRY_MIN_REFRESH", 60)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]) as mock_key:
+        for i in range(5):
+            assert geofencing.get_registered_public_key("unknown") is None
+
+    assert mock_key.call_count == 1
+
+
+# Test the cached key is kept if the carer can't be reached
+def test_registry_keeps_key_when_carer_unreachable(registry, monkeypatch):
+    fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]):
+        geofencing.get_registered_public_key(fingerprint)
+
+    monkeypatch.setattr(geofencing, "KEY_REGISTRY_TTL", -1)
+    with patch("src.app.get_carer_public_keys", return_value=None):
+        assert geofencing.get_registered_public_key(fingerprint).n == public_key.n
+
+
+# Test the key a carer's rotation replaced stays registered while the carer still accepts it, next to the new key
+def test_registry_keeps_keys_carer_accepts(registry):
+    old_fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+    new_fingerprint = geofencing.paillier_engine.key_fingerprint(new_public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[new_public_key.n, public_key.n]):
+        assert geofencing.get_registered_public_key(new_fingerprint).n == new_public_key.n
+        assert geofencing.get_registered_public_key(old_fingerprint).n == public_key.n
+
+    assert registry['current'] == new_public_key.n
+
+    # Obfuscation factors are only kept precomputed for the current key
+    with patch("src.app.paillier_engine.start_obfuscation_pool") as mock_pool:
+        geofencing.start_carer_obfuscation_pool(public_key)
+        geofencing.start_carer_obfuscation_pool(new_public_key)
+
+    assert [call.args[0] for call in mock_pool.call_args_list] == [new_public_key]
+
+
+# Test carer keys shorter than MIN_KEY_SIZE aren't registered, so locations encrypted under them are rejected
+def test_registry_rejects_keys_below_min_key_size(registry, monkeypatch):
+    monkeypatch.setattr(geofencing.paillier_engine, "MIN_KEY_SIZE", 2048)
+    fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]):
+        assert geofencing.get_registered_public_key(fingerprint) is None
+
+    assert registry['keys'] == {}
+    assert registry['current'] is None
+
+
+# Test the carer is fetched from without holding the registry lock: while one thread waits on a slow carer, requests for
+# cached keys are answered from the cache, and a request for an unknown key waits for that fetch instead of starting another
+def test_registry_fetches_without_blocking_cached_keys(registry, monkeypatch):
+    fingerprint = geofencing.paillier_engine.key_fingerprint(public_key.n)
+    new_fingerprint = geofencing.paillier_engine.key_fingerprint(new_public_key.n)
+
+    with patch("src.app.get_carer_public_keys", return_value=[public_key.n]):
+        geofencing.get_registered_public_key(fingerprint)
+
+    monkeypatch.setattr(geofencing, "KEY_REGISTRY_TTL", -1)
+    fetching = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_carer():
+        calls.append(1)
+        fetching.set()
+        release.wait(5)
+        return [new_public_key.n, public_key.n]
+
+    results = {}
+    with patch("src.app.get_carer_public_keys", side_effect=slow_carer):
+        fetcher = threading.Thread(target=lambda: results.update(fetcher=geofencing.get_registered_public_key(fingerprint)))
+        fetcher.start()
+        assert fetching.wait(5)
+
+        start = time.time()
+        assert geofencing.get_registered_public_key(fingerprint).n == public_key.n
+        assert time.time() - start < 1
+
+        waiter = threading.Thread(target=lambda: results.update(waiter=geofencing.get_registered_public_key(new_fingerprint)))
+        waiter.start()
+        time.sleep(0.05)
+        assert "waiter" not in results
+
+        release.set()
+        fetcher.join(5)
+        waiter.join(5)
+
+    assert len(calls) == 1
+    assert results["fetcher"].n == public_key.n
+    assert results["waiter"].n == new_public_key.n
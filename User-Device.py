@@ -8,19 +8,69 @@ import numpy as np
 import pandas as pd
 import argparse
 from tabulate import tabulate
+import paillier_engine
+import http_pool
 
 
 public_key_n = None
+public_key_fingerprint = None  # Sent instead of the full modulus
+
+# Geofences per parallel chunk requested from the geofencing service (None uses the service's default)
+parallel_chunk_size = None
+
+# Ask the geofencing service to pack several results into each ciphertext for the carer
+packed_results = False
+
+# r^n values precomputed in the background for encryption (0 computes each one during encryption)
+randomness_pool_size = 64
+
+# Wire format of the ciphertexts sent to the geofencing service (and on to the carer): 'json' or 'binary'
+wire_format = "json"
+
+# Batch window (s) the geofencing service coalesces each request with others in (None uses the service's BATCH_WINDOW)
+batch_window = None
+
+# Ask the geofencing service to acknowledge each location once it is queued ('Prefer: respond-async') and deliver the
+# results to the carer in the background. Job completion is then polled from the service's /jobs endpoint
+async_delivery = False
+job_poll_interval = 0.05  # Seconds between job status polls
+job_timeout = 300         # Seconds to wait for a job before giving up
+
+# Location fixes buffered before they are sent together (fixes mode), and the batch sizes the runtime experiment compares
+fix_count = 10
+fix_batch_sizes = [1, 10, 50]
+
+# Token for the geofencing service's admin API (its ADMIN_TOKEN, which it must have set), used by the reload and shortcircuit experiments
+admin_token = ""
+
+# Ask the carer only whether the user is inside any geofence, decrypting in priority order until the first hit: the
+# geofences it last found the user in first (unless recent_hits_first is off), then those of priority_group (e.g. the
+# places of the user's carer), then the rest in geofence order. None sends every result and decrypts them all
+any_inside = None
+priority_group = None
+recent_hits_first = True
+
+# Numbers of geofences the runtime experiment (and its key size sweep) measures
+runtime_geofence_counts = [1, 10, 100, 200, 300]
+
+# Token for the carer's key rotation endpoint (its ADMIN_TOKEN, empty when it has none), used to change the key size
+carer_admin_token = ""
+
+# After a rotation, requests in a row (each on a new connection, so they reach the carer's gunicorn workers in turn)
+# that must report the new key, and the seconds to wait for them, before anything is measured under it
+key_check_requests = 16
+key_check_timeout = 10
 
 def get_carer_public_key():
-    global public_key_n
+    global public_key_n, public_key_fingerprint
     try:
         # Fetch public key from carer's devoce
-        response = requests.get('http://localhost:5002/get-public-key')
+        response = http_pool.get('http://localhost:5002/get-public-key')
         response.raise_for_status()
 
         data = response.json()
         public_key_n = data.get('public_key_n')
+        public_key_fingerprint = data.get('fingerprint') or paillier_engine.key_fingerprint(public_key_n)
         public_key = paillier.PaillierPublicKey(public_key_n)
         return public_key
 
@@ -30,6 +80,63 @@ def get_carer_public_key():
         return None
 
 
+def set_carer_key_size(key_size):
+    # Have the carer rotate to a key of key_size bits and encrypt under it from now on, restarting the randomness
+    # pool for the new key. Returns the new public key (None if the carer couldn't rotate)
+    headers = {"Authorization": f"Bearer {carer_admin_token}"} if carer_admin_token else {}
+    try:
+        response = http_pool.post('http://localhost:5002/rotate-key', json={"key_size": key_size}, headers=headers)
+
+        # A carer without a key file can't rotate the key of all its workers
+        if response.status_code == 409:
+            print(f"Failed to change the carer's key size: {response.json().get('message')}. Start it with CARER_KEY_PASSPHRASE set")
+            return None
+
+        response.raise_for_status()
+        fingerprint = response.json()['fingerprint']
+        print(f"Carer key rotated to a {key_size}-bit key in {round(response.json()['seconds'], 3)} s")
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to change the carer's key size: {e}")
+        return None
+
+    if not wait_for_carer_key(fingerprint):
+        return None
+
+    public_key = get_carer_public_key()
+    if public_key is not None:
+        paillier_engine.stop_obfuscation_pools()
+        paillier_engine.start_obfuscation_pool(public_key, randomness_pool_size)
+    return public_key
+
+
+def wait_for_carer_key(fingerprint):
+    # The carer's other workers load a rotated key from the key file on their next request. Wait until
+    # key_check_requests requests in a row report the new key, so no measurement mixes key sizes
+    deadline = time.time() + key_check_timeout
+    confirmed = 0
+
+    while confirmed < key_check_requests:
+        if time.time() > deadline:
+            print(f"Failed to change the carer's key size: its workers didn't all serve key {fingerprint} within {key_check_timeout} s")
+            return False
+
+        try:
+            response = requests.get('http://localhost:5002/get-public-key', headers={"Connection": "close"})
+            response.raise_for_status()
+            reported = response.json().get('fingerprint')
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to check the carer's key: {e}")
+            reported = None
+
+        if reported == fingerprint:
+            confirmed += 1
+        else:
+            confirmed = 0
+            time.sleep(0.1)
+
+    return True
+
+
 def compute_and_encrypt_user_location_terms_ref(user_latitude, user_longitude, public_key):
 
     start_ref = time.time()
@@ -37,10 +144,10 @@ def compute_and_encrypt_user_location_terms_ref(user_latitude, user_longitude, p
     # Terms derived from User point (original, squared, combined, encrypted where applicable)
     alpha = math.cos(user_latitude / 2)
     alpha_sq = alpha**2
-    alpha_sq_enc = public_key.encrypt(alpha_sq)
+    alpha_sq_enc = paillier_engine.encrypt(public_key, alpha_sq)
     gamma = math.sin(user_latitude / 2)
     gamma_sq = gamma**2
-    gamma_sq_enc = public_key.encrypt(gamma_sq)
+    gamma_sq_enc = paillier_engine.encrypt(public_key, gamma_sq)
     zeta = math.cos(user_latitude)
     theta = math.sin(user_longitude / 2)
     theta_sq = theta**2
@@ -48,16 +155,16 @@ def compute_and_encrypt_user_location_terms_ref(user_latitude, user_longitude, p
     mu_sq = mu**2
 
     alpha_gamma_product_A = alpha * gamma            
-    alpha_gamma_product_A_enc = public_key.encrypt(alpha_gamma_product_A)       # A-specific part for term2
+    alpha_gamma_product_A_enc = paillier_engine.encrypt(public_key, alpha_gamma_product_A)       # A-specific part for term2
 
     zeta_theta_sq_product_A  = zeta * theta_sq          
-    zeta_theta_sq_product_A_enc = public_key.encrypt(zeta_theta_sq_product_A)   # A-specific part for term4
+    zeta_theta_sq_product_A_enc = paillier_engine.encrypt(public_key, zeta_theta_sq_product_A)   # A-specific part for term4
 
     zeta_theta_mu_product_A = zeta * theta * mu
-    zeta_theta_mu_product_A_enc = public_key.encrypt(zeta_theta_mu_product_A)   # A-specific part for term5
+    zeta_theta_mu_product_A_enc = paillier_engine.encrypt(public_key, zeta_theta_mu_product_A)   # A-specific part for term5
 
     zeta_mu_sq_product_A = zeta * mu_sq             
-    zeta_mu_sq_product_A_enc = public_key.encrypt(zeta_mu_sq_product_A)
+    zeta_mu_sq_product_A_enc = paillier_engine.encrypt(public_key, zeta_mu_sq_product_A)
 
     end_ref = time.time()
 
@@ -86,9 +193,9 @@ def compute_and_encrypt_user_location_terms_prop(user_latitude, user_longitude,
     start = time.time()
 
     # Terms derived from User point
-    c1 = public_key.encrypt(math.sin(user_latitude))
-    c2 = public_key.encrypt(math.cos(user_latitude) * math.cos(user_longitude))
-    c3 = public_key.encrypt(math.cos(user_latitude) * math.sin(user_longitude))
+    c1 = paillier_engine.encrypt(public_key, math.sin(user_latitude))
+    c2 = paillier_engine.encrypt(public_key, math.cos(user_latitude) * math.cos(user_longitude))
+    c3 = paillier_engine.encrypt(public_key, math.cos(user_latitude) * math.sin(user_longitude))
 
     end = time.time()
 
@@ -141,15 +248,23 @@ def send_encrypted_location_to_geofencing_service_ref(
                 "zeta_theta_mu_product_A_ct": zeta_theta_mu_product_A_ct, "zeta_theta_mu_product_A_exp": zeta_theta_mu_product_A_exp,
                 "zeta_mu_sq_product_A_ct": zeta_mu_sq_product_A_ct, "zeta_mu_sq_product_A_exp": zeta_mu_sq_product_A_exp
             },
-            "public_key_n": public_key_n,
+            "public_key_fingerprint": public_key_fingerprint,
             "number_of_geofences": number_of_geofences,
         }
+
+        if parallel_chunk_size is not None:
+            payload["chunk_size"] = parallel_chunk_size
+
+        if batch_window is not None:
+            payload["batch_window"] = batch_window
+
+        if packed_results:
+            payload["packed"] = True
+
+        add_short_circuit_options(payload)
         
         # Make the POST request
-        response = requests.post(
-            'http://localhost:5001/submit-user-location-ref',
-            json=payload
-        )        
+        response = post_payload('http://localhost:5001/submit-user-location-ref', payload)
     
         response.raise_for_status()
 
@@ -181,15 +296,23 @@ def send_encrypted_location_to_geofencing_service_prop(c1, c2, c3, number_of_geo
                 "c2_ct": c2_ct, "c2_exp": c2_exp,
                 "c3_ct": c3_ct, "c3_exp": c3_exp
             },
-            "public_key_n": public_key_n,
+            "public_key_fingerprint": public_key_fingerprint,
             "number_of_geofences": number_of_geofences,
         }
+
+        if parallel_chunk_size is not None:
+            payload["chunk_size"] = parallel_chunk_size
+
+        if batch_window is not None:
+            payload["batch_window"] = batch_window
+
+        if packed_results:
+            payload["packed"] = True
+
+        add_short_circuit_options(payload)
         
         # Make the POST request
-        response = requests.post(
-            'http://localhost:5001/submit-user-location-prop',
-            json=payload
-        )        
+        response = post_payload('http://localhost:5001/submit-user-location-prop', payload)
     
         response.raise_for_status()
 
@@ -201,11 +324,152 @@ def send_encrypted_location_to_geofencing_service_prop(c1, c2, c3, number_of_geo
         return None
 
 
+def send_location_fixes_to_geofencing_service(system, fixes, number_of_geofences=10):
+    # Send several buffered fixes, each a (timestamp, encrypted terms) pair, in one request. The geofencing service
+    # evaluates them together and sends their results on to the carer in one request
+
+    try:
+        # Serialize every fix's terms under the names the single-fix endpoints use
+        if system == "ref":
+            names = ["alpha_sq", "gamma_sq", "alpha_gamma_product_A", "zeta_theta_sq_product_A", "zeta_theta_mu_product_A", "zeta_mu_sq_product_A"]
+        else:
+            names = ["c1", "c2", "c3"]
+
+        serialized_fixes = []
+        for timestamp, terms in fixes:
+            user_encrypted_location = {}
+            for name, term in zip(names, terms):
+                user_encrypted_location[f"{name}_ct"] = term.ciphertext()
+                user_encrypted_location[f"{name}_exp"] = term.exponent
+            serialized_fixes.append({"timestamp": timestamp, "user_encrypted_location": user_encrypted_location})
+
+        # Create payload
+        payload = {
+            "system": system,
+            "fixes": serialized_fixes,
+            "public_key_fingerprint": public_key_fingerprint,
+            "number_of_geofences": number_of_geofences,
+        }
+
+        if parallel_chunk_size is not None:
+            payload["chunk_size"] = parallel_chunk_size
+
+        if packed_results:
+            payload["packed"] = True
+
+        add_short_circuit_options(payload)
+
+        # Make the POST request (always answered once the carer has the results)
+        if wire_format == "binary":
+            response = http_pool.post(
+                'http://localhost:5001/submit-user-location-batch',
+                data=paillier_engine.encode_binary_payload(payload, public_key_n),
+                headers={"Content-Type": paillier_engine.BINARY_CONTENT_TYPE}
+            )
+        else:
+            response = http_pool.post('http://localhost:5001/submit-user-location-batch', json=payload)
+
+        response.raise_for_status()
+
+        return response.json()
+
+    except requests.exceptions.RequestException as e:
+        # Catch HTTP errors (from raise_for_status) and other request-related issues
+        print(f"Failed to post location fixes: {e}")
+        return None
+
+
+def record_location_fixes(user_latitude, user_longitude, public_key, count):
+    # A buffered track of fixes taken one second apart, moving ~1 m north per fix, encrypted for both systems
+    now = time.time()
+    fixes_ref = []
+    fixes_prop = []
+
+    for i in range(count):
+        timestamp = now - (count - 1 - i)
+        latitude = user_latitude + math.radians(i * 1e-5)
+        fixes_ref.append((timestamp, compute_and_encrypt_user_location_terms_ref(latitude, user_longitude, public_key)))
+        fixes_prop.append((timestamp, compute_and_encrypt_user_location_terms_prop(latitude, user_longitude, public_key)))
+
+    return fixes_ref, fixes_prop
+
+
+def timed_request(send_function, user_location_terms, latencies, end_to_end_latencies):
+    # Send one request and record its response time (list.append is thread-safe)
+    start = time.time()
+    response = send_function(*user_location_terms)
+    latency = time.time() - start
+    latencies.append(latency)
+
+    if response is None or 'job_id' not in response:
+        # Answered synchronously, so the carer already has the results
+        end_to_end_latencies.append(latency)
+        return
+
+    # Acknowledged asynchronously: end-to-end is the acknowledgement plus the time from queueing to delivery to the carer,
+    # both measured by the service's clock so polling granularity doesn't count
+    job = wait_for_job(response['job_id'])
+    if job is not None and job.get('status') == "delivered":
+        end_to_end_latencies.append(latency + job['delivered_at'] - job['submitted_at'])
+
+
+def wait_for_job(job_id):
+    # Poll the geofencing service until the job has been delivered to the carer or has failed
+    deadline = time.time() + job_timeout
+
+    while time.time() < deadline:
+        try:
+            response = http_pool.get(f'http://localhost:5001/jobs/{job_id}')
+            response.raise_for_status()
+            job = response.json()
+
+            if job.get('status') in ("delivered", "failed"):
+                if job['status'] == "failed":
+                    print(f"Job {job_id} failed: {job.get('message')}")
+                return job
+
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to fetch job status: {e}")
+            return None
+
+        time.sleep(job_poll_interval)
+
+    print(f"Job {job_id} didn't complete within {job_timeout} s")
+    return None
+
+
+def add_short_circuit_options(payload):
+    # Request the carer's short-circuit 'any inside' evaluation when it is enabled
+    if any_inside:
+        payload["any_inside"] = True
+        if priority_group is not None:
+            payload["priority_group"] = priority_group
+        if not recent_hits_first:
+            payload["recent_hits_first"] = False
+
+
+def post_payload(url, payload):
+    # Send the payload as JSON, or in the binary ciphertext format negotiated by its content type, over the shared keep-alive connections
+    headers = {"Prefer": "respond-async"} if async_delivery else {}
+
+    if wire_format == "binary":
+        headers["Content-Type"] = paillier_engine.BINARY_CONTENT_TYPE
+        return http_pool.post(
+            url,
+            data=paillier_engine.encode_binary_payload(payload, public_key_n),
+            headers=headers
+        )
+
+    return http_pool.post(url, json=payload, headers=headers)
+
+
 def scalability_experiment(user_location_terms_ref, user_location_terms_prop, num_repitions_mean):
     tableResults = []
 
     # Output files with temporary data
-    files= ["Outputs/scaleRunOutRef.txt", "Outputs/scaleRunOutProp.txt", "Outputs/scaleThroughputOutRef.txt", "Outputs/scaleThroughputOutProp.txt", "Outputs/scaleLatencyOutRef.txt", "Outputs/scaleLatencyOutProp.txt"]
+    files= ["Outputs/scaleRunOutRef.txt", "Outputs/scaleRunOutProp.txt", "Outputs/scaleThroughputOutRef.txt", "Outputs/scaleThroughputOutProp.txt", "Outputs/scaleLatencyOutRef.txt", "Outputs/scaleLatencyOutProp.txt",
+            "Outputs/scaleLatencyP50OutRef.txt", "Outputs/scaleLatencyP50OutProp.txt", "Outputs/scaleLatencyP99OutRef.txt", "Outputs/scaleLatencyP99OutProp.txt",
+            "Outputs/scaleEndToEndP50OutRef.txt", "Outputs/scaleEndToEndP50OutProp.txt", "Outputs/scaleEndToEndP99OutRef.txt", "Outputs/scaleEndToEndP99OutProp.txt"]
 
     requests_counts = [1, 10, 50, 100]
 
@@ -223,12 +487,18 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
         # Repeat for average
         for i in range(num_repitions_mean):
 
+            # Response (acknowledgement) time and end-to-end time (until the carer has the results) of every request, for the latency percentiles
+            request_latencies_ref = []
+            request_latencies_prop = []
+            end_to_end_latencies_ref = []
+            end_to_end_latencies_prop = []
+
             # Simulate multiple requests Referemce system
             start_time_ref = time.time()
             threads = []
             for i in range(num_requests):
                 # Send location data to geofencing service
-                thread = threading.Thread(target=send_encrypted_location_to_geofencing_service_ref, args=(user_location_terms_ref)) 
+                thread = threading.Thread(target=timed_request, args=(send_encrypted_location_to_geofencing_service_ref, user_location_terms_ref, request_latencies_ref, end_to_end_latencies_ref)) 
                 threads.append(thread)
                 thread.start()
 
@@ -242,7 +512,7 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
             threads = []
             for i in range(num_requests):
                 # Send location data to geofencing service
-                thread = threading.Thread(target=send_encrypted_location_to_geofencing_service_prop, args=(user_location_terms_prop)) 
+                thread = threading.Thread(target=timed_request, args=(send_encrypted_location_to_geofencing_service_prop, user_location_terms_prop, request_latencies_prop, end_to_end_latencies_prop)) 
                 threads.append(thread)
                 thread.start()
 
@@ -286,6 +556,15 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
             with open("Outputs/scaleLatencyOutProp.txt", "a") as f:
                 f.write(f"{(latency_prop)}\n")
 
+            # Write median and 99th percentile request latency to file (both systems)
+            for file_name, latencies, percentile in [("Outputs/scaleLatencyP50OutRef.txt", request_latencies_ref, 50), ("Outputs/scaleLatencyP50OutProp.txt", request_latencies_prop, 50),
+                                                     ("Outputs/scaleLatencyP99OutRef.txt", request_latencies_ref, 99), ("Outputs/scaleLatencyP99OutProp.txt", request_latencies_prop, 99),
+                                                     ("Outputs/scaleEndToEndP50OutRef.txt", end_to_end_latencies_ref, 50), ("Outputs/scaleEndToEndP50OutProp.txt", end_to_end_latencies_prop, 50),
+                                                     ("Outputs/scaleEndToEndP99OutRef.txt", end_to_end_latencies_ref, 99), ("Outputs/scaleEndToEndP99OutProp.txt", end_to_end_latencies_prop, 99)]:
+                with open(file_name, "a") as f:
+                    # nan if every request failed
+                    f.write(f"{np.percentile(latencies, percentile) if latencies else np.nan}\n")
+
         # Load temporary scalability data
         scaleRunOutRef = np.loadtxt(files[0])
         scaleRunOutProp = np.loadtxt(files[1])
@@ -293,9 +572,17 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
         scaleThroughputOutProp = np.loadtxt(files[3])
         scaleLatencyOutRef = np.loadtxt(files[4])
         scaleLatencyOutProp = np.loadtxt(files[5])
-
-        scalability_experiment_all_raw_data_ref = np.column_stack((np.full(len(scaleRunOutRef), num_requests), scaleRunOutRef, scaleThroughputOutRef, scaleLatencyOutRef))
-        scalability_experiment_all_raw_data_prop = np.column_stack((np.full(len(scaleRunOutProp), num_requests), scaleRunOutProp, scaleThroughputOutProp, scaleLatencyOutProp))
+        scaleLatencyP50OutRef = np.loadtxt(files[6])
+        scaleLatencyP50OutProp = np.loadtxt(files[7])
+        scaleLatencyP99OutRef = np.loadtxt(files[8])
+        scaleLatencyP99OutProp = np.loadtxt(files[9])
+        scaleEndToEndP50OutRef = np.loadtxt(files[10])
+        scaleEndToEndP50OutProp = np.loadtxt(files[11])
+        scaleEndToEndP99OutRef = np.loadtxt(files[12])
+        scaleEndToEndP99OutProp = np.loadtxt(files[13])
+
+        scalability_experiment_all_raw_data_ref = np.column_stack((np.full(len(scaleRunOutRef), num_requests), scaleRunOutRef, scaleThroughputOutRef, scaleLatencyOutRef, scaleLatencyP50OutRef, scaleLatencyP99OutRef, scaleEndToEndP50OutRef, scaleEndToEndP99OutRef))
+        scalability_experiment_all_raw_data_prop = np.column_stack((np.full(len(scaleRunOutProp), num_requests), scaleRunOutProp, scaleThroughputOutProp, scaleLatencyOutProp, scaleLatencyP50OutProp, scaleLatencyP99OutProp, scaleEndToEndP50OutProp, scaleEndToEndP99OutProp))
         all_raw_data_ref.append(scalability_experiment_all_raw_data_ref)
         all_raw_data_prop.append(scalability_experiment_all_raw_data_prop)
 
@@ -320,10 +607,34 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
             f"{round(scalability_stats[5]['Mean'], 3)} ± {round(scalability_stats[5]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[5]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[5]['95% Confidence Interval'][1], 3)})"]
         )
 
+        tableResults.append(            
+            ["", "Latency p50 (s)", 
+            f"{round(scalability_stats[6]['Mean'], 3)} ± {round(scalability_stats[6]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[6]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[6]['95% Confidence Interval'][1], 3)})", 
+            f"{round(scalability_stats[7]['Mean'], 3)} ± {round(scalability_stats[7]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[7]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[7]['95% Confidence Interval'][1], 3)})"]
+        )
+
+        tableResults.append(            
+            ["", "Latency p99 (s)", 
+            f"{round(scalability_stats[8]['Mean'], 3)} ± {round(scalability_stats[8]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[8]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[8]['95% Confidence Interval'][1], 3)})", 
+            f"{round(scalability_stats[9]['Mean'], 3)} ± {round(scalability_stats[9]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[9]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[9]['95% Confidence Interval'][1], 3)})"]
+        )
+
+        tableResults.append(            
+            ["", "End-to-end Latency p50 (s)", 
+            f"{round(scalability_stats[10]['Mean'], 3)} ± {round(scalability_stats[10]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[10]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[10]['95% Confidence Interval'][1], 3)})", 
+            f"{round(scalability_stats[11]['Mean'], 3)} ± {round(scalability_stats[11]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[11]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[11]['95% Confidence Interval'][1], 3)})"]
+        )
+
+        tableResults.append(            
+            ["", "End-to-end Latency p99 (s)", 
+            f"{round(scalability_stats[12]['Mean'], 3)} ± {round(scalability_stats[12]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[12]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[12]['95% Confidence Interval'][1], 3)})", 
+            f"{round(scalability_stats[13]['Mean'], 3)} ± {round(scalability_stats[13]['Standard Deviation'], 3)} (95% CI: {round(scalability_stats[13]['95% Confidence Interval'][0], 3)}, {round(scalability_stats[13]['95% Confidence Interval'][1], 3)})"]
+        )
+
     # Saves all the raw runtime data
     all_raw_data_ref = np.vstack(all_raw_data_ref)
     all_raw_data_prop = np.vstack(all_raw_data_prop)
-    header = "# of Queries,Total Runtime,Throughput,Latency"
+    header = "# of Queries,Total Runtime,Throughput,Latency,Latency p50,Latency p99,End-to-end Latency p50,End-to-end Latency p99"
     np.savetxt(
         'ExperimentsAllRawData/scalability_experiment_all_raw_data_ref.csv',
         all_raw_data_ref, delimiter=',', 
@@ -337,6 +648,15 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
         comments=''
     )
 
+    # Record the chunk size the requests asked for, so runs with different chunk sizes and PARALLEL_WORKERS can be compared
+    tableResults.append(["", "Parallel Chunk Size", parallel_chunk_size or "service default", parallel_chunk_size or "service default"])
+
+    # Record the User Device's HTTP connection pool, so runs with and without keep-alive connections can be compared
+    tableResults.append(["", "HTTP Connection Pool", http_pool.HTTP_POOL_SIZE or "disabled", http_pool.HTTP_POOL_SIZE or "disabled"])
+
+    # Record whether results were delivered asynchronously (latency is then the acknowledgement latency)
+    tableResults.append(["", "Result Delivery", "async" if async_delivery else "sync", "async" if async_delivery else "sync"])
+
     head = ["Queries", "Metric", "Ref. Alg.", "Prop. Alg."]
 
     save_results(tableResults, head, "Results/scalability.csv")
@@ -354,16 +674,487 @@ def scalability_experiment(user_location_terms_ref, user_location_terms_prop, nu
     # print(f"Proposed system latency: {round(latency_prop, 3)} seconds/query")
 
 
-def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_mean):
+def batching_experiment(user_location_terms_ref, user_location_terms_prop, num_repitions_mean, num_requests=100):
+    global batch_window
+    tableResults = []
+
+    # Output files with temporary data: throughput and request latency measured here, and the batch sizes and
+    # waits of the individual requests recorded by the geofencing service
+    files = ["Outputs/scaleThroughputOutRef.txt", "Outputs/scaleThroughputOutProp.txt", "Outputs/scaleLatencyP50OutRef.txt", "Outputs/scaleLatencyP50OutProp.txt",
+             "Outputs/scaleLatencyP99OutRef.txt", "Outputs/scaleLatencyP99OutProp.txt", "Outputs/runBatchOutRef.txt", "Outputs/runBatchOutProp.txt",
+             "Outputs/runBatchWaitOutRef.txt", "Outputs/runBatchWaitOutProp.txt"]
+
+    # Batch windows (s) to compare, 0 evaluates every request on its own
+    batch_windows = [0, 0.005, 0.01, 0.02, 0.05]
+
+    # Run different test cases
+    for window in batch_windows:
+        batch_window = window
+
+        # Clear output files of temporary data
+        for file_name in files:
+            with open(file_name, 'w'):
+                pass
+
+        # Repeat for average
+        for i in range(num_repitions_mean):
+            for system, send_function, user_location_terms in [("Ref", send_encrypted_location_to_geofencing_service_ref, user_location_terms_ref),
+                                                               ("Prop", send_encrypted_location_to_geofencing_service_prop, user_location_terms_prop)]:
+                # Burst of concurrent requests, as in the scalability experiment
+                latencies = []
+                start = time.time()
+                threads = [threading.Thread(target=timed_request, args=(send_function, user_location_terms, latencies, [])) for i in range(num_requests)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                end = time.time()
+
+                # Write Throughput and median and 99th percentile request latency to files
+                with open(f"Outputs/scaleThroughputOut{system}.txt", "a") as f:
+                    f.write(f"{num_requests / (end - start)}\n")
+                with open(f"Outputs/scaleLatencyP50Out{system}.txt", "a") as f:
+                    f.write(f"{np.percentile(latencies, 50)}\n")
+                with open(f"Outputs/scaleLatencyP99Out{system}.txt", "a") as f:
+                    f.write(f"{np.percentile(latencies, 99)}\n")
+
+        # Calculate staistics and present in table
+        batching_stats = stats.main(files)
+
+        for i, metric in enumerate(["Throughput (q/s)", "Latency p50 (s)", "Latency p99 (s)", "Batch Size (requests)", "Batch Wait (ms)"]):
+            tableResults.append(
+                [window if i == 0 else "", metric, 
+                f"{round(batching_stats[2*i]['Mean'], 3)} ± {round(batching_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(batching_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(batching_stats[2*i]['95% Confidence Interval'][1], 3)})", 
+                f"{round(batching_stats[2*i+1]['Mean'], 3)} ± {round(batching_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(batching_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(batching_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+            )
+
+    # Back to the service's own window
+    batch_window = None
+
+    head = ["Batch Window (s)", "Metric", "Ref. Alg.", "Prop. Alg."]
+
+    save_results(tableResults, head, "Results/batching.csv")
+
+    print(f"Batching results saved to Results/batching.csv\n")
+
+
+def randomness_pool_experiment(user_latitude, user_longitude, public_key, num_repitions_mean):
+    tableResults = []
+
+    # Output files with temporary data
+    files = ["Outputs/runEncOutRef.txt", "Outputs/runEncOutProp.txt"]
+
+    # Encryption latency with the randomness pool empty (every r^n computed during encryption) and full
+    for pool_state in ["empty", "full"]:
+
+        # Clear output files of temporary data
+        for file_name in files:
+            with open(file_name, 'w'):
+                pass
+
+        # Repeat for average
+        for i in range(num_repitions_mean):
+            if pool_state == "empty":
+                paillier_engine.stop_obfuscation_pools()
+            else:
+                # Enough for both systems' terms, filled up before every location fix as an idle device would
+                pool = paillier_engine.start_obfuscation_pool(public_key, max(randomness_pool_size, 9))
+                pool.fill()
+
+            compute_and_encrypt_user_location_terms_ref(user_latitude, user_longitude, public_key)
+            compute_and_encrypt_user_location_terms_prop(user_latitude, user_longitude, public_key)
+
+        # Convert to milliseconds before the statistics (rounded to 3 dp), as encrypting from a full pool takes well under one
+        for file_name in files:
+            np.savetxt(file_name, np.loadtxt(file_name, dtype=float, ndmin=1) * 1000)
+
+        # Calculate staistics and present in table
+        encryption_stats = stats.main(files)
+
+        tableResults.append(
+            ["", f"Encryption, randomness pool {pool_state} (ms)", 
+            f"{round(encryption_stats[0]['Mean'], 3)} ± {round(encryption_stats[0]['Standard Deviation'], 3)} (95% CI: {round(encryption_stats[0]['95% Confidence Interval'][0], 3)}, {round(encryption_stats[0]['95% Confidence Interval'][1], 3)})", 
+            f"{round(encryption_stats[1]['Mean'], 3)} ± {round(encryption_stats[1]['Standard Deviation'], 3)} (95% CI: {round(encryption_stats[1]['95% Confidence Interval'][0], 3)}, {round(encryption_stats[1]['95% Confidence Interval'][1], 3)})"]
+        )
+
+    # Back to the configured pool
+    paillier_engine.stop_obfuscation_pools()
+    paillier_engine.start_obfuscation_pool(public_key, randomness_pool_size)
+
+    return tableResults
+
+
+def fix_batch_experiment(user_latitude, user_longitude, public_key, num_repitions_mean, number_of_geofences=10):
+    tableResults = []
+
+    # Output files with temporary data: the round trip measured here, and the per-fix computation, decryption and
+    # received communication recorded by the services, all amortised over the fixes of a request
+    files = ["Outputs/runFixRoundTripOutRef.txt", "Outputs/runFixRoundTripOutProp.txt", "Outputs/runCompFixOutRef.txt", "Outputs/runCompFixOutProp.txt",
+             "Outputs/runDecFixOutRef.txt", "Outputs/runDecFixOutProp.txt", "Outputs/commGeoFixOutRef.txt", "Outputs/commGeoFixOutProp.txt"]
+
+    # Run different test cases (1 fix per request is the cost of sending every fix on its own)
+    for batch_size in fix_batch_sizes:
+
+        # Clear output files of temporary data
+        for file_name in files:
+            with open(file_name, 'w'):
+                pass
+
+        # Repeat for average
+        for i in range(num_repitions_mean):
+            fixes_ref, fixes_prop = record_location_fixes(user_latitude, user_longitude, public_key, batch_size)
+
+            for system, fixes in [("Ref", fixes_ref), ("Prop", fixes_prop)]:
+                start = time.time()
+                send_location_fixes_to_geofencing_service(system.lower(), fixes, number_of_geofences)
+                end = time.time()
+
+                # Write Round Trip per fix to file
+                with open(f"Outputs/runFixRoundTripOut{system}.txt", "a") as f:
+                    f.write(f"{(end - start) / batch_size}\n")
+
+        # Calculate staistics and present in table
+        fix_stats = stats.main(files)
+
+        for i, metric in enumerate(["Round Trip per Fix (s)", "Computation per Fix (s)", "Decryption per Fix (s)", "Geofencing Recieved Communication per Fix (KB)"]):
+            tableResults.append(
+                ["", f"{metric}, {batch_size} fixes per request", 
+                f"{round(fix_stats[2*i]['Mean'], 3)} ± {round(fix_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(fix_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(fix_stats[2*i]['95% Confidence Interval'][1], 3)})", 
+                f"{round(fix_stats[2*i+1]['Mean'], 3)} ± {round(fix_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(fix_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(fix_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+            )
+
+    return tableResults
+
+
+def post_admin_changes(changes):
+    # Send geofence changes to the geofencing service's admin API, returning its response (None if it failed)
+    headers = {"Authorization": f"Bearer {admin_token}"} if admin_token else {}
+    try:
+        response = http_pool.post('http://localhost:5001/admin/geofences', json=changes, headers=headers)
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to update the geofences: {e}")
+        return None
+
+
+def reload_changes(first_id, count):
+    # Geofences added (then removed again) to make the service publish a new generation, with ids well above OSM's
+    # node ids so they never clash with the service's own geofences
+    ids = [10**15 + first_id + i for i in range(count)]
+    added = [{"id": geofence_id, "longitude": round(np.random.uniform(-10, 2), 6), "latitude": round(np.random.uniform(50, 60), 6)} for geofence_id in ids]
+    return {"add": added}, {"remove": ids}
+
+
+def reload_experiment(user_location_terms_ref, user_location_terms_prop, num_repitions_mean, num_requests=20):
+    reloadResults = []
+    tableResults = []
+
+    # Output files with temporary data: the admin requests' round trip and the time the service took to publish
+    # the new generation, and the location requests' latency
+    reload_files = ["Outputs/runReloadAddOut.txt", "Outputs/runReloadRemoveOut.txt", "Outputs/runReloadAddPublishOut.txt", "Outputs/runReloadRemovePublishOut.txt"]
+    latency_files = ["Outputs/reloadLatencyP50OutRef.txt", "Outputs/reloadLatencyP50OutProp.txt", "Outputs/reloadLatencyP99OutRef.txt", "Outputs/reloadLatencyP99OutProp.txt"]
+
+    try:
+        geofences_served = http_pool.get('http://localhost:5001/geofences').json()['count']
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        geofences_served = None
+
+    # Reload latency for different numbers of changed geofences (the rest of the catalogue is copied over)
+    for changed in [1, 100, 1000]:
+
+        # Clear output files of temporary data
+        for file_name in reload_files:
+            with open(file_name, 'w'):
+                pass
+
+        # Repeat for average
+        for i in range(num_repitions_mean):
+            for changes, name in zip(reload_changes(i * changed, changed), ["Add", "Remove"]):
+                start = time.time()
+                response = post_admin_changes(changes)
+                if response is None:
+                    continue
+
+                with open(f"Outputs/runReload{name}Out.txt", "a") as f:
+                    f.write(f"{(time.time() - start) * 1000}\n")
+                with open(f"Outputs/runReload{name}PublishOut.txt", "a") as f:
+                    f.write(f"{response['seconds'] * 1000}\n")
+
+        # Calculate staistics and present in table
+        reload_stats = stats.main(reload_files)
+
+        for i, metric in enumerate(["Add, round trip (ms)", "Remove, round trip (ms)", "Add, publish (ms)", "Remove, publish (ms)"]):
+            reloadResults.append(
+                [changed if i == 0 else "", metric,
+                f"{round(reload_stats[i]['Mean'], 3)} ± {round(reload_stats[i]['Standard Deviation'], 3)} (95% CI: {round(reload_stats[i]['95% Confidence Interval'][0], 3)}, {round(reload_stats[i]['95% Confidence Interval'][1], 3)})"]
+            )
+
+    # Location request latency with the geofences left alone, and while new generations are published back to back
+    for state in ["idle", "reloading"]:
+
+        # Clear output files of temporary data
+        for file_name in latency_files:
+            with open(file_name, 'w'):
+                pass
+
+        stop_reloading = threading.Event()
+        reloads = []
+
+        def keep_reloading():
+            while not stop_reloading.is_set():
+                for changes in reload_changes(10**6 + len(reloads), 1):
+                    post_admin_changes(changes)
+                    reloads.append(1)
+
+        reloader = threading.Thread(target=keep_reloading)
+        if state == "reloading":
+            reloader.start()
+
+        # Repeat for average
+        for i in range(num_repitions_mean):
+            for system, send_function, user_location_terms in [("Ref", send_encrypted_location_to_geofencing_service_ref, user_location_terms_ref),
+                                                               ("Prop", send_encrypted_location_to_geofencing_service_prop, user_location_terms_prop)]:
+                latencies = []
+                for j in range(num_requests):
+                    timed_request(send_function, user_location_terms, latencies, [])
+
+                # Write median and 99th percentile request latency to files
+                with open(f"Outputs/reloadLatencyP50Out{system}.txt", "a") as f:
+                    f.write(f"{np.percentile(latencies, 50)}\n")
+                with open(f"Outputs/reloadLatencyP99Out{system}.txt", "a") as f:
+                    f.write(f"{np.percentile(latencies, 99)}\n")
+
+        stop_reloading.set()
+        if state == "reloading":
+            reloader.join()
+
+        # Calculate staistics and present in table
+        latency_stats = stats.main(latency_files)
+
+        for i, metric in enumerate(["Latency p50 (s)", "Latency p99 (s)"]):
+            tableResults.append(
+                [state if i == 0 else "", metric,
+                f"{round(latency_stats[2*i]['Mean'], 3)} ± {round(latency_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(latency_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(latency_stats[2*i]['95% Confidence Interval'][1], 3)})",
+                f"{round(latency_stats[2*i+1]['Mean'], 3)} ± {round(latency_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(latency_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(latency_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+            )
+        if state == "reloading":
+            tableResults.append(["", "Generations published", len(reloads), len(reloads)])
+
+    reloadResults.append(["", "Geofences served", geofences_served])
+
+    save_results(reloadResults, ["Changed Geofences", "Metric", "Latency"], "Results/reload.csv")
+    save_results(tableResults, ["Geofences", "Metric", "Ref. Alg.", "Prop. Alg."], "Results/reload_requests.csv")
+
+    print(f"Reload results saved to Results/reload.csv and Results/reload_requests.csv\n")
+
+
+def short_circuit_places(variant, count=20, group=7, radius=50):
+    # The places of a carer's user (home, shops, a day centre, ...) on a grid 300 m apart ~3 km north of the user's
+    # location, as geofences of one group. Each variant adds them with its own ids, well above OSM's node ids and the
+    # reload experiment's, so the service publishes a new generation and the carer's recent hits start afresh
+    places = []
+    for i in range(count):
+        latitude = round(51.573037 + 0.027 + (i // 5) * 0.0027, 6)
+        longitude = round(-9.724087 + (i % 5) * 0.0043, 6)
+        places.append({"id": 2 * 10**15 + variant * 1000 + i, "longitude": longitude, "latitude": latitude, "radius": radius, "group": group})
+    return places
+
+
+def movement_trace(places, length, seed=0):
+    # A walk-and-dwell trace of length fixes (degrees) among the places: the user stays a few fixes at a place, mostly
+    # returning home (the first place) or to a few favourite ones, then walks to the next, the fixes on the way
+    # outside every place. Returns (latitude, longitude, inside) fixes
+    rng = np.random.default_rng(seed)
+    weights = np.array([8, 4, 3, 2] + [1] * (len(places) - 4), dtype=float)
+    weights /= weights.sum()
+
+    def distance(lat1, lon1, lat2, lon2):
+        # Haversine distance (m) between two points in degrees
+        lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+        a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+        return 2 * 6371000 * math.asin(math.sqrt(a))
+
+    trace = []
+    current = places[0]
+    while len(trace) < length:
+        # Dwell within 20 m of the place's centre
+        for _ in range(rng.integers(3, 8)):
+            trace.append((current['latitude'] + rng.uniform(-1.5e-4, 1.5e-4), current['longitude'] + rng.uniform(-1.5e-4, 1.5e-4), True))
+
+        # Walk to another place, keeping only the fixes on the way that are well outside every place
+        following = places[rng.choice(len(places), p=weights)]
+        for fraction in np.linspace(0, 1, 6)[1:-1]:
+            latitude = current['latitude'] + fraction * (following['latitude'] - current['latitude'])
+            longitude = current['longitude'] + fraction * (following['longitude'] - current['longitude'])
+            if all(distance(latitude, longitude, place['latitude'], place['longitude']) > 2 * place['radius'] for place in places):
+                trace.append((latitude, longitude, False))
+        current = following
+
+    return trace[:length]
+
+
+def short_circuit_experiment(public_key, num_repitions_mean, group=7):
+    global any_inside, priority_group, recent_hits_first
+    tableResults = []
+
+    # Output files with temporary data: the carer's decryptions and decryption & evaluation runtime per request
+    files = ["Outputs/decCountCarerOutRef.txt", "Outputs/decCountCarerOutProp.txt", "Outputs/runDecOutRef.txt", "Outputs/runDecOutProp.txt"]
+
+    # The same trace of num_repitions_mean fixes, encrypted once, is replayed for every variant
+    trace = movement_trace(short_circuit_places(0), num_repitions_mean)
+    encrypted_trace = [(compute_and_encrypt_user_location_terms_ref(math.radians(round(latitude, 5)), math.radians(round(longitude, 5)), public_key),
+                        compute_and_encrypt_user_location_terms_prop(math.radians(round(latitude, 5)), math.radians(round(longitude, 5)), public_key))
+                       for latitude, longitude, inside in trace]
+
+    # Every result decrypted, then the first hit searched for in geofence order, after the recent hits, and after the
+    # recent hits and the places of the user's carer
+    variants = [("All results", None, None, True), ("Geofence order", True, None, False), ("Recent hits first", True, None, True),
+                ("Recent hits and carer's places first", True, group, True)]
+
+    previous_ids = []
+    for variant, (name, variant_any_inside, variant_priority_group, variant_recent_hits_first) in enumerate(variants):
+
+        # Publish the places under new ids (a new generation, so no recent hits carry over from the previous variant)
+        places = short_circuit_places(variant + 1, group=group)
+        if post_admin_changes({"add": places, "remove": previous_ids}) is None:
+            return
+        previous_ids = [place['id'] for place in places]
+
+        try:
+            number_of_geofences = http_pool.get('http://localhost:5001/geofences').json()['count']
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            print("Couldn't get the number of geofences served")
+            return
+
+        # Clear output files of temporary data
+        for file_name in files:
+            with open(file_name, 'w'):
+                pass
+
+        any_inside, priority_group, recent_hits_first = variant_any_inside, variant_priority_group, variant_recent_hits_first
+
+        for terms_ref, terms_prop in encrypted_trace:
+            send_encrypted_location_to_geofencing_service_ref(*terms_ref, number_of_geofences=number_of_geofences)
+            send_encrypted_location_to_geofencing_service_prop(*terms_prop, number_of_geofences=number_of_geofences)
+
+        any_inside, priority_group, recent_hits_first = None, None, True
+
+        # Calculate staistics and present in table
+        short_circuit_stats = stats.main(files)
+
+        for i, metric in enumerate(["Decryptions per request", "Decryption & evaluation (s)"]):
+            tableResults.append(
+                [name if i == 0 else "", metric,
+                f"{round(short_circuit_stats[2*i]['Mean'], 3)} ± {round(short_circuit_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(short_circuit_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(short_circuit_stats[2*i]['95% Confidence Interval'][1], 3)})",
+                f"{round(short_circuit_stats[2*i+1]['Mean'], 3)} ± {round(short_circuit_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(short_circuit_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(short_circuit_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+            )
+        if variant == 0:
+            tableResults.append(["", "Geofences", number_of_geofences, number_of_geofences])
+
+    # Remove the places again
+    post_admin_changes({"remove": previous_ids})
+
+    inside = sum(1 for latitude, longitude, inside in trace if inside)
+    tableResults.append(["", "Fixes inside a place", f"{inside} of {len(trace)}", f"{inside} of {len(trace)}"])
+
+    save_results(tableResults, ["Evaluation", "Metric", "Ref. Alg.", "Prop. Alg."], "Results/shortcircuit.csv")
+
+    print(f"Short-circuit results saved to Results/shortcircuit.csv\n")
+
+
+def key_size_experiment(user_latitude, user_longitude, num_repitions_mean, key_sizes):
+    tableResults = []
+    all_raw_data_ref = []
+    all_raw_data_prop = []
+
+    # Output files with temporary data: the runtime of each stage and the payload received by each service
+    files = ["Outputs/runEncOutRef.txt", "Outputs/runEncOutProp.txt", "Outputs/runCompOutRef.txt", "Outputs/runCompOutProp.txt",
+             "Outputs/runSerOutRef.txt", "Outputs/runSerOutProp.txt", "Outputs/runDecOutRef.txt", "Outputs/runDecOutProp.txt",
+             "Outputs/runTotalOutRef.txt", "Outputs/runTotalOutProp.txt",
+             "Outputs/commGeoOutRef.txt", "Outputs/commGeoOutProp.txt", "Outputs/commCarerOutRef.txt", "Outputs/commCarerOutProp.txt"
+    ]
+    metrics = ["Encryption (s)", "Computation (s)", "Serialization (s)", "Decryption (s)", "Total Runtime (s)",
+               "Geofencing Recieved Communication (KB)", "Carer Device Recieved Communication (KB)"]
+
+    # The carer's key is changed for each size, and changed back to a key of its own size afterwards
+    original_key_size = public_key_n.bit_length()
+
+    for key_size in key_sizes:
+        public_key = set_carer_key_size(key_size)
+        if public_key is None:
+            break
+
+        # Wait for the geofencing service to be able to look up the new key (KEY_REGISTRY_MIN_REFRESH), then warm it
+        # up, so its first measured request doesn't pay for registering the key
+        time.sleep(1)
+        send_encrypted_location_to_geofencing_service_prop(*compute_and_encrypt_user_location_terms_prop(user_latitude, user_longitude, public_key), number_of_geofences=1)
+
+        for num_geofences in runtime_geofence_counts:
+
+            # Clear output files of temporary data
+            for file_name in files:
+                with open(file_name, 'w'):
+                    pass
+
+            # Repeat for average
+            for i in range(num_repitions_mean):
+                user_location_terms = compute_and_encrypt_user_location_terms_ref(user_latitude, user_longitude, public_key)
+                user_location_terms_prop = compute_and_encrypt_user_location_terms_prop(user_latitude, user_longitude, public_key)
+                send_encrypted_location_to_geofencing_service_ref(*user_location_terms, number_of_geofences=num_geofences)
+                send_encrypted_location_to_geofencing_service_prop(*user_location_terms_prop, number_of_geofences=num_geofences)
+
+            # Total runtime of each request (encryption, computation, serialization and decryption)
+            stages = [np.loadtxt(file_name, dtype=float) for file_name in files[:8]]
+            total_runtime_ref = stages[0] + stages[2] + stages[4] + stages[6]
+            total_runtime_prop = stages[1] + stages[3] + stages[5] + stages[7]
+            np.savetxt(files[8], total_runtime_ref)
+            np.savetxt(files[9], total_runtime_prop)
+
+            communication = [np.loadtxt(file_name, dtype=float) for file_name in files[10:]]
+            all_raw_data_ref.append(np.column_stack((np.full(len(total_runtime_ref), key_size), np.full(len(total_runtime_ref), num_geofences),
+                                                     stages[0], stages[2], stages[4], stages[6], total_runtime_ref, communication[0], communication[2])))
+            all_raw_data_prop.append(np.column_stack((np.full(len(total_runtime_prop), key_size), np.full(len(total_runtime_prop), num_geofences),
+                                                      stages[1], stages[3], stages[5], stages[7], total_runtime_prop, communication[1], communication[3])))
+
+            # Calculate staistics and present in table
+            key_size_stats = stats.main(files)
+
+            for i, metric in enumerate(metrics):
+                tableResults.append(
+                    [key_size if i == 0 else "", num_geofences if i == 0 else "", metric,
+                    f"{round(key_size_stats[2*i]['Mean'], 3)} ± {round(key_size_stats[2*i]['Standard Deviation'], 3)} (95% CI: {round(key_size_stats[2*i]['95% Confidence Interval'][0], 3)}, {round(key_size_stats[2*i]['95% Confidence Interval'][1], 3)})",
+                    f"{round(key_size_stats[2*i+1]['Mean'], 3)} ± {round(key_size_stats[2*i+1]['Standard Deviation'], 3)} (95% CI: {round(key_size_stats[2*i+1]['95% Confidence Interval'][0], 3)}, {round(key_size_stats[2*i+1]['95% Confidence Interval'][1], 3)})"]
+                )
+
+    set_carer_key_size(original_key_size)
+
+    if not tableResults:
+        return
+
+    # Saves all the raw data
+    header = "Key Size,# of Geofences,Runtime Encrypt,Runtime Compute,Runtime Serialize,Runtime Evaluate,Runtime Total,Geofence Service Recieved,Carer Device Recieved"
+    np.savetxt('ExperimentsAllRawData/key_size_experiment_all_raw_data_ref.csv', np.vstack(all_raw_data_ref), delimiter=',', header=header, comments='')
+    np.savetxt('ExperimentsAllRawData/key_size_experiment_all_raw_data_prop.csv', np.vstack(all_raw_data_prop), delimiter=',', header=header, comments='')
+
+    save_results(tableResults, ["Key Size", "Geofences", "Metric", "Ref. Alg.", "Prop. Alg."], "Results/key_size_runtime.csv")
+
+    print(f"Key size results saved to Results/key_size_runtime.csv\n")
+
+
+def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_mean, key_sizes=None):
     tableResults = []
     commTableResults = []
 
     # Output files with temporary data
     files = ["Outputs/runEncOutRef.txt", "Outputs/runEncOutProp.txt", "Outputs/runCompOutRef.txt", "Outputs/runCompOutProp.txt", "Outputs/runDecOutRef.txt", "Outputs/runDecOutProp.txt", "Outputs/runTotalOutRef.txt", "Outputs/runTotalOutProp.txt",
-             "Outputs/commGeoOutRef.txt", "Outputs/commGeoOutProp.txt", "Outputs/commCarerOutRef.txt", "Outputs/commCarerOutProp.txt"
+             "Outputs/commGeoOutRef.txt", "Outputs/commGeoOutProp.txt", "Outputs/commCarerOutRef.txt", "Outputs/commCarerOutProp.txt",
+             "Outputs/runMulGenericOutRef.txt", "Outputs/runMulGenericOutProp.txt", "Outputs/runMulOutRef.txt", "Outputs/runMulOutProp.txt",
+             "Outputs/runParOutRef.txt", "Outputs/runParOutProp.txt", "Outputs/runSerOutRef.txt", "Outputs/runSerOutProp.txt",
+             "Outputs/parseGeoOutRef.txt", "Outputs/parseGeoOutProp.txt", "Outputs/parseCarerOutRef.txt", "Outputs/parseCarerOutProp.txt"
     ]
 
-    geofence_counts = [1, 10, 100, 200, 300]
+    geofence_counts = runtime_geofence_counts
 
     all_raw_data_ref = []
     all_raw_data_prop = []
@@ -395,15 +1186,18 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
         data4 = np.loadtxt(files[3], dtype=float)
         data5 = np.loadtxt(files[4], dtype=float)
         data6 = np.loadtxt(files[5], dtype=float)
+        data7 = np.loadtxt(files[18], dtype=float)
+        data8 = np.loadtxt(files[19], dtype=float)
 
-        total_runtime_ref = data1 + data3 + data5
-        total_runtime_prop = data2 + data4 + data6
+        # Serialization on the geofencing service (obfuscating every result) is part of the total
+        total_runtime_ref = data1 + data3 + data7 + data5
+        total_runtime_prop = data2 + data4 + data8 + data6
 
         np.savetxt(files[6], total_runtime_ref)
         np.savetxt(files[7], total_runtime_prop)
         
-        runtime_experiment_all_raw_data_ref = np.column_stack((np.full(len(data1), num_geofences), data1, data3, data5, total_runtime_ref))
-        runtime_experiment_all_raw_data_prop = np.column_stack((np.full(len(data2), num_geofences), data2, data4, data6, total_runtime_prop))
+        runtime_experiment_all_raw_data_ref = np.column_stack((np.full(len(data1), num_geofences), data1, data3, data7, data5, total_runtime_ref))
+        runtime_experiment_all_raw_data_prop = np.column_stack((np.full(len(data2), num_geofences), data2, data4, data8, data6, total_runtime_prop))
         all_raw_data_ref.append(runtime_experiment_all_raw_data_ref)
         all_raw_data_prop.append(runtime_experiment_all_raw_data_prop)
 
@@ -412,9 +1206,13 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
         commGeoOutProp = np.loadtxt(files[9])
         commCarerOutRef = np.loadtxt(files[10])
         commCarerOutProp = np.loadtxt(files[11])
+        parseGeoOutRef = np.loadtxt(files[20])
+        parseGeoOutProp = np.loadtxt(files[21])
+        parseCarerOutRef = np.loadtxt(files[22])
+        parseCarerOutProp = np.loadtxt(files[23])
 
-        communication_experiment_all_raw_data_ref = np.column_stack((np.full(len(commGeoOutRef), num_geofences), commGeoOutRef, commCarerOutRef))
-        communication_experiment_all_raw_data_prop = np.column_stack((np.full(len(commGeoOutProp), num_geofences), commGeoOutProp, commCarerOutProp))
+        communication_experiment_all_raw_data_ref = np.column_stack((np.full(len(commGeoOutRef), num_geofences), commGeoOutRef, commCarerOutRef, parseGeoOutRef, parseCarerOutRef))
+        communication_experiment_all_raw_data_prop = np.column_stack((np.full(len(commGeoOutProp), num_geofences), commGeoOutProp, commCarerOutProp, parseGeoOutProp, parseCarerOutProp))
         all_raw_data_ref_comm.append(communication_experiment_all_raw_data_ref)
         all_raw_data_prop_comm.append(communication_experiment_all_raw_data_prop)
 
@@ -433,6 +1231,12 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
             f"{round(runtime_stats[3]['Mean'], 3)} ± {round(runtime_stats[3]['Standard Deviation'], 3)} (95% CI: {round(runtime_stats[3]['95% Confidence Interval'][0], 3)}, {round(runtime_stats[3]['95% Confidence Interval'][1], 3)})"]
         )
 
+        tableResults.append(
+            ["", "Serialization (s)", 
+            f"{round(runtime_stats[18]['Mean'], 3)} ± {round(runtime_stats[18]['Standard Deviation'], 3)} (95% CI: {round(runtime_stats[18]['95% Confidence Interval'][0], 3)}, {round(runtime_stats[18]['95% Confidence Interval'][1], 3)})", 
+            f"{round(runtime_stats[19]['Mean'], 3)} ± {round(runtime_stats[19]['Standard Deviation'], 3)} (95% CI: {round(runtime_stats[19]['95% Confidence Interval'][0], 3)}, {round(runtime_stats[19]['95% Confidence Interval'][1], 3)})"]
+        )
+
         tableResults.append(            
             ["", "Decryption (s)", 
             f"{round(runtime_stats[4]['Mean'], 3)} ± {round(runtime_stats[4]['Standard Deviation'], 3)} (95% CI: {round(runtime_stats[4]['95% Confidence Interval'][0], 3)}, {round(runtime_stats[4]['95% Confidence Interval'][1], 3)})", 
@@ -445,6 +1249,26 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
             f"{round(runtime_stats[7]['Mean'], 3)} ± {round(runtime_stats[7]['Standard Deviation'], 3)} (95% CI: {round(runtime_stats[7]['95% Confidence Interval'][0], 3)}, {round(runtime_stats[7]['95% Confidence Interval'][1], 3)})"]
         )
 
+        # Modular multiplications of the computation, with phe's generic pow and with the path taken (fixed-base tables above the threshold)
+        tableResults.append(            
+            ["", "Computation ModMul (generic pow)", 
+            f"{round(runtime_stats[12]['Mean'])}", 
+            f"{round(runtime_stats[13]['Mean'])}"]
+        )
+
+        tableResults.append(            
+            ["", "Computation ModMul (fixed-base tables)", 
+            f"{round(runtime_stats[14]['Mean'])}", 
+            f"{round(runtime_stats[15]['Mean'])}"]
+        )
+
+        # Processes the geofences were spread over per request, for the requested chunk size
+        tableResults.append(            
+            ["", f"Computation Processes (chunk size: {parallel_chunk_size or 'service default'})", 
+            f"{round(runtime_stats[16]['Mean'], 3)}", 
+            f"{round(runtime_stats[17]['Mean'], 3)}"]
+        )
+
         # Runtime tests include communication overhead
         commTableResults.append(
             [num_geofences,"Geofencing Recieved Communication (KB)", 
@@ -458,10 +1282,23 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
             f"{round(runtime_stats[11]['Mean'], 3)}"]
         )
 
+        # Time to parse the received payloads into integers (decimal JSON or binary)
+        commTableResults.append(
+            ["","Geofencing Payload Parse (ms)", 
+            f"{round(runtime_stats[20]['Mean'], 3)}", 
+            f"{round(runtime_stats[21]['Mean'], 3)}"]
+        )
+
+        commTableResults.append(
+            ["","Carer Device Payload Parse (ms)", 
+            f"{round(runtime_stats[22]['Mean'], 3)}", 
+            f"{round(runtime_stats[23]['Mean'], 3)}"]
+        )
+
     # Saves all the raw runtime data
     all_raw_data_ref = np.vstack(all_raw_data_ref)
     all_raw_data_prop = np.vstack(all_raw_data_prop)
-    header = "# of Geofences,Runtime Encrypt,Runtime Compute,Runtime Evaluate,Runtime Total"
+    header = "# of Geofences,Runtime Encrypt,Runtime Compute,Runtime Serialize,Runtime Evaluate,Runtime Total"
     np.savetxt(
         'ExperimentsAllRawData/runtime_experiment_all_raw_data_ref.csv',
         all_raw_data_ref, delimiter=',', 
@@ -475,31 +1312,46 @@ def runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_
         comments=''
     )
 
-    # Saves all the raw communication data
+    # Saves all the raw communication data (binary format results are kept apart, so both formats can be compared)
+    comm_suffix = "" if wire_format == "json" else f"_{wire_format}"
     all_raw_data_ref_comm = np.vstack(all_raw_data_ref_comm)
     all_raw_data_prop_comm = np.vstack(all_raw_data_prop_comm)
-    header_comm = "# of Geofences,Geofence Service Recieved,Carer Device Recieved"
+    header_comm = "# of Geofences,Geofence Service Recieved,Carer Device Recieved,Geofence Service Parse (ms),Carer Device Parse (ms)"
     np.savetxt(
-        'ExperimentsAllRawData/communication_experiment_all_raw_data_ref.csv',
+        f'ExperimentsAllRawData/communication_experiment_all_raw_data_ref{comm_suffix}.csv',
         all_raw_data_ref_comm, delimiter=',', 
         header=header_comm,
         comments=''
     )
     np.savetxt(
-        'ExperimentsAllRawData/communication_experiment_all_raw_data_prop.csv',
+        f'ExperimentsAllRawData/communication_experiment_all_raw_data_prop{comm_suffix}.csv',
         all_raw_data_prop_comm, delimiter=',',
         header=header_comm,
         comments=''
     )
 
+    # Amortised cost per fix when several buffered fixes are sent in one request (10 geofences)
+    tableResults.extend(fix_batch_experiment(user_latitude, user_longitude, public_key, num_repitions_mean))
+
+    # Compare encryption with the randomness pool empty and full
+    tableResults.extend(randomness_pool_experiment(user_latitude, user_longitude, public_key, num_repitions_mean))
+
+    # Record which big-integer backend produced these timings, so runs with different PAILLIER_BACKEND settings can be compared
+    tableResults.append(["", "Paillier Backend", paillier_engine.PAILLIER_BACKEND, paillier_engine.PAILLIER_BACKEND])
+    tableResults.append(["", "Packed Results", packed_results, packed_results])
+
     head = ["Geofences", "Metric", "Ref. Alg.", "Prop. Alg."]
     head_comm = ["Geofences", "Metric", "Ref. Alg.", "Prop. Alg."]
 
     save_results(tableResults, head, "Results/runtime_performance.csv")
-    save_results(commTableResults, head_comm, "Results/communication.csv")
+    save_results(commTableResults, head_comm, f"Results/communication{comm_suffix}.csv")
 
     print(f"Runtime performance results saved to Results/runtime_performance.csv\n")
-    print(f"Communication results saved to Results/communication.csv\n")
+    print(f"Communication results saved to Results/communication{comm_suffix}.csv\n")
+
+    # How encryption, computation, decryption and the payloads scale with the key size, for each number of geofences
+    if key_sizes:
+        key_size_experiment(user_latitude, user_longitude, num_repitions_mean, key_sizes)
 
 
 def save_results(table_data, headers, filename):
@@ -514,16 +1366,16 @@ def parse_arguments():
 
     parser.add_argument(
         "-m", "--mode",
-        choices=["basic", "runtime", "scalability"],
+        choices=["basic", "runtime", "scalability", "batching", "fixes", "reload", "shortcircuit"],
         default="basic",
-        help="Run mode: basic (just send location), runtime (incl. communication overhead experiment), scalability"
+        help="Run mode: basic (just send location), runtime (incl. communication overhead experiment), scalability, batching (throughput vs. latency for different batch windows), fixes (send a buffered track of fixes in one request), reload (latency of publishing geofence changes, and of requests meanwhile), shortcircuit (carer decryptions per request on a movement trace, with and without 'any inside' evaluation)"
     )
 
     parser.add_argument(
         "-r", "--repetitions",
         type=int,
         default=30,
-        help="Number of repetitions for runtime/scalability experiments to calculate mean"
+        help="Number of repetitions for runtime/scalability experiments to calculate mean (fixes of the movement trace in shortcircuit mode)"
     )
 
     parser.add_argument(
@@ -533,15 +1385,133 @@ def parse_arguments():
         help="Number of geofences to simulate (only used in basic mode)"
     )
 
+    parser.add_argument(
+        "-fc", "--fix-count",
+        type=int,
+        default=10,
+        help="Number of buffered location fixes sent in one request (only used in fixes mode)"
+    )
+
+    parser.add_argument(
+        "-cs", "--chunk-size",
+        type=int,
+        default=None,
+        help="Geofences per chunk for the geofencing service's parallel evaluation (default: the service's PARALLEL_CHUNK_SIZE)"
+    )
+
+    parser.add_argument(
+        "-rp", "--randomness-pool-size",
+        type=int,
+        default=64,
+        help="Number of r^n values precomputed in the background for encryption (0 computes them during encryption)"
+    )
+
+    parser.add_argument(
+        "-wf", "--wire-format",
+        choices=["json", "binary"],
+        default="json",
+        help="Send ciphertexts as JSON decimal integers or in the binary wire format (communication results for binary go to Results/communication_binary.csv)"
+    )
+
+    parser.add_argument(
+        "-p", "--packed",
+        action="store_true",
+        help="Pack several geofence results into each ciphertext sent to the carer (one decryption per ciphertext)"
+    )
+
+    parser.add_argument(
+        "-hp", "--http-pool-size",
+        type=int,
+        default=http_pool.HTTP_POOL_SIZE,
+        help="Keep-alive connections kept open to each service (0 opens a new connection per request)"
+    )
+
+    parser.add_argument(
+        "-at", "--admin-token",
+        default="",
+        help="Token of the geofencing service's admin API (its ADMIN_TOKEN), used in reload mode"
+    )
+
+    parser.add_argument(
+        "-ad", "--async-delivery",
+        action="store_true",
+        help="Have the geofencing service acknowledge locations once queued and deliver results to the carer in the background (basic and scalability modes)"
+    )
+
+    parser.add_argument(
+        "-ai", "--any-inside",
+        action="store_true",
+        help="Have the carer only decide whether the user is inside any geofence, decrypting until the first hit (basic and fixes modes)"
+    )
+
+    parser.add_argument(
+        "-pg", "--priority-group",
+        type=int,
+        default=None,
+        help="Group of geofences (e.g. the places of the user's carer) the carer decrypts first with --any-inside, after its recent hits"
+    )
+
+    parser.add_argument(
+        "-nrh", "--no-recent-hits-first",
+        action="store_true",
+        help="Don't have the carer decrypt the geofences it last found the user in first with --any-inside"
+    )
+
+    parser.add_argument(
+        "-ks", "--key-size",
+        type=int,
+        default=None,
+        help="Have the carer change to a key of this many bits first (its KEY_SIZE otherwise), through its key rotation endpoint"
+    )
+
+    parser.add_argument(
+        "-kss", "--key-sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Key sizes (bits) to repeat the runtime experiment for, e.g. 1024 2048 3072 (only used in runtime mode, results go to Results/key_size_runtime.csv)"
+    )
+
+    parser.add_argument(
+        "-cat", "--carer-admin-token",
+        default="",
+        help="Token of the carer's key rotation endpoint (its ADMIN_TOKEN), used to change the key size"
+    )
+
     return parser.parse_args()
 
 def main():
+    global parallel_chunk_size, packed_results, randomness_pool_size, wire_format, async_delivery, fix_count, admin_token
+    global any_inside, priority_group, recent_hits_first, carer_admin_token
 
     args = parse_arguments()
+    parallel_chunk_size = args.chunk_size
+    packed_results = args.packed
+    randomness_pool_size = args.randomness_pool_size
+    wire_format = args.wire_format
+    fix_count = args.fix_count
+    admin_token = args.admin_token
+    any_inside = args.any_inside or None
+    priority_group = args.priority_group
+    recent_hits_first = not args.no_recent_hits_first
+    carer_admin_token = args.carer_admin_token
+    http_pool.HTTP_POOL_SIZE = args.http_pool_size
+
+    # The runtime and short-circuit experiments read the carer's per-request measurements, so they always wait for the carer
+    async_delivery = args.async_delivery and args.mode not in ("runtime", "shortcircuit")
 
     # Get public key from carer's device
     public_key = get_carer_public_key()
 
+    # The key is checked against the size this device expects (KEY_SIZE), or changed to the size asked for
+    if args.key_size is not None and public_key is not None and public_key.n.bit_length() != args.key_size:
+        public_key = set_carer_key_size(args.key_size) or public_key
+    elif args.key_size is None and public_key is not None and public_key.n.bit_length() != paillier_engine.KEY_SIZE:
+        print(f"Warning: the carer's key is {public_key.n.bit_length()} bits, not KEY_SIZE ({paillier_engine.KEY_SIZE} bits)")
+
+    # Start precomputing the random factors for encryption in the background
+    paillier_engine.start_obfuscation_pool(public_key, randomness_pool_size)
+
     # User's location in radians
     user_latitude, user_longitude = math.radians(round(51.573037, 5)), math.radians(round(-9.724087, 5))
 
@@ -558,12 +1528,31 @@ def main():
 
     elif args.mode == "runtime":
         # Measures the runtime performance of the systems (incl. communication overhead experiment)
-        runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_mean=args.repetitions)
+        runtime_experiment(user_latitude, user_longitude, public_key, num_repitions_mean=args.repetitions, key_sizes=args.key_sizes)
 
     elif args.mode == "scalability":
         # Evaluates the systems scalability under varying request loads
         scalability_experiment(user_location_terms, user_location_terms_prop, num_repitions_mean=args.repetitions)
 
+    elif args.mode == "batching":
+        # Compares throughput and added latency for different batch windows of the geofencing service
+        batching_experiment(user_location_terms, user_location_terms_prop, num_repitions_mean=args.repetitions)
+
+    elif args.mode == "fixes":
+        # Sends a buffered track of location fixes for each system in one request
+        fixes_ref, fixes_prop = record_location_fixes(user_latitude, user_longitude, public_key, fix_count)
+        send_location_fixes_to_geofencing_service("ref", fixes_ref, number_of_geofences=args.geofence_count)
+        send_location_fixes_to_geofencing_service("prop", fixes_prop, number_of_geofences=args.geofence_count)
+
+    elif args.mode == "reload":
+        # Measures publishing geofence changes through the admin API, and request latency while they are published
+        reload_experiment(user_location_terms, user_location_terms_prop, num_repitions_mean=args.repetitions)
+
+    elif args.mode == "shortcircuit":
+        # Measures the carer's decryptions per request on a movement trace among a carer's places, with every result
+        # decrypted and with 'any inside' evaluation in each priority order
+        short_circuit_experiment(public_key, num_repitions_mean=args.repetitions)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import os
+
+# Shared HTTP connection pool used by the User Device and the Geofencing Microservice for every call to another service.
+# A bare requests.get/post opens (and closes) a new TCP connection per call, so under concurrent load every request
+# pays connection setup and leaves a socket in TIME_WAIT. A keep-alive session reuses connections instead
+
+# Connections kept open per host (should cover the number of concurrent requests, e.g. the 100 threads of the
+# scalability experiment). 0 disables pooling: every call opens its own connection, as before
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "100"))
+
+# Seconds to wait for a connection, and for a response once the request is sent (geofence evaluation can be slow)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "120"))
+
+# Retries with exponential backoff (HTTP_BACKOFF * 2^retry seconds). Failed connections are retried for every request,
+# since nothing was sent. Read errors and 502/503/504 responses are only retried for GETs, as a POST may have been processed
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "0.1"))
+
+# One session per process: connections inherited from a parent process (gunicorn --preload forks its workers) must not
+# be shared. The session's connection pool is thread-safe, so all threads of a process use the same one
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def retry_policy():
+    return Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False  # Return the last response, so raise_for_status reports it as before
+    )
+
+
+def create_session(pool_size):
+    session = requests.Session()
+
+    # Requests can wait for a free connection (pool_block) rather than opening extra ones that are thrown away
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry_policy(), pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def get_session():
+    pid = os.getpid()
+    session = sessions.get(pid)
+
+    if session is None:
+        with sessions_lock:
+            session = sessions.get(pid)
+            if session is None:
+                # Forget sessions created by a parent process before this one was forked
+                sessions.clear()
+                session = sessions[pid] = create_session(HTTP_POOL_SIZE)
+
+    return session
+
+
+def request(method, url, **kwargs):
+    # Default timeouts, so a hung service can't block the caller forever
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+    if HTTP_POOL_SIZE <= 0:
+        # Pooling disabled: a new connection for this request only (retries still apply)
+        with create_session(1) as session:
+            return session.request(method, url, **kwargs)
+
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
@@ -2,6 +2,8 @@
 
 mkdir -p Outputs # Creates Outputs directory
 mkdir -p Results # Creates Results directory
+mkdir -p Snapshots # Creates Snapshots directory (geofence snapshots of the geofencing service)
+mkdir -p Keys # Creates Keys directory (the carer's encrypted key file)
 
 # List of required files
 FILES=(
@@ -17,16 +19,64 @@ FILES=(
     "commGeoOutProp.txt"
     "commCarerOutRef.txt"
     "commCarerOutProp.txt"
+    "runMulGenericOutRef.txt"
+    "runMulGenericOutProp.txt"
+    "runMulOutRef.txt"
+    "runMulOutProp.txt"
+    "runParOutRef.txt"
+    "runParOutProp.txt"
+    "runSerOutRef.txt"
+    "runSerOutProp.txt"
+    "runBatchOutRef.txt"
+    "runBatchOutProp.txt"
+    "runBatchWaitOutRef.txt"
+    "runBatchWaitOutProp.txt"
+    "runFixRoundTripOutRef.txt"
+    "runFixRoundTripOutProp.txt"
+    "runCompFixOutRef.txt"
+    "runCompFixOutProp.txt"
+    "runDecFixOutRef.txt"
+    "runDecFixOutProp.txt"
+    "commGeoFixOutRef.txt"
+    "commGeoFixOutProp.txt"
+    "runReloadAddOut.txt"
+    "runReloadRemoveOut.txt"
+    "runReloadAddPublishOut.txt"
+    "runReloadRemovePublishOut.txt"
+    "reloadLatencyP50OutRef.txt"
+    "reloadLatencyP50OutProp.txt"
+    "reloadLatencyP99OutRef.txt"
+    "reloadLatencyP99OutProp.txt"
+    "parseGeoOutRef.txt"
+    "parseGeoOutProp.txt"
+    "parseCarerOutRef.txt"
+    "parseCarerOutProp.txt"
+    "decCountCarerOutRef.txt"
+    "decCountCarerOutProp.txt"
     "scaleRunOutRef.txt"
     "scaleRunOutProp.txt"
     "scaleThroughputOutRef.txt"
     "scaleThroughputOutProp.txt"
     "scaleLatencyOutRef.txt"
     "scaleLatencyOutProp.txt"
+    "scaleLatencyP50OutRef.txt"
+    "scaleLatencyP50OutProp.txt"
+    "scaleLatencyP99OutRef.txt"
+    "scaleLatencyP99OutProp.txt"
+    "scaleEndToEndP50OutRef.txt"
+    "scaleEndToEndP50OutProp.txt"
+    "scaleEndToEndP99OutRef.txt"
+    "scaleEndToEndP99OutProp.txt"
     "securityRunOutRef.txt"
     "securityRunOutProp.txt"
     "securityOverOutRef.txt"
     "securityOverOutProp.txt"
+    "securityEncOutRef.txt"
+    "securityEncOutProp.txt"
+    "securityCompOutRef.txt"
+    "securityCompOutProp.txt"
+    "securityDecOutRef.txt"
+    "securityDecOutProp.txt"
     "accuracyRef.txt"
     "accuracyProp.txt"
 )
@@ -0,0 +1,729 @@
+from phe import paillier, EncodedNumber
+import phe.util
+import collections
+import threading
+import hashlib
+import json
+import random
+import math
+import os
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# Shared Paillier helpers used by the User Device, the Geofencing Microservice and the Carer Device.
+# Every component must use the same settings, so they are read from the environment in one place.
+
+# Big-integer backend: 'gmpy2' and 'python' work on raw ciphertext integers (GMP or Python ints), 'phe' keeps
+# phe's EncryptedNumber objects. The wire format ({'ciphertext': int, 'exponent': int}) is the same for all three
+PAILLIER_BACKEND = os.environ.get("PAILLIER_BACKEND", "gmpy2" if gmpy2 is not None else "python")
+
+if PAILLIER_BACKEND not in ("gmpy2", "python", "phe"):
+    raise ValueError(f"Unknown PAILLIER_BACKEND '{PAILLIER_BACKEND}', expected 'gmpy2', 'python' or 'phe'")
+
+if PAILLIER_BACKEND == "gmpy2" and gmpy2 is None:
+    print("gmpy2 is not installed, falling back to the 'python' Paillier backend")
+    PAILLIER_BACKEND = "python"
+
+
+def to_backend_int(value):
+    # Integers in the backend's native type, so every % and * afterwards runs in GMP when available
+    if PAILLIER_BACKEND == "gmpy2":
+        return gmpy2.mpz(value)
+    return int(value)
+
+
+def powmod(base, exponent, modulus):
+    if PAILLIER_BACKEND == "gmpy2":
+        return gmpy2.powmod(base, exponent, modulus)
+    if PAILLIER_BACKEND == "phe":
+        return phe.util.powmod(base, exponent, modulus)
+    return pow(base, exponent, modulus)
+
+
+def invert(value, modulus):
+    if PAILLIER_BACKEND == "gmpy2":
+        return gmpy2.invert(value, modulus)
+    if PAILLIER_BACKEND == "phe":
+        return phe.util.invert(value, modulus)
+    return pow(value, -1, modulus)
+
+# Bit length of the modulus n of the carer's keys: the carer generates its keys with it (and moves its key to it on
+# startup), and the User Device checks the key it is given. Keys can also be changed to another size at runtime
+# (e.g. for the key size experiments), but never below MIN_KEY_SIZE, which the geofencing service enforces too
+KEY_SIZE = int(os.environ.get("KEY_SIZE", str(paillier.DEFAULT_KEYSIZE)))
+MIN_KEY_SIZE = int(os.environ.get("MIN_KEY_SIZE", "1024"))
+
+if KEY_SIZE < MIN_KEY_SIZE:
+    raise ValueError(f"KEY_SIZE {KEY_SIZE} is below MIN_KEY_SIZE {MIN_KEY_SIZE}")
+
+# Fixed-point encoding: every value is encoded as mantissa * BASE**FIXED_POINT_EXPONENT (BASE = 16), so
+# encrypted terms that are added together already share an exponent and never need re-aligning
+FIXED_POINT_ENCODING = os.environ.get("FIXED_POINT_ENCODING", "1") == "1"
+FIXED_POINT_EXPONENT = int(os.environ.get("FIXED_POINT_EXPONENT", "-14"))  # 16^-14 ≈ 1.4e-17, below float64 precision of values in [-2, 2]
+
+
+def encode(public_key, value):
+    # Encode a float for Paillier using the configured encoding
+    if FIXED_POINT_ENCODING:
+        return encode_fixed_point(public_key, value)
+    return EncodedNumber.encode(public_key, value)
+
+
+def encode_fixed_point(public_key, value, exponent=None):
+    if exponent is None:
+        exponent = FIXED_POINT_EXPONENT
+
+    # Scaling by a power of two is exact for floats, so rounding is the only error introduced
+    mantissa = round(value * EncodedNumber.BASE ** -exponent)
+
+    if abs(mantissa) > public_key.max_int:
+        raise ValueError(f"Value {value} overflows the fixed-point encoding with exponent {exponent}")
+
+    return EncodedNumber(public_key, mantissa % public_key.n, exponent)
+
+
+# Paillier ciphertext held as a backend integer with its exponent. Serialises exactly like phe's EncryptedNumber
+# (ciphertext() and exponent), without phe's per-operation object overhead
+class RawEncryptedNumber(object):
+    def __init__(self, public_key, ciphertext, exponent=0, is_obfuscated=False):
+        self.public_key = public_key
+        self.raw_ciphertext = to_backend_int(ciphertext)
+        self.exponent = exponent
+        self.is_obfuscated = is_obfuscated
+
+    def __repr__(self):
+        return f"<RawEncryptedNumber exponent={self.exponent}>"
+
+    def ciphertext(self, be_secure=True):
+        # Like phe, only hand out a ciphertext others will see once it has been obfuscated
+        if be_secure and not self.is_obfuscated:
+            self.obfuscate()
+        return int(self.raw_ciphertext)
+
+    def obfuscate(self):
+        self.raw_ciphertext = obfuscate(self.public_key, self.raw_ciphertext)
+        self.is_obfuscated = True
+
+
+def encrypted_number(public_key, ciphertext, exponent, is_obfuscated=False):
+    # Deserialise a ciphertext for the configured backend
+    if PAILLIER_BACKEND == "phe":
+        return paillier.EncryptedNumber(public_key, int(ciphertext), exponent)
+    return RawEncryptedNumber(public_key, ciphertext, exponent, is_obfuscated)
+
+
+def client_encrypted_number(public_key, ciphertext, exponent):
+    # Deserialise a ciphertext sent by a client, which must be an int below n² (not a string or float int() or mpz()
+    # would accept) with an int exponent. With the fixed-point encoding every client value is encrypted at
+    # FIXED_POINT_EXPONENT, so any other exponent is rejected too. Raises ValueError for invalid values
+    if type(ciphertext) is not int or type(exponent) is not int or not 0 < ciphertext < public_key.nsquare:
+        raise ValueError("Ciphertexts and exponents must be integers, with ciphertexts below n squared")
+    if FIXED_POINT_ENCODING and exponent != FIXED_POINT_EXPONENT:
+        raise ValueError(f"Exponents must be the fixed-point exponent {FIXED_POINT_EXPONENT}")
+
+    return encrypted_number(public_key, ciphertext, exponent)
+
+
+def obfuscate(public_key, ciphertext):
+    # Multiply by r^n mod n² for a fresh random r, as phe does before a ciphertext leaves the device.
+    # With an obfuscation pool running for the key, r^n comes precomputed and this is one multiplication
+    nsquare = to_backend_int(public_key.nsquare)
+    pool = obfuscation_pools.get(public_key.n)
+
+    if pool is not None and pool.pid == os.getpid():
+        factor = pool.take()
+    else:
+        factor = obfuscation_factor(public_key)
+
+    return to_backend_int(ciphertext) * factor % nsquare
+
+
+def obfuscation_factor(public_key):
+    # r^n mod n² for a fresh random r
+    r = random.SystemRandom().randrange(1, public_key.n)
+    return powmod(to_backend_int(r), to_backend_int(public_key.n), to_backend_int(public_key.nsquare))
+
+
+# Default number of precomputed obfuscation factors kept per public key
+OBFUSCATION_POOL_SIZE = int(os.environ.get("OBFUSCATION_POOL_SIZE", "1024"))
+
+# Running obfuscation pools by public key modulus (requests in several threads may start the first pool at the same time)
+obfuscation_pools = {}
+obfuscation_pools_lock = threading.RLock()
+
+
+# Bounded pool of obfuscation factors r^n mod n² for one public key, refilled by a background thread once it drops
+# below half its size, so a burst of takes isn't slowed down by the refill competing with it.
+# Each factor is handed out once and discarded, as reusing r would link the ciphertexts
+class ObfuscationPool(object):
+    def __init__(self, public_key, size=None):
+        self.public_key = public_key
+        self.size = OBFUSCATION_POOL_SIZE if size is None else size
+        self.factors = collections.deque()
+        self.lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.stopped = False
+        self.pid = os.getpid()  # Threads don't survive a fork, so a forked process must start its own pool
+
+        self.thread = threading.Thread(target=self.refill, daemon=True)
+        self.thread.start()
+        self.refill_needed.set()
+
+    def __len__(self):
+        return len(self.factors)
+
+    def take(self):
+        # A precomputed factor if there is one, otherwise one computed now so callers never wait on the refill
+        with self.lock:
+            factor = self.factors.popleft() if self.factors else None
+            if len(self.factors) < self.size // 2:
+                self.refill_needed.set()
+
+        if factor is None:
+            factor = obfuscation_factor(self.public_key)
+        return factor
+
+    def refill(self):
+        while not self.stopped:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+
+            while not self.stopped and len(self.factors) < self.size:
+                self.add(obfuscation_factor(self.public_key))
+
+    def fill(self):
+        # Fill the pool now, in the caller's thread
+        while len(self.factors) < self.size:
+            self.add(obfuscation_factor(self.public_key))
+
+    def add(self, factor):
+        with self.lock:
+            if len(self.factors) < self.size:
+                self.factors.append(factor)
+
+    def drain(self):
+        # Discard every precomputed factor (the background thread starts refilling straight away)
+        with self.lock:
+            self.factors.clear()
+        self.refill_needed.set()
+
+    def stop(self):
+        self.stopped = True
+        self.refill_needed.set()
+
+
+def start_obfuscation_pool(public_key, size=None):
+    # Start (once per key and process) a background-refilled obfuscation pool, which obfuscate then draws from.
+    # Only the current key is kept, so pools for keys no longer in use are stopped
+    pool = obfuscation_pools.get(public_key.n)
+
+    if pool is None or pool.pid != os.getpid():
+        if (size if size is not None else OBFUSCATION_POOL_SIZE) <= 0:
+            return None
+
+        with obfuscation_pools_lock:
+            pool = obfuscation_pools.get(public_key.n)
+            if pool is None or pool.pid != os.getpid():
+                stop_obfuscation_pools()
+                pool = ObfuscationPool(public_key, size)
+                obfuscation_pools[public_key.n] = pool
+
+    return pool
+
+
+def stop_obfuscation_pools():
+    with obfuscation_pools_lock:
+        for pool in obfuscation_pools.values():
+            if pool.pid == os.getpid():
+                pool.stop()
+        obfuscation_pools.clear()
+
+
+def raw_encrypt_unobfuscated(public_key, mantissa):
+    # g^m = 1 + n·m mod n² for g = n + 1, negative mantissas wrap around mod n
+    return (to_backend_int(public_key.n) * (mantissa % public_key.n) + 1) % to_backend_int(public_key.nsquare)
+
+
+def encrypt(public_key, value):
+    # Encrypt a float using the configured encoding and backend
+    encoding = encode(public_key, value)
+
+    if PAILLIER_BACKEND == "phe":
+        return public_key.encrypt(encoding)
+
+    ciphertext = raw_encrypt_unobfuscated(public_key, encoding.encoding)
+    return RawEncryptedNumber(public_key, obfuscate(public_key, ciphertext), encoding.exponent, is_obfuscated=True)
+
+
+# Private key parts in backend integers, computed once per key
+private_key_parts = {}
+
+
+def decrypt(private_key, encrypted):
+    # Decrypt and decode an EncryptedNumber or RawEncryptedNumber
+    if PAILLIER_BACKEND == "phe":
+        return private_key.decrypt(encrypted)
+
+    return decode_plaintext(private_key.public_key, raw_decrypt(private_key, encrypted), encrypted.exponent)
+
+
+def decode_plaintext(public_key, plaintext, exponent):
+    # phe's decoding, including its overflow detection for values that were not encrypted with this key
+    return EncodedNumber(public_key, plaintext, exponent).decode()
+
+
+def raw_decrypt(private_key, encrypted):
+    # Decrypt to the plaintext integer mod n, without decoding it
+    public_key = private_key.public_key
+    if encrypted.public_key != public_key:
+        raise ValueError("encrypted_number was encrypted against a different key!")
+
+    if PAILLIER_BACKEND == "phe":
+        return private_key.raw_decrypt(encrypted.ciphertext(False))
+
+    return crt_decrypt(private_key_crt_parts(private_key), encrypted.ciphertext(False))
+
+
+def private_key_crt_parts(private_key):
+    # The private key's primes and the values Chinese-remaindering needs, as backend integers, computed once per key
+    public_key = private_key.public_key
+    if public_key.n not in private_key_parts:
+        private_key_parts[public_key.n] = tuple(to_backend_int(part) for part in (
+            private_key.p, private_key.q, private_key.psquare, private_key.qsquare,
+            private_key.hp, private_key.hq, private_key.p_inverse))
+    return private_key_parts[public_key.n]
+
+
+def crt_decrypt(parts, ciphertext):
+    # Decrypt a raw ciphertext integer using Chinese-remaindering, as in phe's raw_decrypt: two exponentiations
+    # with half-size exponents modulo p² and q² instead of one modulo n²
+    p, q, psquare, qsquare, hp, hq, p_inverse = parts
+    ciphertext = to_backend_int(ciphertext)
+    decrypt_to_p = (powmod(ciphertext, p - 1, psquare) - 1) // p * hp % p
+    decrypt_to_q = (powmod(ciphertext, q - 1, qsquare) - 1) // q * hq % q
+    plaintext = decrypt_to_p + (decrypt_to_q - decrypt_to_p) * p_inverse % q * p
+
+    return int(plaintext)
+
+
+# Fixed-base exponentiation: when one ciphertext is raised to many different scalars, precomputing
+# base^(d * 2^(k*w)) for every w-bit digit d and window position k turns each exponentiation into one
+# multiplication per non-zero digit, with no squarings
+FIXED_BASE_WINDOW_BITS = int(os.environ.get("FIXED_BASE_WINDOW_BITS", "4"))
+
+
+def signed_mantissa(encoded):
+    # Recover the signed integer an EncodedNumber holds (negative values are stored as n - |value|)
+    if encoded.encoding >= encoded.public_key.n - encoded.public_key.max_int:
+        return encoded.encoding - encoded.public_key.n
+    return encoded.encoding
+
+
+def build_fixed_base_table(base, exponent_bits, modulus, window_bits=None):
+    if window_bits is None:
+        window_bits = FIXED_BASE_WINDOW_BITS
+
+    table = []
+    window_base = base  # base^(2^(k*w)) for the current window position k
+
+    for k in range(max(1, math.ceil(exponent_bits / window_bits))):
+        if k > 0:
+            window_base = table[-1][-1] * table[-1][1] % modulus
+        row = [1, window_base]
+        for digit in range(2, 2**window_bits):
+            row.append(row[-1] * window_base % modulus)
+        table.append(row)
+
+    return table
+
+
+def fixed_base_table_cost(table):
+    # Modular multiplications spent building the table
+    return len(table) * (len(table[0]) - 2) + (len(table) - 1)
+
+
+def binary_powmod_cost(exponent):
+    # Modular multiplications of left-to-right square-and-multiply, which CPython's pow uses for exponents of this size
+    exponent = abs(exponent)
+    if exponent < 2:
+        return 0
+    return (exponent.bit_length() - 1) + (bin(exponent).count("1") - 1)
+
+
+# Simultaneous multi-exponentiation: an encrypted inner product Enc(Σ a_i·x_i + k) is Enc(k)·∏ c_i^(a_i) mod n²,
+# so the whole product is computed at once on raw integers rather than one phe pow per term
+
+
+def column_layout(exponent_rows, fixed_base=False, window_bits=None):
+    if window_bits is None:
+        window_bits = FIXED_BASE_WINDOW_BITS
+
+    # Per base (column of scalars): the exponent bits its tables must cover, and whether positive and negative
+    # scalars occur, so only the tables that are used get built
+    layout = []
+    for column in zip(*exponent_rows):
+        exponent_bits = max(abs(exponent) for exponent in column).bit_length() if fixed_base else window_bits
+        layout.append((exponent_bits, any(exponent > 0 for exponent in column), any(exponent < 0 for exponent in column)))
+    return layout
+
+
+def prepare_multi_powmod(bases, exponent_rows, modulus, fixed_base=False, window_bits=None, layout=None):
+    if window_bits is None:
+        window_bits = FIXED_BASE_WINDOW_BITS
+    if layout is None:
+        layout = column_layout(exponent_rows, fixed_base, window_bits)
+
+    # Per base, a table for positive exponents and one for its inverse for negative ones, built only when needed.
+    # Straus interleaving needs the digit powers base^d (one table row), fixed-base needs a row per window position
+    tables = []
+    cost = 0
+
+    for base, (exponent_bits, has_positive, has_negative) in zip(bases, layout):
+        positive_table = negative_table = None
+
+        if has_positive:
+            positive_table = build_fixed_base_table(base, exponent_bits, modulus, window_bits)
+            cost += fixed_base_table_cost(positive_table)
+        if has_negative:
+            negative_table = build_fixed_base_table(invert(base, modulus), exponent_bits, modulus, window_bits)
+            cost += fixed_base_table_cost(negative_table)
+
+        tables.append((positive_table, negative_table))
+
+    return {
+        'modulus': modulus,
+        'window_bits': window_bits,
+        'fixed_base': fixed_base,
+        'tables': tables,
+        'cost': cost
+    }
+
+
+def exponent_digits(exponents, window_bits, fixed_base):
+    # The non-zero window digits of a row of exponents, which is all multi_powmod needs from them. They don't depend
+    # on the bases, so they are worked out once per row and reused for every user the row is evaluated for
+    mask = 2**window_bits - 1
+
+    if fixed_base:
+        # (base index, negative, window position, digit) for every non-zero digit
+        digits = []
+        for i, exponent in enumerate(exponents):
+            negative = exponent < 0
+            exponent = abs(exponent)
+            k = 0
+            while exponent:
+                if exponent & mask:
+                    digits.append((i, negative, k, exponent & mask))
+                exponent >>= window_bits
+                k += 1
+        return digits
+
+    # Straus: per window position, most significant first, (base index, negative, digit) for every non-zero digit
+    windows = math.ceil(max((abs(exponent) for exponent in exponents), default=0).bit_length() / window_bits)
+    return [
+        [(i, exponent < 0, (abs(exponent) >> (k * window_bits)) & mask) for i, exponent in enumerate(exponents) if (abs(exponent) >> (k * window_bits)) & mask]
+        for k in reversed(range(windows))
+    ]
+
+
+def multi_powmod(precomputed, exponents, initial=1):
+    # Returns initial·∏ base_i^exponents[i] and the number of modular multiplications it took
+    return multi_powmod_digits(precomputed, exponent_digits(exponents, precomputed['window_bits'], precomputed['fixed_base']), initial)
+
+
+def multi_powmod_digits(precomputed, digits, initial=1):
+    modulus = precomputed['modulus']
+    tables = precomputed['tables']
+
+    result = initial
+    multiplications = 0
+
+    if precomputed['fixed_base']:
+        # Every digit of every exponent is a table lookup, so no squarings are needed at all
+        for i, negative, k, digit in digits:
+            result = result * tables[i][negative][k][digit] % modulus
+        return result, len(digits)
+
+    # Straus interleaving: one shared run of squarings for all exponents, one multiplication per non-zero digit
+    window_bits = precomputed['window_bits']
+    result = 1
+    started = False
+
+    for window in digits:
+        if started:
+            for i in range(window_bits):
+                result = result * result % modulus
+            multiplications += window_bits
+
+        for i, negative, digit in window:
+            result = result * tables[i][negative][0][digit] % modulus
+            multiplications += 1
+            started = True
+
+    # The initial factor is multiplied in last so it is not caught up in the squarings
+    if initial != 1:
+        result = result * initial % modulus
+        multiplications += 1
+
+    return result, multiplications
+
+
+def align_coefficient_rows(values, coefficient_rows):
+    # Terms can only be multiplied together on a common exponent, so align each row on its lowest exponent
+    # by folding the BASE powers into the scalars rather than re-encrypting.
+    # Only the values' exponents are used, so values may also be a list of exponents
+    value_exponents = [value if isinstance(value, int) else value.exponent for value in values]
+    exponent_rows = []
+    result_exponents = []
+    generic_multiplications = 0
+
+    for row in coefficient_rows:
+        mantissas = [signed_mantissa(coefficient) for coefficient in row]
+        term_exponents = [value_exponent + coefficient.exponent for value_exponent, coefficient in zip(value_exponents, row)]
+        result_exponent = min(term_exponents)
+
+        exponent_rows.append([mantissa * EncodedNumber.BASE ** (exponent - result_exponent) for mantissa, exponent in zip(mantissas, term_exponents)])
+        result_exponents.append(result_exponent)
+        generic_multiplications += sum(binary_powmod_cost(mantissa) for mantissa in mantissas) + len(row) - 1
+
+    return exponent_rows, result_exponents, generic_multiplications
+
+
+def plan_inner_products(public_key, value_exponents, coefficient_rows, constant=0, fixed_base=False, packed=False, value_bound=2, window_bits=None):
+    # Everything about evaluating coefficient_rows that depends only on the key and the exponents of the user's
+    # ciphertexts, not on the ciphertexts themselves: the aligned (and packed) scalars, the constants, the window
+    # digits of every scalar and which tables are needed. Users with the same key and exponents share one plan
+    if window_bits is None:
+        window_bits = FIXED_BASE_WINDOW_BITS
+
+    exponent_rows, result_exponents, generic_multiplications = align_coefficient_rows(value_exponents, coefficient_rows)
+    plan = {'public_key': public_key, 'fixed_base': fixed_base, 'window_bits': window_bits, 'packed': packed}
+
+    if not packed:
+        # Unobfuscated encryptions of the constant, g^m = 1 + n·m mod n², one per exponent in use
+        constant_ciphertexts = {}
+        initials = []
+        for result_exponent in result_exponents:
+            if constant and result_exponent not in constant_ciphertexts:
+                constant_ciphertexts[result_exponent] = raw_encrypt_unobfuscated(public_key, round(constant * EncodedNumber.BASE ** -result_exponent))
+                generic_multiplications += 1
+            initials.append(constant_ciphertexts.get(result_exponent, 1))
+
+        plan['result_exponents'] = result_exponents
+    elif exponent_rows:
+        # Every slot needs the same exponent, so all rows are aligned on the lowest one
+        exponent = min(result_exponents)
+        exponent_rows = [
+            [scalar * EncodedNumber.BASE ** (result_exponent - exponent) for scalar in row]
+            for row, result_exponent in zip(exponent_rows, result_exponents)
+        ]
+
+        # Shifting row k into slot k is folded into the scalars, Σ_k row_k[i]·2^(k·slot_bits)
+        slot_bits, slots = packing_layout(public_key, exponent, value_bound)
+        offset = 1 << (slot_bits - 1)
+        constant_mantissa = round(constant * EncodedNumber.BASE ** -exponent)
+
+        packed_rows = []
+        initials = []
+        slot_counts = []
+        for start in range(0, len(exponent_rows), slots):
+            pack = exponent_rows[start:start + slots]
+            packed_rows.append([sum(row[i] << (k * slot_bits) for k, row in enumerate(pack)) for i in range(len(value_exponents))])
+            initials.append(raw_encrypt_unobfuscated(public_key, sum((constant_mantissa + offset) << (k * slot_bits) for k in range(len(pack)))))
+            slot_counts.append(len(pack))
+
+        exponent_rows = packed_rows
+        plan.update({'exponent': exponent, 'slot_counts': slot_counts, 'slot_bits': slot_bits})
+    else:
+        initials = []
+        plan.update({'exponent': None, 'slot_counts': [], 'slot_bits': None})
+
+    plan.update({
+        'initials': initials,
+        'digits': [exponent_digits(row, window_bits, fixed_base) for row in exponent_rows],
+        'layout': column_layout(exponent_rows, fixed_base, window_bits) if exponent_rows else [],
+        'generic': generic_multiplications
+    })
+    return plan
+
+
+def run_inner_products(plan, users_values):
+    # Evaluate a plan for several users at once, in one pass over its rows: each row's digits are used for every user
+    # while they are at hand. Returns each user's raw ciphertexts and modular multiplication counts
+    nsquare = to_backend_int(plan['public_key'].nsquare)
+    precomputed = [
+        prepare_multi_powmod([to_backend_int(value.ciphertext(False)) for value in values], None, nsquare, plan['fixed_base'], plan['window_bits'], plan['layout'])
+        for values in users_values
+    ]
+
+    ciphertexts = [[] for values in users_values]
+    multiplications = [{'generic': plan['generic'], 'actual': user_precomputed['cost']} for user_precomputed in precomputed]
+
+    for digits, initial in zip(plan['digits'], plan['initials']):
+        for user_precomputed, user_ciphertexts, user_multiplications in zip(precomputed, ciphertexts, multiplications):
+            ciphertext, count = multi_powmod_digits(user_precomputed, digits, initial)
+            user_ciphertexts.append(ciphertext)
+            user_multiplications['actual'] += count
+
+    return ciphertexts, multiplications
+
+
+def batched_inner_products(users_values, coefficient_rows, constant=0, fixed_base=False, packed=False, value_bound=2):
+    # encrypted_inner_products (or encrypted_packed_inner_products when packed) for several users with the same key
+    # and ciphertext exponents, planned once and evaluated in one pass. Returns one result per user, as those return
+    public_key = users_values[0][0].public_key
+    value_exponents = [value.exponent for value in users_values[0]]
+
+    for values in users_values:
+        if values[0].public_key.n != public_key.n or [value.exponent for value in values] != value_exponents:
+            raise ValueError("Batched users must share a public key and ciphertext exponents")
+
+    if not coefficient_rows:
+        empty = ([], None, [], None) if packed else ([], [])
+        return [empty + ({'generic': 0, 'actual': 0},) for values in users_values]
+
+    plan = plan_inner_products(public_key, value_exponents, coefficient_rows, constant, fixed_base, packed, value_bound)
+    ciphertexts, multiplications = run_inner_products(plan, users_values)
+
+    if packed:
+        return [(user_ciphertexts, plan['exponent'], plan['slot_counts'], plan['slot_bits'], user_multiplications)
+                for user_ciphertexts, user_multiplications in zip(ciphertexts, multiplications)]
+    return [(user_ciphertexts, plan['result_exponents'], user_multiplications) for user_ciphertexts, user_multiplications in zip(ciphertexts, multiplications)]
+
+
+def encrypted_inner_products(values, coefficient_rows, constant=0, fixed_base=False):
+    # For every row of EncodedNumber coefficients, the raw ciphertext and exponent of Σ values[i]·row[i] + constant,
+    # where values are the EncryptedNumbers every row is multiplied with.
+    # Also returns the modular multiplications if every term went through phe's generic pow, and with this kernel
+    return batched_inner_products([values], coefficient_rows, constant, fixed_base)[0]
+
+
+# Slot packing: several results share one plaintext, each in its own slot of slot_bits bits, so one ciphertext
+# (and one decryption) carries many results. Every slot is offset by half its range so negative results fit
+def packing_layout(public_key, exponent, value_bound):
+    # Slot size for results of magnitude up to value_bound at this exponent (plus a sign and a guard bit),
+    # and the number of slots that keep the packed plaintext below n
+    slot_bits = math.ceil(value_bound * EncodedNumber.BASE ** -exponent).bit_length() + 2
+    slots = (public_key.n.bit_length() - 2) // slot_bits
+
+    if slots < 1:
+        raise ValueError(f"A {slot_bits}-bit slot doesn't fit in the plaintext of this key")
+
+    return slot_bits, slots
+
+
+def encrypted_packed_inner_products(values, coefficient_rows, constant=0, value_bound=2, fixed_base=False):
+    # Like encrypted_inner_products, but consecutive rows are packed into the slots of one ciphertext, so a packed
+    # ciphertext costs about as much as the rows it holds. Results must stay within ±value_bound
+    return batched_inner_products([values], coefficient_rows, constant, fixed_base, True, value_bound)[0]
+
+
+def unpack_slots(plaintext, slots, slot_bits, exponent):
+    # Split a decrypted packed plaintext back into its results, decoded like phe's EncodedNumber.decode
+    if plaintext >> (slots * slot_bits):
+        raise OverflowError("Packed plaintext has bits above its last slot, it was not packed with this key or a result overflowed its slot")
+
+    offset = 1 << (slot_bits - 1)
+    mask = (1 << slot_bits) - 1
+
+    mantissas = [((plaintext >> (k * slot_bits)) & mask) - offset for k in range(slots)]
+
+    if exponent >= 0:
+        return [mantissa * EncodedNumber.BASE ** exponent for mantissa in mantissas]
+    return [mantissa / EncodedNumber.BASE ** -exponent for mantissa in mantissas]
+
+
+# Binary wire format, sent with this content type instead of JSON: the JSON payload with every ciphertext
+# ('ciphertext' and '*_ct' fields) replaced by its index into one buffer of fixed-width big-endian integers,
+# and public_key_n replaced by the key's fingerprint.
+# Layout: magic, header length (4 bytes), JSON header, ciphertext buffer
+BINARY_CONTENT_TYPE = "application/x-paillier-ciphertexts"
+BINARY_MAGIC = b"PHE\x01"
+
+
+def key_fingerprint(public_key_n):
+    # Short identifier of a public key: the first 16 bytes of the SHA-256 of n, in hex
+    return hashlib.sha256(public_key_n.to_bytes((public_key_n.bit_length() + 7) // 8, "big")).hexdigest()[:32]
+
+
+def payload_key_fingerprint(data):
+    # A payload names its key by its fingerprint, or (for older clients) by the full modulus
+    if 'public_key_fingerprint' in data:
+        return data['public_key_fingerprint']
+    if type(data.get('public_key_n')) is int:
+        return key_fingerprint(data['public_key_n'])
+    return None
+
+
+def payload_matches_key(data, public_key_n):
+    if 'public_key_n' in data:
+        return data['public_key_n'] == public_key_n
+    return data.get('public_key_fingerprint') == key_fingerprint(public_key_n)
+
+
+def is_ciphertext_field(key):
+    return key == "ciphertext" or key.endswith("_ct")
+
+
+def encode_binary_payload(payload, public_key_n):
+    # Ciphertexts are below n², so they all fit in the byte width of n²
+    width = ((public_key_n * public_key_n).bit_length() + 7) // 8
+    ciphertexts = []
+
+    def strip_ciphertexts(value):
+        if isinstance(value, dict):
+            stripped = {}
+            for key, item in value.items():
+                if key == 'public_key_n':
+                    stripped['public_key_fingerprint'] = key_fingerprint(item)
+                elif is_ciphertext_field(key):
+                    stripped[key] = len(ciphertexts)
+                    ciphertexts.append(int(item))
+                else:
+                    stripped[key] = strip_ciphertexts(item)
+            return stripped
+        if isinstance(value, list):
+            return [strip_ciphertexts(item) for item in value]
+        return value
+
+    stripped_payload = strip_ciphertexts(payload)
+    header = json.dumps({'width': width, 'count': len(ciphertexts), 'payload': stripped_payload}).encode()
+
+    return b"".join([BINARY_MAGIC, len(header).to_bytes(4, "big"), header] + [ciphertext.to_bytes(width, "big") for ciphertext in ciphertexts])
+
+
+def decode_binary_payload(body):
+    # The JSON-shaped payload back, with its ciphertexts as ints. Raises ValueError for malformed bodies
+    if body[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a binary ciphertext payload")
+
+    offset = len(BINARY_MAGIC) + 4
+    header_length = int.from_bytes(body[len(BINARY_MAGIC):offset], "big")
+    header = json.loads(body[offset:offset + header_length])
+    width, count = header['width'], header['count']
+    buffer = memoryview(body)[offset + header_length:]
+
+    if type(width) is not int or type(count) is not int or width < 1 or len(buffer) != width * count:
+        raise ValueError(f"Ciphertext buffer of {len(buffer)} bytes doesn't match its header")
+
+    ciphertexts = [int.from_bytes(buffer[i * width:(i + 1) * width], "big") for i in range(count)]
+
+    def restore_ciphertexts(value):
+        if isinstance(value, dict):
+            restored = {}
+            for key, item in value.items():
+                if is_ciphertext_field(key):
+                    if type(item) is not int or not 0 <= item < count:
+                        raise ValueError(f"Invalid ciphertext index for '{key}'")
+                    restored[key] = ciphertexts[item]
+                else:
+                    restored[key] = restore_ciphertexts(item)
+            return restored
+        if isinstance(value, list):
+            return [restore_ciphertexts(item) for item in value]
+        return value
+
+    return restore_ciphertexts(header['payload'])